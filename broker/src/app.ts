@@ -2,6 +2,12 @@ import Aedes from 'aedes';
 import { createServer } from 'net';
 import { type Server } from 'net';
 import { config } from 'dotenv';
+import {
+    authorizeForward,
+    authorizeSubscribe,
+    handleUnsubscribe,
+    leaveGroups,
+} from './shared_subscriptions.js';
 
 // Load environment variables
 config();
@@ -27,8 +33,12 @@ if (isNaN(port)) {
     throw new Error('BROKER_PORT is not a number');
 }
 
-// create aedes broker
-const broker = new Aedes();
+// create aedes broker with support for shared subscriptions, used by the replicas of a service
+const broker = new Aedes({ authorizeSubscribe, authorizeForward });
+broker.on('clientDisconnect', leaveGroups);
+broker.on('unsubscribe', (unsubscriptions, client) =>
+    handleUnsubscribe(broker, client, unsubscriptions),
+);
 
 // create a server and attach it to the broker
 const server: Server = createServer(broker.handle);
@@ -0,0 +1,296 @@
+import type Aedes from 'aedes';
+import {
+    type AedesPublishPacket,
+    type Client,
+    type Subscription,
+} from 'aedes';
+
+/**
+ * Shared subscriptions ($share/<group>/<filter>) on top of aedes, which does
+ * not support them.
+ *
+ * A client that subscribes to $share/<group>/<filter> is subscribed to
+ * <filter> and becomes a member of the group. A message matching the filter
+ * is then forwarded to a single member of the group, picked in turn from the
+ * counter the broker gives to every message. This is how the replicas of a
+ * service share its requests. Unsubscribing from $share/<group>/<filter>
+ * leaves the group, and unsubscribes from <filter> once no other
+ * subscription of the client needs it.
+ */
+
+// Prefix of the shared subscriptions
+const SHARE_PREFIX: string = '$share/';
+
+interface SharedSubscription {
+    group: string;
+    filter: string;
+}
+
+// The shared subscriptions of every client, by client id
+const memberships: Map<string, SharedSubscription[]> = new Map();
+
+// The members of every group, by group and filter, in the order they joined
+const members: Map<string, string[]> = new Map();
+
+// The topic filters every client subscribed to without $share, by client id
+const plainSubscriptions: Map<string, Set<string>> = new Map();
+
+// What aedes keeps of a subscription on its client, which is not in its typings
+interface ClientSubscriptions {
+    subscriptions: Record<
+        string,
+        | { func: (packet: AedesPublishPacket, callback: () => void) => void }
+        | undefined
+    >;
+}
+
+/**
+ * Get the key of a group in the members map.
+ * @param shared - The shared subscription.
+ * @returns The key of the group.
+ */
+function getGroupKey(shared: SharedSubscription): string {
+    return `${shared.group}\0${shared.filter}`;
+}
+
+/**
+ * Parse a shared subscription.
+ * @param topic - The topic filter of a subscription.
+ * @returns The group and the filter, or null if it is not a shared subscription.
+ */
+export function parseSharedTopic(topic: string): SharedSubscription | null {
+    if (!topic.startsWith(SHARE_PREFIX)) {
+        return null;
+    }
+
+    const rest: string = topic.slice(SHARE_PREFIX.length);
+    const slash: number = rest.indexOf('/');
+
+    // Both the group and the filter must be present
+    if (slash <= 0 || slash === rest.length - 1) {
+        return null;
+    }
+
+    return { group: rest.slice(0, slash), filter: rest.slice(slash + 1) };
+}
+
+/**
+ * Check if a topic matches a topic filter with the + and # wildcards.
+ * @param filter - The topic filter.
+ * @param topic - The topic of a message.
+ * @returns True if the topic matches the filter.
+ */
+export function topicMatches(filter: string, topic: string): boolean {
+    const filterLevels: string[] = filter.split('/');
+    const topicLevels: string[] = topic.split('/');
+
+    for (let i = 0; i < filterLevels.length; i++) {
+        if (filterLevels[i] === '#') {
+            return true;
+        }
+        if (i >= topicLevels.length) {
+            return false;
+        }
+        if (filterLevels[i] !== '+' && filterLevels[i] !== topicLevels[i]) {
+            return false;
+        }
+    }
+
+    return filterLevels.length === topicLevels.length;
+}
+
+/**
+ * aedes hook called before a subscription is added. A shared subscription
+ * is replaced by a subscription to its filter and the client joins the group.
+ * @param client - The client that subscribes.
+ * @param subscription - The subscription.
+ * @param callback - Called with the subscription to add.
+ */
+export function authorizeSubscribe(
+    client: Client | null,
+    subscription: Subscription,
+    callback: (error: Error | null, subscription?: Subscription | null) => void,
+): void {
+    const shared: SharedSubscription | null = parseSharedTopic(
+        subscription.topic,
+    );
+
+    if (!client) {
+        callback(null, subscription);
+        return;
+    }
+
+    if (!shared) {
+        const filters: Set<string> =
+            plainSubscriptions.get(client.id) ?? new Set();
+        filters.add(subscription.topic);
+        plainSubscriptions.set(client.id, filters);
+        callback(null, subscription);
+        return;
+    }
+
+    const subscriptions: SharedSubscription[] =
+        memberships.get(client.id) ?? [];
+    const key: string = getGroupKey(shared);
+
+    if (!subscriptions.some((existing) => getGroupKey(existing) === key)) {
+        subscriptions.push(shared);
+        memberships.set(client.id, subscriptions);
+        members.set(key, [...(members.get(key) ?? []), client.id]);
+    }
+
+    callback(null, { ...subscription, topic: shared.filter });
+}
+
+/**
+ * aedes hook called before a message is forwarded to a client. A message
+ * that matches a shared subscription of the client is only forwarded if the
+ * client is the member of one of its groups whose turn it is, or if it also
+ * matches a subscription of the client without $share.
+ * @param client - The client the message is about to be forwarded to.
+ * @param packet - The message.
+ * @returns The message, or null to not forward it to this client.
+ */
+export function authorizeForward(
+    client: Client,
+    packet: AedesPublishPacket,
+): AedesPublishPacket | null {
+    const subscriptions: SharedSubscription[] | undefined = memberships.get(
+        client.id,
+    );
+
+    if (!subscriptions) {
+        return packet;
+    }
+
+    for (const filter of plainSubscriptions.get(client.id) ?? []) {
+        if (topicMatches(filter, packet.topic)) {
+            return packet;
+        }
+    }
+
+    let matched: boolean = false;
+    for (const shared of subscriptions) {
+        if (!topicMatches(shared.filter, packet.topic)) {
+            continue;
+        }
+
+        matched = true;
+        const group: string[] = members.get(getGroupKey(shared)) ?? [];
+        const turn: number = Number(packet.brokerCounter) % group.length;
+        if (group[turn] === client.id) {
+            return packet;
+        }
+    }
+
+    return matched ? null : packet;
+}
+
+/**
+ * Remove a client from a group.
+ * @param clientId - The id of the client.
+ * @param key - The key of the group.
+ */
+function leaveGroup(clientId: string, key: string): void {
+    const group: string[] = (members.get(key) ?? []).filter(
+        (id) => id !== clientId,
+    );
+
+    if (group.length) {
+        members.set(key, group);
+    } else {
+        members.delete(key);
+    }
+}
+
+/**
+ * Handler of the unsubscribe event of aedes, called once aedes removed the
+ * subscriptions. aedes only knows the filter of a shared subscription, so
+ * unsubscribing from $share/<group>/<filter> removed nothing: the client
+ * leaves the group here, and its subscription to the filter is removed if
+ * neither another group nor a subscription without $share uses it.
+ * Unsubscribing from a filter without $share removes the subscription that
+ * the groups of the client on that filter relied on, so it leaves them too.
+ * @param broker - The broker.
+ * @param client - The client that unsubscribed.
+ * @param unsubscriptions - The topic filters the client unsubscribed from.
+ */
+export function handleUnsubscribe(
+    broker: Aedes,
+    client: Client,
+    unsubscriptions: string[],
+): void {
+    let subscriptions: SharedSubscription[] =
+        memberships.get(client.id) ?? [];
+    const filters: Set<string> = plainSubscriptions.get(client.id) ?? new Set();
+
+    for (const topic of unsubscriptions) {
+        const shared: SharedSubscription | null = parseSharedTopic(topic);
+
+        if (!shared) {
+            filters.delete(topic);
+            for (const existing of subscriptions) {
+                if (existing.filter === topic) {
+                    leaveGroup(client.id, getGroupKey(existing));
+                }
+            }
+            subscriptions = subscriptions.filter(
+                (existing) => existing.filter !== topic,
+            );
+            continue;
+        }
+
+        const key: string = getGroupKey(shared);
+        if (!subscriptions.some((existing) => getGroupKey(existing) === key)) {
+            continue;
+        }
+
+        leaveGroup(client.id, key);
+        subscriptions = subscriptions.filter(
+            (existing) => getGroupKey(existing) !== key,
+        );
+
+        const stillUsed: boolean =
+            filters.has(shared.filter) ||
+            subscriptions.some((existing) => existing.filter === shared.filter);
+        const aedesSubscriptions: ClientSubscriptions['subscriptions'] = (
+            client as unknown as ClientSubscriptions
+        ).subscriptions;
+        const subscription: ClientSubscriptions['subscriptions'][string] =
+            aedesSubscriptions[shared.filter];
+
+        if (!stillUsed && subscription) {
+            // What aedes does for an unsubscription, on the filter it was given
+            delete aedesSubscriptions[shared.filter];
+            broker.unsubscribe(
+                shared.filter,
+                subscription.func,
+                () => undefined,
+            );
+        }
+    }
+
+    if (subscriptions.length) {
+        memberships.set(client.id, subscriptions);
+    } else {
+        memberships.delete(client.id);
+    }
+    if (filters.size) {
+        plainSubscriptions.set(client.id, filters);
+    } else {
+        plainSubscriptions.delete(client.id);
+    }
+}
+
+/**
+ * Remove a client from all of its groups, e.g. when it disconnects.
+ * @param client - The client.
+ */
+export function leaveGroups(client: Client): void {
+    for (const shared of memberships.get(client.id) ?? []) {
+        leaveGroup(client.id, getGroupKey(shared));
+    }
+
+    memberships.delete(client.id);
+    plainSubscriptions.delete(client.id);
+}
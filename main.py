@@ -1,18 +1,147 @@
 import argparse
+import json
 import shlex
 import subprocess
 import os
 import dotenv
 import re
+import sys
+import threading
 import time
-import psutil
-
-# Gather up the processes tuples. Each tuple is (process, stdout file, stderr file) we will use this later to terminate the processes
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from orchestrator.graph import Component, ComponentGraph, start_graph
+from orchestrator.boot_profile import BootProfiler, append_history, format_gantt
+from orchestrator.build_cache import BUILD_ENTRY_POINT, build_package
+from orchestrator.db_reset import DEFAULT_MONGO_BASE_PATH, drop_database, empty_database, has_snapshot, restore_snapshot
+from orchestrator.http_load import DEFAULT_COLLECTION, add_load_arguments, run_load_test
+from orchestrator.install_cache import install_package
+from orchestrator.logmux import LogMultiplexer, StreamFlagCheck
+from orchestrator.mongo_memory import (DEFAULT_BUDGET_FRACTION, compute_cache_size_gb, get_tmpfs_base_path, get_total_memory_gb,
+                                       rewrite_database_uri)
+from orchestrator.mqtt_broker import MqttBroker
+from orchestrator.mqtt_trace import LatencyTracer, TracerClient
+from orchestrator.processes import ProcessHandle, group_by_tier, kill_process_tree, terminate_tier
+from orchestrator.shards import allocate_ports, format_report, load_report, merge_reports, replace_uri_port, rewrite_port, split_collection
+from orchestrator.soak import run_soak_test
+from orchestrator.supervisor import ControlServer, Supervisor
+from orchestrator.warm_stack import TestDaemon, TestDaemonServer
+from orchestrator.telemetry import TelemetrySampler
+from orchestrator.readiness import LogFlagCheck, MongoPingCheck, ReadinessTarget, TcpCheck, wait_until_ready
+from orchestrator.runtime import RuntimeProfile, apply_runtime_env, parse_runtime_profiles, place_process_tree, plan_placement
+
+# Commands used to launch the broker, the services and the gateway for each launch profile.
+# The dev profile lints, builds and then watches the sources. The prod profile runs the build made by the orchestrator
+LAUNCH_COMMANDS = {
+    "dev": "npm run dev",
+    "prod": f"node {BUILD_ENTRY_POINT}",
+}
+
+# Command used to launch the replicas of a service other than the first one in the dev profile. They run the build
+# of the first replica and restart when it rebuilds
+REPLICA_WATCH_COMMAND = f"npx nodemon -q {BUILD_ENTRY_POINT}"
+
+# Commands used to launch the gateway in test mode for each launch profile
+GATEWAY_TEST_COMMANDS = {
+    "dev": "npm run test",
+    "prod": f"npx cross-env NODE_ENV=test start-server-and-test \"node {BUILD_ENTRY_POINT}\" http://localhost:3000/api/v1 newman",
+}
+
+# Command run by the test daemon against the running gateway, the newman script of the gateway package
+DAEMON_TEST_COMMAND = "npm run newman"
+
+# Name of the mongo instance holding the databases of every service in the shared mongo mode
+SHARED_DATABASE_COMPONENT = "shared_database"
+
+# Services that keep the libuv threadpool busy, user_service hashes the passwords with bcrypt.
+# --placement auto gives them their own cores, away from the mongo instances, and a threadpool as large as their cores
+HOT_SERVICES = ["user_service"]
+
+# Kinds of components a runtime profile can be given to with --runtime, on top of the components and the services
+COMPONENT_KINDS = ["database", "broker", "service", "gateway"]
+
+# Gather up the process handles. Each handle is (process, stdout file, stderr file, name, kind, port) we will use this later to terminate the processes
 processes_handles = []
 
-def clear_databases(services: list, services_to_exclude: list, services_root: str):
+# Reads the output of every spawned process, writes the log files and keeps the last lines of each component in memory
+log_multiplexer = LogMultiplexer()
+
+# Samples the resource usage of the process handles, if enabled with --telemetry-interval
+telemetry_sampler = None
+
+# The lightweight MQTT broker running in the orchestrator, if enabled with --broker embedded
+embedded_broker = None
+
+# Pairs the requests of the gateway with the replies of the services, if enabled with --trace
+latency_tracer = None
+# Feeds the latency tracer from the aedes broker. The embedded broker feeds it directly
+tracer_client = None
+
+# Environment values that override the .env file of each package, by package dir name. Set with --env-overrides
+env_overrides = {}
+
+# Runtime profiles by kind of component, service or component name. Set with --placement and --runtime
+runtime_profiles = {}
+
+def load_env(package_path: str, env_file_name: str) -> dict:
+    """
+    Load the environment of a package: the environment of the orchestrator, the .env file of the package
+    and then the overrides given to the orchestrator for the package, e.g. the ports of a shard.
+
+    Parameters
+    ----------
+    package_path : str
+        Path to the package directory
+    env_file_name : str
+        Name of the .env file to load
+
+    Returns
+    -------
+    dict
+        The environment of the package
+    """
+    env_copy = os.environ.copy()
+    env_copy.update(dotenv.dotenv_values(os.path.join(package_path, env_file_name)))
+    env_copy.update(env_overrides.get(os.path.basename(os.path.normpath(package_path)), {}))
+
+    return env_copy
+
+def clear_database(service: str, env_file_name: str, services_root: str, port: int = None, keep_indexes: bool = False):
+    """
+    Clear the database of a service by dropping it directly on its mongo instance.
+    
+    Parameters
+    ----------
+    service : str
+        Name of the service
+    env_file_name : str
+        Name of the .env file holding the DATABASE_URI of the service
+    services_root : str
+        Root directory of the services
+    port : int
+        Port of the mongo instance holding the database, the port of the DATABASE_URI by default
+    keep_indexes : bool
+        If true, empty the collections instead of dropping the database, for a service that is already running
+    """
+    database_port, database_name = get_database_config(service, env_file_name, services_root)
+    port = port or database_port
+
+    try:
+        if keep_indexes:
+            empty_database("127.0.0.1", int(port), database_name)
+        else:
+            drop_database("127.0.0.1", int(port), database_name)
+        print(f"Successfully cleared database for {service}")
+    except Exception as e:
+        print(f"Failed to clear database for {service}:\n{e}")
+        raise e
+
+def clear_databases(services: list, services_to_exclude: list, services_root: str, env_file_name: str = ".env.test",
+                    port: int = None, keep_indexes: bool = False):
     """
     Clear the databases for each service except the ones in the exclude list.
+    The databases are cleared concurrently.
     
     Parameters
     ----------
@@ -22,109 +151,228 @@ def clear_databases(services: list, services_to_exclude: list, services_root: st
         List of service names that should be excluded
     services_root : str
         Root directory of the services
+    env_file_name : str
+        Name of the .env file holding the DATABASE_URI of each service
+    port : int
+        Port of the mongo instance holding every database, the port of the DATABASE_URI of each service by default
+    keep_indexes : bool
+        If true, empty the collections instead of dropping the databases, for services that are already running
     """
     # Clear the databases for each service except the ones in the exclude list
-    for service in services:
-        if service not in services_to_exclude:
+    services_to_clear = [service for service in services if service not in services_to_exclude]
+    if not services_to_clear:
+        return
 
-            # This command runs the JavaScript script to clear the database
-            cmd = "npm run dropdb"
-            
-            try:
-                subprocess.run(
-                    cmd,
-                    cwd=f"{os.path.join(services_root, service)}",
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    check=True,
-                    shell=True
-                )
-
-                print(f"Successfully cleared database for {service}")
-            except subprocess.CalledProcessError as e:
-                print(f"Failed to clear database for {service}")
-                print(f"stdout:\n{e.stdout.decode()}")
-                print(f"stderr:\n{e.stderr.decode()}")
-                raise e
-            except Exception as e:
-                print(f"Unexpected error while clearing database for {service}:\n{e}")
-                raise e
+    with ThreadPoolExecutor(max_workers=len(services_to_clear)) as executor:
+        futures = [executor.submit(clear_database, service, env_file_name, services_root, port, keep_indexes)
+                   for service in services_to_clear]
 
+    for future in futures:
+        future.result()
 
-def kill_process_tree(pid, grace_period=3):
-    """
-    Kill a process tree including all child processes
-    
-    Parameters
-    ----------
-    proc : Popen
-        The parent process
-    grace_period : int
-        The time in seconds to wait for processes to terminate gracefully
-        before killing them with SIGKILL
-    
-    Raises
-    ------
-    Exception
-        If there is an error killing the process tree
-    """
-    try:
-        parent = psutil.Process(pid)
-        children = parent.children(recursive=True)
-
-        # Try graceful termination first
-        for child in children:
-            child.terminate()
-        parent.terminate()
-
-        # Wait for termination
-        gone, alive = psutil.wait_procs([parent] + children, timeout=grace_period)
-        
-        # Force kill remaining
-        for p in alive:
-            p.kill()
-    except Exception as e:
-        print(f"Failed to kill process tree for PID {pid}: {e}")
-        raise e
 
-def cleanup_processes(processes: list):
+def cleanup_processes(processes: list, grace_period: float = 3, database_grace_period: float = 30):
     """
     Clean up processes and MongoDB instances spawned by this script.
+    The processes are terminated in reverse dependency order: the gateway, the services, the broker
+    and then the MongoDB instances. The processes of each tier are terminated at the same time.
     
     Parameters
     ----------
     processes : list
-        List of tuples containing a Popen object, an output log file, and an error log file
-    mongo_paths : list
-        List of paths to MongoDB data directories
+        List of ProcessHandle of the spawned processes
+    grace_period : float
+        The time in seconds to wait for the processes of a tier to terminate gracefully
+        before killing them with SIGKILL
+    database_grace_period : float
+        The time in seconds to wait for the MongoDB instances to shut down cleanly
+        before killing them with SIGKILL
     
     Raises
     ------
     Exception
         If there is an error killing the processes or MongoDB instances
     """
+    stop_telemetry()
+    stop_tracer()
+
     print("\nCleaning up processes...")
 
-    # Terminate the processes
-    for process, out_file, err_file, name in processes:
-        try:
-            print(f"Terminating {name} process with PID {process.pid}...")
-            if process.poll() is None:
-                kill_process_tree(process.pid)
-                print(f"Successfully terminated {name} process with PID {process.pid}")
+    # Terminate the processes tier by tier
+    for tier in group_by_tier(processes):
+        running = []
+        for handle in tier:
+            if handle.process.poll() is None:
+                print(f"Terminating {handle.name} process with PID {handle.process.pid}...")
+                running.append(handle)
             else:
-                print(f"Process for {name} with PID {process.pid} is already terminated")
+                print(f"Process for {handle.name} with PID {handle.process.pid} is already terminated")
+
+        try:
+            if running:
+                is_database_tier = all(handle.kind == "database" for handle in running)
+                killed = terminate_tier(running, database_grace_period if is_database_tier else grace_period)
+
+                for handle in running:
+                    if handle.name in killed:
+                        print(f"Killed {handle.name} process with PID {handle.process.pid} after the grace period")
+                    else:
+                        print(f"Successfully terminated {handle.name} process with PID {handle.process.pid}")
         except Exception as e:
-            print(f"Failed to terminate {name} process with PID {process.pid}:\n{e}")
+            print(f"Failed to terminate {', '.join(handle.name for handle in running)}:\n{e}")
         finally:
-            out_file.close()
-            err_file.close()
+            # Let the multiplexer save the last lines of the tier before closing the log files
+            deadline = time.monotonic() + 1
+            for handle in tier:
+                log_multiplexer.wait_closed(handle.name, max(0, deadline - time.monotonic()))
+                handle.out_file.close()
+                handle.err_file.close()
+
+    # The embedded broker goes last, like the broker tier would, once nothing is connected to it anymore
+    stop_embedded_broker()
 
     print("Cleanup complete.")
 
-def wait_for_green_flag(component_name: str, logs_dir: str, timeOut: int, green_flag: str):
+def stop_telemetry():
+    """
+    Stop the telemetry sampler, if it runs, and print the summary of the resource usage of every component.
     """
-    Wait for a green flag in a log file.
+    global telemetry_sampler
+
+    if telemetry_sampler is None:
+        return
+
+    sampler, telemetry_sampler = telemetry_sampler, None
+    sampler.stop()
+
+    if sampler.rings:
+        print("\nResource usage of the components:")
+        print(sampler.format_summary())
+    if sampler.csv_path is not None:
+        print(f"Samples saved to {sampler.csv_path}")
+
+def start_embedded_broker(broker_path: str, env_file_name: str):
+    """
+    Start the lightweight MQTT broker in the orchestrator, on the host and port of the broker's .env file.
+    It is listening as soon as this returns, so it does not need a readiness check.
+    If the latency tracer is enabled, the broker hands it every message it routes.
+
+    Parameters
+    ----------
+    broker_path : str
+        Path to the broker directory
+    env_file_name : str
+        Name of the .env file to load
+
+    Raises
+    ------
+    ValueError
+        If BROKER_HOST or BROKER_PORT is not defined
+    OSError
+        If the port can not be bound
+    """
+    global embedded_broker
+
+    broker_address = get_broker_address(broker_path, env_file_name)
+    if broker_address is None:
+        raise ValueError(f"BROKER_HOST and BROKER_PORT must be defined in {os.path.join(broker_path, env_file_name)}")
+
+    print("Starting embedded broker")
+
+    try:
+        on_publish = None
+        if latency_tracer is not None:
+            on_publish = lambda client_id, message: latency_tracer.observe(message.topic, message.payload)
+        broker = MqttBroker(*broker_address, on_publish=on_publish)
+        broker.start_in_thread()
+        embedded_broker = broker
+        print(f"Embedded broker running on {broker_address[0]}:{broker_address[1]}")
+    except Exception as e:
+        print("Failed to start embedded broker")
+        raise e
+
+def stop_embedded_broker():
+    """
+    Stop the embedded broker, if it runs, and print how many messages it routed.
+    """
+    global embedded_broker
+
+    if embedded_broker is None:
+        return
+
+    broker, embedded_broker = embedded_broker, None
+    broker.stop()
+    print(f"Stopped embedded broker after {broker.published} messages published and {broker.delivered} delivered")
+
+def start_tracer(broker_path: str, env_file_name: str):
+    """
+    Feed the latency tracer from the aedes broker with a client subscribed to every topic.
+    The embedded broker feeds it without a client.
+
+    Parameters
+    ----------
+    broker_path : str
+        Path to the broker directory
+    env_file_name : str
+        Name of the .env file to load
+    """
+    global tracer_client
+
+    if latency_tracer is None or embedded_broker is not None:
+        return
+
+    broker_address = get_broker_address(broker_path, env_file_name)
+    if broker_address is None:
+        print("Can not trace the MQTT traffic, BROKER_HOST and BROKER_PORT are not defined")
+        return
+
+    tracer_client = TracerClient(latency_tracer, *broker_address)
+    tracer_client.start()
+
+def stop_tracer():
+    """
+    Stop the latency tracer, if it runs, and print the slowest request topics.
+    """
+    global latency_tracer, tracer_client
+
+    if latency_tracer is None:
+        return
+
+    if tracer_client is not None:
+        tracer_client.stop()
+        tracer_client = None
+
+    tracer, latency_tracer = latency_tracer, None
+    if tracer.prometheus_path is not None:
+        tracer.write_prometheus(tracer.prometheus_path)
+    if tracer.topics:
+        print("\nSlowest MQTT request topics:")
+        print(tracer.format_top())
+
+def print_crash_dumps(processes: list, lines: int = 50):
+    """
+    Print the last lines of output of the components whose process exited with an error.
+    The lines come from the ring buffers of the log multiplexer, so the log files do not have to be read.
+
+    Parameters
+    ----------
+    processes : list
+        List of ProcessHandle of the spawned processes
+    lines : int
+        Number of lines to print per component
+    """
+    for handle in processes:
+        exit_code = handle.process.poll()
+        if exit_code is not None and exit_code != 0 and log_multiplexer.has_component(handle.name):
+            print(f"\n{handle.name} exited with code {exit_code}")
+            print(log_multiplexer.format_crash_dump(handle.name, lines))
+
+def wait_for_green_flag(component_name: str, logs_dir: str, timeOut: int, green_flag: str, cancel_event: threading.Event = None,
+                        process: subprocess.Popen = None, probes: list = None):
+    """
+    Wait for a green flag in the output of a component.
+    The output is matched in memory as the log multiplexer reads it. For a component that is not attached to
+    the multiplexer, the log file is tailed from where the previous read stopped instead.
 
     Parameters
     ----------
@@ -136,38 +384,223 @@ def wait_for_green_flag(component_name: str, logs_dir: str, timeOut: int, green_
         The number of seconds to wait for the green flag
     green_flag : str
         The string to look for in the log file
+    cancel_event : threading.Event
+        If given, stop waiting as soon as the event is set
+    process : subprocess.Popen
+        If given, fail as soon as the process exits without giving the green flag
+    probes : list
+        Extra readiness checks (e.g. a TcpCheck) that also have to pass
 
     Raises
     ------
     TimeoutError
         If the green flag is not found in the log file after timeOut seconds
+    ComponentExitedError
+        If the process exits before giving the green flag
+    RuntimeError
+        If the cancel event is set before the green flag is found
     """
     # Log file to check for the green flag
     log_file = f"{os.path.join(logs_dir, f'{component_name}.out')}"
-    start_time = time.time()
-
-    # Wait for the green flag for timeOut seconds
-    while time.time() - start_time < timeOut:
-        # Check if the log file exists
-        # if it does not exist, sleep for 1 second, maybe it is not created yet
-        if not os.path.exists(log_file):
-            time.sleep(1)
-            continue
+    if log_multiplexer.has_component(component_name):
+        flag_check = StreamFlagCheck(log_multiplexer, component_name, green_flag, log_file)
+    else:
+        flag_check = LogFlagCheck(log_file, green_flag)
+    checks = [flag_check] + list(probes or [])
 
-        # Check if the green flag is in the log file
-        # if it is in the log file, return
-        with open(log_file, "r") as f:
-            if green_flag in f.read():
-                return
-            
-        # If the green flag is not in the log file, sleep for 1 second
-        time.sleep(1)
+    wait_until_ready([ReadinessTarget(component_name, checks, process, timeOut)], cancel_event)
+
+def wait_for_mongo_instance(instance_name: str, port: str, timeOut: int, cancel_event: threading.Event = None,
+                            process: subprocess.Popen = None):
+    """
+    Wait for a mongo instance to answer a ping command.
+
+    Parameters
+    ----------
+    instance_name : str
+        The name of the mongo instance
+    port : str
+        The port of the mongo instance
+    timeOut : int
+        The number of seconds to wait for the mongo instance
+    cancel_event : threading.Event
+        If given, stop waiting as soon as the event is set
+    process : subprocess.Popen
+        If given, fail as soon as the process exits
+
+    Raises
+    ------
+    TimeoutError
+        If the mongo instance does not answer after timeOut seconds
+    ComponentExitedError
+        If the process exits before the mongo instance answers
+    """
+    checks = [MongoPingCheck("127.0.0.1", port)]
+    wait_until_ready([ReadinessTarget(instance_name, checks, process, timeOut)], cancel_event)
+
+def get_broker_address(broker_path: str, env_file_name: str):
+    """
+    Get the host and the port the broker listens on from its .env file.
+
+    Parameters
+    ----------
+    broker_path : str
+        Path to the broker directory
+    env_file_name : str
+        Name of the .env file to load
+
+    Returns
+    -------
+    tuple or None
+        Tuple containing the host and the port, or None if they are not defined
+    """
+    env_copy = load_env(broker_path, env_file_name)
+
+    host = env_copy.get("BROKER_HOST")
+    port = env_copy.get("BROKER_PORT")
+    if not host or not port or not port.isdigit():
+        return None
+
+    return (host, int(port))
+
+def get_gateway_url(gateway_path: str, env_file_name: str) -> str:
+    """
+    Get the base URL of the API from the .env file of the gateway.
+
+    Parameters
+    ----------
+    gateway_path : str
+        Path to the gateway directory
+    env_file_name : str
+        Name of the .env file to load
+
+    Returns
+    -------
+    str
+        The base URL, e.g. http://localhost:3000/api/v1
+    """
+    env_copy = load_env(gateway_path, env_file_name)
+
+    host = env_copy.get("GATEWAY_HOST") or "localhost"
+    port = env_copy.get("GATEWAY_PORT") or "3000"
+
+    return f"http://{host}:{port}/api/v1"
+
+
+def get_runtime_profile(name: str, service: str, kind: str) -> RuntimeProfile:
+    """
+    Get the runtime profile of a component: the profile of its kind, then of its service, then of the component itself,
+    each one on top of the previous one.
+
+    Parameters
+    ----------
+    name : str
+        Name of the component, e.g. user_service.1
+    service : str
+        Name of the service the component runs, or the name of the component
+    kind : str
+        Kind of the component: "database", "broker", "service" or "gateway"
+
+    Returns
+    -------
+    RuntimeProfile
+        The merged profile, with every option left to None if no profile applies
+    """
+    profile = RuntimeProfile()
+    for key in dict.fromkeys([kind, service, name]):
+        if key in runtime_profiles:
+            profile = profile.merged(runtime_profiles[key])
+
+    if profile != RuntimeProfile():
+        print(f"Runtime profile of {name}: {profile.describe()}")
+    return profile
+
+def get_replica_name(service: str, replica: int = None) -> str:
+    """
+    Get the name of a replica of a service, e.g. user_service.2. A service without replicas keeps its name.
+    """
+    return service if replica is None else f"{service}.{replica}"
+
+def spawn_service(service: str, env_file_name: str, services_root: str, logs_dir: str, profile: str = "dev",
+                  replica: int = None, command: str = None, database_uri: str = None):
+    """
+    Spawn a single service, or a single replica of a service.
+    The replicas of a service join the MQTT shared subscription group named after the service,
+    so every request is handled by one of them.
+
+    Parameters
+    ----------
+    service : str
+        Name of the service to spawn
+    env_file_name : str
+        Name of the .env file to load for the service
+    services_root : str
+        Root directory of the services
+    logs_dir : str
+        Directory to save the log files to
+    profile : str
+        The launch profile, "dev" or "prod"
+    replica : int
+        Index of the replica, None if the service has no replicas
+    command : str
+        Command to run instead of the command of the launch profile
+    database_uri : str
+        DATABASE_URI to give to the service instead of the one of its .env file
+
+    Returns
+    -------
+    ProcessHandle
+        Handle containing a Popen object, an output log file, an error log file and the name of the spawned service
+    """
+    name = get_replica_name(service, replica)
+
+    # Log files to save the output and errors to
+    out_log_file = f"{os.path.join(logs_dir, f'{name}.out')}"
+    err_log_file = f"{os.path.join(logs_dir, f'{name}.err')}"
+
+    # Load the .env file for the service
+    env_copy = load_env(os.path.join(services_root, service), env_file_name)
+
+    # The replicas subscribe through $share/<service>/<topic>, see receivers/receiver.ts in the services
+    if replica is not None:
+        env_copy["MQTT_SHARE_GROUP"] = service
+
+    # dotenv does not override the environment, so the service connects to this URI
+    if database_uri is not None:
+        env_copy["DATABASE_URI"] = database_uri
+
+    runtime_profile = get_runtime_profile(name, service, "service")
+    apply_runtime_env(runtime_profile, env_copy)
+
+    print(f"Spawning {name}")
+    
+    # Directory to run the npm command in
+    cwd = f"{os.path.join(services_root, service)}"
+    
+    # Command to run
+    command = command or LAUNCH_COMMANDS[profile]
     
-    # If the green flag is not in the log file after timeOut seconds, raise an error
-    raise TimeoutError(f"[{component_name}] Did not give green flag '{green_flag}' in {timeOut} seconds.")
+    # The service i slong running. It will be in the background
+    process = None
+    try:
+        process = subprocess.Popen(command, cwd=cwd, env=env_copy, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   shell=True, start_new_session=True)
+        # Place the node process behind npm and sh on its cores once it shows up
+        place_process_tree(name, process.pid, runtime_profile)
+        # Save the output and errors to the log files
+        out_file, err_file = log_multiplexer.attach(name, process, out_log_file, err_log_file)
+        print(f"{name} spawned. Check the log files for errors.")
 
+        return ProcessHandle(process, out_file, err_file, name, "service")
+    except Exception as e:
+        print(f"Failed to spawn {name}")
+        # The process has no handle yet, the teardown would not find it
+        if process is not None:
+            kill_process_tree(process)
+        raise e
 
-def spawn_services(services: list, services_to_exclude: list, env_file_name: str, services_root: str, logs_dir: str):
+def spawn_services(services: list, services_to_exclude: list, env_file_name: str, services_root: str, logs_dir: str,
+                   profile: str = "dev"):
     """
     Spawn the services in the services list, excluding those in the services_to_exclude list
     
@@ -183,56 +616,26 @@ def spawn_services(services: list, services_to_exclude: list, env_file_name: str
         Root directory of the services
     logs_dir : str
         Directory to save the log files to
+    profile : str
+        The launch profile, "dev" or "prod"
     
     Returns
     -------
     list
-        List of tuples containing a Popen object, an output log file, and an error log file for each spawned service
+        List of handles containing a Popen object, an output log file, and an error log file for each spawned service
     """
     processes = []
     # Spawn the services
     for service in services:
-        # Log files to save the output and errors to
-        out_log_file = f"{os.path.join(logs_dir, f'{service}.out')}"
-        err_log_file = f"{os.path.join(logs_dir, f'{service}.err')}"
-
         # If the service is in the exclude list, skip it
         if service in services_to_exclude:
             continue
 
-        # Load the .env file for the service
-        env_file_path = f"{os.path.join(services_root, service, env_file_name)}"
-        env_copy = os.environ.copy()
-        env_copy.update(dotenv.dotenv_values(env_file_path))
-
-        print(f"Spawning {service}")
-        
-        # Directory to run the npm command in
-        cwd = f"{os.path.join(services_root, service)}"
-        
-        # Command to run
-        command = "npm i && npm run dev"
-        
-        # The service i slong running. It will be in the background
-        try:
-            # Save the output and errors to the log files
-            out_file = open(out_log_file, "w")
-            err_file = open(err_log_file, "w")
-
-            process = subprocess.Popen(command, cwd=cwd, env=env_copy, stdout=out_file, stderr=err_file, shell=True)
-            print(f"{service} spawned. Check the log files for errors.")
-
-            processes.append((process, out_file, err_file, service))
-        except Exception as e:
-            out_file.close()
-            err_file.close()
-
-            print(f"Failed to spawn {service}")
-            raise e
+        processes.append(spawn_service(service, env_file_name, services_root, logs_dir, profile))
 
     return processes
 
-def spawn_broker(broker_path: str, logs_dir: str, env_file_name: str):
+def spawn_broker(broker_path: str, logs_dir: str, env_file_name: str, profile: str = "dev"):
     """
     Spawn the MQTT broker.
 
@@ -244,45 +647,50 @@ def spawn_broker(broker_path: str, logs_dir: str, env_file_name: str):
         Directory to save the log files to
     env_file_name : str
         Name of the .env file to load
+    profile : str
+        The launch profile, "dev" or "prod"
     
     Returns
     -------
-    tuple
-        Tuple containing a Popen object, an output log file, and an error log file for the spawned broker
+    ProcessHandle
+        Handle containing a Popen object, an output log file, and an error log file for the spawned broker
     """
     # Log files to save the output and errors to
     out_log_file = f"{os.path.join(logs_dir, 'broker.out')}"
     err_log_file = f"{os.path.join(logs_dir, 'broker.err')}"
 
     # Load the .env file for the broker
-    env_file_path = f"{os.path.join(broker_path, env_file_name)}"
-    env_copy = os.environ.copy()
-    env_copy.update(dotenv.dotenv_values(env_file_path))
+    env_copy = load_env(broker_path, env_file_name)
+
+    runtime_profile = get_runtime_profile("broker", "broker", "broker")
+    apply_runtime_env(runtime_profile, env_copy)
 
     # Directory to run the npm command in
     cwd = f"{broker_path}"
     # Command to run
-    command = "npm i && npm run dev"
+    command = LAUNCH_COMMANDS[profile]
 
     print("Spawning broker")
 
     # The broker is long running. It will be in the background
+    process = None
     try:
+        process = subprocess.Popen(command, cwd=cwd, env=env_copy, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   shell=True, start_new_session=True)
+        place_process_tree("broker", process.pid, runtime_profile)
         # Save the output and errors to the log files
-        out_file = open(out_log_file, "w")
-        err_file = open(err_log_file, "w")
-        process = subprocess.Popen(command, cwd=cwd, env=env_copy, stdout=out_file, stderr=err_file, shell=True)
+        out_file, err_file = log_multiplexer.attach("broker", process, out_log_file, err_log_file)
         print("Broker spawned. Check the log files for errors.")
 
-        return (process, out_file, err_file, "broker")
+        return ProcessHandle(process, out_file, err_file, "broker", "broker")
     except Exception as e:
-        out_file.close()
-        err_file.close()
-
         print("Failed to spawn broker")
+        if process is not None:
+            kill_process_tree(process)
         raise e
     
-def spawn_gateway(gateway_path: str, logs_dir: str, env_file_name: str, is_testing: bool):
+def spawn_gateway(gateway_path: str, logs_dir: str, env_file_name: str, is_testing: bool, profile: str = "dev",
+                  run_tests: bool = True):
     """
     Spawn the gateway.
 
@@ -296,77 +704,216 @@ def spawn_gateway(gateway_path: str, logs_dir: str, env_file_name: str, is_testi
         Name of the .env file to load
     is_testing : bool
         If true, run the test command instead of the dev command
+    profile : str
+        The launch profile, "dev" or "prod"
+    run_tests : bool
+        If false in test mode, only run the gateway with NODE_ENV=test. The tests are run by the orchestrator
 
     Returns
     -------
-    tuple
-        Tuple containing a Popen object, an output log file, and an error log file for the spawned gateway
+    ProcessHandle
+        Handle containing a Popen object, an output log file, and an error log file for the spawned gateway
     """
     # Log files to save the output and errors to
     out_log_file = f"{os.path.join(logs_dir, 'gateway.out')}"
     err_log_file = f"{os.path.join(logs_dir, 'gateway.err')}"
 
     # Load the .env file for the gateway
-    env_file_path = f"{os.path.join(gateway_path, env_file_name)}"
-    env_copy = os.environ.copy()
-    env_copy.update(dotenv.dotenv_values(env_file_path))
+    env_copy = load_env(gateway_path, env_file_name)
 
     print("Spawning gateway")
 
     # Directory to run the npm command in
     cwd = f"{gateway_path}"
     # Command to run. If is_testing is true, run the test command
-    if is_testing:
-        command = "npm i && npm run test"
+    if is_testing and run_tests:
+        command = GATEWAY_TEST_COMMANDS[profile]
     else:
-        command = "npm i && npm run dev"
+        command = LAUNCH_COMMANDS[profile]
+
+    # The test command sets NODE_ENV itself
+    if is_testing and not run_tests:
+        env_copy["NODE_ENV"] = "test"
+
+    runtime_profile = get_runtime_profile("gateway", "gateway", "gateway")
+    apply_runtime_env(runtime_profile, env_copy)
 
     # The gateway is long running. It will be in the background
+    process = None
     try:
+        process = subprocess.Popen(command, cwd=cwd, env=env_copy, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   shell=True, start_new_session=True)
+        place_process_tree("gateway", process.pid, runtime_profile)
         # Save the output and errors to the log files
-        out_file = open(out_log_file, "w")
-        err_file = open(err_log_file, "w")
-
-        process = subprocess.Popen(command, cwd=cwd, env=env_copy, stdout=out_file, stderr=err_file, shell=True)
+        out_file, err_file = log_multiplexer.attach("gateway", process, out_log_file, err_log_file)
         print("Gateway spawned. Check the log files for errors.")
 
-        return (process, out_file, err_file, "gateway")
+        return ProcessHandle(process, out_file, err_file, "gateway", "gateway")
     except Exception as e:
-        out_file.close()
-        err_file.close()
-
         print("Failed to spawn gateway")
+        if process is not None:
+            kill_process_tree(process)
         raise e
 
-def create_mongo_instances(services: list, services_to_exclude: list, env_file_name: str, services_root: str, logs_dir: str):
+def get_database_uri(service: str, env_file_name: str, services_root: str) -> str:
     """
-    Create a mongo instance for each service in the services list except the ones in the exclude list.
+    Get the DATABASE_URI of a service from its .env file.
 
     Parameters
     ----------
-    services : list
-        List of service names
-    services_to_exclude : list
-        List of service names to exclude
+    service : str
+        Name of the service
     env_file_name : str
         Name of the .env file to load
     services_root : str
         Root directory of the services
+
+    Returns
+    -------
+    str
+        The DATABASE_URI of the service
+
+    Raises
+    ------
+    ValueError
+        If DATABASE_URI is not defined
+    """
+    # Load the .env file for the service
+    env_copy = load_env(os.path.join(services_root, service), env_file_name)
+
+    # Get the MONGO_URI from the .env file
+    mongo_uri = env_copy.get("DATABASE_URI")
+
+    if mongo_uri is None:
+        raise ValueError("DATABASE_URI is not defined in the .env file")
+
+    return mongo_uri
+
+def get_database_config(service: str, env_file_name: str, services_root: str):
+    """
+    Get the port and the database name of a service from the DATABASE_URI in its .env file.
+
+    Parameters
+    ----------
+    service : str
+        Name of the service
+    env_file_name : str
+        Name of the .env file to load
+    services_root : str
+        Root directory of the services
+
+    Returns
+    -------
+    tuple
+        Tuple containing the port and the database name
+
+    Raises
+    ------
+    ValueError
+        If DATABASE_URI is not defined or has an invalid format
+    """
+    mongo_uri = get_database_uri(service, env_file_name, services_root)
+
+    # Get the port from the MONGO_URI
+    match = re.search(r"mongodb://.*:(\d+)", mongo_uri)
+    if not match:
+        raise ValueError(f"Invalid DATABASE_URI format in {service}")
+    port = match.group(1)
+
+    # Get the database name from the MONGO_URI
+    sliced_mongo_uri = mongo_uri.split("/")
+
+    # The last element in the sliced list is the database name e.g. mongodb://localhost:27017/test -> test is the database name
+    database_name = sliced_mongo_uri[-1]
+
+    return (port, database_name)
+
+def spawn_mongod(instance_name: str, port: int, mongo_path: str, mongo_log_path: str, logs_dir: str,
+                 cache_size_gb: float = None) -> ProcessHandle:
+    """
+    Spawn a mongod instance.
+
+    Parameters
+    ----------
+    instance_name : str
+        Name of the instance, also the name of its component and of its log files
+    port : int
+        Port the instance listens on
+    mongo_path : str
+        The dbpath of the instance. It must exist
+    mongo_log_path : str
+        The log file of mongod itself
     logs_dir : str
         Directory to save the log files to
+    cache_size_gb : float
+        Size of the WiredTiger cache in GB, left to mongod if None
 
     Returns
     -------
-    list
-        List of paths to the mongo instances
-    """ 
-    # The base dir is where the mongo data will be stored
-    # Please note that this is not the dir that mongo itself uses by default
-    # as mongo uses ~/data/db
-    mongo_base_path = f"{os.path.join(os.path.expanduser('~'), 'mongo_data')}"
+    ProcessHandle
+        Handle containing a Popen object, an output log file, an error log file, the name and the port of the mongo instance
+    """
+    # Log files to save the output and errors to
+    out_log_file = f"{os.path.join(logs_dir, f'{instance_name}.out')}"
+    err_log_file = f"{os.path.join(logs_dir, f'{instance_name}.err')}"
 
-    mongo_processes = []
+    # Mongo instance creation command
+    mongo_creation_cmd = f"mongod --port {port} --dbpath {mongo_path} --logpath {mongo_log_path} --logappend"
+    # Without a cache size, every instance would take about half of the RAM
+    if cache_size_gb is not None:
+        mongo_creation_cmd += f" --wiredTigerCacheSizeGB {cache_size_gb:.2f}"
+
+    # Use subprocess to run the command
+    try:
+        # Spawn the database and save the process, stdout and stderr in a handle. This will be used later to terminate the process
+        process = subprocess.Popen(mongo_creation_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+                                   start_new_session=True)
+    # If the mongo instance could not be created
+    except Exception as e:
+        print(f"Failed to create mongo instance {instance_name}")
+        raise e
+
+    try:
+        # Keep mongod off the cores of the hot services
+        place_process_tree(instance_name, process.pid, get_runtime_profile(instance_name, instance_name, "database"),
+                           target="mongod")
+        # Save the output and errors to the log files
+        out_file, err_file = log_multiplexer.attach(instance_name, process, out_log_file, err_log_file)
+    # The process has no handle yet, the teardown would not find it
+    except Exception as e:
+        print(f"Failed to start mongo instance {instance_name}")
+        kill_process_tree(process)
+        raise e
+
+    return ProcessHandle(process, out_file, err_file, instance_name, "database", int(port))
+
+def create_mongo_instance(service: str, env_file_name: str, services_root: str, logs_dir: str,
+                          mongo_base_path: str = DEFAULT_MONGO_BASE_PATH, cache_size_gb: float = None):
+    """
+    Create the mongo instance of a service.
 
+    Parameters
+    ----------
+    service : str
+        Name of the service
+    env_file_name : str
+        Name of the .env file to load
+    services_root : str
+        Root directory of the services
+    logs_dir : str
+        Directory to save the log files to
+    mongo_base_path : str
+        The base dir where the mongo data will be stored, ~/mongo_data by default.
+        Please note that this is not the dir that mongo itself uses by default
+        as mongo uses ~/data/db
+    cache_size_gb : float
+        Size of the WiredTiger cache in GB, left to mongod if None
+
+    Returns
+    -------
+    ProcessHandle
+        Handle containing a Popen object, an output log file, an error log file, the name and the port of the mongo instance
+    """
     # Create the base dir
     try:
         os.makedirs(mongo_base_path, exist_ok=True)
@@ -374,83 +921,593 @@ def create_mongo_instances(services: list, services_to_exclude: list, env_file_n
         print("Failed to create mongo base dir")
         raise e
 
-    # Create the mongo instance for each service except the ones in the exclude list
-    for service in services:
-        if service not in services_to_exclude:
-            # Load the .env file for the service
-            env_file_path = f"{os.path.join(services_root, service, env_file_name)}"
-            env_copy = os.environ.copy()
-            env_copy.update(dotenv.dotenv_values(env_file_path))
+    port, database_name = get_database_config(service, env_file_name, services_root)
 
-            # Get the MONGO_URI from the .env file
-            mongo_uri = env_copy.get("DATABASE_URI")
+    # Create the path for the mongo instance for the service
+    mongo_path = f"{os.path.join(mongo_base_path, database_name)}"
 
-            if mongo_uri is None:
-                raise ValueError("DATABASE_URI is not defined in the .env file")
+    # Create the path for the mongo log for the service
+    mongo_log_path = f"{os.path.join(mongo_base_path, f'{database_name}.log')}"
 
-            # Get the port from the MONGO_URI
-            match = re.search(r"mongodb://.*:(\d+)", mongo_uri)
-            if not match:
-                raise ValueError(f"Invalid DATABASE_URI format in {service}")
-            port = match.group(1)
+    # Create the mongo dir for the service
+    try:
+        os.makedirs(mongo_path, exist_ok=True)
+        print(f"Created mongo dir {mongo_path} for {service}")
+    except Exception as e:
+        print(f"Failed to create mongo dir {mongo_path} for {service}")
+        raise e
 
-            # Get the database name from the MONGO_URI
-            sliced_mongo_uri = mongo_uri.split("/")
+    handle = spawn_mongod(f"{database_name}_database", port, mongo_path, mongo_log_path, logs_dir, cache_size_gb)
 
-            # The last element in the sliced list is the database name e.g. mongodb://localhost:27017/test -> test is the database name
-            database_name = sliced_mongo_uri[-1]
-            
-            # Create the path for the mongo instance for the service
-            mongo_path = f"{os.path.join(mongo_base_path, database_name)}"
+    print(f"Mongo instance created for {service} on port {port}. check {handle.out_file.name}", 
+          "for logs.\n")
 
-            # Create the path for the mongo log for the service
-            mongo_log_path = f"{os.path.join(mongo_base_path, f"{database_name}.log")}"
+    return handle
 
-            # Log files to save the output and errors to
-            out_log_file = f"{os.path.join(logs_dir, f"{database_name}_database.out")}"
-            err_log_file = f"{os.path.join(logs_dir, f"{database_name}_database.err")}"
-            
-            # Create the mongo dir for the service
-            try:
-                os.makedirs(mongo_path, exist_ok=True)
-                print(f"Created mongo dir {mongo_path} for {service}")
-            except Exception as e:
-                print(f"Failed to create mongo dir {mongo_path} for {service}")
-                raise e
+def create_shared_mongo_instance(instance_name: str, port: int, logs_dir: str, mongo_base_path: str = DEFAULT_MONGO_BASE_PATH,
+                                 cache_size_gb: float = None):
+    """
+    Create the mongo instance that holds the databases of every service in the shared mongo mode.
 
-            # Mongo instance creation command
-            mongo_creation_cmd = f"mongod --port {port} --dbpath {mongo_path} --logpath {mongo_log_path} --logappend"
-            
-            # Use subprocess to run the command
-            try:
-                # Save the output and errors to the log files
-                out_file = open(out_log_file, "w")
-                err_file = open(err_log_file, "w")
+    Parameters
+    ----------
+    instance_name : str
+        Name of the instance, also the name of its dbpath in the mongo base dir
+    port : int
+        Port the instance listens on
+    logs_dir : str
+        Directory to save the log files to
+    mongo_base_path : str
+        The base dir where the mongo data will be stored
+    cache_size_gb : float
+        Size of the WiredTiger cache in GB, left to mongod if None
+
+    Returns
+    -------
+    ProcessHandle
+        Handle containing a Popen object, an output log file, an error log file, the name and the port of the mongo instance
+    """
+    mongo_path = f"{os.path.join(mongo_base_path, instance_name)}"
+    mongo_log_path = f"{os.path.join(mongo_base_path, f'{instance_name}.log')}"
 
-                # Spawn the databases and save the process, stdout and stderr as tuple. This will be used later to terminate the processes
-                process = subprocess.Popen(mongo_creation_cmd, stdout=out_file, stderr=err_file, shell=True)
+    try:
+        os.makedirs(mongo_path, exist_ok=True)
+    except Exception as e:
+        print(f"Failed to create mongo dir {mongo_path}")
+        raise e
+
+    handle = spawn_mongod(instance_name, port, mongo_path, mongo_log_path, logs_dir, cache_size_gb)
+    print(f"Shared mongo instance created on port {port}. check {handle.out_file.name} for logs.\n")
+
+    return handle
+
+def create_mongo_instances(services: list, services_to_exclude: list, env_file_name: str, services_root: str, logs_dir: str):
+    """
+    Create a mongo instance for each service in the services list except the ones in the exclude list.
+
+    Parameters
+    ----------
+    services : list
+        List of service names
+    services_to_exclude : list
+        List of service names to exclude
+    env_file_name : str
+        Name of the .env file to load
+    services_root : str
+        Root directory of the services
+    logs_dir : str
+        Directory to save the log files to
+
+    Returns
+    -------
+    list
+        List of paths to the mongo instances
+    """ 
+    mongo_processes = []
+
+    # Create the mongo instance for each service except the ones in the exclude list
+    for service in services:
+        if service not in services_to_exclude:
+            try:
                 # Add the process, stdout and stderr to the list
-                mongo_processes.append((process, out_file, err_file, f"{database_name}_database"))
-            # If the log files could not be created
-            except FileNotFoundError as e:
-                print("Failed to create log files")
-                raise e
-            # If the mongo instance could not be created
+                mongo_processes.append(create_mongo_instance(service, env_file_name, services_root, logs_dir))
             except Exception as e:
-                # Close the log files
-                out_file.close()
-                err_file.close()
                 # Clean up the processes that were created
                 cleanup_processes(mongo_processes)
-                print(f"Failed to create mongo instance for {service}")
                 raise e
             
-            print(f"Mongo instance created for {service} on port {port}. check {out_log_file}", 
-                  "for logs.\n")
-            
     # Return the list of mongo instaces processes which will be used to terminate the processes later on
     return mongo_processes
 
+@dataclass
+class StackOptions:
+    """
+    Options of the stack booted from the component graph.
+
+    Attributes
+    ----------
+    is_testing : bool
+        If true, clear the databases and run the gateway in test mode
+    profile : str
+        The launch profile. "dev" lints, builds and watches the sources of every package.
+        "prod" only compiles the packages whose sources changed and runs them without a watcher
+    force_install : bool
+        If true, install the dependencies of every package even if they did not change
+    install_workers : int
+        Maximum number of packages installed at the same time
+    force_build : bool
+        If true, build every package in the prod profile even if its sources did not change
+    build_workers : int
+        Maximum number of packages built at the same time
+    reset : str
+        How the databases are reset in test mode. "drop" drops them once mongod is up.
+        "snapshot" restores the saved snapshot of each database before mongod is started,
+        and falls back to a drop for the databases without a snapshot
+    replicas : dict
+        Number of replicas of the services that run more than one
+    broker : str
+        The MQTT broker. "aedes" runs the broker package, "embedded" runs the lightweight broker
+        of the orchestrator inside the orchestrator process
+    mongo_mode : str
+        "per-service" runs a mongo instance per service, "shared" runs a single mongo instance
+        holding the databases of every service
+    mongo_port : int
+        Port of the shared mongo instance, the port of the first service's database by default
+    mongo_memory_gb : float
+        WiredTiger cache of all the mongo instances together in GB, a share of the RAM by default
+    mongo_base_path : str
+        The base dir of the dbpaths of the mongo instances
+    external_tests : bool
+        If true in test mode, run the gateway without its test script. The tests are run by the orchestrator,
+        e.g. by the test daemon or against a shard of the collection
+    """
+    is_testing: bool = False
+    profile: str = "dev"
+    force_install: bool = False
+    install_workers: int = 4
+    force_build: bool = False
+    build_workers: int = os.cpu_count() or 1
+    reset: str = "drop"
+    replicas: dict = field(default_factory=dict)
+    broker: str = "aedes"
+    mongo_mode: str = "per-service"
+    mongo_port: int = None
+    mongo_memory_gb: float = None
+    mongo_base_path: str = DEFAULT_MONGO_BASE_PATH
+    external_tests: bool = False
+
+def get_shared_mongo_port(database_services: list, env_file_name: str, services_root: str, options: StackOptions) -> int:
+    """
+    Get the port of the shared mongo instance, the port of the first service's database unless it is set in the options.
+    """
+    return options.mongo_port or int(get_database_config(database_services[0], env_file_name, services_root)[0])
+
+def get_package_components(services: list, broker_path: str, gateway_path: str, services_root: str,
+                           options: StackOptions) -> dict:
+    """
+    Get the components running each package of the stack, by package path.
+    The embedded broker does not run the broker package.
+    """
+    packages = {}
+    if options.broker != "embedded":
+        packages[broker_path] = ["broker"]
+
+    for service in services:
+        replica_count = options.replicas.get(service, 1)
+        packages[os.path.join(services_root, service)] = [
+            get_replica_name(service, replica) for replica in (range(replica_count) if replica_count > 1 else [None])
+        ]
+
+    packages[gateway_path] = ["gateway"]
+    return packages
+
+def build_component_graph(services: list, services_without_database: list, env_file_name: str, services_root: str,
+                          broker_path: str, gateway_path: str, logs_dir: str, state_dir: str, options: StackOptions):
+    """
+    Build the graph of the components of the stack.
+    Every service depends on the broker and on its own mongo instance, or on the shared mongo instance
+    in the shared mongo mode. In test mode the database of the service is cleared before the service
+    is started. The gateway depends on all the services.
+    A service with replicas gets one component per replica, each with its own logs, readiness and teardown.
+    The npm packages are installed by tasks that the broker, the services and the gateway depend on.
+    The install of a package is skipped if it did not change since its last successful install.
+    In the prod profile every package is also built by a task, which is skipped if its sources did not change.
+
+    Parameters
+    ----------
+    services : list
+        List of service names
+    services_without_database : list
+        List of service names that do not have a mongo instance
+    env_file_name : str
+        Name of the .env file to load for each component
+    services_root : str
+        Root directory of the services
+    broker_path : str
+        Path to the broker directory
+    gateway_path : str
+        Path to the gateway directory
+    logs_dir : str
+        Directory to save the log files to
+    state_dir : str
+        Directory where the orchestrator keeps its state, such as the install and build caches
+    options : StackOptions
+        Options of the stack
+
+    Returns
+    -------
+    ComponentGraph
+        The graph of the components
+    """
+    # These are the green flags that will be printed when the services are running
+    # These are used for the script to allow dependent services to start
+    BROKER_GREEN_FLAG = "Broker running on port"
+    SERVICE_GREEN_FLAG = "Subscribed to MQTT topics"
+    GATEWAY_GREEN_FLAG = "Gateway running on port"
+    WAITING_TIMEOUT = 60
+
+    graph = ComponentGraph()
+
+    # The broker is only ready once it accepts connections on its port
+    broker_address = get_broker_address(broker_path, env_file_name)
+    broker_probes = [TcpCheck(*broker_address)] if broker_address is not None else []
+
+    # Bound the number of npm installs and builds running at the same time
+    install_semaphore = threading.Semaphore(options.install_workers)
+    build_semaphore = threading.Semaphore(options.build_workers)
+
+    def add_package_tasks(name: str, package_path: str) -> list:
+        """
+        Add the tasks that prepare a package and return their names, which its component depends on.
+        """
+        def install():
+            install_package(package_path, state_dir, options.force_install, semaphore=install_semaphore)
+
+        def build():
+            build_package(package_path, state_dir, options.force_build, semaphore=build_semaphore)
+
+        graph.add(Component(name=f"{name}_install", kind="task", start=install))
+        if options.profile != "prod":
+            return [f"{name}_install"]
+
+        graph.add(Component(name=f"{name}_build", kind="task", start=build, depends_on=[f"{name}_install"]))
+        return [f"{name}_build"]
+
+    # The embedded broker does not need the broker package to be installed or built, and is listening once started
+    if options.broker == "embedded":
+        graph.add(Component(
+            name="broker",
+            kind="broker",
+            start=lambda: start_embedded_broker(broker_path, env_file_name),
+        ))
+    else:
+        graph.add(Component(
+            name="broker",
+            kind="broker",
+            start=lambda: [spawn_broker(broker_path, logs_dir, env_file_name, options.profile)],
+            ready=lambda handles, cancel: wait_for_green_flag("broker", logs_dir, WAITING_TIMEOUT, BROKER_GREEN_FLAG, cancel,
+                                                              handles[0].process, broker_probes),
+            depends_on=add_package_tasks("broker", broker_path),
+        ))
+
+    # The gateway depends on every service, or on every replica of a service
+    service_components = []
+
+    # Split the memory budget between the mongo instances, so that they do not take half of the RAM each
+    database_services = [service for service in services if service not in services_without_database]
+    shared_mongo = options.mongo_mode == "shared" and len(database_services) > 0
+    instance_count = 1 if shared_mongo else len(database_services)
+    cache_size_gb = compute_cache_size_gb(instance_count, options.mongo_memory_gb)
+    if instance_count > 0:
+        print(f"WiredTiger cache of {cache_size_gb:.2f} GB for each of the {instance_count} mongo instance(s)")
+
+    # In the shared mongo mode a single instance holds the database of every service
+    if shared_mongo:
+        shared_port = get_shared_mongo_port(database_services, env_file_name, services_root, options)
+        graph.add(Component(
+            name=SHARED_DATABASE_COMPONENT,
+            kind="database",
+            start=lambda: [create_shared_mongo_instance(SHARED_DATABASE_COMPONENT, shared_port, logs_dir,
+                                                        options.mongo_base_path, cache_size_gb)],
+            ready=lambda handles, cancel: wait_for_mongo_instance(
+                SHARED_DATABASE_COMPONENT, shared_port, WAITING_TIMEOUT, cancel, handles[0].process),
+        ))
+
+    for service in services:
+        service_dependencies = ["broker"] + add_package_tasks(service, os.path.join(services_root, service))
+        database_uri = None
+
+        if service in database_services and shared_mongo:
+            # Point the service to its database on the shared instance
+            database_uri = rewrite_database_uri(get_database_uri(service, env_file_name, services_root), shared_port)
+            service_dependencies.append(SHARED_DATABASE_COMPONENT)
+
+            if options.is_testing:
+                graph.add(Component(
+                    name=f"{service}_dropdb",
+                    kind="task",
+                    start=lambda service=service: clear_database(service, env_file_name, services_root, shared_port),
+                    depends_on=[SHARED_DATABASE_COMPONENT],
+                ))
+                service_dependencies.append(f"{service}_dropdb")
+
+        elif service in database_services:
+            # The name of the mongo instance is based on the database name, like the process handle
+            port, database_name = get_database_config(service, env_file_name, services_root)
+            database_component = f"{database_name}_database"
+            database_dependencies = []
+
+            # In test mode with snapshots, restore the seeded dbpath before mongod is started
+            use_snapshot = options.is_testing and options.reset == "snapshot" and has_snapshot(database_name)
+            if use_snapshot:
+                graph.add(Component(
+                    name=f"{service}_restoredb",
+                    kind="task",
+                    start=lambda database_name=database_name: restore_snapshot(
+                        database_name, dbpath_base_path=options.mongo_base_path),
+                ))
+                database_dependencies.append(f"{service}_restoredb")
+
+            graph.add(Component(
+                name=database_component,
+                kind="database",
+                start=lambda service=service: [create_mongo_instance(service, env_file_name, services_root, logs_dir,
+                                                                     options.mongo_base_path, cache_size_gb)],
+                ready=lambda handles, cancel, name=database_component, port=port: wait_for_mongo_instance(
+                    name, port, WAITING_TIMEOUT, cancel, handles[0].process),
+                depends_on=database_dependencies,
+            ))
+            service_dependencies.append(database_component)
+
+            # Otherwise in test mode, start every service with an empty database
+            if options.is_testing and not use_snapshot:
+                graph.add(Component(
+                    name=f"{service}_dropdb",
+                    kind="task",
+                    start=lambda service=service: clear_database(service, env_file_name, services_root),
+                    depends_on=[database_component],
+                ))
+                service_dependencies.append(f"{service}_dropdb")
+
+        replica_count = options.replicas.get(service, 1)
+        for replica in range(replica_count) if replica_count > 1 else [None]:
+            name = get_replica_name(service, replica)
+            replica_dependencies = list(service_dependencies)
+            command = None
+
+            # In the dev profile the first replica builds and watches the sources. The other ones wait for its build
+            # and restart when it rebuilds, as several tsc --watch in the same package would overwrite each other
+            if options.profile == "dev" and replica:
+                replica_dependencies.append(get_replica_name(service, 0))
+                command = REPLICA_WATCH_COMMAND
+
+            graph.add(Component(
+                name=name,
+                kind="service",
+                start=lambda service=service, replica=replica, command=command, database_uri=database_uri: [spawn_service(
+                    service, env_file_name, services_root, logs_dir, options.profile, replica, command, database_uri)],
+                ready=lambda handles, cancel, name=name: wait_for_green_flag(
+                    name, logs_dir, WAITING_TIMEOUT, SERVICE_GREEN_FLAG, cancel, handles[0].process),
+                depends_on=replica_dependencies,
+            ))
+            service_components.append(name)
+
+    graph.add(Component(
+        name="gateway",
+        kind="gateway",
+        start=lambda: [spawn_gateway(gateway_path, logs_dir, env_file_name, options.is_testing, options.profile,
+                                     not options.external_tests)],
+        ready=lambda handles, cancel: wait_for_green_flag("gateway", logs_dir, WAITING_TIMEOUT, GATEWAY_GREEN_FLAG, cancel,
+                                                          handles[0].process),
+        depends_on=service_components + add_package_tasks("gateway", gateway_path),
+    ))
+
+    return graph
+
+def run_collection(gateway_path: str, collection_path: str, report_path: str = None) -> int:
+    """
+    Run a Postman collection with newman against the running gateway.
+
+    Parameters
+    ----------
+    gateway_path : str
+        Path to the gateway directory, where newman is installed
+    collection_path : str
+        Path to the Postman collection
+    report_path : str
+        If given, save the JSON report of newman to this file
+
+    Returns
+    -------
+    int
+        The exit code of newman
+    """
+    command = f"npx newman run {shlex.quote(os.path.abspath(collection_path))}"
+    if report_path is not None:
+        command += f" --reporters cli,json --reporter-json-export {shlex.quote(os.path.abspath(report_path))}"
+
+    print(f"Running {collection_path}")
+    return subprocess.run(command, cwd=gateway_path, shell=True).returncode
+
+def run_sharded_tests(shard_count: int, services: list, services_without_database: list, env_file_name: str,
+                      services_root: str, broker_path: str, gateway_path: str, logs_dir: str, state_dir: str,
+                      options: StackOptions, collection_path: str, child_arguments: list) -> int:
+    """
+    Split the Postman collection across several isolated test stacks run side by side, and merge their results.
+    Every stack is a child main.py --test with its own ports, logs dir and dbpaths. The packages are installed
+    and built once beforehand, so that the stacks do not build the same package at the same time.
+
+    Parameters
+    ----------
+    shard_count : int
+        Number of stacks
+    services : list
+        List of service names
+    services_without_database : list
+        List of service names that do not have a mongo instance
+    env_file_name : str
+        Name of the .env file the ports of the packages are taken from
+    services_root : str
+        Root directory of the services
+    broker_path : str
+        Path to the broker directory
+    gateway_path : str
+        Path to the gateway directory
+    logs_dir : str
+        Directory where the logs dir of every stack is created
+    state_dir : str
+        Directory where the orchestrator keeps its state. The collections and reports of the shards are kept in it
+    options : StackOptions
+        Options of the stacks. The memory budget of the mongo instances is split between the stacks
+    collection_path : str
+        Path to the Postman collection
+    child_arguments : list
+        Arguments given to every child main.py, such as the profile and the broker
+
+    Returns
+    -------
+    int
+        0 if the tests of every shard passed, 1 otherwise
+    """
+    with open(collection_path, "r") as f:
+        collection = json.load(f)
+
+    shard_collections = split_collection(collection, shard_count)
+    if len(shard_collections) < shard_count:
+        print(f"The collection only has {len(shard_collections)} top-level items, running {len(shard_collections)} shard(s)")
+    shard_count = len(shard_collections)
+
+    # Install and build every package once, the stacks then find them up to date
+    packages = get_package_components(services, broker_path, gateway_path, services_root, options)
+
+    def prepare(package_path: str):
+        install_package(package_path, state_dir, options.force_install)
+        if options.profile == "prod":
+            build_package(package_path, state_dir, options.force_build)
+
+    with ThreadPoolExecutor(max_workers=options.install_workers) as executor:
+        for future in [executor.submit(prepare, package_path) for package_path in packages]:
+            future.result()
+
+    database_services = [service for service in services if service not in services_without_database]
+    gateway_port = load_env(gateway_path, env_file_name).get("GATEWAY_PORT") or "3000"
+    memory_gb = options.mongo_memory_gb or get_total_memory_gb() * DEFAULT_BUDGET_FRACTION
+    shards_dir = os.path.join(state_dir, "shards")
+
+    shards = []
+    for shard in range(1, shard_count + 1):
+        # A broker, a gateway and the mongo instances
+        mongo_ports = 1 if options.mongo_mode == "shared" else len(database_services)
+        broker_port, shard_gateway_port, *database_ports = allocate_ports(2 + mongo_ports)
+
+        # The packages read their ports from the environment before their .env files
+        overrides = {os.path.basename(broker_path): {"BROKER_PORT": str(broker_port)}}
+        for package_path in [os.path.join(services_root, service) for service in services] + [gateway_path]:
+            package_env = load_env(package_path, env_file_name)
+            package_overrides = overrides.setdefault(os.path.basename(package_path), {})
+            if package_env.get("BROKER_URI"):
+                package_overrides["BROKER_URI"] = replace_uri_port(package_env["BROKER_URI"], broker_port)
+        overrides[os.path.basename(gateway_path)]["GATEWAY_PORT"] = str(shard_gateway_port)
+        for index, service in enumerate(database_services):
+            database_uri = get_database_uri(service, env_file_name, services_root)
+            overrides[service]["DATABASE_URI"] = replace_uri_port(database_uri, database_ports[min(index, mongo_ports - 1)])
+
+        shard_dir = os.path.join(shards_dir, str(shard))
+        shard_logs_dir = os.path.join(logs_dir, f"shard-{shard}")
+        os.makedirs(shard_dir, exist_ok=True)
+        os.makedirs(shard_logs_dir, exist_ok=True)
+
+        shard_collection_path = os.path.join(shard_dir, "collection.json")
+        with open(shard_collection_path, "w") as f:
+            json.dump(rewrite_port(shard_collections[shard - 1], gateway_port, shard_gateway_port), f, indent=1)
+        overrides_path = os.path.join(shard_dir, "env_overrides.json")
+        with open(overrides_path, "w") as f:
+            json.dump(overrides, f, indent=1)
+        report_path = os.path.join(shard_dir, "report.json")
+        if os.path.exists(report_path):
+            os.remove(report_path)
+
+        command = [sys.executable, os.path.realpath(__file__), "--test", *child_arguments,
+                   "--logs-dir", shard_logs_dir,
+                   "--mongo-base-path", os.path.join(options.mongo_base_path, f"shard-{shard}"),
+                   "--mongo-memory-gb", f"{memory_gb / shard_count:.2f}",
+                   "--env-overrides", overrides_path,
+                   "--collection", shard_collection_path,
+                   "--report", report_path]
+
+        log_path = os.path.join(shard_logs_dir, "orchestrator.out")
+        log_file = open(log_path, "w")
+        # The children stay in the process group, so that Ctrl-C reaches them and they clean up their stacks
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        print(f"Shard {shard}: {sum(1 for _ in shard_collections[shard - 1]['item'])} items, gateway on port "
+              f"{shard_gateway_port}, broker on port {broker_port}. Check {log_path} for its output")
+        shards.append({"shard": shard, "process": process, "log_file": log_file, "log": log_path,
+                       "report_path": report_path, "started_at": time.monotonic()})
+
+    results = []
+    try:
+        pending = list(shards)
+        while pending:
+            for shard in list(pending):
+                exit_code = shard["process"].poll()
+                if exit_code is None:
+                    continue
+
+                pending.remove(shard)
+                shard["log_file"].close()
+                duration = time.monotonic() - shard["started_at"]
+                print(f"Shard {shard['shard']} finished with exit code {exit_code} in {duration:.1f}s")
+                results.append({"shard": shard["shard"], "exit_code": exit_code, "duration": duration, "log": shard["log"],
+                                "report": load_report(shard["report_path"])})
+            time.sleep(0.1)
+    except KeyboardInterrupt as e:
+        print("Interrupted, waiting for the shards to shut their stacks down...")
+        for shard in shards:
+            shard["process"].wait()
+            shard["log_file"].close()
+        raise e
+
+    merged = merge_reports(sorted(results, key=lambda result: result["shard"]))
+    report_path = os.path.join(shards_dir, "report.json")
+    with open(report_path, "w") as f:
+        json.dump(merged, f, indent=1)
+
+    print(f"\n{format_report(merged)}")
+    print(f"Merged report saved to {report_path}")
+    return merged["exit_code"]
+
+def parse_replicas(values: list, services: list) -> dict:
+    """
+    Parse the replica counts given as SERVICE=N.
+
+    Parameters
+    ----------
+    values : list
+        List of strings such as user_service=4
+    services : list
+        List of service names
+
+    Returns
+    -------
+    dict
+        The number of replicas of every service given
+
+    Raises
+    ------
+    ValueError
+        If a value is malformed or names an unknown service
+    """
+    replicas = {}
+    for value in values:
+        service, _, count = value.partition("=")
+        if service not in services:
+            raise ValueError(f"Unknown service {service!r} in --replicas, expected one of {', '.join(services)}")
+        if not count.isdigit() or int(count) < 1:
+            raise ValueError(f"Invalid number of replicas in {value!r}, expected SERVICE=N with N >= 1")
+        replicas[service] = int(count)
+
+    return replicas
+
 def main():
     """
     This script is used to start the services and the gateway for the chat app.
@@ -460,19 +1517,81 @@ def main():
     If the tests fail, the script will exit with a non-zero exit code.
     If the tests pass, the script will exit with a zero exit code.
     If the --test argument is not passed, the script will spawn the, broker, the services and the gateway without clearing the databases.
-    The script will wait for the broker, the services, and the gateway to give the green flag.
+    The components are booted as a dependency graph: every component is started as soon as the components it depends on
+    gave the green flag, and independent components are started and waited on concurrently.
     """
-    # These are the green flags that will be printed when the services are running
-    # These are used for the script to allow dependent services to start
-    BROKER_GREEN_FLAG = f"Broker running on port"
-    SERVICE_GREEN_FLAG = f"Subscribed to MQTT topics"
-    GATEWAY_GREEN_FLAG = f"Gateway running on port"
-    WAITING_TIMEOUT = 60
-
     # Create the argument parser for parsing the arguments passed to the script
     parser = argparse.ArgumentParser()
     # Add the arguments
     parser.add_argument("--test", "-t", action="store_true", help="Run Postman tests")
+    parser.add_argument("--reinstall", action="store_true", help="Run npm i in every package even if it did not change")
+    parser.add_argument("--install-workers", type=int, default=4, help="Maximum number of npm installs running at the same time")
+    parser.add_argument("--profile", choices=["dev", "prod"], default="dev",
+                        help="dev lints, builds and watches every package. prod only builds the packages that changed and runs them without a watcher")
+    parser.add_argument("--rebuild", action="store_true", help="Build every package in the prod profile even if it did not change")
+    parser.add_argument("--build-workers", type=int, default=os.cpu_count() or 1, help="Maximum number of packages built at the same time")
+    parser.add_argument("--reset", choices=["drop", "snapshot"], default="drop",
+                        help="How the databases are reset in test mode. snapshot restores the snapshots saved with python -m orchestrator.db_reset save")
+    parser.add_argument("--merged-logs", action="store_true", help="Also print the output of every component to the console, prefixed with its time and name")
+    parser.add_argument("--log-max-bytes", type=int, default=10 * 1024 * 1024, help="Size at which a log file is rotated")
+    parser.add_argument("--log-backups", type=int, default=3, help="Number of rotated log files kept per log file")
+    parser.add_argument("--telemetry-interval", type=float, default=0,
+                        help="Sample the CPU, memory, fds, threads, context switches and I/O of every component every N seconds. 0 disables it")
+    parser.add_argument("--telemetry-csv", help="Save every telemetry sample to this CSV file on shutdown")
+    parser.add_argument("--telemetry-prom", help="Keep the last telemetry sample in this Prometheus text file")
+    parser.add_argument("--replicas", nargs="+", default=[], metavar="SERVICE=N",
+                        help="Run N replicas of a service, e.g. --replicas user_service=4 ad_service=2. The replicas share the requests of the service")
+    parser.add_argument("--load", choices=["constant", "ramp"],
+                        help="Boot the stack, then load test the gateway with the requests of the Postman collection and shut down")
+    add_load_arguments(parser, "load-")
+    parser.add_argument("--soak", type=float, metavar="SECONDS",
+                        help="Boot the stack, send a steady load at --load-rate for this many seconds, then report the components "
+                             "whose memory or fds grow and the drift of the p99 latency, and shut down")
+    parser.add_argument("--soak-window", type=float, default=60, help="Seconds per window of the soak test, the p99 latency is measured per window")
+    parser.add_argument("--soak-interval", type=float, default=5, help="Seconds between two samples of the components during the soak test")
+    parser.add_argument("--soak-warmup", type=float, default=120, help="Seconds at the start of the soak test that are left out of the trends")
+    parser.add_argument("--soak-rss-growth", type=float, default=10, help="RSS growth of a component that fails the soak test, in MiB per hour")
+    parser.add_argument("--soak-fd-growth", type=float, default=10, help="Growth of the open fds of a component that fails the soak test, per hour")
+    parser.add_argument("--soak-p99-drift", type=float, default=20,
+                        help="Growth of the p99 latency that fails the soak test, in percent of the p99 after the warmup per hour")
+    parser.add_argument("--soak-min-r2", type=float, default=0.5,
+                        help="Only fail on trends that explain at least this much of the variance of their samples")
+    parser.add_argument("--soak-report", help="Save the report of the soak test to this JSON file")
+    parser.add_argument("--boot-history", help="File every boot is appended to, .orchestrator/boot_history.jsonl by default")
+    parser.add_argument("--no-boot-profile", action="store_true",
+                        help="Do not print the phases and the critical path of the boot or save them to the boot history")
+    parser.add_argument("--ring-lines", type=int, default=200, help="Number of lines of output kept in memory per component for the crash reports")
+    parser.add_argument("--broker", choices=["aedes", "embedded"], default="aedes",
+                        help="aedes runs the broker package. embedded runs a lightweight MQTT broker inside the orchestrator, which is ready in milliseconds")
+    parser.add_argument("--trace", action="store_true",
+                        help="Measure the latency between the requests of the gateway and the replies of the services, per topic, and print the slowest topics on shutdown")
+    parser.add_argument("--trace-prom", help="Keep the statistics of the latency tracer in this Prometheus text file")
+    parser.add_argument("--supervise", action="store_true",
+                        help="Restart a component on its own when it exits, and take commands from python -m orchestrator.supervisor")
+    parser.add_argument("--max-backoff", type=float, default=60, help="Longest wait in seconds before restarting a component that keeps crashing")
+    parser.add_argument("--daemon", action="store_true",
+                        help="With --test, keep the test stack running and run the tests whenever python -m orchestrator.warm_stack run asks for it")
+    parser.add_argument("--mongo-mode", choices=["per-service", "shared"], default="per-service",
+                        help="per-service runs a mongo instance per service. shared runs a single mongo instance holding the database of every service")
+    parser.add_argument("--mongo-port", type=int, help="Port of the shared mongo instance, the port of the first service's database by default")
+    parser.add_argument("--mongo-memory-gb", type=float,
+                        help="WiredTiger cache of all the mongo instances together in GB, a quarter of the RAM by default")
+    parser.add_argument("--mongo-disk", action="store_true", help="In test mode, keep the dbpaths on disk instead of on a tmpfs")
+    parser.add_argument("--mongo-base-path", help="Base dir of the dbpaths of the mongo instances")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="With --test, split the Postman collection across N isolated stacks run side by side and merge their results")
+    parser.add_argument("--collection",
+                        help="With --test, run this Postman collection with newman instead of the test script of the gateway. With --shards, the collection to split")
+    parser.add_argument("--report", help="With --collection, save the JSON report of newman to this file")
+    parser.add_argument("--logs-dir", help="Directory to save the log files to, logs/ by default")
+    parser.add_argument("--placement", choices=["none", "auto"], default="none",
+                        help="auto splits the cores between the mongo instances, the hot services and the other components")
+    parser.add_argument("--runtime", nargs="+", default=[], metavar="NAME.KEY=VALUE",
+                        help="Runtime profile of a component, a service or a kind of component (database, broker, service, gateway), "
+                             "e.g. user_service.threadpool=16 user_service.heap=1024 database.cpus=6-7 database.ionice=be:2. "
+                             "Keys: threadpool, heap (MB), semi-space (MB), node-options, cpus, nice, ionice")
+    parser.add_argument("--env-overrides",
+                        help="JSON file of environment values that override the .env file of each package, by package dir name, e.g. {\"broker\": {\"BROKER_PORT\": \"1885\"}}")
 
     # Get the root dir of the services
     services_root = os.path.join(os.path.dirname(os.path.realpath(__file__)), "services")
@@ -483,12 +1602,22 @@ def main():
         "notification_service",
         "admin_service",
     ]
+    # Services that do not have a database
+    services_without_database = ["notification_service"]
 
     gateway_path = f"{os.path.join(os.path.dirname(os.path.realpath(__file__)), 'api_gateway')}"
     broker_path = f"{os.path.join(os.path.dirname(os.path.realpath(__file__)), 'broker')}"
     env_file_name = ".env"
     # Get the logs dir
     logs_dir = f"{os.path.join(os.path.dirname(os.path.realpath(__file__)), 'logs')}"
+    # Get the dir where the orchestrator keeps its state between runs
+    state_dir = f"{os.path.join(os.path.dirname(os.path.realpath(__file__)), '.orchestrator')}"
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if args.logs_dir:
+        logs_dir = os.path.abspath(args.logs_dir)
 
     # Create the logs dir
     try:
@@ -497,90 +1626,245 @@ def main():
         print("Failed to create logs dir")
         raise e
 
-    # Parse the arguments
-    args = parser.parse_args()
+    if args.test and args.load:
+        parser.error("--test and --load can not be used together")
+    if args.soak is not None and (args.test or args.load or args.supervise or args.soak <= 0):
+        parser.error("--soak needs a positive duration and can not be used with --test, --load or --supervise")
+    if args.supervise and (args.test or args.load):
+        parser.error("--supervise can not be used with --test or --load")
+    if args.daemon and (not args.test or args.profile != "prod"):
+        parser.error("--daemon needs --test and --profile prod, it rebuilds the changed packages itself")
+    if args.mongo_mode == "shared" and args.reset == "snapshot":
+        parser.error("--reset snapshot can not be used with --mongo-mode shared, the snapshots are per database")
+    if args.mongo_memory_gb is not None and args.mongo_memory_gb <= 0:
+        parser.error("--mongo-memory-gb must be positive")
+    if args.shards and (not args.test or args.profile != "prod" or args.shards < 1):
+        parser.error("--shards needs --test, --profile prod and at least 1 shard, the stacks share the builds of the packages")
+    if args.shards and (args.daemon or args.report or args.mongo_port):
+        parser.error("--shards can not be used with --daemon, --report or --mongo-port")
+    if args.collection and not args.test:
+        parser.error("--collection needs --test")
+    if args.report and not args.collection:
+        parser.error("--report needs --collection")
+
+    if args.env_overrides:
+        global env_overrides
+        try:
+            with open(args.env_overrides, "r") as f:
+                env_overrides = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error(f"Failed to load --env-overrides: {e}")
+
+    try:
+        replicas = parse_replicas(args.replicas, services)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # The explicit profiles go on top of the automatic placement
+    global runtime_profiles
+    if args.placement == "auto":
+        runtime_profiles = plan_placement(HOT_SERVICES)
+        if not runtime_profiles:
+            print("Not enough cores to split between the components, --placement auto is ignored")
+    replica_names = [get_replica_name(service, replica) for service, count in replicas.items() for replica in range(count)]
+    try:
+        for name, profile in parse_runtime_profiles(args.runtime, COMPONENT_KINDS + services + replica_names).items():
+            runtime_profiles[name] = runtime_profiles.get(name, RuntimeProfile()).merged(profile)
+    except ValueError as e:
+        parser.error(str(e))
 
     # If the test argument is passed, set the env file name to .env.test
     if args.test:
         env_file_name = ".env.test"
 
-    try:      
-        mongo_processes = create_mongo_instances(services, ["notification_service"], env_file_name, services_root, logs_dir)
-        processes_handles.extend(mongo_processes)
+    # The test databases are thrown away at every run, so keep them in memory where mongod never waits on the disk
+    mongo_base_path = DEFAULT_MONGO_BASE_PATH
+    if args.mongo_base_path:
+        mongo_base_path = os.path.abspath(args.mongo_base_path)
+    elif args.test and not args.mongo_disk:
+        tmpfs_base_path = get_tmpfs_base_path()
+        if tmpfs_base_path is not None:
+            mongo_base_path = tmpfs_base_path
+            print(f"Test dbpaths on the tmpfs {mongo_base_path}")
+        else:
+            print("No tmpfs found, the test dbpaths stay on disk")
+
+    options = StackOptions(
+        is_testing=args.test,
+        profile=args.profile,
+        force_install=args.reinstall,
+        install_workers=args.install_workers,
+        force_build=args.rebuild,
+        build_workers=args.build_workers,
+        reset=args.reset,
+        replicas=replicas,
+        broker=args.broker,
+        mongo_mode=args.mongo_mode,
+        mongo_port=args.mongo_port,
+        mongo_memory_gb=args.mongo_memory_gb,
+        mongo_base_path=mongo_base_path,
+        external_tests=args.daemon or args.collection is not None,
+    )
+
+    # Every shard is a child main.py with its own stack, this process only splits the collection and merges the results
+    if args.shards:
+        child_arguments = ["--profile", args.profile, "--broker", args.broker, "--mongo-mode", args.mongo_mode,
+                           "--reset", args.reset, "--ring-lines", str(args.ring_lines),
+                           "--log-max-bytes", str(args.log_max_bytes), "--log-backups", str(args.log_backups)]
+        if args.replicas:
+            child_arguments += ["--replicas", *args.replicas]
+        # The shards run side by side on the same cores, each with the same placement
+        child_arguments += ["--placement", args.placement]
+        # The shards boot side by side on the same cores, their boots are not comparable with the other ones
+        child_arguments += ["--no-boot-profile"]
+        if args.runtime:
+            child_arguments += ["--runtime", *args.runtime]
+        exit(run_sharded_tests(args.shards, services, services_without_database, env_file_name, services_root, broker_path,
+                               gateway_path, logs_dir, state_dir, options, args.collection or DEFAULT_COLLECTION,
+                               child_arguments))
+
+    log_multiplexer.configure(max_bytes=args.log_max_bytes, backup_count=args.log_backups, ring_lines=args.ring_lines,
+                              merged=args.merged_logs)
+
+    # Sample the components from the start of the boot
+    if args.telemetry_interval > 0:
+        global telemetry_sampler
+        telemetry_sampler = TelemetrySampler(processes_handles, args.telemetry_interval,
+                                             prometheus_path=args.telemetry_prom, csv_path=args.telemetry_csv)
+        telemetry_sampler.start()
+
+    # The tracer has to exist before the embedded broker is started, so that the broker can feed it
+    if args.trace:
+        global latency_tracer
+        latency_tracer = LatencyTracer(prometheus_path=args.trace_prom)
+
+    # Boot the mongo instances, the broker, the services and the gateway.
+    # If the test argument is passed we run gateway in test mode, otherwise we run it in dev mode
+    try:
+        graph = build_component_graph(services, services_without_database, env_file_name, services_root,
+                                      broker_path, gateway_path, logs_dir, state_dir, options)
+        # Time the phases of every component from the markers in their output
+        boot_profiler = None
+        if not args.no_boot_profile:
+            boot_profiler = BootProfiler(log_multiplexer)
+            boot_profiler.watch(graph)
+        timings = start_graph(graph, processes_handles, boot_start=boot_profiler.boot_start if boot_profiler else None)
+        print(f"\nStack booted in {max(ready_at for _, ready_at in timings.values()):.1f}s")
+        start_tracer(broker_path, env_file_name)
     except Exception as e:
-        print(f"Failed to create mongo instances:\n{e}")
+        print_crash_dumps(processes_handles)
+        cleanup_processes(processes_handles)
+        print("Failed to spawn services or gateway or broker or to clear databases.")
+        print(e)
         exit(1)
 
-    # If the test argument is passed we run gateway in test mode, otherwise we run it in dev mode
-    if args.test:
+    if boot_profiler is not None:
+        boot_profiler.stop()
+        boot_record = boot_profiler.profile(graph, timings, profile=args.profile, test=args.test, broker=args.broker,
+                                            mongo_mode=args.mongo_mode, replicas=replicas)
+        print(f"\n{format_gantt(boot_record)}")
+        boot_history_path = args.boot_history or os.path.join(state_dir, "boot_history.jsonl")
+        try:
+            append_history(boot_history_path, boot_record)
+        except OSError as e:
+            print(f"Failed to save the boot to {boot_history_path}: {e}")
+
+    if args.load:
+        try:
+            run_load_test(get_gateway_url(gateway_path, env_file_name), args.load_collection, args.load, args.load_rate,
+                          args.load_duration, args.load_step, args.load_steps, args.load_connections, args.load_timeout)
+        finally:
+            # Always terminate the processes before exiting
+            cleanup_processes(processes_handles)
+        exit(0)
+
+    if args.soak is not None:
         try:
-            # Clear the databases
-            clear_databases(services, ["notification_service"], services_root)
-
-            # Spawn the broker
-            broker_process_tuple = spawn_broker(broker_path, logs_dir, env_file_name)
-            processes_handles.append(broker_process_tuple)
-            # Wait for the broker to give the green flag
-            wait_for_green_flag("broker", logs_dir, WAITING_TIMEOUT, BROKER_GREEN_FLAG)
-
-            # After broker gave the green flag, spawn the services
-            services_processes_tuples = spawn_services(services, [], env_file_name, services_root, logs_dir)
-            processes_handles.extend(services_processes_tuples)
-            # Wait for the services to give the green flag
-            for service in services:
-                wait_for_green_flag(service, logs_dir, WAITING_TIMEOUT, SERVICE_GREEN_FLAG)
-
-            # Spawn the gateway after the services gave the green flag
-            gateway_process_tuple = spawn_gateway(gateway_path, logs_dir, env_file_name, True)
-            processes_handles.append(gateway_process_tuple)
-            # Wait for the gateway to give the green flag
-            wait_for_green_flag("gateway", logs_dir, WAITING_TIMEOUT, GATEWAY_GREEN_FLAG)
-            # See if the tests passed
-
-            gateway_exit_code = gateway_process_tuple[0].wait()
-            # If the tests failed, exit with a non-zero exit code
-            if gateway_exit_code != 0:
-                print(f"Tests failed with exit code {gateway_exit_code}. Look at the logs for more information.")
-                # Always terminate the processes before exiting
-                cleanup_processes(processes_handles)
-                exit(1)
-
-            # If the tests passed, exit with a zero exit code
-            print("\nAll tests passed.")
+            soak_exit_code = run_soak_test(get_gateway_url(gateway_path, env_file_name), args.load_collection, processes_handles,
+                                           args.soak, args.load_rate, args.soak_window, args.soak_interval, args.soak_warmup,
+                                           args.soak_rss_growth, args.soak_fd_growth, args.soak_p99_drift / 100,
+                                           args.soak_min_r2, connections=args.load_connections, timeout=args.load_timeout,
+                                           report_path=args.soak_report)
+        finally:
             # Always terminate the processes before exiting
             cleanup_processes(processes_handles)
-            exit(0)
-        except Exception as e:
+        exit(soak_exit_code)
+
+    if args.daemon:
+        # Keep the test stack running. The crashed components are restarted and the changed packages rebuilt on every run
+        supervisor = Supervisor(graph, processes_handles, log_multiplexer, backoff_max=args.max_backoff)
+        database_services = [service for service in services if service not in services_without_database]
+        database_port = None
+        if args.mongo_mode == "shared" and database_services:
+            database_port = get_shared_mongo_port(database_services, env_file_name, services_root, options)
+
+        daemon = TestDaemon(
+            supervisor,
+            get_package_components(services, broker_path, gateway_path, services_root, options),
+            lambda: clear_databases(services, services_without_database, services_root, env_file_name, database_port,
+                                    keep_indexes=True),
+            DAEMON_TEST_COMMAND,
+            gateway_path,
+            os.environ.copy(),
+            state_dir,
+        )
+        daemon_server = TestDaemonServer(daemon, os.path.join(state_dir, "warm_stack.sock"))
+        daemon_server.start()
+        print("\nThe test stack is running. Run the tests with python -m orchestrator.warm_stack run, "
+              "stop it with python -m orchestrator.warm_stack stop or Ctrl-C.")
+        try:
+            supervisor.run()
+        finally:
+            daemon_server.stop()
+
+        cleanup_processes(processes_handles)
+        exit(0)
+
+    if args.test and args.collection:
+        # Run the collection against the gateway of this stack
+        tests_exit_code = run_collection(gateway_path, args.collection, args.report)
+        if tests_exit_code != 0:
+            print(f"Tests failed with exit code {tests_exit_code}. Look at the logs for more information.")
             cleanup_processes(processes_handles)
-            print("Failed to spawn services or gateway or broker or to clear databases.")
-            print(e)
             exit(1)
-    else:
-        try:
-            # Spawn the broker
-            broker_process_tuple = spawn_broker(broker_path, logs_dir, env_file_name)
-            processes_handles.append(broker_process_tuple)
-            # Wait for the broker to give the green flag
-            wait_for_green_flag("broker", logs_dir, WAITING_TIMEOUT, BROKER_GREEN_FLAG)
-
-            # After broker gave the green flag, spawn the services
-            services_processes_tuples = spawn_services(services, [], env_file_name, services_root, logs_dir)
-            processes_handles.extend(services_processes_tuples)
-            # Wait for the services to give the green flag
-            for service in services:
-                wait_for_green_flag(service, logs_dir, WAITING_TIMEOUT, SERVICE_GREEN_FLAG)
-
-            # Spawn the gateway after the services gave the green flag
-            gateway_process_tuple = spawn_gateway(gateway_path, logs_dir, env_file_name, False)
-            processes_handles.append(gateway_process_tuple)
-            # Wait for the gateway to give the green flag
-            wait_for_green_flag("gateway", logs_dir, WAITING_TIMEOUT, GATEWAY_GREEN_FLAG)
-        except Exception as e:
+
+        print("\nAll tests passed.")
+        cleanup_processes(processes_handles)
+        exit(0)
+
+    if args.test:
+        # See if the tests passed
+        gateway_process = next(handle.process for handle in processes_handles if handle.name == "gateway")
+        gateway_exit_code = gateway_process.wait()
+        # If the tests failed, exit with a non-zero exit code
+        if gateway_exit_code != 0:
+            print(f"Tests failed with exit code {gateway_exit_code}. Look at the logs for more information.")
+            print_crash_dumps(processes_handles)
+            # Always terminate the processes before exiting
             cleanup_processes(processes_handles)
-            print("Failed to spawn services or gateway or broker")
-            print(e)
             exit(1)
 
+        # If the tests passed, exit with a zero exit code
+        print("\nAll tests passed.")
+        # Always terminate the processes before exiting
+        cleanup_processes(processes_handles)
+        exit(0)
+
+    if args.supervise:
+        # Keep the stack running until an operator stops it, restarting the components that exit
+        supervisor = Supervisor(graph, processes_handles, log_multiplexer, backoff_max=args.max_backoff)
+        control_server = ControlServer(supervisor, os.path.join(state_dir, "supervisor.sock"))
+        control_server.start()
+        print("\nAll services are running and supervised. Control them with python -m orchestrator.supervisor "
+              "status|restart <component>|stop, or press Ctrl-C to shut them down and exit.")
+        try:
+            supervisor.run()
+        finally:
+            control_server.stop()
+
+        cleanup_processes(processes_handles)
+        exit(0)
+
 if __name__ == "__main__":
     try:
         main()
@@ -0,0 +1,4 @@
+"""
+Helpers used by main.py to orchestrate the Garage stack (MongoDB instances,
+the MQTT broker, the services and the API gateway).
+"""
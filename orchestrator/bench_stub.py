@@ -0,0 +1,234 @@
+"""
+Stub of the executables the orchestrator runs, for the orchestrator benchmark.
+
+The benchmark puts wrappers named npm, npx, node and mongod on the PATH that
+run this script with the name of the executable as first argument. The stub
+behaves like the real component as far as the orchestrator can tell: it
+prints the same green flags, listens on the same ports and answers the
+commands the orchestrator sends to mongod, after the delays given in the
+JSON file named by STACK_BENCH_STUB_CONFIG. It can also spawn a tree of
+child processes and ignore SIGTERM, like a component that is slow to stop.
+
+No node or mongod is needed.
+"""
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from orchestrator.mongo_wire import OP_MSG, decode_document, encode_document
+
+# Environment variable naming the JSON config of the stubs
+CONFIG_ENV = "STACK_BENCH_STUB_CONFIG"
+
+DEFAULT_CONFIG = {
+    # Seconds before a component of each kind is ready
+    "delays": {"database": 0.1, "broker": 0.1, "service": 0.2, "gateway": 0.1},
+    # Seconds taken by npm i and by tsc
+    "install_delay": 0.05,
+    "build_delay": 0.1,
+    # Number of child processes every long running component spawns, and the depth of the tree
+    "children": 0,
+    "depth": 1,
+    # If true, the components and their children ignore SIGTERM and have to be killed
+    "ignore_sigterm": False,
+}
+
+
+def load_config() -> dict:
+    config = dict(DEFAULT_CONFIG)
+    path = os.environ.get(CONFIG_ENV)
+    if path:
+        with open(path, "r") as f:
+            config.update(json.load(f))
+    return config
+
+
+def get_kind() -> str:
+    """
+    Get the kind of the component from the package the stub is run in.
+    """
+    package = os.path.basename(os.getcwd())
+    if package == "broker":
+        return "broker"
+    if package == "api_gateway":
+        return "gateway"
+    return "service"
+
+
+def spawn_children(config: dict, depth: int):
+    """
+    Spawn the tree of child processes of a component. They sleep until they are killed.
+    """
+    if depth <= 0:
+        return
+    for _ in range(config["children"]):
+        subprocess.Popen([sys.executable, os.path.realpath(__file__), "child", str(depth - 1)],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start(config: dict, kind: str):
+    """
+    Behave like a component that takes its delay to start.
+    """
+    if config["ignore_sigterm"]:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    spawn_children(config, config["depth"])
+    time.sleep(config["delays"].get(kind, 0))
+
+
+def listen(host: str, port: int) -> socket.socket:
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(64)
+    return server
+
+
+def serve(config: dict, kind: str):
+    """
+    Run a broker, a service or the gateway: print its green flag and run until it is stopped.
+    """
+    start(config, kind)
+
+    if kind == "broker":
+        port = int(os.environ.get("BROKER_PORT", "1884"))
+        server = listen(os.environ.get("BROKER_HOST", "127.0.0.1"), port)
+        print(f"Broker running on port {port}", flush=True)
+        # Connections are accepted and closed, the readiness check only needs the port to be open
+        while True:
+            connection, _ = server.accept()
+            connection.close()
+
+    if kind == "gateway":
+        print(f"Gateway running on port {os.environ.get('GATEWAY_PORT', '3000')}", flush=True)
+    else:
+        print("Subscribed to MQTT topics", flush=True)
+
+    while True:
+        time.sleep(3600)
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("closed")
+        data += chunk
+    return data
+
+
+def _handle_mongo_connection(connection: socket.socket):
+    try:
+        while True:
+            length, request_id, _, _ = struct.unpack("<iiii", _receive_exactly(connection, 16))
+            body = _receive_exactly(connection, length - 16)
+            command, _ = decode_document(body, 5)
+            name = next(iter(command))
+
+            reply = {"ok": 1.0}
+            if name == "listCollections":
+                reply = {"cursor": {"id": 0, "ns": f"{command.get('$db')}.$cmd.listCollections", "firstBatch": []},
+                         "ok": 1.0}
+            sections = b"\x00" + encode_document(reply)
+            connection.sendall(struct.pack("<iiiiI", 16 + 4 + len(sections), 0, request_id, OP_MSG, 0) + sections)
+
+            if name == "shutdown":
+                os._exit(0)
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        connection.close()
+
+
+def mongod(config: dict, args: list):
+    """
+    Run a mongod that answers every command with ok, and exits on shutdown.
+    """
+    port = int(args[args.index("--port") + 1]) if "--port" in args else 27017
+    start(config, "database")
+
+    server = listen("127.0.0.1", port)
+    print(f"Waiting for connections on port {port}", flush=True)
+    while True:
+        connection, _ = server.accept()
+        threading.Thread(target=_handle_mongo_connection, args=(connection,), daemon=True).start()
+
+
+def npm(config: dict, args: list):
+    if args and args[0] in ("i", "install", "ci"):
+        time.sleep(config["install_delay"])
+        os.makedirs("node_modules", exist_ok=True)
+        print("up to date")
+        return
+    if args[:2] in (["run", "dev"], ["run", "start"]):
+        serve(config, get_kind())
+    if args[:2] == ["run", "test"]:
+        print(f"Gateway running on port {os.environ.get('GATEWAY_PORT', '3000')}", flush=True)
+        # The tests run for a while before the gateway exits
+        time.sleep(config["delays"]["gateway"])
+        return
+    if args[:2] == ["run", "newman"]:
+        return
+
+    print(f"Unknown npm command {' '.join(args)}", file=sys.stderr)
+    sys.exit(1)
+
+
+def npx(config: dict, args: list):
+    if args and args[0] == "tsc":
+        time.sleep(config["build_delay"])
+        os.makedirs("dist", exist_ok=True)
+        with open(os.path.join("dist", "app.js"), "w") as f:
+            f.write("// built by the benchmark stub\n")
+        return
+    if args and args[0] == "nodemon":
+        serve(config, get_kind())
+    if args and args[0] == "cross-env":
+        print(f"Gateway running on port {os.environ.get('GATEWAY_PORT', '3000')}", flush=True)
+        # The tests run for a while before the gateway exits
+        time.sleep(config["delays"]["gateway"])
+        return
+    if args and args[0] == "newman":
+        return
+
+    print(f"Unknown npx command {' '.join(args)}", file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    executable, args = sys.argv[1], sys.argv[2:]
+    config = load_config()
+
+    if executable == "child":
+        if config["ignore_sigterm"]:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        spawn_children(config, int(args[0]))
+        while True:
+            time.sleep(3600)
+    elif executable == "mongod":
+        mongod(config, args)
+    elif executable == "npm":
+        npm(config, args)
+    elif executable == "npx":
+        npx(config, args)
+    elif executable == "node":
+        if args == ["--version"]:
+            print("v20.0.0-stub")
+            return
+        serve(config, get_kind())
+    else:
+        print(f"Unknown executable {executable}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
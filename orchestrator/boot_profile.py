@@ -0,0 +1,484 @@
+"""
+Critical path of the boot of the stack, with a history of the boots to compare them.
+
+The component graph only tells when every component was started and when it
+gave its green flag. When a boot is slow, the time in between can be npm,
+eslint, tsc, the connection to mongod or to the broker, or the subscriptions.
+The profiler splits it into phases:
+
+- the tasks a component waits on, folded into its row: the npm install,
+  the tsc build of the prod profile, the restore or the drop of its database,
+- the phases of its own startup, ended by markers in its output: the first
+  eslint run of npm run dev (lint), the second one and tsc until the watchers
+  start (compile), the connection to mongod (database) and to the broker
+  (mqtt), and the rest until the green flag (ready). The green flag of the
+  broker and of the gateway is logged once they listen on their port.
+
+The critical path is the chain of components, from the last one to become
+ready, through the dependency that became ready last, down to a component
+without dependencies. Nothing off that chain can make the boot faster.
+
+main.py prints the Gantt chart of every boot and appends it to
+.orchestrator/boot_history.jsonl. The last runs can be listed, shown and
+compared phase by phase, to find the phase that regressed.
+
+Usage:
+    python -m orchestrator.boot_profile list
+    python -m orchestrator.boot_profile show -1
+    python -m orchestrator.boot_profile compare -2 -1
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+from orchestrator.graph import ComponentGraph
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_HISTORY_PATH = os.path.join(REPO_ROOT, ".orchestrator", "boot_history.jsonl")
+
+# Number of boots kept in the history
+HISTORY_LIMIT = 500
+
+# Markers in the output of the components that end a phase of their startup, by kind of component.
+# In the dev profile, npm run dev runs eslint, then npm run build (eslint again and tsc), then concurrently prefixes
+# the output of tsc --watch and nodemon with [0] and [1]
+_CONCURRENTLY_PREFIX = rb"^(?:\[\d+\] )?"
+NODE_MARKERS = [
+    ("lint", re.compile(rb"^> \S+ build\s*$")),
+    ("compile", re.compile(rb"^\[\d+\] ")),
+    ("database", re.compile(_CONCURRENTLY_PREFIX + rb"connected to mongodb")),
+    ("mqtt", re.compile(_CONCURRENTLY_PREFIX + rb"(?:Connected to MQTT broker|MQTT connected)")),
+]
+PHASE_MARKERS = {
+    "broker": NODE_MARKERS,
+    "service": NODE_MARKERS,
+    "gateway": NODE_MARKERS,
+}
+
+# Character of every phase in the Gantt chart
+PHASE_SYMBOLS = {
+    "install": "i",
+    "build": "b",
+    "restoredb": "r",
+    "dropdb": "x",
+    "lint": "l",
+    "compile": "c",
+    "database": "d",
+    "mqtt": "m",
+    "ready": "#",
+}
+WAITING_SYMBOL = "."
+
+
+class BootProfiler:
+    """
+    Records the time at which the markers of every component show up in its output during the boot.
+
+    Parameters
+    ----------
+    multiplexer : LogMultiplexer
+        The multiplexer reading the output of the components
+    markers : dict
+        Markers by kind of component, see PHASE_MARKERS
+    """
+
+    def __init__(self, multiplexer, markers: dict = None):
+        self.multiplexer = multiplexer
+        self.markers = PHASE_MARKERS if markers is None else markers
+        # time.monotonic() value the timings of the boot are measured from, given to start_graph
+        self.boot_start = time.monotonic()
+        self.marks = collections.defaultdict(dict)
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def watch(self, graph: ComponentGraph):
+        """
+        Start watching the output of the components of a graph, before they are started.
+        """
+        for component in graph.components.values():
+            markers = self.markers.get(component.kind)
+            if not markers:
+                continue
+
+            def feed(line: bytes, name=component.name, markers=markers):
+                self._feed(name, markers, line)
+
+            self.multiplexer.add_listener(component.name, feed)
+            self._listeners.append((component.name, feed))
+
+    def _feed(self, name: str, markers: list, line: bytes):
+        # Called from the reader thread of the multiplexer. Only the first occurrence of a marker counts
+        now = time.monotonic() - self.boot_start
+        with self._lock:
+            marks = self.marks[name]
+            for phase, pattern in markers:
+                if phase not in marks and pattern.search(line):
+                    marks[phase] = now
+
+    def stop(self):
+        """
+        Stop watching the output of the components, once the boot is over.
+        """
+        for name, feed in self._listeners:
+            self.multiplexer.remove_listener(name, feed)
+        self._listeners = []
+
+    def profile(self, graph: ComponentGraph, timings: dict, **context) -> dict:
+        """
+        Build the record of the boot.
+
+        Parameters
+        ----------
+        graph : ComponentGraph
+            The graph that was booted
+        timings : dict
+            The timings returned by start_graph, measured from boot_start
+        context
+            Options of the boot saved with it, e.g. the profile
+
+        Returns
+        -------
+        dict
+            The record of the boot, see build_boot_record
+        """
+        with self._lock:
+            marks = {name: dict(component_marks) for name, component_marks in self.marks.items()}
+        return build_boot_record(graph, timings, marks, **context)
+
+
+def _task_phases(graph: ComponentGraph, timings: dict, name: str, seen: set) -> list:
+    """
+    Get the phases of the tasks a component waits on, directly or through other tasks.
+    """
+    phases = []
+    for dependency in graph[name].depends_on:
+        if graph[dependency].kind != "task" or dependency in seen or dependency not in timings:
+            continue
+        seen.add(dependency)
+        phases.extend(_task_phases(graph, timings, dependency, seen))
+        # The tasks are named <package>_<action>
+        started_at, ready_at = timings[dependency]
+        phases.append([dependency.rsplit("_", 1)[-1], started_at, ready_at])
+    return phases
+
+
+def _startup_phases(started_at: float, ready_at: float, marks: dict) -> list:
+    """
+    Split the startup of a component at its markers. Every phase is named after the marker that ends it.
+    """
+    phases = []
+    previous = started_at
+    for marked_at, phase in sorted((marked_at, phase) for phase, marked_at in marks.items()
+                                   if started_at <= marked_at <= ready_at):
+        phases.append([phase, previous, marked_at])
+        previous = marked_at
+    phases.append(["ready", previous, ready_at])
+    return phases
+
+
+def find_critical_path(graph: ComponentGraph, timings: dict) -> list:
+    """
+    Get the chain of components that set the boot time: the last component to become ready,
+    the dependency of it that became ready last, and so on.
+
+    Returns
+    -------
+    list
+        Names of the components of the chain, the first one to start first
+    """
+    if not timings:
+        return []
+
+    path = [max(timings, key=lambda name: timings[name][1])]
+    while True:
+        dependencies = [dependency for dependency in graph[path[-1]].depends_on if dependency in timings]
+        if not dependencies:
+            break
+        path.append(max(dependencies, key=lambda name: timings[name][1]))
+
+    return path[::-1]
+
+
+def build_boot_record(graph: ComponentGraph, timings: dict, marks: dict, **context) -> dict:
+    """
+    Build the record of a boot: the phases of every component and the critical path.
+
+    Parameters
+    ----------
+    graph : ComponentGraph
+        The graph that was booted
+    timings : dict
+        Maps each component name to (started at, ready at) in seconds since the start of the boot
+    marks : dict
+        Maps each component name to the time of every marker found in its output
+    context
+        Options of the boot saved with it
+
+    Returns
+    -------
+    dict
+        The time of the boot, its duration, its context, the phases of every component that is not a task
+        as lists of [phase, start, end] and the critical path as lists of [component, phase, start, end]
+    """
+    components = {}
+    for name, (started_at, ready_at) in timings.items():
+        component = graph[name]
+        if component.kind == "task":
+            continue
+
+        phases = _task_phases(graph, timings, name, set())
+        phases.extend(_startup_phases(started_at, ready_at, marks.get(name, {})))
+        components[name] = {
+            "kind": component.kind,
+            "started": round(started_at, 4),
+            "ready": round(ready_at, 4),
+            "phases": [[phase, round(start, 4), round(end, 4)] for phase, start, end in sorted(phases, key=lambda p: p[1])],
+        }
+
+    critical_path = []
+    previous_ready = 0.0
+    for name in find_critical_path(graph, timings):
+        started_at, ready_at = timings[name]
+        # Time between the dependency becoming ready and the component being started by the scheduler
+        if started_at - previous_ready >= 0.005:
+            critical_path.append([name, "waiting", round(previous_ready, 4), round(started_at, 4)])
+
+        if graph[name].kind == "task":
+            phases = [[name.rsplit("_", 1)[-1], started_at, ready_at]]
+        else:
+            phases = _startup_phases(started_at, ready_at, marks.get(name, {}))
+        critical_path.extend([name, phase, round(start, 4), round(end, 4)] for phase, start, end in phases)
+        previous_ready = ready_at
+
+    return {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "boot_seconds": round(max((ready_at for _, ready_at in timings.values()), default=0.0), 4),
+        "context": context,
+        "components": components,
+        "critical_path": critical_path,
+    }
+
+
+def format_gantt(record: dict, width: int = 60) -> str:
+    """
+    Format a boot as a Gantt chart of the phases of every component, followed by the critical path.
+    The components on the critical path are marked with a *.
+    """
+    total = max(record["boot_seconds"], 1e-9)
+    on_path = {name for name, _, _, _ in record["critical_path"]}
+    name_width = max([len(name) for name in record["components"]] + [9])
+
+    def column(seconds: float) -> int:
+        return min(width, int(seconds / total * width))
+
+    rows = [f"  {'component':<{name_width}} |{'0s':<{width // 2}}{f'{total:.1f}s':>{width - width // 2}}|   ready"]
+    for name, component in sorted(record["components"].items(), key=lambda item: (item[1]["ready"], item[0])):
+        bar = [" "] * width
+        phases = component["phases"]
+        if phases:
+            # Whatever is not covered by a phase between the first phase and the green flag is waiting on dependencies
+            for index in range(column(phases[0][1]), column(component["ready"])):
+                bar[index] = WAITING_SYMBOL
+        for phase, start, end in phases:
+            start_column = min(column(start), width - 1)
+            for index in range(start_column, max(column(end), start_column + 1)):
+                bar[index] = PHASE_SYMBOLS.get(phase, "?")
+
+        marker = "*" if name in on_path else " "
+        rows.append(f"{marker} {name:<{name_width}} |{''.join(bar)}| {component['ready']:>6.2f}s")
+
+    legend = ", ".join(f"{symbol} {phase}" for phase, symbol in PHASE_SYMBOLS.items())
+    rows.append(f"  {legend}, {WAITING_SYMBOL} waiting")
+
+    rows.append(f"\nCritical path ({record['boot_seconds']:.2f}s):")
+    for name, phase, start, end in record["critical_path"]:
+        duration = end - start
+        rows.append(f"  {name:<{name_width}} {phase:<10} {duration:>7.2f}s {100 * duration / total:>4.0f}%")
+
+    return "\n".join(rows)
+
+
+def append_history(path: str, record: dict, limit: int = HISTORY_LIMIT):
+    """
+    Append a boot to the history file, dropping the oldest boots beyond limit.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    with open(path) as f:
+        lines = f.readlines()
+    if len(lines) > limit:
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w") as f:
+            f.writelines(lines[-limit:])
+        os.replace(temporary_path, path)
+
+
+def load_history(path: str) -> list:
+    """
+    Load the boots of the history file, the oldest first. Lines that can not be parsed are skipped.
+    """
+    if not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def phase_durations(record: dict) -> dict:
+    """
+    Get the seconds spent in every phase of every component of a boot.
+
+    Returns
+    -------
+    dict
+        Maps (component, phase) to seconds, and ("boot", "total") to the boot time
+    """
+    durations = collections.defaultdict(float)
+    for name, component in record["components"].items():
+        for phase, start, end in component["phases"]:
+            durations[(name, phase)] += end - start
+    durations[("boot", "total")] = record["boot_seconds"]
+    return dict(durations)
+
+
+def compare_boots(old: dict, new: dict, min_seconds: float = 0.5, min_fraction: float = 0.2) -> list:
+    """
+    Compare the phases of two boots.
+
+    Parameters
+    ----------
+    old : dict
+        Record of the reference boot
+    new : dict
+        Record of the boot to compare to it
+    min_seconds : float
+        A phase regressed if it got slower by at least this many seconds
+    min_fraction : float
+        and by at least this fraction of its old duration
+
+    Returns
+    -------
+    list
+        List of (component, phase, old seconds, new seconds, regressed) of the phases of either boot,
+        the ones that got slower the most first. A phase missing from a boot has None as duration
+    """
+    old_durations, new_durations = phase_durations(old), phase_durations(new)
+    rows = []
+    for key in set(old_durations) | set(new_durations):
+        old_seconds, new_seconds = old_durations.get(key), new_durations.get(key)
+        delta = (new_seconds or 0.0) - (old_seconds or 0.0)
+        regressed = delta >= min_seconds and (not old_seconds or delta / old_seconds >= min_fraction)
+        rows.append((*key, old_seconds, new_seconds, regressed))
+
+    return sorted(rows, key=lambda row: -((row[3] or 0.0) - (row[2] or 0.0)))
+
+
+def _format_seconds(seconds: float) -> str:
+    return f"{'-':>8}" if seconds is None else f"{seconds:>7.2f}s"
+
+
+def format_comparison(old: dict, new: dict, rows: list, top: int = 15) -> str:
+    """
+    Format the comparison of two boots: the phases that changed the most and the ones that regressed.
+    """
+    lines = [f"{old['time']} ({old['boot_seconds']:.2f}s) -> {new['time']} ({new['boot_seconds']:.2f}s)"]
+    for record in (old, new):
+        context = ", ".join(f"{key}={value}" for key, value in record.get("context", {}).items())
+        if context:
+            lines.append(f"  {record['time']}: {context}")
+
+    name_width = max([len(row[0]) for row in rows] + [9])
+    lines.append(f"\n  {'component':<{name_width}} {'phase':<10} {'old':>8} {'new':>8} {'delta':>8}")
+    changed = [row for row in rows if abs((row[3] or 0.0) - (row[2] or 0.0)) >= 0.01]
+    for component, phase, old_seconds, new_seconds, regressed in changed[:top]:
+        delta = (new_seconds or 0.0) - (old_seconds or 0.0)
+        lines.append(f"{'!' if regressed else ' '} {component:<{name_width}} {phase:<10} {_format_seconds(old_seconds)} "
+                     f"{_format_seconds(new_seconds)} {delta:>+7.2f}s")
+    if not changed:
+        lines.append("  No phase changed by 10ms or more")
+
+    old_path = list(dict.fromkeys(name for name, _, _, _ in old["critical_path"]))
+    new_path = list(dict.fromkeys(name for name, _, _, _ in new["critical_path"]))
+    if old_path != new_path:
+        lines.append(f"\nThe critical path changed:\n  {' > '.join(old_path)}\n  {' > '.join(new_path)}")
+
+    regressions = [row for row in rows if row[4] and row[0] != "boot"]
+    if regressions:
+        lines.append("\nRegressed:")
+        for component, phase, old_seconds, new_seconds, _ in regressions:
+            lines.append(f"  {component} {phase}: {_format_seconds(old_seconds).strip()} -> {_format_seconds(new_seconds).strip()}")
+    else:
+        lines.append("\nNo phase regressed")
+
+    return "\n".join(lines)
+
+
+def _select(records: list, index: int) -> dict:
+    try:
+        return records[index]
+    except IndexError:
+        raise SystemExit(f"No boot {index} in the history, it has {len(records)} boots")
+
+
+def main():
+    """
+    List, show and compare the boots of the history.
+    """
+    parser = argparse.ArgumentParser(description="Show and compare the critical path of the boots of the stack")
+    parser.add_argument("--history", default=DEFAULT_HISTORY_PATH, help="History file written by main.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List the boots of the history")
+    list_parser.add_argument("--last", type=int, default=20, help="Number of boots to list")
+
+    show_parser = subparsers.add_parser("show", help="Show the Gantt chart and the critical path of a boot")
+    show_parser.add_argument("run", type=int, nargs="?", default=-1, help="Index of the boot in the history, -1 is the last one")
+    show_parser.add_argument("--width", type=int, default=60, help="Width of the Gantt chart")
+
+    compare_parser = subparsers.add_parser("compare", help="Show which phases got slower between two boots")
+    compare_parser.add_argument("old", type=int, nargs="?", default=-2, help="Index of the reference boot")
+    compare_parser.add_argument("new", type=int, nargs="?", default=-1, help="Index of the boot to compare to it")
+    compare_parser.add_argument("--min-seconds", type=float, default=0.5, help="Slowdown from which a phase regressed")
+    compare_parser.add_argument("--min-percent", type=float, default=20, help="Slowdown in percent from which a phase regressed")
+    compare_parser.add_argument("--top", type=int, default=15, help="Number of changed phases to show")
+    args = parser.parse_args()
+
+    records = load_history(args.history)
+    if not records:
+        raise SystemExit(f"No boot in {args.history}, boot the stack with main.py first")
+
+    if args.command == "list":
+        first = max(0, len(records) - args.last)
+        for index, record in enumerate(records[first:], start=first):
+            context = ", ".join(f"{key}={value}" for key, value in record.get("context", {}).items())
+            last = record["critical_path"][-1][0] if record["critical_path"] else "-"
+            print(f"{index - len(records):>4} {record['time']} {record['boot_seconds']:>7.2f}s  last ready: {last:<20} {context}")
+
+    elif args.command == "show":
+        record = _select(records, args.run)
+        print(f"Boot of {record['time']}")
+        print(format_gantt(record, args.width))
+
+    else:
+        old, new = _select(records, args.old), _select(records, args.new)
+        rows = compare_boots(old, new, args.min_seconds, args.min_percent / 100)
+        print(format_comparison(old, new, rows, args.top))
+        # Lets a CI job fail on a slower boot
+        exit(1 if any(regressed for component, _, _, _, regressed in rows if component != "boot") else 0)
+
+
+if __name__ == "__main__":
+    main()
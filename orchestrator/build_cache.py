@@ -0,0 +1,139 @@
+"""
+Build cache for the production launch profile.
+
+The fingerprint of a package is the hash of every file in its src/ tree, its
+tsconfig.json and the fingerprint of its installed dependencies. A package is
+only compiled again when its fingerprint changed since its last successful
+build and its dist/app.js is still there. The build runs `tsc` directly,
+without the lint step and without a watcher.
+"""
+import hashlib
+import os
+import subprocess
+import threading
+
+from orchestrator.install_cache import package_fingerprint
+from orchestrator.state import load_state, update_state
+
+# Name of the file in the state dir where the fingerprints of the successful builds are recorded
+BUILD_CACHE_FILE = "build_cache.json"
+# Entry point of every package once it is built
+BUILD_ENTRY_POINT = os.path.join("dist", "app.js")
+
+
+def source_fingerprint(package_path: str) -> str:
+    """
+    Hash the src/ tree and the tsconfig.json of a package together with its dependencies.
+
+    Parameters
+    ----------
+    package_path : str
+        Path to the package directory
+
+    Returns
+    -------
+    str
+        The hex digest of the fingerprint
+    """
+    digest = hashlib.sha256()
+    digest.update(package_fingerprint(package_path).encode())
+
+    paths = [os.path.join(package_path, "tsconfig.json")]
+    for dir_path, dir_names, file_names in os.walk(os.path.join(package_path, "src")):
+        # Walk the tree in a stable order so that the fingerprint does not depend on the filesystem
+        dir_names.sort()
+        paths.extend(os.path.join(dir_path, file_name) for file_name in sorted(file_names))
+
+    for path in paths:
+        # The path is part of the fingerprint so that renaming a file triggers a build
+        digest.update(b"\0" + os.path.relpath(path, package_path).encode() + b"\0")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def needs_build(package_path: str, state_dir: str) -> bool:
+    """
+    Check if a package has to be compiled.
+
+    Parameters
+    ----------
+    package_path : str
+        Path to the package directory
+    state_dir : str
+        Directory where the orchestrator keeps its state
+
+    Returns
+    -------
+    bool
+        True if dist/app.js is missing or if the sources changed since the last successful build
+    """
+    if not os.path.exists(os.path.join(package_path, BUILD_ENTRY_POINT)):
+        return True
+
+    cache = load_state(state_dir, BUILD_CACHE_FILE)
+    return cache.get(os.path.realpath(package_path)) != source_fingerprint(package_path)
+
+
+def build_package(package_path: str, state_dir: str, force: bool = False, semaphore: threading.Semaphore = None) -> bool:
+    """
+    Compile a package with tsc unless its sources did not change since its last successful build.
+
+    Parameters
+    ----------
+    package_path : str
+        Path to the package directory
+    state_dir : str
+        Directory where the orchestrator keeps its state
+    force : bool
+        If true, build even if the fingerprint did not change
+    semaphore : threading.Semaphore
+        If given, it bounds the number of builds running at the same time
+
+    Returns
+    -------
+    bool
+        True if the package was built, False if the build was skipped
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If tsc fails
+    """
+    package_name = os.path.basename(package_path)
+
+    if not force and not needs_build(package_path, state_dir):
+        print(f"Build of {package_name} is up to date, skipping tsc")
+        return False
+
+    # Fingerprint before the build, so that a change made while tsc runs triggers the next build
+    fingerprint = source_fingerprint(package_path)
+
+    if semaphore is not None:
+        semaphore.acquire()
+    try:
+        print(f"Building {package_name}")
+        subprocess.run(
+            "npx tsc",
+            cwd=package_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+            shell=True
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"Failed to build {package_name}")
+        # tsc reports the errors on stdout
+        print(f"stdout:\n{e.stdout.decode()}")
+        print(f"stderr:\n{e.stderr.decode()}")
+        raise e
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+    update_state(state_dir, BUILD_CACHE_FILE, os.path.realpath(package_path), fingerprint)
+    print(f"Built {package_name}")
+
+    return True
@@ -0,0 +1,522 @@
+"""
+Deterministic bulk dataset of users, ads, chats and reports for the service databases.
+
+The test databases start empty, so the services are never run against
+millions of documents. This generator fills the databases of the running
+stack with documents that follow the mongoose schemas of the services
+(services/*/src/models):
+
+- users (user_service): unique emails, a few blocked users referencing other users,
+- ads (ad_service): unique plate numbers, owned by a user through userEmail,
+- chats (chat_service): between the creator of an ad and another user, linked to the ad by its id,
+- reports (admin_service): from a user about another one, unique by reporter and time.
+
+Every document is computed from the seed, its collection and its index
+only, so the dataset is the same on every run, any range of documents can
+be generated on its own and the references (the email of the owner of an
+ad, the id of the ad of a chat) are computed without keeping the referenced
+documents. The documents are generated and inserted in batches by a pool of
+worker processes, each with its own connection to every mongod, so the
+dataset scales to tens of millions of documents in bounded memory.
+
+The unique indexes of the schemas are created after the load (they already
+exist if the services ran). With --snapshot, the mongod instances are shut
+down after the load and their dbpaths saved as snapshots, which main.py
+restores with --test --reset snapshot.
+
+Every user has the same bcrypt hash as password, the one of "U*U".
+
+Usage:
+    python -m orchestrator.dataset --users 100000
+    python -m orchestrator.dataset --env-file .env.test --users 5000000 --workers 8 --drop --snapshot
+"""
+import argparse
+import datetime
+import os
+import random
+import struct
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import dotenv
+
+from orchestrator import mongo_wire
+from orchestrator.db_reset import DEFAULT_MONGO_BASE_PATH, is_dbpath_in_use, save_snapshot
+from orchestrator.mongo_memory import get_tmpfs_base_path
+from orchestrator.mongo_wire import MongoConnection, ObjectId
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SERVICES_ROOT = os.path.join(REPO_ROOT, "services")
+
+# Collection of every model (mongoose pluralizes the model names), the service owning it and the tag of its ObjectIds
+COLLECTIONS = {
+    "users": ("user_service", 1),
+    "ads": ("ad_service", 2),
+    "chats": ("chat_service", 3),
+    "reports": ("admin_service", 4),
+}
+
+# Unique indexes of the schemas, with the names mongoose gives them
+INDEXES = {
+    "users": [{"key": {"email": 1}, "name": "email_1", "unique": True, "background": True}],
+    "ads": [{"key": {"plateNumber": 1}, "name": "plateNumber_1", "unique": True, "background": True}],
+    "reports": [{"key": {"reporter": 1, "timeStamp": 1}, "name": "reporter_1_timeStamp_1", "unique": True, "background": True}],
+}
+
+# bcrypt hash of "U*U" from the reference test vectors of bcrypt. The cost of 5 keeps the logins of load tests cheap
+PASSWORD_HASH = "$2a$05$CCCCCCCCCCCCCCCCCCCCC.E5YPO9kmyuRGyh0XouQYb4YMJKvyOeW"
+
+FIRST_NAMES = ["Alice", "Oscar", "Maja", "Liam", "Elsa", "Noah", "Wilma", "Hugo", "Alma", "William", "Ella", "Lucas",
+               "Astrid", "Adam", "Freja", "Elias", "Saga", "Leo", "Olivia", "Viktor", "Ebba", "Isak", "Selma", "Axel"]
+LAST_NAMES = ["Andersson", "Johansson", "Karlsson", "Nilsson", "Eriksson", "Larsson", "Olsson", "Persson", "Svensson",
+              "Gustafsson", "Pettersson", "Jonsson", "Jansson", "Hansson", "Bengtsson", "Lindberg", "Berg", "Lind"]
+EMAIL_DOMAINS = ["gmail.com", "outlook.com", "hotmail.com", "yahoo.com", "student.chalmers.se", "telia.com"]
+MODELS = ["Volvo V70", "Volvo XC60", "Volvo V90", "Saab 9-3", "Saab 9-5", "Volkswagen Golf", "Volkswagen Passat",
+          "Toyota Corolla", "Toyota RAV4", "Tesla Model 3", "Tesla Model Y", "BMW 320d", "Audi A4", "Kia Niro",
+          "Skoda Octavia", "Ford Focus", "Mercedes-Benz C 200", "Peugeot 308", "Renault Clio", "Nissan Leaf"]
+CITIES = [("Sweden", "Gothenburg", 41), ("Sweden", "Stockholm", 11), ("Sweden", "Malmö", 21), ("Sweden", "Uppsala", 75),
+          ("Sweden", "Linköping", 58), ("Norway", "Oslo", 1), ("Denmark", "Copenhagen", 10)]
+STREETS = ["Storgatan", "Kungsgatan", "Drottninggatan", "Vasagatan", "Skolgatan", "Kyrkogatan", "Parkvägen", "Björkvägen"]
+MESSAGES = ["Hi! Is the {model} still available?", "Yes, it is.", "Would you take {offer} kr?", "The lowest I can go is {price} kr.",
+            "Has it been in any accidents?", "No, never. Full service history.", "Can I come and see it this weekend?",
+            "Sure, Saturday works.", "Is the price negotiable?", "Deal, see you then!"]
+REPORT_REASONS = ["Spam", "Scam attempt", "Offensive language", "Fake ad", "Did not show up", "Wrong price", "Harassment"]
+
+# Plate numbers are three letters and four digits. The index of an ad is spread over them by a multiplication
+# with a number prime to their count, which is a bijection, so the plates are unique without looking sequential
+PLATE_COUNT = 26 ** 3 * 10 ** 4
+PLATE_MULTIPLIER = 1000003
+
+# Start of the time range of the dataset
+EPOCH = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+SPAN_SECONDS = 3 * 365 * 24 * 3600
+
+# State of a worker process: the dataset, the targets and the connections to the mongod instances, opened on first use
+_dataset = None
+_targets = None
+_connections = {}
+
+
+def _mix(value: int) -> int:
+    """
+    splitmix64 finalizer, spreads the bits of a 64 bit integer.
+    """
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+class Dataset:
+    """
+    The documents of a dataset, computed from the seed and their index.
+
+    Parameters
+    ----------
+    seed : int
+        Seed of the dataset
+    users : int
+        Number of users, at least 2
+    ads : int
+        Number of ads
+    chats : int
+        Number of chats, 0 if there are no ads
+    reports : int
+        Number of reports
+    messages_per_chat : int
+        Average number of messages per chat
+    blocked_ratio : float
+        Fraction of the users that blocked other users
+    """
+
+    def __init__(self, seed: int, users: int, ads: int, chats: int, reports: int, messages_per_chat: int = 6,
+                 blocked_ratio: float = 0.05):
+        if users < 2:
+            raise ValueError("A dataset needs at least 2 users")
+        if ads > PLATE_COUNT:
+            raise ValueError(f"A dataset can not have more than {PLATE_COUNT} ads, the number of plate numbers")
+        if chats and not ads:
+            raise ValueError("Chats need ads to be linked to")
+        if not 1 <= messages_per_chat <= 128:
+            raise ValueError("The average number of messages per chat must be between 1 and 128")
+
+        self.seed = seed
+        self.counts = {"users": users, "ads": ads, "chats": chats, "reports": reports}
+        self.messages_per_chat = messages_per_chat
+        self.blocked_ratio = blocked_ratio
+
+    def _random(self, salt: int, index: int) -> random.Random:
+        return random.Random(_mix(_mix(self.seed) ^ (salt << 48) ^ index))
+
+    def _time(self, salt: int, index: int) -> datetime.datetime:
+        return EPOCH + datetime.timedelta(milliseconds=_mix(self.seed ^ (salt << 48) ^ index) % (SPAN_SECONDS * 1000))
+
+    @staticmethod
+    def _object_id(collection: str, index: int, created_at: datetime.datetime) -> ObjectId:
+        # The tag of the collection and the index take the place of the random part and the counter
+        return ObjectId(struct.pack(">IB", int(created_at.timestamp()), COLLECTIONS[collection][1]) + index.to_bytes(7, "big"))
+
+    def user_id(self, index: int) -> ObjectId:
+        return self._object_id("users", index, self._time(1, index))
+
+    def user_email(self, index: int) -> str:
+        rng = self._random(2, index)
+        first, last, domain = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice(EMAIL_DOMAINS)
+        # The index makes the email unique
+        return f"{first.lower()}.{last.lower()}{index}@{domain}"
+
+    def ad_owner(self, index: int) -> int:
+        return _mix(self.seed ^ (3 << 48) ^ index) % self.counts["users"]
+
+    def ad_created_at(self, index: int) -> datetime.datetime:
+        return self._time(4, index)
+
+    def ad_id(self, index: int) -> ObjectId:
+        return self._object_id("ads", index, self.ad_created_at(index))
+
+    def plate_number(self, index: int) -> str:
+        plate = index * PLATE_MULTIPLIER % PLATE_COUNT
+        letters, digits = divmod(plate, 10 ** 4)
+        return "".join(chr(ord("A") + letters // 26 ** power % 26) for power in (2, 1, 0)) + f" {digits:04d}"
+
+    def _other_user(self, rng: random.Random, user: int) -> int:
+        other = rng.randrange(self.counts["users"] - 1)
+        return other + 1 if other >= user else other
+
+    def user(self, index: int) -> dict:
+        rng = self._random(5, index)
+        email = self.user_email(index)
+        name_rng = self._random(2, index)
+        first_name, last_name = name_rng.choice(FIRST_NAMES), name_rng.choice(LAST_NAMES)
+
+        blocked = []
+        if rng.random() < self.blocked_ratio:
+            blocked = sorted({self._other_user(rng, index) for _ in range(rng.randint(1, 5))})
+
+        return {
+            "_id": self.user_id(index),
+            "fullName": {"firstName": first_name, "lastName": last_name},
+            "email": email,
+            "emailVerification": rng.random() < 0.9,
+            "dateOfBirth": datetime.datetime(rng.randint(1950, 2005), rng.randint(1, 12), rng.randint(1, 28),
+                                             tzinfo=datetime.timezone.utc),
+            "isAdmin": index == 0 or rng.random() < 0.0001,
+            "profilePicture": f"https://images.thegarage.test/users/{self.user_id(index)}.jpg" if rng.random() < 0.6 else "",
+            "blockedUsers": [self.user_id(user) for user in blocked],
+            "password": PASSWORD_HASH,
+            "__v": 0,
+        }
+
+    def ad(self, index: int) -> dict:
+        rng = self._random(6, index)
+        country, city, zip_prefix = rng.choice(CITIES)
+        production_year = rng.randint(1995, 2024)
+        return {
+            "_id": self.ad_id(index),
+            "productionYear": production_year,
+            "price": round(rng.lognormvariate(11.8, 0.6) / 1000) * 1000,
+            "plateNumber": self.plate_number(index),
+            "picture": f"https://images.thegarage.test/ads/{self.ad_id(index)}.jpg",
+            "model": rng.choice(MODELS),
+            "location": {"country": country, "city": city, "street": f"{rng.choice(STREETS)} {rng.randint(1, 120)}",
+                         "zipCode": zip_prefix * 1000 + rng.randint(0, 999)},
+            "userEmail": self.user_email(self.ad_owner(index)),
+            "adCreationDate": self.ad_created_at(index),
+            "__v": 0,
+        }
+
+    def chat(self, index: int) -> dict:
+        rng = self._random(7, index)
+        ad_index = rng.randrange(self.counts["ads"])
+        ad = self.ad(ad_index)
+        owner = self.ad_owner(ad_index)
+        creator_email, interester_email = ad["userEmail"], self.user_email(self._other_user(rng, owner))
+
+        messages = []
+        sent_at = ad["adCreationDate"]
+        for number in range(rng.randint(1, 2 * self.messages_per_chat - 1)):
+            sent_at += datetime.timedelta(seconds=rng.randint(30, 36 * 3600))
+            text = MESSAGES[number % len(MESSAGES)].format(model=ad["model"], offer=int(ad["price"] * 0.9),
+                                                            price=int(ad["price"] * 0.95))
+            messages.append({
+                "sender": interester_email if number % 2 == 0 else creator_email,
+                "message": text,
+                "timeStamps": sent_at,
+                "_id": ObjectId(struct.pack(">IB", int(sent_at.timestamp()), 5) + (index * 256 + number).to_bytes(7, "big")),
+            })
+
+        return {
+            "_id": self._object_id("chats", index, ad["adCreationDate"]),
+            "adCreator": creator_email,
+            "interester": interester_email,
+            "linkedAd": str(ad["_id"]),
+            "messages": messages,
+            "__v": 0,
+        }
+
+    def report(self, index: int) -> dict:
+        rng = self._random(8, index)
+        reporter = rng.randrange(self.counts["users"])
+        # The index is in the time, so that the reporter and the time are unique together
+        reported_at = EPOCH + datetime.timedelta(seconds=index, milliseconds=rng.randrange(1000))
+        return {
+            "_id": self._object_id("reports", index, reported_at),
+            "reporter": self.user_email(reporter),
+            "reported": self.user_email(self._other_user(rng, reporter)),
+            "timeStamp": reported_at,
+            "discription": rng.sample(REPORT_REASONS, rng.randint(1, 3)),
+            "__v": 0,
+        }
+
+    def documents(self, collection: str, start: int, end: int) -> list:
+        """
+        Get the documents of a collection from index start to end, excluded.
+        """
+        make = {"users": self.user, "ads": self.ad, "chats": self.chat, "reports": self.report}[collection]
+        return [make(index) for index in range(start, end)]
+
+
+def plan_dataset(seed: int, users: int, ads_per_user: float, chats_per_ad: float, reports_per_user: float,
+                 messages_per_chat: int, blocked_ratio: float) -> Dataset:
+    """
+    Get the dataset of a number of users, with the other collections scaled on it.
+    """
+    ads = round(users * ads_per_user)
+    return Dataset(seed, users, ads, round(ads * chats_per_ad), round(users * reports_per_user), messages_per_chat,
+                   blocked_ratio)
+
+
+def get_targets(env_file_name: str, mongo_port: int = None, services_root: str = SERVICES_ROOT) -> dict:
+    """
+    Get the mongod instance and the database of every collection from the DATABASE_URI of its service.
+
+    Parameters
+    ----------
+    env_file_name : str
+        Name of the .env file of the services, .env or .env.test
+    mongo_port : int
+        If given, every database is on the single mongod listening on this port, as with --mongo-mode shared
+    services_root : str
+        Root directory of the services
+
+    Returns
+    -------
+    dict
+        Dictionary of collection name to (host, port, database name)
+
+    Raises
+    ------
+    ValueError
+        If the DATABASE_URI of a service is missing or has no port or database
+    """
+    targets = {}
+    for collection, (service, _) in COLLECTIONS.items():
+        env_path = os.path.join(services_root, service, env_file_name)
+        database_uri = dotenv.dotenv_values(env_path).get("DATABASE_URI")
+        if not database_uri:
+            raise ValueError(f"DATABASE_URI is not defined in {env_path}")
+
+        uri = urllib.parse.urlsplit(database_uri)
+        database_name = uri.path.lstrip("/")
+        if uri.port is None or not database_name:
+            raise ValueError(f"Invalid DATABASE_URI format in {env_path}")
+        targets[collection] = ("127.0.0.1", mongo_port or uri.port, database_name)
+
+    return targets
+
+
+def _init_worker(dataset: Dataset, targets: dict):
+    global _dataset, _targets
+    _dataset, _targets = dataset, targets
+
+
+def _insert_batch(collection: str, start: int, end: int) -> int:
+    """
+    Generate and insert a batch of documents in a worker process.
+
+    Returns
+    -------
+    int
+        Number of documents inserted
+    """
+    host, port, database_name = _targets[collection]
+    connection = _connections.get((host, port))
+    if connection is None:
+        connection = _connections[(host, port)] = MongoConnection(host, port, timeout=120)
+
+    # Unordered, so mongod does not stop at the first error and can spread the batch over its threads
+    reply = connection.command(database_name, {"insert": collection, "ordered": False},
+                               documents=("documents", _dataset.documents(collection, start, end)))
+    if reply.get("writeErrors"):
+        raise mongo_wire.MongoCommandError({"codeName": "WriteError", "errmsg": reply["writeErrors"][0].get("errmsg")})
+    return int(reply.get("n", 0))
+
+
+def prepare_collections(targets: dict, drop: bool):
+    """
+    Drop the collections to load, or make sure they are empty.
+
+    Raises
+    ------
+    RuntimeError
+        If a collection holds documents and drop is false
+    """
+    for collection, (host, port, database_name) in targets.items():
+        with MongoConnection(host, port) as connection:
+            if drop:
+                # Fails with NamespaceNotFound when the collection does not exist yet
+                connection.command(database_name, {"drop": collection}, check=False)
+                continue
+
+            count = int(connection.command(database_name, {"count": collection}).get("n", 0))
+            if count:
+                raise RuntimeError(f"{database_name}.{collection} already holds {count} documents, use --drop to replace them")
+
+
+def create_indexes(targets: dict):
+    """
+    Create the unique indexes of the schemas, as mongoose would when the services start.
+    """
+    for collection, indexes in INDEXES.items():
+        host, port, database_name = targets[collection]
+        started_at = time.time()
+        with MongoConnection(host, port, timeout=3600) as connection:
+            connection.command(database_name, {"createIndexes": collection, "indexes": indexes})
+        print(f"Indexed {database_name}.{collection} in {time.time() - started_at:.1f}s")
+
+
+def load_dataset(dataset: Dataset, targets: dict, workers: int = None, batch_size: int = 1000) -> dict:
+    """
+    Generate the documents of a dataset and insert them, in batches spread over a pool of processes.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        The dataset to load
+    targets : dict
+        Dictionary of collection name to (host, port, database name), see get_targets
+    workers : int
+        Number of worker processes, one per core by default
+    batch_size : int
+        Number of documents per insert
+
+    Returns
+    -------
+    dict
+        Dictionary of collection name to number of documents inserted
+    """
+    workers = workers or os.cpu_count() or 1
+    batches = ((collection, start, min(start + batch_size, count))
+               for collection, count in dataset.counts.items() for start in range(0, count, batch_size))
+    total = sum(dataset.counts.values())
+    inserted = dict.fromkeys(dataset.counts, 0)
+
+    started_at = time.time()
+    last_progress = started_at
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(dataset, targets)) as executor:
+        # Only a few batches per worker are in flight, so that the memory does not grow with the dataset
+        pending = {}
+        while True:
+            while len(pending) < 4 * workers:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending[executor.submit(_insert_batch, *batch)] = batch[0]
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                inserted[pending.pop(future)] += future.result()
+
+            if time.time() - last_progress >= 2:
+                last_progress = time.time()
+                count = sum(inserted.values())
+                print(f"{count}/{total} documents ({100 * count / total:.0f}%), "
+                      f"{count / (last_progress - started_at):.0f} documents/s")
+
+    elapsed = time.time() - started_at
+    print(f"Inserted {sum(inserted.values())} documents in {elapsed:.1f}s "
+          f"({sum(inserted.values()) / max(elapsed, 1e-9):.0f} documents/s): "
+          + ", ".join(f"{count} {collection}" for collection, count in inserted.items()))
+    return inserted
+
+
+def snapshot_databases(targets: dict, mongo_base_path: str, dbpath_base_path: str, timeout: float = 60):
+    """
+    Shut down the mongod instances of the databases and save their dbpaths as snapshots.
+
+    Raises
+    ------
+    TimeoutError
+        If a mongod instance is still running on its dbpath after timeout seconds
+    """
+    for host, port, database_name in targets.values():
+        try:
+            with MongoConnection(host, port, timeout=timeout) as connection:
+                connection.command("admin", {"shutdown": 1})
+        except ConnectionError:
+            # mongod closes the connection without answering once it shuts down
+            pass
+
+        dbpath = os.path.join(dbpath_base_path, database_name)
+        deadline = time.time() + timeout
+        while is_dbpath_in_use(dbpath):
+            if time.time() > deadline:
+                raise TimeoutError(f"mongod is still running on {dbpath}")
+            time.sleep(0.1)
+
+        save_snapshot(database_name, mongo_base_path, dbpath_base_path)
+
+
+def main():
+    """
+    Generate a dataset and load it into the databases of the running stack.
+    """
+    parser = argparse.ArgumentParser(description="Fill the service databases with a deterministic synthetic dataset")
+    parser.add_argument("--users", type=int, default=10000, help="Number of users, the other collections are scaled on it")
+    parser.add_argument("--ads-per-user", type=float, default=2, help="Average number of ads per user")
+    parser.add_argument("--chats-per-ad", type=float, default=0.5, help="Average number of chats per ad")
+    parser.add_argument("--messages-per-chat", type=int, default=8, help="Average number of messages per chat")
+    parser.add_argument("--reports-per-user", type=float, default=0.01, help="Average number of reports per user")
+    parser.add_argument("--blocked-ratio", type=float, default=0.05, help="Fraction of the users that blocked other users")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the dataset, the same seed gives the same documents")
+    parser.add_argument("--env-file", default=".env", help="The .env file of the services to take the DATABASE_URI from")
+    parser.add_argument("--mongo-port", type=int,
+                        help="Port of the single mongod holding every database, as with main.py --mongo-mode shared")
+    parser.add_argument("--workers", type=int, help="Number of worker processes, one per core by default")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of documents per insert")
+    parser.add_argument("--drop", action="store_true", help="Drop the collections first instead of refusing to load into them")
+    parser.add_argument("--no-indexes", action="store_true", help="Do not create the unique indexes after the load")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Shut the mongod instances down after the load and save their dbpaths as snapshots")
+    parser.add_argument("--mongo-base-path", default=DEFAULT_MONGO_BASE_PATH, help="Directory holding the snapshots")
+    parser.add_argument("--dbpath-base-path",
+                        help="Directory holding the dbpaths, the tmpfs with .env.test and the mongo base path otherwise")
+    args = parser.parse_args()
+
+    if args.snapshot and args.mongo_port is not None:
+        parser.error("--snapshot can not be used with --mongo-port, the shared mongod has no snapshots")
+
+    dataset = plan_dataset(args.seed, args.users, args.ads_per_user, args.chats_per_ad, args.reports_per_user,
+                           args.messages_per_chat, args.blocked_ratio)
+    targets = get_targets(args.env_file, args.mongo_port)
+    print("Dataset: " + ", ".join(f"{count} {collection} in {targets[collection][2]} on port {targets[collection][1]}"
+                                  for collection, count in dataset.counts.items()))
+
+    prepare_collections(targets, args.drop)
+    load_dataset(dataset, targets, args.workers, args.batch_size)
+    if not args.no_indexes:
+        create_indexes(targets)
+
+    if args.snapshot:
+        dbpath_base_path = args.dbpath_base_path
+        if dbpath_base_path is None:
+            # main.py keeps the test dbpaths on the tmpfs unless --mongo-disk is given
+            dbpath_base_path = (get_tmpfs_base_path() if args.env_file == ".env.test" else None) or args.mongo_base_path
+        snapshot_databases(targets, args.mongo_base_path, dbpath_base_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Fast reset of the service databases for test runs.
+
+There are two ways to reset a database:
+- drop: send dropDatabase straight to the mongod instance, without starting
+  a TypeScript toolchain. main.py drops all the databases concurrently.
+  Between the runs of the test daemon the collections are emptied instead,
+  which keeps the indexes the running services built.
+- snapshot: copy a seeded dbpath once into a snapshot, then restore it in
+  place before mongod is started. The files are cloned with reflinks
+  (copy-on-write) where the filesystem supports it (btrfs, XFS, ...), so a
+  restore takes milliseconds, and copied otherwise.
+
+Snapshots are never shared with the dbpath through hardlinks: WiredTiger
+rewrites its files in place, so a hardlinked file would change the snapshot
+as well.
+
+Usage:
+    python -m orchestrator.db_reset save user-test ad-test
+    python -m orchestrator.db_reset save user-test --dbpath-base-path ~/mongo_data   # a test stack run with --mongo-disk
+    python -m orchestrator.db_reset restore user-test
+    python -m orchestrator.db_reset list
+"""
+import argparse
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where files are always copied
+    fcntl = None
+
+from orchestrator import mongo_wire
+from orchestrator.mongo_memory import get_tmpfs_base_path
+
+# Where the dbpaths of the mongo instances live, see create_mongo_instance in main.py
+DEFAULT_MONGO_BASE_PATH = os.path.join(os.path.expanduser("~"), "mongo_data")
+# Name of the dir in the mongo base path where the snapshots are kept, on the same filesystem as the dbpaths
+SNAPSHOTS_DIR = "snapshots"
+
+# ioctl that clones a file on Linux filesystems with reflink support
+FICLONE = 0x40049409
+
+
+def drop_database(host: str, port: int, database_name: str):
+    """
+    Drop a database.
+
+    Parameters
+    ----------
+    host : str
+        Host of the mongod instance
+    port : int
+        Port of the mongod instance
+    database_name : str
+        Name of the database to drop
+
+    Raises
+    ------
+    MongoCommandError
+        If mongod refuses to drop the database
+    OSError
+        If mongod can not be reached
+    """
+    with mongo_wire.MongoConnection(host, port) as connection:
+        connection.command(database_name, {"dropDatabase": 1})
+
+
+def empty_database(host: str, port: int, database_name: str):
+    """
+    Delete every document of a database but keep its collections and their indexes.
+    The indexes are only built by the services when they start, so a database that is reset
+    under running services has to be emptied rather than dropped.
+
+    Parameters
+    ----------
+    host : str
+        Host of the mongod instance
+    port : int
+        Port of the mongod instance
+    database_name : str
+        Name of the database to empty
+
+    Raises
+    ------
+    MongoCommandError
+        If mongod refuses to list or to empty the collections
+    OSError
+        If mongod can not be reached
+    """
+    with mongo_wire.MongoConnection(host, port) as connection:
+        reply = connection.command(database_name, {"listCollections": 1, "nameOnly": True,
+                                                   "filter": {"type": "collection"}})
+        for collection in reply["cursor"]["firstBatch"]:
+            # System collections can not be written to
+            if collection["name"].startswith("system."):
+                continue
+            connection.command(database_name, {"delete": collection["name"]},
+                               documents=("deletes", [{"q": {}, "limit": 0}]))
+
+
+def get_snapshot_path(database_name: str, mongo_base_path: str = DEFAULT_MONGO_BASE_PATH) -> str:
+    """
+    Get the path of the snapshot of a database.
+
+    Parameters
+    ----------
+    database_name : str
+        Name of the database
+    mongo_base_path : str
+        Directory holding the dbpaths of the mongo instances
+
+    Returns
+    -------
+    str
+        Path of the snapshot
+    """
+    return os.path.join(mongo_base_path, SNAPSHOTS_DIR, database_name)
+
+
+def has_snapshot(database_name: str, mongo_base_path: str = DEFAULT_MONGO_BASE_PATH) -> bool:
+    """
+    Check if a database has a snapshot.
+    """
+    return os.path.isdir(get_snapshot_path(database_name, mongo_base_path))
+
+
+def clone_file(source: str, destination: str) -> bool:
+    """
+    Copy a file, sharing its blocks with the source through a reflink when the filesystem supports it.
+
+    Parameters
+    ----------
+    source : str
+        Path of the file to copy
+    destination : str
+        Path of the copy
+
+    Returns
+    -------
+    bool
+        True if the file was cloned, False if it had to be copied
+    """
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            if fcntl is None:
+                raise OSError(errno.ENOSYS, "fcntl is not available")
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            cloned = True
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF):
+                raise e
+            cloned = False
+
+    if not cloned:
+        shutil.copyfile(source, destination)
+    shutil.copystat(source, destination)
+
+    return cloned
+
+
+def copy_tree(source: str, destination: str) -> tuple:
+    """
+    Copy a directory tree, cloning the files with reflinks where possible.
+    The destination is replaced.
+
+    Parameters
+    ----------
+    source : str
+        Directory to copy
+    destination : str
+        Path of the copy
+
+    Returns
+    -------
+    tuple
+        Number of files cloned and number of files copied
+    """
+    # Build the copy next to the destination, then swap it in
+    tmp_destination = f"{destination}.tmp"
+    shutil.rmtree(tmp_destination, ignore_errors=True)
+
+    cloned = copied = 0
+    for dir_path, _, file_names in os.walk(source):
+        target_dir = os.path.join(tmp_destination, os.path.relpath(dir_path, source))
+        os.makedirs(target_dir, exist_ok=True)
+
+        for file_name in file_names:
+            # The lock file belongs to a running mongod, it must not be carried over
+            if file_name == "mongod.lock":
+                continue
+
+            if clone_file(os.path.join(dir_path, file_name), os.path.join(target_dir, file_name)):
+                cloned += 1
+            else:
+                copied += 1
+
+    shutil.rmtree(destination, ignore_errors=True)
+    os.replace(tmp_destination, destination)
+
+    return (cloned, copied)
+
+
+def is_dbpath_in_use(dbpath: str) -> bool:
+    """
+    Check if a mongod instance is running on a dbpath. mongod writes its PID in mongod.lock
+    while it runs and empties the file when it shuts down cleanly.
+    """
+    lock_path = os.path.join(dbpath, "mongod.lock")
+    return os.path.exists(lock_path) and os.path.getsize(lock_path) > 0
+
+
+def save_snapshot(database_name: str, mongo_base_path: str = DEFAULT_MONGO_BASE_PATH, dbpath_base_path: str = None):
+    """
+    Save the dbpath of a database as its snapshot. The mongod instance must be stopped.
+
+    Parameters
+    ----------
+    database_name : str
+        Name of the database
+    mongo_base_path : str
+        Directory holding the dbpaths of the mongo instances and the snapshots
+    dbpath_base_path : str
+        Directory holding the dbpath to save, mongo_base_path by default, e.g. the tmpfs of the test dbpaths
+
+    Raises
+    ------
+    FileNotFoundError
+        If the dbpath does not exist
+    RuntimeError
+        If a mongod instance is running on the dbpath
+    """
+    dbpath = os.path.join(dbpath_base_path or mongo_base_path, database_name)
+    if not os.path.isdir(dbpath):
+        raise FileNotFoundError(f"No dbpath for {database_name} in {dbpath_base_path or mongo_base_path}")
+    if is_dbpath_in_use(dbpath):
+        raise RuntimeError(f"mongod is running on {dbpath}, stop it before saving a snapshot")
+
+    snapshot_path = get_snapshot_path(database_name, mongo_base_path)
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    cloned, copied = copy_tree(dbpath, snapshot_path)
+    print(f"Saved snapshot of {database_name} ({cloned} files cloned, {copied} files copied)")
+
+
+def restore_snapshot(database_name: str, mongo_base_path: str = DEFAULT_MONGO_BASE_PATH, dbpath_base_path: str = None):
+    """
+    Restore the dbpath of a database from its snapshot. The mongod instance must be stopped.
+
+    Parameters
+    ----------
+    database_name : str
+        Name of the database
+    mongo_base_path : str
+        Directory holding the dbpaths of the mongo instances and the snapshots
+    dbpath_base_path : str
+        Directory holding the dbpath to restore, mongo_base_path by default. On another filesystem,
+        e.g. a tmpfs, the files are copied
+
+    Raises
+    ------
+    FileNotFoundError
+        If the database has no snapshot
+    RuntimeError
+        If a mongod instance is running on the dbpath
+    """
+    snapshot_path = get_snapshot_path(database_name, mongo_base_path)
+    if not os.path.isdir(snapshot_path):
+        raise FileNotFoundError(f"No snapshot for {database_name} in {mongo_base_path}")
+
+    dbpath = os.path.join(dbpath_base_path or mongo_base_path, database_name)
+    if is_dbpath_in_use(dbpath):
+        raise RuntimeError(f"mongod is running on {dbpath}, stop it before restoring a snapshot")
+
+    cloned, copied = copy_tree(snapshot_path, dbpath)
+    print(f"Restored snapshot of {database_name} ({cloned} files cloned, {copied} files copied)")
+
+
+def main():
+    """
+    Save, restore and list the snapshots of the databases.
+    """
+    parser = argparse.ArgumentParser(description="Save and restore snapshots of the service databases")
+    parser.add_argument("action", choices=["save", "restore", "list"])
+    parser.add_argument("databases", nargs="*", help="Names of the databases, e.g. user-test")
+    parser.add_argument("--mongo-base-path", default=DEFAULT_MONGO_BASE_PATH,
+                        help="Directory holding the snapshots, and the dbpaths of the mongo instances by default")
+    parser.add_argument("--dbpath-base-path",
+                        help="Directory holding the dbpaths, the tmpfs for the *-test databases and the mongo base path otherwise")
+    args = parser.parse_args()
+
+    if args.action == "list":
+        snapshots_path = os.path.join(args.mongo_base_path, SNAPSHOTS_DIR)
+        for database_name in sorted(os.listdir(snapshots_path)) if os.path.isdir(snapshots_path) else []:
+            print(database_name)
+        return
+
+    for database_name in args.databases:
+        dbpath_base_path = args.dbpath_base_path
+        if dbpath_base_path is None:
+            # main.py keeps the test dbpaths on the tmpfs unless --mongo-disk is given
+            dbpath_base_path = (get_tmpfs_base_path() if database_name.endswith("-test") else None) or args.mongo_base_path
+
+        if args.action == "save":
+            save_snapshot(database_name, args.mongo_base_path, dbpath_base_path)
+        else:
+            restore_snapshot(database_name, args.mongo_base_path, dbpath_base_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Declarative component graph and the scheduler that boots it.
+
+Every component of the stack (a mongod instance, the broker, a service, the
+gateway or a one-off task such as dropping a database) is a node in the graph.
+A node knows how to start itself, how to tell when it is ready and which
+nodes it depends on. The scheduler starts every node whose dependencies are
+ready at the same time, so the boot time is set by the longest chain of
+dependencies instead of the sum of all the steps.
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+
+@dataclass
+class Component:
+    """
+    A node in the component graph.
+
+    Attributes
+    ----------
+    name : str
+        Unique name of the component. Process handles use the same name
+    kind : str
+        One of "database", "broker", "service", "gateway" or "task"
+    start : Callable[[], list]
+        Starts the component and returns the list of process handles it spawned.
+        Tasks that do not leave a process behind may return None
+    ready : Callable[[list, threading.Event], None] or None
+        Blocks until the component is ready. It receives the process handles returned
+        by start and the cancel event of the boot, and should give up as soon as the event is set.
+        If None, the component is ready as soon as it is started
+    depends_on : list
+        Names of the components that must be ready before this one is started
+    """
+    name: str
+    kind: str
+    start: Callable[[], list]
+    ready: Optional[Callable[[list, threading.Event], None]] = None
+    depends_on: list = field(default_factory=list)
+
+
+class ComponentGraph:
+    """
+    A set of components and the dependency edges between them.
+    """
+
+    def __init__(self):
+        self.components = {}
+
+    def __len__(self):
+        return len(self.components)
+
+    def __contains__(self, name: str):
+        return name in self.components
+
+    def __getitem__(self, name: str) -> Component:
+        return self.components[name]
+
+    def add(self, component: Component):
+        """
+        Add a component to the graph.
+
+        Parameters
+        ----------
+        component : Component
+            The component to add
+
+        Raises
+        ------
+        ValueError
+            If a component with the same name is already in the graph
+        """
+        if component.name in self.components:
+            raise ValueError(f"Component {component.name} is already in the graph")
+
+        self.components[component.name] = component
+
+    def validate(self):
+        """
+        Make sure every dependency exists and that there are no cycles.
+
+        Raises
+        ------
+        ValueError
+            If a component depends on an unknown component or if the graph has a cycle
+        """
+        for component in self.components.values():
+            for dependency in component.depends_on:
+                if dependency not in self.components:
+                    raise ValueError(f"{component.name} depends on unknown component {dependency}")
+
+        # tiers() can only place every component if there is no cycle
+        placed = sum(len(tier) for tier in self.tiers())
+        if placed != len(self.components):
+            raise ValueError("The component graph has a dependency cycle")
+
+    def tiers(self) -> list:
+        """
+        Group the components by their depth in the graph.
+        Tier 0 has no dependencies, tier 1 only depends on tier 0 and so on.
+        Components that are part of a cycle are left out.
+
+        Returns
+        -------
+        list
+            List of lists of component names, one list per tier
+        """
+        depth = {}
+        remaining = dict(self.components)
+
+        while remaining:
+            placed = {}
+            for name, component in remaining.items():
+                if all(dependency in depth for dependency in component.depends_on):
+                    placed[name] = 1 + max((depth[d] for d in component.depends_on), default=-1)
+
+            # Nothing could be placed, the rest of the graph is a cycle
+            if not placed:
+                break
+
+            depth.update(placed)
+            for name in placed:
+                del remaining[name]
+
+        tiers = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+        for name, tier in depth.items():
+            tiers[tier].append(name)
+        return tiers
+
+    def dependents(self, name: str) -> list:
+        """
+        Get every component that directly or indirectly depends on a component.
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+
+        Returns
+        -------
+        list
+            Names of the dependent components
+        """
+        found = []
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            for component in self.components.values():
+                if current in component.depends_on and component.name not in found:
+                    found.append(component.name)
+                    pending.append(component.name)
+        return found
+
+
+def _boot_component(component: Component, handles: list, cancel_event: threading.Event, boot_start: float) -> tuple:
+    """
+    Start a component and wait for it to be ready.
+
+    Parameters
+    ----------
+    component : Component
+        The component to boot
+    handles : list
+        List the spawned process handles are added to as soon as they exist,
+        so that they can be cleaned up even if the component never gets ready
+    cancel_event : threading.Event
+        Set when the boot is aborted
+    boot_start : float
+        time.monotonic() value of the start of the boot
+
+    Returns
+    -------
+    tuple
+        Seconds since the start of the boot at which the component was started and became ready
+    """
+    started_at = time.monotonic() - boot_start
+    component_handles = component.start() or []
+    handles.extend(component_handles)
+
+    if component.ready is not None:
+        component.ready(component_handles, cancel_event)
+
+    ready_at = time.monotonic() - boot_start
+    print(f"{component.name} ready after {ready_at:.1f}s")
+
+    return (started_at, ready_at)
+
+
+def start_graph(graph: ComponentGraph, handles: list, max_workers: int = None, boot_start: float = None) -> dict:
+    """
+    Boot every component in the graph. A component is started as soon as all of
+    its dependencies are ready, and all the components that can be started are
+    started and waited on concurrently.
+
+    Parameters
+    ----------
+    graph : ComponentGraph
+        The components to boot
+    handles : list
+        List the spawned process handles are added to
+    max_workers : int
+        Maximum number of components booting at the same time. Defaults to all of them
+    boot_start : float
+        time.monotonic() value the timings are measured from, e.g. to line them up with other measures. Defaults to now
+
+    Returns
+    -------
+    dict
+        Maps each component name to a tuple of (started at, ready at) in seconds since the start of the boot
+
+    Raises
+    ------
+    Exception
+        The first error raised while starting a component or waiting for it.
+        The other components that are still booting are cancelled
+    """
+    graph.validate()
+
+    cancel_event = threading.Event()
+    if boot_start is None:
+        boot_start = time.monotonic()
+
+    # Dependencies that are not ready yet for every component that has not been started
+    waiting_on = {name: set(component.depends_on) for name, component in graph.components.items()}
+    timings = {}
+    running = {}
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or max(len(graph), 1), thread_name_prefix="boot")
+    try:
+        while waiting_on or running:
+            # Start every component whose dependencies are all ready
+            for name in [name for name, dependencies in waiting_on.items() if not dependencies]:
+                del waiting_on[name]
+                future = executor.submit(_boot_component, graph[name], handles, cancel_event, boot_start)
+                running[future] = name
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                # Raises the error of the component if it failed
+                timings[name] = future.result()
+
+                for dependencies in waiting_on.values():
+                    dependencies.discard(name)
+    except BaseException:
+        # Tell the components that are still booting to give up
+        cancel_event.set()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return timings
@@ -0,0 +1,122 @@
+"""
+Fixed size latency histogram with log-linear buckets.
+
+Every power of two is split in 2^SUB_BUCKET_BITS linear sub-buckets, so a
+recorded value is known to about 3% whatever its magnitude, and the memory
+used does not depend on the number of values recorded. Two histograms can be
+merged, e.g. the histograms of several worker processes.
+"""
+import array
+
+# Number of bits of precision kept per power of two: 32 sub-buckets, about 3% of error
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Values above 2^MAX_EXPONENT are recorded in the last bucket
+MAX_EXPONENT = 42
+BUCKETS = (MAX_EXPONENT + 2) * SUB_BUCKETS
+
+
+def _bucket_index(value: int) -> int:
+    if value < 2 * SUB_BUCKETS:
+        return value
+
+    # Keep the SUB_BUCKET_BITS bits after the leading one
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    if shift > MAX_EXPONENT:
+        return BUCKETS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def _bucket_value(index: int) -> int:
+    """
+    Get the highest value that falls in a bucket.
+    """
+    if index < 2 * SUB_BUCKETS:
+        return index
+
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """
+    Histogram of non-negative integer values, e.g. latencies in microseconds.
+    """
+
+    def __init__(self):
+        self.counts = array.array("Q", bytes(8 * BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value: int):
+        """
+        Record a value. Negative values are recorded as 0.
+        """
+        value = max(0, int(value))
+        self.counts[_bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other: "LatencyHistogram"):
+        """
+        Add the values of another histogram to this one.
+        """
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def reset(self):
+        """
+        Forget every recorded value.
+        """
+        self.counts = array.array("Q", bytes(8 * len(self.counts)))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percentile: float) -> int:
+        """
+        Get the value below which a percentage of the recorded values fall.
+
+        Parameters
+        ----------
+        percentile : float
+            The percentile, between 0 and 100, e.g. 99.9
+
+        Returns
+        -------
+        int
+            The highest value of the bucket holding the percentile, capped by the largest recorded value,
+            or 0 if the histogram is empty
+        """
+        if not self.count:
+            return 0
+
+        rank = max(1, int(self.count * percentile / 100 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # The last bucket also holds every value above its range, only the max bounds them
+                if index == BUCKETS - 1:
+                    return self.max
+                return min(_bucket_value(index), self.max)
+
+        return self.max
@@ -0,0 +1,515 @@
+"""
+Open-loop HTTP load generator for the API gateway.
+
+The requests are taken from the Postman collection of the gateway and sent
+in turn over a pool of keep-alive connections. The load is open-loop: the
+requests are sent on a fixed schedule whatever the gateway does, and the
+latency of a request is measured from the time it was scheduled, so the time
+spent waiting behind a slow gateway is part of the latency instead of
+silently lowering the load.
+
+Two profiles are supported:
+- constant: a single step at a fixed rate,
+- ramp: steps of increasing rate, which finds the saturation knee, the first
+  rate at which the gateway stops keeping up (throughput below the offered
+  rate, errors or a p99 latency far above the one of the first step).
+
+Usage (with the stack running, main.py --load boots the stack first):
+    python -m orchestrator.http_load --rate 200 --duration 30
+    python -m orchestrator.http_load --profile ramp --rate 100 --step 100 --steps 10 --duration 10
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import re
+import time
+import urllib.parse
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+from orchestrator.histogram import LatencyHistogram
+
+# Root of the repository, the default collection is read from it
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_COLLECTION = os.path.join(REPO_ROOT, "api_gateway", "src", "tests", "The_Garage.postman_collection.json")
+
+
+class HttpRequest(NamedTuple):
+    """
+    A request of the collection.
+    """
+    name: str
+    method: str
+    path: str
+    headers: dict
+    body: bytes = b""
+
+
+class HttpError(Exception):
+    """
+    Raised when a response can not be parsed.
+    """
+
+
+def _substitute(value: str, variables: dict) -> str:
+    return re.sub(r"\{\{\s*([^}\s]+)\s*\}\}", lambda match: str(variables.get(match.group(1), match.group(0))), value)
+
+
+def load_postman_requests(collection_path: str, variables: dict = None) -> list:
+    """
+    Load the requests of a Postman collection (format v2.1), including the requests in folders.
+
+    Parameters
+    ----------
+    collection_path : str
+        Path of the collection
+    variables : dict
+        Values of the {{variables}}, on top of the variables of the collection
+
+    Returns
+    -------
+    list
+        List of HttpRequest, in the order of the collection
+    """
+    with open(collection_path, "r") as f:
+        collection = json.load(f)
+
+    values = {variable["key"]: variable.get("value", "") for variable in collection.get("variable", [])}
+    values.update(variables or {})
+
+    requests = []
+
+    def visit(items: list):
+        for item in items:
+            if "item" in item:
+                visit(item["item"])
+                continue
+
+            request = item["request"]
+            url = request["url"]["raw"] if isinstance(request["url"], dict) else request["url"]
+            parsed = urllib.parse.urlsplit(_substitute(url, values))
+            path = parsed.path or "/"
+            if parsed.query:
+                path += f"?{parsed.query}"
+
+            headers = {header["key"]: _substitute(header["value"], values)
+                       for header in request.get("header", []) if not header.get("disabled")}
+
+            body = b""
+            if request.get("body", {}).get("mode") == "raw":
+                body = _substitute(request["body"].get("raw", ""), values).encode()
+                if request["body"].get("options", {}).get("raw", {}).get("language") == "json":
+                    headers.setdefault("Content-Type", "application/json")
+
+            requests.append(HttpRequest(item.get("name", path), request.get("method", "GET"), path, headers, body))
+
+    visit(collection.get("item", []))
+    return requests
+
+
+async def _read_response(reader: asyncio.StreamReader) -> tuple:
+    """
+    Read a response.
+
+    Returns
+    -------
+    tuple
+        The status code, the body and True if the connection can be reused
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by the server")
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+        raise HttpError(f"Malformed status line {status_line!r}")
+    status = int(parts[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.partition(b":")
+        headers[key.strip().lower()] = value.strip()
+
+    keep_alive = headers.get(b"connection", b"").lower() != b"close" and parts[0] != b"HTTP/1.0"
+
+    if headers.get(b"transfer-encoding", b"").lower() == b"chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if not size:
+                # Skip the trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    elif b"content-length" in headers:
+        body = await reader.readexactly(int(headers[b"content-length"]))
+    elif status in (204, 304) or 100 <= status < 200:
+        body = b""
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    return status, body, keep_alive
+
+
+class ConnectionPool:
+    """
+    Pool of keep-alive HTTP/1.1 connections to one server.
+
+    Parameters
+    ----------
+    host : str
+        Host of the server
+    port : int
+        Port of the server
+    size : int
+        Maximum number of connections
+    """
+
+    def __init__(self, host: str, port: int, size: int):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.opened = 0
+        self._idle = []
+        self._released = asyncio.Condition()
+
+    async def _acquire(self) -> tuple:
+        async with self._released:
+            while not self._idle and self.opened >= self.size:
+                await self._released.wait()
+            if self._idle:
+                return self._idle.pop()
+            self.opened += 1
+
+        try:
+            return await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            await self._discard()
+            raise e
+
+    async def _release(self, connection: tuple):
+        async with self._released:
+            self._idle.append(connection)
+            self._released.notify()
+
+    async def _discard(self, connection: tuple = None):
+        if connection is not None:
+            connection[1].close()
+        async with self._released:
+            self.opened -= 1
+            self._released.notify()
+
+    async def request(self, request: HttpRequest, timeout: float) -> int:
+        """
+        Send a request and read its response.
+
+        Returns
+        -------
+        int
+            The status code of the response
+        """
+        connection = await self._acquire()
+        reader, writer = connection
+        try:
+            head = [f"{request.method} {request.path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+            head += [f"{key}: {value}" for key, value in request.headers.items()]
+            if request.body or request.method in ("POST", "PUT", "PATCH"):
+                head.append(f"Content-Length: {len(request.body)}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + request.body)
+
+            status, _, keep_alive = await asyncio.wait_for(_read_response(reader), timeout)
+        except BaseException as e:
+            # The state of the connection is unknown
+            await self._discard(connection)
+            raise e
+
+        if keep_alive:
+            await self._release(connection)
+        else:
+            await self._discard(connection)
+        return status
+
+    async def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+@dataclass
+class StepResult:
+    """
+    Result of one step of a load profile.
+    """
+    offered_rate: float
+    duration: float
+    sent: int = 0
+    completed: int = 0
+    errors: int = 0
+    dropped: int = 0
+    statuses: collections.Counter = field(default_factory=collections.Counter)
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+    @property
+    def throughput(self) -> float:
+        return self.completed / self.duration
+
+    @property
+    def error_rate(self) -> float:
+        return (self.errors + self.dropped) / self.sent if self.sent else 0.0
+
+
+async def run_step(pool: ConnectionPool, requests: list, rate: float, duration: float, timeout: float = 10,
+                   max_outstanding: int = 10000) -> StepResult:
+    """
+    Send requests at a fixed rate for a given time, then wait for the last responses.
+
+    Parameters
+    ----------
+    pool : ConnectionPool
+        Pool of connections to the gateway
+    requests : list
+        The requests to send in turn
+    rate : float
+        Requests per second
+    duration : float
+        Seconds during which requests are sent
+    timeout : float
+        Seconds after which a request counts as an error
+    max_outstanding : int
+        Requests waiting for a response above which new requests are dropped and counted as errors
+
+    Returns
+    -------
+    StepResult
+        The counters and the latency histogram of the step
+    """
+    result = StepResult(rate, duration)
+    outstanding = set()
+    interval = 1 / rate
+    start = time.monotonic()
+    sent = 0
+
+    async def send(request: HttpRequest, scheduled_at: float):
+        try:
+            status = await pool.request(request, timeout)
+            result.statuses[status] += 1
+            if status >= 400:
+                result.errors += 1
+        except (OSError, asyncio.TimeoutError, HttpError, asyncio.IncompleteReadError) as e:
+            result.statuses[type(e).__name__] += 1
+            result.errors += 1
+        result.completed += 1
+        result.latency.record((time.monotonic() - scheduled_at) * 1e6)
+
+    while True:
+        now = time.monotonic()
+        if now - start >= duration:
+            break
+
+        # Send every request that is due, the schedule does not wait for the responses
+        while start + sent * interval <= now and sent * interval < duration:
+            scheduled_at = start + sent * interval
+            request = requests[sent % len(requests)]
+            sent += 1
+            result.sent += 1
+            if len(outstanding) >= max_outstanding:
+                result.dropped += 1
+                continue
+            task = asyncio.create_task(send(request, scheduled_at))
+            outstanding.add(task)
+            task.add_done_callback(outstanding.discard)
+
+        await asyncio.sleep(max(0, start + sent * interval - time.monotonic()))
+
+    if outstanding:
+        await asyncio.wait(outstanding, timeout=timeout)
+
+    return result
+
+
+async def run_profile(base_url: str, requests: list, rates: list, step_duration: float, connections: int = 64,
+                      timeout: float = 10, on_step=None) -> list:
+    """
+    Run a load profile, one step per rate.
+
+    Parameters
+    ----------
+    base_url : str
+        URL of the gateway, e.g. http://localhost:3000/api/v1. Only its host and port are used,
+        the paths come from the requests
+    requests : list
+        List of HttpRequest to send in turn
+    rates : list
+        Rate of every step, in requests per second
+    step_duration : float
+        Seconds per step
+    connections : int
+        Maximum number of keep-alive connections
+    timeout : float
+        Seconds after which a request counts as an error
+    on_step : Callable[[StepResult], None]
+        Called after every step, e.g. to print it
+
+    Returns
+    -------
+    list
+        List of StepResult
+    """
+    parsed = urllib.parse.urlsplit(base_url)
+    pool = ConnectionPool(parsed.hostname, parsed.port or 80, connections)
+
+    results = []
+    try:
+        for rate in rates:
+            result = await run_step(pool, requests, rate, step_duration, timeout)
+            results.append(result)
+            if on_step is not None:
+                on_step(result)
+    finally:
+        await pool.close()
+
+    return results
+
+
+def find_knee(results: list, latency_factor: float = 3, max_error_rate: float = 0.01,
+              min_throughput_ratio: float = 0.95):
+    """
+    Find the first step at which the gateway stops keeping up with the load.
+
+    Parameters
+    ----------
+    results : list
+        List of StepResult, in increasing rate
+    latency_factor : float
+        A step whose p99 latency is this many times the p99 of the first step is saturated
+    max_error_rate : float
+        A step with more errors than this is saturated
+    min_throughput_ratio : float
+        A step whose throughput is below this fraction of the offered rate is saturated
+
+    Returns
+    -------
+    tuple
+        The index of the step and the reason, or None if no step is saturated
+    """
+    if not results:
+        return None
+
+    baseline = max(results[0].latency.percentile(99), 1)
+    for index, result in enumerate(results):
+        if result.error_rate > max_error_rate:
+            return index, f"{100 * result.error_rate:.1f}% of errors"
+        if result.throughput < min_throughput_ratio * result.offered_rate:
+            return index, f"throughput {result.throughput:.0f} req/s below the offered rate"
+        if index and result.latency.percentile(99) > latency_factor * baseline:
+            return index, f"p99 latency {result.latency.percentile(99) / baseline:.1f}x the one of the first step"
+
+    return None
+
+
+REPORT_HEADER = (f"{'offered/s':>10} {'done/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'p99.9 ms':>8} "
+                 f"{'max ms':>8} {'errors':>7}  statuses")
+
+
+def format_step(result: StepResult) -> str:
+    """
+    Format a step as a row of the report.
+    """
+    latency = result.latency
+    statuses = ", ".join(f"{status}: {count}" for status, count in sorted(result.statuses.items(), key=str))
+    if result.dropped:
+        statuses += f", dropped: {result.dropped}"
+    return (f"{result.offered_rate:>10.0f} {result.throughput:>9.0f} {latency.percentile(50) / 1000:>8.2f} "
+            f"{latency.percentile(90) / 1000:>8.2f} {latency.percentile(99) / 1000:>8.2f} "
+            f"{latency.percentile(99.9) / 1000:>8.2f} {(latency.max or 0) / 1000:>8.2f} "
+            f"{100 * result.error_rate:>6.2f}%  {statuses}")
+
+
+def format_knee(results: list) -> str:
+    """
+    Describe the saturation knee of a ramp.
+    """
+    knee = find_knee(results)
+    if knee is None:
+        return f"No saturation up to {results[-1].offered_rate:.0f} req/s"
+
+    index, reason = knee
+    if index == 0:
+        return f"Saturated from the first step ({results[0].offered_rate:.0f} req/s): {reason}"
+    return (f"Saturation knee between {results[index - 1].offered_rate:.0f} and {results[index].offered_rate:.0f} req/s: "
+            f"{reason}")
+
+
+def get_rates(profile: str, rate: float, step: float = 0, steps: int = 1) -> list:
+    """
+    Get the rate of every step of a profile.
+    """
+    if profile == "constant":
+        return [rate]
+    return [rate + index * step for index in range(steps)]
+
+
+def run_load_test(base_url: str, collection_path: str, profile: str, rate: float, duration: float, step: float = 0,
+                  steps: int = 1, connections: int = 64, timeout: float = 10) -> list:
+    """
+    Load the requests of the collection, run the profile and print the report.
+
+    Returns
+    -------
+    list
+        List of StepResult
+    """
+    requests = load_postman_requests(collection_path)
+    if not requests:
+        raise ValueError(f"No request in {collection_path}")
+
+    rates = get_rates(profile, rate, step, steps)
+    print(f"\nLoad test of {base_url}: {profile} profile, {len(requests)} requests from the collection, "
+          f"{duration:.0f}s per step at {', '.join(f'{rate:.0f}' for rate in rates)} req/s")
+    print(REPORT_HEADER)
+
+    results = asyncio.run(run_profile(base_url, requests, rates, duration, connections, timeout,
+                                      on_step=lambda result: print(format_step(result))))
+    if profile == "ramp":
+        print(format_knee(results))
+
+    return results
+
+
+def add_load_arguments(parser: argparse.ArgumentParser, prefix: str = ""):
+    """
+    Add the arguments of a load test to a parser, optionally prefixed, e.g. --load-rate in main.py.
+    """
+    parser.add_argument(f"--{prefix}rate", type=float, default=100, help="Requests per second, the first step of a ramp")
+    parser.add_argument(f"--{prefix}step", type=float, default=100, help="Increase of the rate at every step of a ramp")
+    parser.add_argument(f"--{prefix}steps", type=int, default=10, help="Number of steps of a ramp")
+    parser.add_argument(f"--{prefix}duration", type=float, default=10, help="Seconds per step")
+    parser.add_argument(f"--{prefix}connections", type=int, default=64, help="Maximum number of keep-alive connections")
+    parser.add_argument(f"--{prefix}timeout", type=float, default=10, help="Seconds after which a request is an error")
+    parser.add_argument(f"--{prefix}collection", default=DEFAULT_COLLECTION, help="Postman collection to take the requests from")
+
+
+def main():
+    """
+    Run a load test against a running gateway.
+    """
+    parser = argparse.ArgumentParser(description="Open-loop load test of the API gateway")
+    parser.add_argument("--url", default="http://localhost:3000/api/v1", help="URL of the gateway")
+    parser.add_argument("--profile", choices=["constant", "ramp"], default="constant", help="Load profile")
+    add_load_arguments(parser)
+    args = parser.parse_args()
+
+    run_load_test(args.url, args.collection, args.profile, args.rate, args.duration, args.step, args.steps,
+                  args.connections, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Content-addressed cache for the `npm i` of every package of the stack.
+
+The fingerprint of a package is the hash of its package.json, its
+package-lock.json and the version of node. The install is skipped when the
+fingerprint matches the one recorded after the last successful install and
+node_modules is still there.
+
+After an install, the files in node_modules are moved to a shared
+content-addressed store and hardlinked back. The packages share most of their
+dependencies (typescript, eslint, nodemon, concurrently, ...) so every file
+that is the same in several packages is only stored once on disk. The stored
+files are made read-only, as a write through one of their links would change
+them in every package, and a stored file is hashed again before it is reused
+in case it was changed anyway (root ignores the permissions).
+"""
+import hashlib
+import os
+import subprocess
+import threading
+
+from orchestrator.state import load_state, update_state
+
+# Name of the file in the state dir where the fingerprints of the successful installs are recorded
+INSTALL_CACHE_FILE = "install_cache.json"
+# Name of the dir in the state dir where the shared node_modules files are stored
+STORE_DIR = "store"
+
+_node_version = None
+
+
+def get_node_version() -> str:
+    """
+    Get the version of node. Native modules such as bcrypt have to be reinstalled when it changes.
+
+    Returns
+    -------
+    str
+        The output of `node --version`, or an empty string if node could not be run
+    """
+    global _node_version
+
+    if _node_version is None:
+        try:
+            result = subprocess.run(["node", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+            _node_version = result.stdout.decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            _node_version = ""
+
+    return _node_version
+
+
+def package_fingerprint(package_path: str) -> str:
+    """
+    Hash the package.json and the package-lock.json of a package together with the node version.
+
+    Parameters
+    ----------
+    package_path : str
+        Path to the package directory
+
+    Returns
+    -------
+    str
+        The hex digest of the fingerprint
+    """
+    digest = hashlib.sha256()
+    digest.update(get_node_version().encode())
+
+    for file_name in ("package.json", "package-lock.json"):
+        digest.update(b"\0" + file_name.encode() + b"\0")
+        file_path = os.path.join(package_path, file_name)
+        if os.path.exists(file_path):
+            with open(file_path, "rb") as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def needs_install(package_path: str, state_dir: str) -> bool:
+    """
+    Check if the dependencies of a package have to be installed.
+
+    Parameters
+    ----------
+    package_path : str
+        Path to the package directory
+    state_dir : str
+        Directory where the orchestrator keeps its state
+
+    Returns
+    -------
+    bool
+        True if node_modules is missing or if the package changed since its last successful install
+    """
+    if not os.path.isdir(os.path.join(package_path, "node_modules")):
+        return True
+
+    cache = load_state(state_dir, INSTALL_CACHE_FILE)
+    return cache.get(os.path.realpath(package_path)) != package_fingerprint(package_path)
+
+
+def _hash_file(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_into_store(node_modules_path: str, store_path: str) -> int:
+    """
+    Move the files of a node_modules dir into the content-addressed store and hardlink them back.
+    A file that is already in the store is replaced with a hardlink to the stored copy.
+    The files that enter the store are made read-only. The files npm and the tools keep at the top of
+    node_modules (.package-lock.json, .cache, ...) are rewritten in place, so they are not linked.
+
+    Parameters
+    ----------
+    node_modules_path : str
+        Path to the node_modules dir
+    store_path : str
+        Path to the store. It has to be on the same filesystem as node_modules
+
+    Returns
+    -------
+    int
+        Number of bytes saved by linking files that were already in the store
+    """
+    saved = 0
+    # Stored files whose content was checked against their key
+    verified = set()
+
+    for dir_path, dir_names, file_names in os.walk(node_modules_path):
+        if dir_path == node_modules_path:
+            dir_names[:] = [dir_name for dir_name in dir_names if not dir_name.startswith(".")]
+            file_names = [file_name for file_name in file_names if not file_name.startswith(".")]
+
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            stat = os.lstat(file_path)
+
+            # Only link regular files that are not shared yet. Symlinks are left as they are
+            if not os.path.isfile(file_path) or os.path.islink(file_path) or stat.st_nlink > 1 or stat.st_size == 0:
+                continue
+
+            digest = _hash_file(file_path)
+
+            # Files with the same content but a different mode (e.g. executables) are stored separately
+            mode = stat.st_mode & 0o777
+            key = f"{digest}-{mode:o}"
+            stored_file = os.path.join(store_path, key[:2], key)
+
+            try:
+                if os.path.exists(stored_file) and stored_file not in verified:
+                    if _hash_file(stored_file) != digest:
+                        # Changed in place through one of its links, the file no longer matches its key
+                        print(f"Dropping {key} from the store, its content changed")
+                        os.unlink(stored_file)
+                    else:
+                        # Entries stored before they were made read-only
+                        os.chmod(stored_file, mode & ~0o222)
+                        verified.add(stored_file)
+
+                if os.path.exists(stored_file):
+                    # Replace the file with a link to the stored copy
+                    tmp_path = f"{file_path}.link-tmp"
+                    os.link(stored_file, tmp_path)
+                    os.replace(tmp_path, file_path)
+                    saved += stat.st_size
+                else:
+                    os.makedirs(os.path.dirname(stored_file), exist_ok=True)
+                    os.link(file_path, stored_file)
+                    os.chmod(stored_file, mode & ~0o222)
+                    verified.add(stored_file)
+            except OSError:
+                # The store is on another filesystem or the file can not be linked, keep the copy
+                continue
+
+    return saved
+
+
+def install_package(package_path: str, state_dir: str, force: bool = False, use_store: bool = True,
+                    semaphore: threading.Semaphore = None) -> bool:
+    """
+    Install the dependencies of a package unless its fingerprint matches the last successful install.
+
+    Parameters
+    ----------
+    package_path : str
+        Path to the package directory
+    state_dir : str
+        Directory where the orchestrator keeps its state
+    force : bool
+        If true, install even if the fingerprint did not change
+    use_store : bool
+        If true, share the installed files with the other packages through the store
+    semaphore : threading.Semaphore
+        If given, it bounds the number of installs running at the same time
+
+    Returns
+    -------
+    bool
+        True if the dependencies were installed, False if the install was skipped
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If `npm i` fails
+    """
+    package_name = os.path.basename(package_path)
+
+    if not force and not needs_install(package_path, state_dir):
+        print(f"Dependencies of {package_name} are up to date, skipping npm i")
+        return False
+
+    if semaphore is not None:
+        semaphore.acquire()
+    try:
+        print(f"Installing dependencies of {package_name}")
+        subprocess.run(
+            "npm i",
+            cwd=package_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+            shell=True
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"Failed to install dependencies of {package_name}")
+        print(f"stderr:\n{e.stderr.decode()}")
+        raise e
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+    # Fingerprint after the install, npm i may have updated package-lock.json
+    fingerprint = package_fingerprint(package_path)
+
+    if use_store:
+        saved = link_into_store(os.path.join(package_path, "node_modules"), os.path.join(state_dir, STORE_DIR))
+        print(f"Linked node_modules of {package_name} into the shared store, saved {saved / (1 << 20):.1f} MiB")
+
+    update_state(state_dir, INSTALL_CACHE_FILE, os.path.realpath(package_path), fingerprint)
+    print(f"Installed dependencies of {package_name}")
+
+    return True
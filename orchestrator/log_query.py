@@ -0,0 +1,610 @@
+"""
+Indexed queries over the logs of the stack.
+
+Answers questions such as "every error of every component between T1 and
+T2, interleaved by time" over the log files of the components (logs/*.out,
+logs/*.err and their rotated copies, logs/shard-<n>/...) and the logs of
+the mongod instances (<mongo base path>/<db>.log), without reading the files
+again at every query.
+
+Every log file gets a sidecar index in .orchestrator/log_index, named after
+the device and inode of the file so that it follows the file when it is
+rotated. The index is a list of blocks of about --index-interval bytes of
+lines, each with its time range, the severities of its lines and, for
+mongod, the longest operation it logged. A query memory-maps the files,
+brings their indexes up to date by only scanning the lines written since
+the last query, skips the blocks that can not match and merges the lines of
+the files by time.
+
+The lines of the components start with the ISO time written by the log
+multiplexer. Their severity is error for the lines that mention an error or
+an exception, warning for the ones that mention a warning, and info for the
+other ones, or error for the other lines of stderr. mongod writes structured
+JSON lines, whose time, severity and durationMillis are read from their
+fields, so its slow queries can be filtered by duration with --slow.
+
+Usage:
+    python -m orchestrator.log_query --severity error --since -15m
+    python -m orchestrator.log_query --since 2024-01-01T12:00 --until 2024-01-01T12:05 --components user_service gateway
+    python -m orchestrator.log_query --slow 100 --grep COLLSCAN
+    python -m orchestrator.log_query --list
+"""
+import argparse
+import datetime
+import glob
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from typing import NamedTuple
+
+from orchestrator.db_reset import DEFAULT_MONGO_BASE_PATH
+from orchestrator.mongo_memory import get_tmpfs_base_path
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_LOGS_DIR = os.path.join(REPO_ROOT, "logs")
+DEFAULT_INDEX_DIR = os.path.join(REPO_ROOT, ".orchestrator", "log_index")
+
+# Header of an index: magic, length and CRC of the start of the file it indexes, to notice a file replaced on the same inode
+INDEX_MAGIC = b"LOGIDX01"
+INDEX_HEADER = struct.Struct(">8sII")
+# Entry of an index: earliest and latest time in milliseconds, offset and length of the block, number of lines,
+# mask of the severities and longest mongod operation in milliseconds
+INDEX_ENTRY = struct.Struct(">qqQIIBI")
+# Bytes at the start of a file covered by the CRC of the header
+CHECK_BYTES = 4096
+# Indexes of files that are gone are removed once they were not updated for this many seconds
+INDEX_MAX_AGE = 7 * 24 * 3600
+
+SEVERITIES = ["debug", "info", "warning", "error"]
+DEBUG, INFO, WARNING, ERROR = range(len(SEVERITIES))
+# Markers of the severities in the output, "!" for the errors like in the merged logs
+SEVERITY_MARKERS = {DEBUG: "·", INFO: "|", WARNING: "?", ERROR: "!"}
+
+# Severity field of the mongod log lines
+MONGOD_SEVERITIES = {b"F": ERROR, b"E": ERROR, b"W": WARNING, b"I": INFO}
+
+# Length of the ISO time prefix written by the log multiplexer, e.g. 2024-01-01T12:00:00.123
+TIME_PREFIX_LENGTH = 23
+MONGOD_LINE_START = b'{"t":{"$date":"'
+
+ERROR_PATTERN = re.compile(rb"error|exception|fatal|unhandled|ECONNREFUSED", re.IGNORECASE)
+WARNING_PATTERN = re.compile(rb"warn|deprecat", re.IGNORECASE)
+MONGOD_SEVERITY_PATTERN = re.compile(rb'"s":"(\w+)"')
+MONGOD_DURATION_PATTERN = re.compile(rb'"durationMillis":(\d+)')
+
+# Log files of the components: name.out, name.err and their rotated copies name.out.1, ...
+COMPONENT_LOG_PATTERN = re.compile(r"^(.+)\.(out|err)(?:\.\d+)?$")
+
+
+class IndexEntry(NamedTuple):
+    min_time: int
+    max_time: int
+    offset: int
+    length: int
+    lines: int
+    severity_mask: int
+    max_duration: int
+
+
+class LogLine(NamedTuple):
+    time: int
+    component: str
+    severity: int
+    text: str
+    duration: int
+
+
+class _TimeParser:
+    """
+    Parse the times of the log lines into milliseconds since the epoch.
+    The local times of the components are cached by second, as most lines of a log share their second with the previous one.
+    """
+
+    def __init__(self):
+        self._seconds = {}
+
+    def parse_local(self, prefix: bytes) -> int:
+        """
+        Parse a local time such as 2024-01-01T12:00:00.123, or return None if it is not one.
+        """
+        second = prefix[:19]
+        epoch = self._seconds.get(second)
+        if epoch is None:
+            try:
+                epoch = int(datetime.datetime.fromisoformat(second.decode()).timestamp())
+            except (ValueError, UnicodeDecodeError):
+                return None
+            if len(self._seconds) > 100000:
+                self._seconds.clear()
+            self._seconds[second] = epoch
+
+        milliseconds = prefix[20:23]
+        if prefix[19:20] != b"." or not milliseconds.isdigit():
+            return None
+        return epoch * 1000 + int(milliseconds)
+
+    @staticmethod
+    def parse_mongod(line: bytes) -> int:
+        """
+        Parse the time of a mongod log line, e.g. {"t":{"$date":"2024-01-01T12:00:00.123+00:00"},...
+        """
+        end = line.find(b'"', len(MONGOD_LINE_START))
+        try:
+            return int(datetime.datetime.fromisoformat(line[len(MONGOD_LINE_START):end].decode()).timestamp() * 1000)
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+
+def classify_line(line: bytes, is_mongod: bool, is_stderr: bool = False) -> tuple:
+    """
+    Get the severity of a log line and, for a mongod line, the duration of the operation it logged.
+    The lines of stderr are errors unless they are warnings, e.g. the lines of a stack trace.
+
+    Returns
+    -------
+    tuple
+        The severity and the duration in milliseconds, 0 if the line has none
+    """
+    if is_mongod:
+        match = MONGOD_SEVERITY_PATTERN.search(line)
+        severity = MONGOD_SEVERITIES.get(match.group(1), DEBUG) if match else INFO
+        duration = MONGOD_DURATION_PATTERN.search(line)
+        return severity, int(duration.group(1)) if duration else 0
+
+    if not is_stderr and ERROR_PATTERN.search(line):
+        return ERROR, 0
+    if WARNING_PATTERN.search(line):
+        return WARNING, 0
+    return ERROR if is_stderr else INFO, 0
+
+
+class LogFile:
+    """
+    A memory-mapped log file and its sidecar index.
+
+    Parameters
+    ----------
+    path : str
+        Path of the log file
+    component : str
+        Name of the component that wrote it
+    index_dir : str
+        Directory of the indexes
+    index_interval : int
+        Bytes of lines per index entry
+    """
+
+    def __init__(self, path: str, component: str, index_dir: str, index_interval: int = 64 * 1024):
+        self.path = path
+        self.component = component
+        self.index_interval = index_interval
+        self.is_mongod = path.endswith(".log")
+        match = COMPONENT_LOG_PATTERN.match(os.path.basename(path))
+        self.is_stderr = match is not None and match.group(2) == "err"
+        self._times = _TimeParser()
+
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.size = stat.st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+
+        self.index_path = os.path.join(index_dir, f"{stat.st_dev}-{stat.st_ino}.idx")
+        self.blocks = []
+        # Number of blocks found in the index file, the following ones were added by this update
+        self.indexed_blocks = 0
+
+    def update_index(self, rebuild: bool = False):
+        """
+        Load the index and index the lines written since it was last updated.
+        The index is rebuilt if the file was truncated or replaced.
+        """
+        check_length = min(CHECK_BYTES, self.size)
+        check_crc = zlib.crc32(self._map[:check_length])
+
+        blocks = []
+        if not rebuild and os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            if len(data) >= INDEX_HEADER.size:
+                magic, length, crc = INDEX_HEADER.unpack_from(data, 0)
+                if magic == INDEX_MAGIC and length <= self.size and crc == zlib.crc32(self._map[:length]):
+                    # A partly written entry at the end is ignored
+                    for offset in range(INDEX_HEADER.size, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+                        blocks.append(IndexEntry(*INDEX_ENTRY.unpack_from(data, offset)))
+                    if blocks and blocks[-1].offset + blocks[-1].length > self.size:
+                        blocks = []
+
+        self.blocks = list(blocks)
+        self.indexed_blocks = len(blocks)
+        start = blocks[-1].offset + blocks[-1].length if blocks else 0
+        if start == self.size:
+            if blocks:
+                os.utime(self.index_path)
+            return
+
+        # A short last block is scanned again with the new lines, so that a log queried often does not end up in tiny blocks
+        replaced = 0
+        if blocks and blocks[-1].length < self.index_interval:
+            start = blocks[-1].offset
+            replaced = 1
+            self.blocks = blocks[:-1]
+            self.indexed_blocks -= 1
+
+        new_blocks = self._scan(start)
+        self.blocks.extend(new_blocks)
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        if blocks:
+            with open(self.index_path, "r+b") as f:
+                f.seek(INDEX_HEADER.size + (len(blocks) - replaced) * INDEX_ENTRY.size)
+                f.write(b"".join(INDEX_ENTRY.pack(*block) for block in new_blocks))
+                f.truncate()
+        else:
+            # The start of the file is only checked when it is first indexed, it does not change afterwards
+            with open(self.index_path, "wb") as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, check_length, check_crc))
+                f.write(b"".join(INDEX_ENTRY.pack(*block) for block in new_blocks))
+
+    def _lines(self, start: int, end: int):
+        """
+        Iterate over the complete lines between two offsets.
+
+        Yields
+        ------
+        tuple
+            The offset of the line, the line without its newline and the offset of the next line
+        """
+        offset = start
+        while offset < end:
+            newline = self._map.find(b"\n", offset, end)
+            if newline < 0:
+                return
+            yield offset, self._map[offset:newline], newline + 1
+            offset = newline + 1
+
+    def _parse(self, line: bytes, previous_time: int) -> tuple:
+        """
+        Get the time and the text of a line. A line without a time, e.g. a line of a stack trace, takes the time of the previous one.
+        """
+        if self.is_mongod:
+            if line.startswith(MONGOD_LINE_START):
+                return self._times.parse_mongod(line) or previous_time, line
+            return previous_time, line
+
+        line_time = self._times.parse_local(line[:TIME_PREFIX_LENGTH]) if len(line) > TIME_PREFIX_LENGTH else None
+        if line_time is None:
+            return previous_time, line
+        return line_time, line[TIME_PREFIX_LENGTH + 1:]
+
+    def _scan(self, start: int) -> list:
+        """
+        Build the index entries of the complete lines from an offset to the end of the file.
+        """
+        blocks = []
+        block = None
+        previous_time = self.blocks[-1].max_time if self.blocks else 0
+        for offset, line, next_offset in self._lines(start, self.size):
+            line_time, text = self._parse(line, previous_time)
+            previous_time = line_time
+            severity, duration = classify_line(text, self.is_mongod, self.is_stderr)
+
+            if block is None:
+                block = IndexEntry(line_time, line_time, offset, 0, 0, 0, 0)
+            block = IndexEntry(min(block.min_time, line_time), max(block.max_time, line_time), block.offset,
+                               next_offset - block.offset, block.lines + 1, block.severity_mask | (1 << severity),
+                               max(block.max_duration, duration))
+            if block.length >= self.index_interval:
+                blocks.append(block)
+                block = None
+
+        if block is not None:
+            blocks.append(block)
+        return blocks
+
+    def query(self, start_time: int = None, end_time: int = None, min_severity: int = DEBUG, min_duration: int = None,
+              pattern: re.Pattern = None):
+        """
+        Iterate over the lines of the file that match a query, using the index to skip the blocks that can not match.
+
+        Parameters
+        ----------
+        start_time : int
+            Skip the lines before this time, in milliseconds since the epoch
+        end_time : int
+            Skip the lines at or after this time
+        min_severity : int
+            Skip the lines of a lower severity
+        min_duration : int
+            Only yield the mongod lines of operations that took at least this many milliseconds
+        pattern : re.Pattern
+            Only yield the lines matching this bytes pattern
+
+        Yields
+        ------
+        LogLine
+            The matching lines, in the order of the file
+        """
+        if min_duration is not None and not self.is_mongod:
+            return
+
+        for block in self.blocks:
+            if start_time is not None and block.max_time < start_time:
+                continue
+            if end_time is not None and block.min_time >= end_time:
+                continue
+            if not block.severity_mask >> min_severity:
+                continue
+            if min_duration is not None and block.max_duration < min_duration:
+                continue
+
+            previous_time = block.min_time
+            for _, line, _ in self._lines(block.offset, block.offset + block.length):
+                line_time, text = self._parse(line, previous_time)
+                previous_time = line_time
+                if start_time is not None and line_time < start_time:
+                    continue
+                if end_time is not None and line_time >= end_time:
+                    continue
+                if pattern is not None and not pattern.search(text):
+                    continue
+                severity, duration = classify_line(text, self.is_mongod, self.is_stderr)
+                if severity < min_severity or (min_duration is not None and duration < min_duration):
+                    continue
+                yield LogLine(line_time, self.component, severity, text.decode(errors="replace"), duration)
+
+    def close(self):
+        if self.size:
+            self._map.close()
+
+
+def find_log_files(logs_dir: str, mongo_dirs: list) -> list:
+    """
+    Find the log files of the components and of the mongod instances.
+
+    Parameters
+    ----------
+    logs_dir : str
+        The logs dir of the stack. The logs of the shards in its subdirs are named shard-<n>/<component>
+    mongo_dirs : list
+        The base dirs of the dbpaths, holding the mongod logs and the base dirs of the shards
+
+    Returns
+    -------
+    list
+        List of (path, component) tuples
+    """
+    files = []
+    for path in sorted(glob.glob(os.path.join(logs_dir, "**", "*"), recursive=True)):
+        match = COMPONENT_LOG_PATTERN.match(os.path.basename(path))
+        if match and os.path.isfile(path):
+            subdir = os.path.relpath(os.path.dirname(path), logs_dir)
+            files.append((path, match.group(1) if subdir == "." else f"{subdir}/{match.group(1)}"))
+
+    for mongo_dir in mongo_dirs:
+        for path in sorted(glob.glob(os.path.join(mongo_dir, "*.log")) + glob.glob(os.path.join(mongo_dir, "*", "*.log"))):
+            # The dbpaths are named after the databases, and their instances <database>_database, except the shared one
+            name = os.path.splitext(os.path.basename(path))[0]
+            component = name if name.endswith("_database") else f"{name}_database"
+            subdir = os.path.relpath(os.path.dirname(path), mongo_dir)
+            files.append((path, component if subdir == "." else f"{subdir}/{component}"))
+
+    return files
+
+
+def prune_indexes(index_dir: str, log_files: list):
+    """
+    Remove the indexes of the files that are gone, once they were not updated for INDEX_MAX_AGE seconds.
+    """
+    used = {log_file.index_path for log_file in log_files}
+    now = time.time()
+    for path in glob.glob(os.path.join(index_dir, "*.idx")):
+        try:
+            if path not in used and now - os.path.getmtime(path) > INDEX_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def open_log_files(files: list, index_dir: str, index_interval: int = 64 * 1024, rebuild: bool = False) -> list:
+    """
+    Open the log files and bring their indexes up to date.
+
+    Parameters
+    ----------
+    files : list
+        List of (path, component) tuples
+    index_dir : str
+        Directory of the indexes
+    index_interval : int
+        Bytes of lines per index entry
+    rebuild : bool
+        If true, index every file from the start
+
+    Returns
+    -------
+    list
+        List of LogFile
+    """
+    log_files = []
+    for path, component in files:
+        try:
+            log_file = LogFile(path, component, index_dir, index_interval)
+        except OSError:
+            # Rotated away between the glob and the open
+            continue
+        log_file.update_index(rebuild)
+        log_files.append(log_file)
+
+    prune_indexes(index_dir, log_files)
+    return log_files
+
+
+def query_logs(log_files: list, start_time: int = None, end_time: int = None, min_severity: int = DEBUG,
+               min_duration: int = None, pattern: re.Pattern = None, components: list = None):
+    """
+    Iterate over the lines of several log files that match a query, interleaved by time.
+
+    Parameters
+    ----------
+    log_files : list
+        List of LogFile with their indexes up to date
+    start_time, end_time, min_severity, min_duration, pattern
+        See LogFile.query
+    components : list
+        Only read the files of these components. A service also selects its replicas and its database
+
+    Yields
+    ------
+    LogLine
+        The matching lines of every file, by time
+    """
+    selected = []
+    for log_file in log_files:
+        names = {log_file.component, log_file.component.rpartition("/")[2]}
+        if components and not any(name == component or name.startswith(f"{component}.")
+                                  for name in names for component in components):
+            continue
+        selected.append(log_file.query(start_time, end_time, min_severity, min_duration, pattern))
+
+    return heapq.merge(*selected, key=lambda line: line.time)
+
+
+def parse_time(value: str, now: float = None) -> int:
+    """
+    Parse a time given on the command line into milliseconds since the epoch.
+
+    Parameters
+    ----------
+    value : str
+        An ISO time or date such as 2024-01-01T12:00:00, a time of today such as 12:00,
+        or a time relative to now such as -15m, -30s, -2h or -1d
+
+    Raises
+    ------
+    ValueError
+        If the value is none of these
+    """
+    now = time.time() if now is None else now
+    relative = re.match(r"^-(\d+(?:\.\d+)?)([smhd])$", value)
+    if relative:
+        seconds = float(relative.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[relative.group(2)]
+        return int((now - seconds) * 1000)
+
+    if re.match(r"^\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?$", value):
+        hour, _, rest = value.partition(":")
+        value = f"{datetime.date.fromtimestamp(now).isoformat()}T{int(hour):02d}:{rest}"
+
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        raise ValueError(f"Invalid time {value!r}, expected e.g. 2024-01-01T12:00, 12:00 or -15m")
+
+
+def format_line(line: LogLine, raw: bool = False) -> str:
+    """
+    Format a line with its time, component and severity. A mongod line is summed up unless raw is true.
+    """
+    clock = datetime.datetime.fromtimestamp(line.time / 1000).isoformat(timespec="milliseconds")
+    text = line.text
+    if not raw and text.startswith(MONGOD_LINE_START.decode()):
+        try:
+            entry = json.loads(text)
+            attributes = entry.get("attr", {})
+            parts = [entry.get("msg", "")]
+            if "durationMillis" in attributes:
+                parts.append(f"{attributes['durationMillis']}ms")
+            for key in ("ns", "planSummary", "error", "errmsg"):
+                if key in attributes:
+                    parts.append(f"{key}={attributes[key]}")
+            if "command" in attributes:
+                parts.append(f"command={json.dumps(attributes['command'], separators=(',', ':'))[:200]}")
+            text = " ".join(str(part) for part in parts)
+        except ValueError:
+            pass
+
+    return f"{clock} {line.component:>22} {SEVERITY_MARKERS[line.severity]} {text}"
+
+
+def format_files(log_files: list) -> str:
+    """
+    Describe the log files from their indexes.
+    """
+    rows = [f"{'component':<28} {'file':<28} {'size MiB':>9} {'lines':>9} {'blocks':>7} {'new':>5} {'first':>23} {'last':>23}"]
+    for log_file in log_files:
+        lines = sum(block.lines for block in log_file.blocks)
+        if log_file.blocks:
+            first = datetime.datetime.fromtimestamp(min(block.min_time for block in log_file.blocks) / 1000)
+            last = datetime.datetime.fromtimestamp(max(block.max_time for block in log_file.blocks) / 1000)
+            times = f"{first.isoformat(timespec='milliseconds'):>23} {last.isoformat(timespec='milliseconds'):>23}"
+        else:
+            times = f"{'-':>23} {'-':>23}"
+        rows.append(f"{log_file.component:<28} {os.path.basename(log_file.path):<28} {log_file.size / 2 ** 20:>9.2f} {lines:>9} "
+                    f"{len(log_file.blocks):>7} {len(log_file.blocks) - log_file.indexed_blocks:>5} {times}")
+    return "\n".join(rows)
+
+
+def main():
+    """
+    Query the logs of the components and of the mongod instances.
+    """
+    mongo_dirs = [DEFAULT_MONGO_BASE_PATH]
+    tmpfs_base_path = get_tmpfs_base_path()
+    if tmpfs_base_path is not None:
+        mongo_dirs.append(tmpfs_base_path)
+
+    parser = argparse.ArgumentParser(description="Query the logs of the stack through incremental indexes")
+    parser.add_argument("--since", help="Start of the time range: an ISO time, a time of today such as 12:00 or a relative time such as -15m")
+    parser.add_argument("--until", help="End of the time range, excluded, in the same formats")
+    parser.add_argument("--severity", choices=SEVERITIES, default="debug", help="Only show the lines of this severity or higher")
+    parser.add_argument("--components", nargs="+",
+                        help="Only show these components. A service also selects its replicas, shard-<n>/<component> a component of a shard")
+    parser.add_argument("--slow", type=int, metavar="MS", help="Only show the mongod operations that took at least MS milliseconds")
+    parser.add_argument("--grep", help="Only show the lines matching this regular expression")
+    parser.add_argument("--limit", type=int, help="Stop after this many lines")
+    parser.add_argument("--raw", action="store_true", help="Show the mongod lines as they were logged instead of summing them up")
+    parser.add_argument("--list", action="store_true", help="Describe the log files and their indexes instead of querying them")
+    parser.add_argument("--logs-dir", default=DEFAULT_LOGS_DIR, help="Logs dir of the stack")
+    parser.add_argument("--mongo-dirs", nargs="+", default=mongo_dirs, help="Base dirs of the dbpaths, where the mongod logs are")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR, help="Directory of the indexes")
+    parser.add_argument("--index-interval", type=int, default=64 * 1024, help="Bytes of lines per index entry of a new index")
+    parser.add_argument("--reindex", action="store_true", help="Index every file from the start")
+    args = parser.parse_args()
+
+    try:
+        start_time = parse_time(args.since) if args.since else None
+        end_time = parse_time(args.until) if args.until else None
+        pattern = re.compile(args.grep.encode()) if args.grep else None
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+
+    started_at = time.perf_counter()
+    log_files = open_log_files(find_log_files(args.logs_dir, args.mongo_dirs), args.index_dir, args.index_interval,
+                               args.reindex)
+    try:
+        if args.list:
+            print(format_files(log_files))
+            return
+
+        count = 0
+        lines = query_logs(log_files, start_time, end_time, SEVERITIES.index(args.severity), args.slow, pattern,
+                           args.components)
+        for line in lines:
+            if args.limit is not None and count >= args.limit:
+                break
+            print(format_line(line, args.raw))
+            count += 1
+
+        print(f"{count} lines from {len(log_files)} files in {time.perf_counter() - started_at:.2f}s")
+    except BrokenPipeError:
+        pass
+    finally:
+        for log_file in log_files:
+            log_file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+"""
+Non-blocking multiplexer for the output of the spawned processes.
+
+A single background thread reads the stdout and stderr pipes of every child
+with a selector and, for every complete line:
+- writes it with a timestamp to a size-capped log file that is rotated
+  instead of truncated (logs/<name>.out, logs/<name>.out.1, ...),
+- keeps it in a ring buffer of the last lines of the component, which is
+  printed when the component crashes,
+- optionally prints it to a merged, prefixed and timestamped stream,
+- hands it to the listeners of the component, e.g. a readiness check.
+
+On Windows a selector only accepts sockets, so every pipe is read by its own
+thread instead.
+"""
+import collections
+import datetime
+import os
+import selectors
+import sys
+import threading
+
+from orchestrator.readiness import GreenFlagMatcher
+
+# A line longer than this is split, so that a child that never prints a newline can not grow the buffer forever
+MAX_LINE_BYTES = 64 * 1024
+
+# Whether the pipes of the children can be registered with a selector, which on Windows only accepts sockets
+SELECTABLE_PIPES = os.name != "nt"
+
+
+class RotatingLogFile:
+    """
+    A log file that is rotated once it reaches a maximum size.
+    When it is opened, the previous file is rotated instead of being truncated.
+
+    Parameters
+    ----------
+    path : str
+        Path of the log file
+    max_bytes : int
+        Size at which the file is rotated
+    backup_count : int
+        Number of rotated files to keep (path.1 is the most recent one)
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 3):
+        self.name = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.closed = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._rotate()
+        self._file = open(path, "wb")
+        self._size = 0
+
+    def _rotate(self):
+        # path.2 -> path.3, path.1 -> path.2, path -> path.1
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.name}.{index}"):
+                os.replace(f"{self.name}.{index}", f"{self.name}.{index + 1}")
+
+        if self.backup_count > 0:
+            os.replace(self.name, f"{self.name}.1")
+
+    def write(self, data: bytes):
+        """
+        Write to the file, rotating it first if the data does not fit. Writes after close are dropped.
+        """
+        with self._lock:
+            if self.closed:
+                return
+
+            if self._size and self._size + len(data) > self.max_bytes:
+                self._file.close()
+                self._rotate()
+                self._file = open(self.name, "wb")
+                self._size = 0
+
+            self._file.write(data)
+            self._size += len(data)
+
+    def flush(self):
+        with self._lock:
+            if not self.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                self._file.close()
+
+
+class _Stream:
+    """
+    State of one pipe read by the multiplexer.
+    """
+
+    def __init__(self, name: str, pipe, log_file: RotatingLogFile, is_error: bool):
+        self.name = name
+        self.pipe = pipe
+        self.log_file = log_file
+        self.is_error = is_error
+        self.partial = b""
+
+
+class LogMultiplexer:
+    """
+    Reads the pipes of the children without blocking and dispatches their lines.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Size at which a log file is rotated
+    backup_count : int
+        Number of rotated files to keep per log file
+    ring_lines : int
+        Number of lines kept in memory per component
+    merged : bool
+        If true, also print every line to stdout, prefixed with its time and component
+    """
+
+    def __init__(self, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 3, ring_lines: int = 200,
+                 merged: bool = False):
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.ring_lines = ring_lines
+        self.merged = merged
+
+        self._rings = {}
+        # Number of lines of every component, and that number when its current process was attached
+        self._line_counts = collections.Counter()
+        self._attach_marks = {}
+        self._listeners = collections.defaultdict(list)
+        # Reentrant, as a listener replayed by add_listener may remove itself
+        self._lock = threading.RLock()
+        self._pending = []
+        self._open_streams = collections.Counter()
+        self._streams_closed = threading.Condition(self._lock)
+        self._selector = None
+        self._thread = None
+        self._wakeup_read, self._wakeup_write = None, None
+        # Read every pipe with its own thread rather than with the selector
+        self._threaded = not SELECTABLE_PIPES
+
+    def configure(self, max_bytes: int = None, backup_count: int = None, ring_lines: int = None, merged: bool = None):
+        """
+        Change the settings. Only the streams attached afterwards use the new file settings.
+        """
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if backup_count is not None:
+            self.backup_count = backup_count
+        if ring_lines is not None:
+            self.ring_lines = ring_lines
+        if merged is not None:
+            self.merged = merged
+
+    def _start(self):
+        # Called with the lock held
+        if self._thread is not None:
+            return
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+
+        self._thread = threading.Thread(target=self._run, name="log-multiplexer", daemon=True)
+        self._thread.start()
+
+    def attach(self, name: str, process, out_log_file: str, err_log_file: str) -> tuple:
+        """
+        Start reading the stdout and stderr pipes of a process.
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+        process : subprocess.Popen
+            The process, started with stdout and stderr set to subprocess.PIPE
+        out_log_file : str
+            Path of the file the output is saved to
+        err_log_file : str
+            Path of the file the errors are saved to
+
+        Returns
+        -------
+        tuple
+            The RotatingLogFile of the output and of the errors
+        """
+        out_file = RotatingLogFile(out_log_file, self.max_bytes, self.backup_count)
+        err_file = RotatingLogFile(err_log_file, self.max_bytes, self.backup_count)
+
+        with self._lock:
+            # A restarted component keeps the lines of its previous run in its ring buffer
+            if name not in self._rings:
+                self._rings[name] = collections.deque(maxlen=self.ring_lines)
+            self._attach_marks[name] = self._line_counts[name]
+
+            streams = [_Stream(name, process.stdout, out_file, False), _Stream(name, process.stderr, err_file, True)]
+            self._open_streams[name] += 2
+            if not self._threaded:
+                self._pending.extend(streams)
+                self._start()
+
+        if self._threaded:
+            for stream in streams:
+                threading.Thread(target=self._read_blocking, args=(stream,), name=f"log-{name}", daemon=True).start()
+        else:
+            # Wake the reader up so that it registers the new pipes
+            os.write(self._wakeup_write, b"\0")
+
+        return (out_file, err_file)
+
+    def has_component(self, name: str) -> bool:
+        """
+        Check if the output of a component was ever attached.
+        """
+        with self._lock:
+            return name in self._rings
+
+    def add_listener(self, name: str, callback):
+        """
+        Call a function with every line of the output of a component.
+        The lines of the current process that are already in the ring buffer are replayed first, so no line is missed.
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+        callback : Callable[[bytes], None]
+            Called from the reader thread with every line, including its newline
+        """
+        with self._lock:
+            self._listeners[name].append(callback)
+
+            # Do not replay the lines of a previous process of the component
+            ring = list(self._rings.get(name, []))
+            current_lines = self._line_counts[name] - self._attach_marks.get(name, 0)
+            for is_error, _, line in ring[max(0, len(ring) - current_lines):]:
+                if not is_error:
+                    callback(line)
+
+    def remove_listener(self, name: str, callback):
+        with self._lock:
+            if callback in self._listeners[name]:
+                self._listeners[name].remove(callback)
+
+    def tail(self, name: str, lines: int = None) -> list:
+        """
+        Get the last lines of a component.
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+        lines : int
+            Number of lines to return, all the lines in the ring buffer by default
+
+        Returns
+        -------
+        list
+            List of tuples containing the time of the line, the stream ("out" or "err") and the line
+        """
+        with self._lock:
+            ring = list(self._rings.get(name, []))
+
+        ring = ring[-lines:] if lines else ring
+        return [(timestamp, "err" if is_error else "out", line.decode(errors="replace").rstrip("\n"))
+                for is_error, timestamp, line in ring]
+
+    def format_crash_dump(self, name: str, lines: int = None) -> str:
+        """
+        Format the last lines of a component for a crash report.
+        """
+        dump = [f"----- last lines of {name} -----"]
+        for timestamp, stream, line in self.tail(name, lines):
+            dump.append(f"{timestamp} [{stream}] {line}")
+        dump.append(f"----- end of {name} -----")
+        return "\n".join(dump)
+
+    def wait_closed(self, name: str, timeout: float) -> bool:
+        """
+        Wait until both pipes of a component reached the end of file.
+
+        Returns
+        -------
+        bool
+            True if the pipes are closed, False if the timeout expired
+        """
+        with self._lock:
+            return self._streams_closed.wait_for(lambda: self._open_streams[name] <= 0, timeout)
+
+    def _dispatch(self, stream: _Stream, lines: list):
+        """
+        Save, keep and forward complete lines. Called from the reader thread.
+        """
+        now = datetime.datetime.now()
+        timestamp = now.isoformat(timespec="milliseconds")
+
+        # The listeners go first, so that a readiness check woken up by the write to the file sees the line
+        with self._lock:
+            ring = self._rings[stream.name]
+            for line in lines:
+                ring.append((stream.is_error, timestamp, line))
+            self._line_counts[stream.name] += len(lines)
+
+            listeners = [] if stream.is_error else list(self._listeners[stream.name])
+
+        for line in lines:
+            for callback in listeners:
+                callback(line)
+
+        prefix = timestamp.encode() + b" "
+        stream.log_file.write(b"".join(prefix + line for line in lines))
+        stream.log_file.flush()
+
+        if self.merged:
+            clock = now.strftime("%H:%M:%S.") + f"{now.microsecond // 1000:03d}"
+            marker = "!" if stream.is_error else "|"
+            sys.stdout.write("".join(f"{clock} {stream.name:>22} {marker} {line.decode(errors='replace')}"
+                                     for line in lines))
+            sys.stdout.flush()
+
+    def _consume(self, stream: _Stream, data: bytes):
+        """
+        Split the data read from a pipe in lines and dispatch the complete ones.
+        """
+        buffer = stream.partial + data
+        lines = buffer.splitlines(keepends=True)
+
+        # Keep the last line for later if it is not complete yet, unless it is too long.
+        # A line ending with \r is kept as well, the \n of a \r\n may be in the next read
+        stream.partial = b""
+        if lines and not lines[-1].endswith(b"\n"):
+            stream.partial = lines.pop()
+            if len(stream.partial) > MAX_LINE_BYTES:
+                lines.append(stream.partial if stream.partial.endswith(b"\r") else stream.partial + b"\n")
+                stream.partial = b""
+
+        if lines:
+            self._dispatch(stream, lines)
+
+    def _close_stream(self, stream: _Stream):
+        """
+        Flush the incomplete line of a pipe that reached the end of file and close it.
+        """
+        if stream.partial:
+            self._dispatch(stream, [stream.partial if stream.partial.endswith(b"\r") else stream.partial + b"\n"])
+            stream.partial = b""
+
+        stream.pipe.close()
+
+        with self._lock:
+            self._open_streams[stream.name] -= 1
+            self._streams_closed.notify_all()
+
+    def _read(self, key: selectors.SelectorKey):
+        stream = key.data
+        try:
+            data = os.read(key.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if data:
+            self._consume(stream, data)
+            return
+
+        # End of file: forget the pipe
+        self._selector.unregister(key.fd)
+        self._close_stream(stream)
+
+    def _read_blocking(self, stream: _Stream):
+        """
+        Read a pipe until the end of file, in its own thread.
+        """
+        while True:
+            try:
+                data = os.read(stream.pipe.fileno(), 65536)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            self._consume(stream, data)
+
+        self._close_stream(stream)
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    # Wake up call, register the new pipes
+                    try:
+                        while os.read(self._wakeup_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+
+                    with self._lock:
+                        pending, self._pending = self._pending, []
+                    for stream in pending:
+                        os.set_blocking(stream.pipe.fileno(), False)
+                        self._selector.register(stream.pipe.fileno(), selectors.EVENT_READ, stream)
+                else:
+                    self._read(key)
+
+
+class StreamFlagCheck:
+    """
+    Readiness check that passes once a green flag shows up in the output of a component,
+    read from the multiplexer instead of from the log file.
+
+    Parameters
+    ----------
+    multiplexer : LogMultiplexer
+        The multiplexer reading the output of the component
+    name : str
+        Name of the component
+    green_flag : str
+        The string to look for
+    log_file : str
+        Path of the log file of the output of the component, if it should be watched for wake ups
+    """
+
+    def __init__(self, multiplexer: LogMultiplexer, name: str, green_flag: str, log_file: str = None):
+        self.multiplexer = multiplexer
+        self.name = name
+        # Lets wait_until_ready watch the log file, which is written right after the listeners are called
+        self.log_file = log_file
+        self.matcher = GreenFlagMatcher(green_flag)
+        self._found = threading.Event()
+        multiplexer.add_listener(name, self._feed)
+
+    def _feed(self, line: bytes):
+        if self.matcher.feed(line):
+            self._found.set()
+            self.multiplexer.remove_listener(self.name, self._feed)
+
+    def describe(self) -> str:
+        return f"green flag '{self.matcher.green_flag.decode()}'"
+
+    def poll(self) -> bool:
+        return self._found.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        try:
+            return self._found.wait(timeout)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop matching the output of the component, e.g. once the wait timed out or was cancelled.
+        """
+        self.multiplexer.remove_listener(self.name, self._feed)
@@ -0,0 +1,129 @@
+"""
+Memory budget and placement of the mongod instances.
+
+Left to itself, every mongod sizes its WiredTiger cache to about half of the
+RAM of the host, so the instances of one stack oversubscribe the memory and
+fight the page cache. The orchestrator splits one budget, a share of the RAM
+by default, between the instances it starts and gives each one an explicit
+--wiredTigerCacheSizeGB.
+
+The test databases are thrown away at every run, so their dbpaths can live on
+a tmpfs, where mongod never waits on the disk.
+"""
+import os
+import re
+
+import psutil
+
+# Smallest cache WiredTiger accepts, in GB
+MIN_CACHE_SIZE_GB = 0.25
+# Share of the RAM of the host given to the caches of all the instances by default
+DEFAULT_BUDGET_FRACTION = 0.25
+
+# tmpfs mounted on most Linux hosts
+TMPFS_ROOT = "/dev/shm"
+# Dir of the test dbpaths on the tmpfs
+TMPFS_DIR_NAME = "the-garage-mongo"
+
+
+def get_total_memory_gb() -> float:
+    """
+    Get the RAM of the host in GB.
+    """
+    return psutil.virtual_memory().total / 2 ** 30
+
+
+def compute_cache_size_gb(instances: int, budget_gb: float = None) -> float:
+    """
+    Split the memory budget between the mongod instances.
+
+    Parameters
+    ----------
+    instances : int
+        Number of mongod instances
+    budget_gb : float
+        Total WiredTiger cache of all the instances in GB, DEFAULT_BUDGET_FRACTION of the RAM by default
+
+    Returns
+    -------
+    float
+        The cache size of every instance in GB, rounded down to 0.01 GB and at least MIN_CACHE_SIZE_GB
+    """
+    if budget_gb is None:
+        budget_gb = get_total_memory_gb() * DEFAULT_BUDGET_FRACTION
+
+    per_instance = int(budget_gb / max(instances, 1) * 100) / 100
+    return max(MIN_CACHE_SIZE_GB, per_instance)
+
+
+def get_filesystem_type(path: str) -> str:
+    """
+    Get the type of the filesystem a path is on, from /proc/mounts.
+
+    Returns
+    -------
+    str or None
+        The type, e.g. "tmpfs" or "ext4", or None if it can not be known
+    """
+    try:
+        with open("/proc/mounts", "r") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return None
+
+    path = os.path.realpath(path)
+    best = None
+    for fields in mounts:
+        if len(fields) < 3:
+            continue
+        # Spaces in mount points are escaped as \040
+        mount_point = fields[1].replace("\\040", " ")
+        if path == mount_point or path.startswith(mount_point.rstrip("/") + "/"):
+            if best is None or len(mount_point) >= len(best[0]):
+                best = (mount_point, fields[2])
+
+    return best[1] if best is not None else None
+
+
+def get_tmpfs_base_path() -> str:
+    """
+    Get a dir on a tmpfs for the test dbpaths.
+
+    Returns
+    -------
+    str or None
+        The dir, or None if there is no tmpfs to put it on
+    """
+    if not os.path.isdir(TMPFS_ROOT) or get_filesystem_type(TMPFS_ROOT) != "tmpfs":
+        return None
+
+    return os.path.join(TMPFS_ROOT, TMPFS_DIR_NAME)
+
+
+def rewrite_database_uri(database_uri: str, port: int) -> str:
+    """
+    Point a mongodb:// URI to another port of the same host, keeping the credentials, the database and the options.
+
+    Parameters
+    ----------
+    database_uri : str
+        The URI, e.g. mongodb://localhost:27021/user
+    port : int
+        The new port
+
+    Returns
+    -------
+    str
+        The rewritten URI, e.g. mongodb://localhost:27017/user
+
+    Raises
+    ------
+    ValueError
+        If the URI is not a mongodb:// URI
+    """
+    match = re.match(r"^(mongodb://(?:[^@/]*@)?)([^/:?,]+)(?::\d+)?(.*)$", database_uri)
+    if not match:
+        raise ValueError(f"Invalid mongodb:// URI {database_uri!r}")
+
+    prefix, host, rest = match.groups()
+    return f"{prefix}{host}:{port}{rest}"
@@ -0,0 +1,315 @@
+"""
+Minimal MongoDB client speaking the OP_MSG wire protocol.
+
+The orchestrator only needs to run a handful of commands against the mongod
+instances it spawns (ping, dropDatabase, shutdown, insert, ...), so instead
+of depending on a driver this module implements the subset of BSON and of
+the wire protocol that these commands use.
+"""
+import datetime
+import itertools
+import os
+import socket
+import struct
+import threading
+
+# Opcode of OP_MSG, the only message type used by MongoDB 3.6 and later
+OP_MSG = 2013
+
+# BSON datetimes are milliseconds since the Unix epoch
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+_request_ids = itertools.count(1)
+
+
+class MongoCommandError(Exception):
+    """
+    Raised when a command is answered with ok: 0.
+    """
+
+    def __init__(self, reply: dict):
+        self.reply = reply
+        super().__init__(f"{reply.get('codeName', 'Error')}: {reply.get('errmsg', reply)}")
+
+
+class ObjectId:
+    """
+    A BSON ObjectId: 4 bytes of timestamp, 5 random bytes and a 3 bytes counter.
+    """
+    _counter = itertools.count(int.from_bytes(os.urandom(3), "big"))
+    _random = os.urandom(5)
+    _lock = threading.Lock()
+
+    def __init__(self, oid: bytes = None):
+        if oid is None:
+            with ObjectId._lock:
+                counter = next(ObjectId._counter) & 0xFFFFFF
+            oid = struct.pack(">I", int(datetime.datetime.now().timestamp())) + ObjectId._random + counter.to_bytes(3, "big")
+
+        if len(oid) != 12:
+            raise ValueError("An ObjectId is 12 bytes long")
+        self.binary = oid
+
+    def __eq__(self, other):
+        return isinstance(other, ObjectId) and other.binary == self.binary
+
+    def __hash__(self):
+        return hash(self.binary)
+
+    def __str__(self):
+        return self.binary.hex()
+
+    def __repr__(self):
+        return f"ObjectId('{self}')"
+
+
+def _encode_cstring(value: str) -> bytes:
+    encoded = value.encode()
+    if b"\0" in encoded:
+        raise ValueError(f"Key {value!r} contains a null byte")
+    return encoded + b"\0"
+
+
+def _encode_element(key: str, value) -> bytes:
+    name = _encode_cstring(key)
+
+    # bool has to be checked before int, as bool is a subclass of int
+    if isinstance(value, bool):
+        return b"\x08" + name + (b"\x01" if value else b"\x00")
+    if isinstance(value, int):
+        if -(1 << 31) <= value < (1 << 31):
+            return b"\x10" + name + struct.pack("<i", value)
+        return b"\x12" + name + struct.pack("<q", value)
+    if isinstance(value, float):
+        return b"\x01" + name + struct.pack("<d", value)
+    if isinstance(value, str):
+        encoded = value.encode()
+        return b"\x02" + name + struct.pack("<i", len(encoded) + 1) + encoded + b"\0"
+    if isinstance(value, dict):
+        return b"\x03" + name + encode_document(value)
+    if isinstance(value, (list, tuple)):
+        return b"\x04" + name + encode_document({str(i): item for i, item in enumerate(value)})
+    if isinstance(value, bytes):
+        return b"\x05" + name + struct.pack("<i", len(value)) + b"\x00" + value
+    if isinstance(value, ObjectId):
+        return b"\x07" + name + value.binary
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        # Computed on timedeltas, a float timestamp can round a millisecond down
+        return b"\x09" + name + struct.pack("<q", (value - _EPOCH) // _MILLISECOND)
+    if value is None:
+        return b"\x0a" + name
+
+    raise TypeError(f"Can not encode {type(value).__name__} to BSON")
+
+
+def encode_document(document: dict) -> bytes:
+    """
+    Encode a dict to BSON.
+
+    Parameters
+    ----------
+    document : dict
+        The document to encode. The values can be bool, int, float, str, dict,
+        list, bytes, ObjectId, datetime or None
+
+    Returns
+    -------
+    bytes
+        The BSON document
+    """
+    body = b"".join(_encode_element(key, value) for key, value in document.items())
+    return struct.pack("<i", len(body) + 5) + body + b"\0"
+
+
+def _decode_cstring(data: bytes, offset: int) -> tuple:
+    end = data.index(b"\0", offset)
+    return data[offset:end].decode(), end + 1
+
+
+def decode_document(data: bytes, offset: int = 0) -> tuple:
+    """
+    Decode a BSON document.
+
+    Parameters
+    ----------
+    data : bytes
+        Buffer holding the document
+    offset : int
+        Offset of the document in the buffer
+
+    Returns
+    -------
+    tuple
+        The decoded dict and the offset right after the document
+
+    Raises
+    ------
+    ValueError
+        If the document contains a type this module does not know
+    """
+    size = struct.unpack_from("<i", data, offset)[0]
+    end = offset + size - 1
+    position = offset + 4
+    document = {}
+
+    while position < end:
+        element_type = data[position]
+        key, position = _decode_cstring(data, position + 1)
+
+        if element_type == 0x01:
+            value = struct.unpack_from("<d", data, position)[0]
+            position += 8
+        elif element_type == 0x02:
+            length = struct.unpack_from("<i", data, position)[0]
+            value = data[position + 4:position + 3 + length].decode()
+            position += 4 + length
+        elif element_type in (0x03, 0x04):
+            value, position = decode_document(data, position)
+            if element_type == 0x04:
+                value = list(value.values())
+        elif element_type == 0x05:
+            length = struct.unpack_from("<i", data, position)[0]
+            value = data[position + 5:position + 5 + length]
+            position += 5 + length
+        elif element_type == 0x07:
+            value = ObjectId(data[position:position + 12])
+            position += 12
+        elif element_type == 0x08:
+            value = data[position] == 1
+            position += 1
+        elif element_type == 0x09:
+            millis = struct.unpack_from("<q", data, position)[0]
+            value = _EPOCH + millis * _MILLISECOND
+            position += 8
+        elif element_type == 0x0a:
+            value = None
+        elif element_type == 0x10:
+            value = struct.unpack_from("<i", data, position)[0]
+            position += 4
+        elif element_type in (0x11, 0x12):
+            # 0x11 is the internal timestamp type, it is returned as its raw 64 bits value
+            value = struct.unpack_from("<Q" if element_type == 0x11 else "<q", data, position)[0]
+            position += 8
+        else:
+            raise ValueError(f"Unsupported BSON type 0x{element_type:02x} for key {key!r}")
+
+        document[key] = value
+
+    return document, offset + size
+
+
+class MongoConnection:
+    """
+    A single connection to a mongod instance.
+
+    Parameters
+    ----------
+    host : str
+        Host of the mongod instance
+    port : int
+        Port of the mongod instance
+    timeout : float
+        Timeout in seconds of the connection and of every command
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 10):
+        self.sock = socket.create_connection((host, int(port)), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def _receive_exactly(self, size: int) -> bytes:
+        chunks = []
+        while size:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise ConnectionError("Connection closed by mongod")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def command(self, database: str, command: dict, documents: tuple = None, check: bool = True) -> dict:
+        """
+        Run a command.
+
+        Parameters
+        ----------
+        database : str
+            Name of the database to run the command against
+        command : dict
+            The command. The first key is the name of the command
+        documents : tuple
+            Optional tuple of (identifier, list of documents) sent as a document sequence,
+            e.g. ("documents", [...]) for an insert. This avoids building one huge BSON array
+        check : bool
+            If true, raise MongoCommandError when the reply has ok: 0
+
+        Returns
+        -------
+        dict
+            The reply of mongod
+
+        Raises
+        ------
+        MongoCommandError
+            If check is true and the command failed
+        """
+        body = dict(command)
+        body["$db"] = database
+        sections = b"\x00" + encode_document(body)
+
+        if documents is not None:
+            identifier, docs = documents
+            payload = _encode_cstring(identifier) + b"".join(encode_document(doc) for doc in docs)
+            sections += b"\x01" + struct.pack("<i", len(payload) + 4) + payload
+
+        request_id = next(_request_ids) & 0x7FFFFFFF
+        message = struct.pack("<iiiiI", 16 + 4 + len(sections), request_id, 0, OP_MSG, 0) + sections
+        self.sock.sendall(message)
+
+        # Read the reply header then the rest of the message
+        length, _, _, opcode = struct.unpack("<iiii", self._receive_exactly(16))
+        data = self._receive_exactly(length - 16)
+        if opcode != OP_MSG or data[4] != 0:
+            raise ConnectionError(f"Unexpected reply from mongod (opcode {opcode})")
+
+        reply, _ = decode_document(data, 5)
+        if check and reply.get("ok") != 1:
+            raise MongoCommandError(reply)
+        return reply
+
+
+def ping(host: str, port: int, timeout: float = 1) -> bool:
+    """
+    Check if a mongod instance accepts commands.
+
+    Parameters
+    ----------
+    host : str
+        Host of the mongod instance
+    port : int
+        Port of the mongod instance
+    timeout : float
+        Timeout in seconds of the connection and of the command
+
+    Returns
+    -------
+    bool
+        True if the instance answered the ping
+    """
+    try:
+        with MongoConnection(host, port, timeout) as connection:
+            connection.command("admin", {"ping": 1})
+        return True
+    except (OSError, ConnectionError, MongoCommandError, ValueError):
+        return False
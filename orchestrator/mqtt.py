@@ -0,0 +1,444 @@
+"""
+Minimal asyncio MQTT client for MQTT 3.1.1 and MQTT 5.
+
+Like mongo_wire, this implements only the part of the protocol the
+orchestrator tools need: connect, subscribe, unsubscribe, publish and
+receive at QoS 0, 1 and 2, and keep alive. The MQTT 5 properties sent by the
+broker are skipped and none are sent. The packet helpers are shared with the
+tools that parse MQTT traffic.
+"""
+import asyncio
+import itertools
+import os
+import struct
+from typing import NamedTuple
+
+# Protocol levels
+MQTT_311 = 4
+MQTT_5 = 5
+
+# Packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# Above this many bytes waiting to be sent, a publish waits for the socket to drain
+WRITE_BUFFER_HIGH = 256 * 1024
+
+
+class MqttError(Exception):
+    """
+    Raised when the broker refuses a connection, a subscription or a publish.
+    """
+
+
+class Message(NamedTuple):
+    """
+    A message received from the broker.
+    """
+    topic: str
+    payload: bytes
+    qos: int = 0
+    retain: bool = False
+
+
+def encode_varint(value: int) -> bytes:
+    """
+    Encode a variable byte integer, e.g. the remaining length of a packet.
+    """
+    encoded = bytearray()
+    while True:
+        value, digit = divmod(value, 128)
+        if value:
+            encoded.append(digit | 0x80)
+        else:
+            encoded.append(digit)
+            return bytes(encoded)
+
+
+def decode_varint(data: bytes, offset: int) -> tuple:
+    """
+    Decode a variable byte integer.
+
+    Returns
+    -------
+    tuple
+        The value and the offset right after it
+    """
+    value = 0
+    for position in range(4):
+        byte = data[offset + position]
+        value |= (byte & 0x7F) << (7 * position)
+        if not byte & 0x80:
+            return value, offset + position + 1
+    raise MqttError("Malformed variable byte integer")
+
+
+def encode_string(value) -> bytes:
+    """
+    Encode a UTF-8 string or binary data with its 2 bytes length.
+    """
+    encoded = value.encode() if isinstance(value, str) else value
+    return struct.pack(">H", len(encoded)) + encoded
+
+
+def decode_string(data: bytes, offset: int) -> tuple:
+    """
+    Decode a UTF-8 string prefixed with its 2 bytes length.
+
+    Returns
+    -------
+    tuple
+        The string and the offset right after it
+    """
+    length = struct.unpack_from(">H", data, offset)[0]
+    return data[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+
+def skip_properties(data: bytes, offset: int) -> int:
+    """
+    Skip the properties of an MQTT 5 packet.
+
+    Returns
+    -------
+    int
+        The offset right after the properties
+    """
+    length, offset = decode_varint(data, offset)
+    return offset + length
+
+
+def build_packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    """
+    Build a packet from its type, the flags of its fixed header and its body.
+    """
+    return bytes([(packet_type << 4) | flags]) + encode_varint(len(body)) + body
+
+
+async def read_packet(reader: asyncio.StreamReader) -> tuple:
+    """
+    Read the next packet from a stream.
+
+    Returns
+    -------
+    tuple
+        The type of the packet, the flags of its fixed header and its body
+
+    Raises
+    ------
+    asyncio.IncompleteReadError
+        If the stream is closed
+    """
+    header = (await reader.readexactly(1))[0]
+
+    length = 0
+    for position in range(4):
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << (7 * position)
+        if not byte & 0x80:
+            break
+    else:
+        raise MqttError("Malformed remaining length")
+
+    body = await reader.readexactly(length) if length else b""
+    return header >> 4, header & 0x0F, body
+
+
+def encode_publish(topic: str, payload: bytes, qos: int = 0, retain: bool = False, packet_id: int = None,
+                   protocol: int = MQTT_311, dup: bool = False) -> bytes:
+    """
+    Build a PUBLISH packet.
+    """
+    flags = (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack(">H", packet_id)
+    if protocol == MQTT_5:
+        body += b"\x00"
+    return build_packet(PUBLISH, flags, body + payload)
+
+
+def decode_publish(flags: int, body: bytes, protocol: int = MQTT_311) -> tuple:
+    """
+    Parse the body of a PUBLISH packet.
+
+    Returns
+    -------
+    tuple
+        The topic, the payload, the QoS, the retain flag and the packet id (None at QoS 0)
+    """
+    qos = (flags >> 1) & 0x03
+    retain = bool(flags & 0x01)
+    topic, offset = decode_string(body, 0)
+
+    packet_id = None
+    if qos:
+        packet_id = struct.unpack_from(">H", body, offset)[0]
+        offset += 2
+    if protocol == MQTT_5:
+        offset = skip_properties(body, offset)
+
+    return topic, body[offset:], qos, retain, packet_id
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """
+    Check if a topic matches a topic filter with the + and # wildcards.
+    Topics starting with $ are not matched by a filter starting with a wildcard.
+    """
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False
+
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+
+class MqttClient:
+    """
+    An MQTT client running on an asyncio event loop.
+
+    Parameters
+    ----------
+    host : str
+        Host of the broker
+    port : int
+        Port of the broker
+    client_id : str
+        Client identifier, a random one by default
+    protocol : int
+        MQTT_311 or MQTT_5
+    keepalive : int
+        Keep alive interval in seconds
+    on_message : Callable[[Message], None]
+        Called with every message received. If not given, the messages are put in the messages queue
+    """
+
+    def __init__(self, host: str, port: int, client_id: str = None, protocol: int = MQTT_311, keepalive: int = 60,
+                 on_message=None):
+        self.host = host
+        self.port = int(port)
+        self.client_id = client_id or f"orchestrator-{os.urandom(6).hex()}"
+        self.protocol = protocol
+        self.keepalive = keepalive
+        self.on_message = on_message
+        self.messages = asyncio.Queue()
+
+        self._reader = None
+        self._writer = None
+        self._packet_ids = itertools.cycle(range(1, 65536))
+        self._pending = {}
+        self._incoming_qos2 = set()
+        self._tasks = []
+        self.closed = None
+
+    async def connect(self, timeout: float = 10):
+        """
+        Connect to the broker with a clean session.
+
+        Raises
+        ------
+        MqttError
+            If the broker refuses the connection
+        OSError
+            If the broker can not be reached
+        """
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+
+        body = encode_string("MQTT") + bytes([self.protocol, 0x02]) + struct.pack(">H", self.keepalive)
+        if self.protocol == MQTT_5:
+            body += b"\x00"
+        body += encode_string(self.client_id)
+        self._writer.write(build_packet(CONNECT, 0, body))
+
+        packet_type, _, body = await asyncio.wait_for(read_packet(self._reader), timeout)
+        if packet_type != CONNACK:
+            raise MqttError(f"Expected CONNACK, got packet type {packet_type}")
+        if body[1] != 0:
+            raise MqttError(f"Connection refused with code 0x{body[1]:02x}")
+
+        self.closed = asyncio.get_running_loop().create_future()
+        self._tasks = [asyncio.create_task(self._read_loop()), asyncio.create_task(self._keepalive_loop())]
+
+    def _next_packet_id(self) -> int:
+        for packet_id in self._packet_ids:
+            if packet_id not in self._pending:
+                return packet_id
+
+    def _expect(self, packet_type: int, packet_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[packet_id] = (packet_type, future)
+        return future
+
+    def _resolve(self, packet_type: int, body: bytes):
+        packet_id = struct.unpack_from(">H", body, 0)[0]
+        expected = self._pending.get(packet_id)
+        if expected is None or expected[0] != packet_type:
+            return
+
+        del self._pending[packet_id]
+        if not expected[1].done():
+            expected[1].set_result(body)
+
+    async def _write(self, packet: bytes):
+        self._writer.write(packet)
+        if self._writer.transport.get_write_buffer_size() > WRITE_BUFFER_HIGH:
+            await self._writer.drain()
+
+    async def subscribe(self, topic_filter: str, qos: int = 0) -> int:
+        """
+        Subscribe to a topic filter.
+
+        Returns
+        -------
+        int
+            The QoS granted by the broker
+
+        Raises
+        ------
+        MqttError
+            If the broker refuses the subscription
+        """
+        packet_id = self._next_packet_id()
+        body = struct.pack(">H", packet_id)
+        if self.protocol == MQTT_5:
+            body += b"\x00"
+        body += encode_string(topic_filter) + bytes([qos])
+
+        reply = self._expect(SUBACK, packet_id)
+        await self._write(build_packet(SUBSCRIBE, 0x02, body))
+        body = await reply
+
+        offset = skip_properties(body, 2) if self.protocol == MQTT_5 else 2
+        if body[offset] >= 0x80:
+            raise MqttError(f"Subscription to {topic_filter} refused with code 0x{body[offset]:02x}")
+        return body[offset]
+
+    async def unsubscribe(self, topic_filter: str):
+        """
+        Unsubscribe from a topic filter.
+        """
+        packet_id = self._next_packet_id()
+        body = struct.pack(">H", packet_id)
+        if self.protocol == MQTT_5:
+            body += b"\x00"
+        body += encode_string(topic_filter)
+
+        reply = self._expect(UNSUBACK, packet_id)
+        await self._write(build_packet(UNSUBSCRIBE, 0x02, body))
+        await reply
+
+    async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        """
+        Publish a message. At QoS 1 and 2 this returns once the broker acknowledged it.
+
+        Raises
+        ------
+        MqttError
+            If the broker refuses the message (MQTT 5 only)
+        """
+        if not qos:
+            await self._write(encode_publish(topic, payload, 0, retain, protocol=self.protocol))
+            return
+
+        packet_id = self._next_packet_id()
+        reply = self._expect(PUBACK if qos == 1 else PUBREC, packet_id)
+        await self._write(encode_publish(topic, payload, qos, retain, packet_id, self.protocol))
+        body = await reply
+
+        # MQTT 5 acknowledgements can carry a reason code
+        if len(body) > 2 and body[2] >= 0x80:
+            raise MqttError(f"Publish to {topic} refused with code 0x{body[2]:02x}")
+
+        if qos == 2:
+            reply = self._expect(PUBCOMP, packet_id)
+            await self._write(build_packet(PUBREL, 0x02, struct.pack(">H", packet_id)))
+            await reply
+
+    def _deliver(self, message: Message):
+        if self.on_message is not None:
+            self.on_message(message)
+        else:
+            self.messages.put_nowait(message)
+
+    async def _read_loop(self):
+        error = None
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(self._reader)
+
+                if packet_type == PUBLISH:
+                    topic, payload, qos, retain, packet_id = decode_publish(flags, body, self.protocol)
+                    if qos == 1:
+                        self._writer.write(build_packet(PUBACK, 0, struct.pack(">H", packet_id)))
+                    elif qos == 2:
+                        self._writer.write(build_packet(PUBREC, 0, struct.pack(">H", packet_id)))
+                        # A QoS 2 message is delivered once, even if the broker sends it again before PUBREL
+                        if packet_id in self._incoming_qos2:
+                            continue
+                        self._incoming_qos2.add(packet_id)
+                    self._deliver(Message(topic, payload, qos, retain))
+                elif packet_type == PUBREL:
+                    packet_id = struct.unpack_from(">H", body, 0)[0]
+                    self._incoming_qos2.discard(packet_id)
+                    self._writer.write(build_packet(PUBCOMP, 0, struct.pack(">H", packet_id)))
+                elif packet_type in (PUBACK, PUBREC, PUBCOMP, SUBACK, UNSUBACK):
+                    self._resolve(packet_type, body)
+                elif packet_type == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, MqttError) as e:
+            error = e
+        finally:
+            # Fail everything that waits for the broker
+            for _, future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to the broker closed"))
+            self._pending.clear()
+            if not self.closed.done():
+                self.closed.set_result(error)
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive * 0.75)
+            self._writer.write(build_packet(PINGREQ, 0, b""))
+
+    async def disconnect(self):
+        """
+        Disconnect cleanly from the broker.
+        """
+        if self._writer is None:
+            return
+
+        try:
+            self._writer.write(build_packet(DISCONNECT, 0, b"\x00" if self.protocol == MQTT_5 else b""))
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+        for task in self._tasks:
+            task.cancel()
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+        self._writer = None
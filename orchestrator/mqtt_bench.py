@@ -0,0 +1,323 @@
+"""
+Throughput and latency benchmark of the MQTT broker.
+
+N publishers and M subscribers connect to the broker spawned by main.py.
+Every publisher publishes on the topics of the services, under a benchmark
+prefix so that the services do not handle the messages, and every subscriber
+subscribes to all of them. Each payload carries the time it was sent, so every
+delivery gives a publish -> deliver latency, recorded in a histogram.
+
+There are two load modes:
+- closed: every publisher keeps a window of messages in flight and publishes
+  the next one when one of its own messages comes back from the broker. This
+  finds the highest throughput the broker sustains.
+- rate: the publishers publish at a fixed total rate, whatever the broker
+  does. The latency is measured from the time a message was scheduled, so a
+  broker that falls behind shows up in the latency instead of slowing the
+  load down.
+
+One round runs for every payload size and QoS level. The clients can be
+spread over several worker processes with --workers when one Python process is
+not enough to saturate the broker.
+
+Usage:
+    python -m orchestrator.mqtt_bench --publishers 4 --subscribers 4 --payload-sizes 64 1024 --qos 0 1
+    python -m orchestrator.mqtt_bench --mode rate --rate 5000 --duration 20 --protocol 5
+"""
+import argparse
+import asyncio
+import glob
+import os
+import re
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import dotenv
+
+from orchestrator.histogram import LatencyHistogram
+from orchestrator.mqtt import MQTT_5, MQTT_311, MqttClient
+
+# Header of every payload: send time in monotonic nanoseconds, publisher and sequence number
+PAYLOAD_HEADER = struct.Struct(">QIQ")
+
+# Messages published at QoS 1 or 2 waiting for their acknowledgement per publisher, below the 65535 packet ids
+MAX_IN_FLIGHT = 60000
+
+# Root of the repository, the benchmark reads the broker address and the topics from it
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+@dataclass
+class BenchConfig:
+    """
+    Settings of one round of the benchmark.
+    """
+    host: str
+    port: int
+    topics: list
+    protocol: int = MQTT_311
+    publishers: int = 1
+    subscribers: int = 1
+    payload_size: int = 64
+    qos: int = 0
+    mode: str = "closed"
+    window: int = 16
+    rate: float = 1000
+    duration: float = 10
+    warmup: float = 2
+    prefix: str = "bench/"
+
+
+@dataclass
+class BenchResult:
+    """
+    Counters and latency histogram of a round, or of the part of a round run by one worker.
+    Only the messages published after the warmup are counted.
+    """
+    published: int = 0
+    delivered: int = 0
+    delivered_bytes: int = 0
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+    def merge(self, other: "BenchResult"):
+        self.published += other.published
+        self.delivered += other.delivered
+        self.delivered_bytes += other.delivered_bytes
+        self.latency.merge(other.latency)
+
+
+def load_service_topics(services_root: str) -> list:
+    """
+    Get the topics the services subscribe to from their src/mqtt/topics.ts files.
+
+    Parameters
+    ----------
+    services_root : str
+        Root directory of the services
+
+    Returns
+    -------
+    list
+        The sorted list of topics
+    """
+    topics = set()
+    for topics_file in glob.glob(os.path.join(services_root, "*", "src", "mqtt", "topics.ts")):
+        with open(topics_file, "r") as f:
+            # e.g. export const userTopics: string[] = ['user/test'];
+            for topic_list in re.findall(r"=\s*\[([^\]]*)\]", f.read()):
+                topics.update(re.findall(r"['\"]([^'\"]+)['\"]", topic_list))
+
+    return sorted(topics)
+
+
+def make_payload(size: int, publisher: int, sequence: int, sent_at: int) -> bytes:
+    header = PAYLOAD_HEADER.pack(sent_at, publisher, sequence)
+    return header + bytes(max(0, size - len(header)))
+
+
+async def _run_worker(config: BenchConfig, publisher_ids: list, subscriber_ids: list, start_at: float) -> BenchResult:
+    """
+    Run the publishers and subscribers of one worker until the end of the round.
+    """
+    result = BenchResult()
+    measure_from = int((start_at + config.warmup) * 1e9)
+    measure_until = int((start_at + config.warmup + config.duration) * 1e9)
+
+    def on_delivery(message):
+        sent_at, _, _ = PAYLOAD_HEADER.unpack_from(message.payload)
+        if measure_from <= sent_at < measure_until:
+            result.delivered += 1
+            result.delivered_bytes += len(message.payload)
+            result.latency.record((time.monotonic_ns() - sent_at) // 1000)
+
+    subscribers = []
+    for subscriber_id in subscriber_ids:
+        client = MqttClient(config.host, config.port, f"bench-sub-{os.getpid()}-{subscriber_id}", config.protocol,
+                            on_message=on_delivery)
+        await client.connect()
+        await client.subscribe(f"{config.prefix}#", config.qos)
+        subscribers.append(client)
+
+    async def publish(publisher_id: int, client: MqttClient, window: asyncio.Semaphore, holding: dict):
+        topics = [f"{config.prefix}{publisher_id}/{topic}" for topic in config.topics]
+        in_flight = set()
+        sequence = 0
+        interval = config.publishers / config.rate if config.mode == "rate" else 0
+        next_send = start_at
+
+        # Wait for every worker to be connected
+        await asyncio.sleep(max(0, start_at - time.monotonic()))
+
+        while True:
+            if config.mode == "rate":
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # The send time is the scheduled one, so the time spent behind schedule counts in the latency
+                sent_at = int(next_send * 1e9)
+                next_send += interval
+            else:
+                try:
+                    await asyncio.wait_for(window.acquire(), 1)
+                except asyncio.TimeoutError:
+                    # A message of the window was lost (QoS 0), do not wait for it forever. Its permit goes to
+                    # the next message, so that it is not released a second time if it shows up late
+                    if holding:
+                        del holding[next(iter(holding))]
+                sent_at = time.monotonic_ns()
+
+            if sent_at >= measure_until:
+                break
+
+            payload = make_payload(config.payload_size, publisher_id, sequence, sent_at)
+            topic = topics[sequence % len(topics)]
+            if config.mode == "closed":
+                holding[sequence] = True
+            sequence += 1
+            if sent_at >= measure_from:
+                result.published += 1
+
+            if config.qos:
+                # Acknowledgements are awaited in the background, the publisher keeps going
+                # as long as packet ids are left
+                if len(in_flight) >= MAX_IN_FLIGHT:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                task = asyncio.create_task(client.publish(topic, payload, config.qos))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            else:
+                await client.publish(topic, payload)
+
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=5)
+
+    def on_return(message, window: asyncio.Semaphore, holding: dict):
+        # Only a message that still holds a permit of the window gives it back
+        _, _, sequence = PAYLOAD_HEADER.unpack_from(message.payload)
+        if holding.pop(sequence, None) is not None:
+            window.release()
+
+    publishers = []
+    for publisher_id in publisher_ids:
+        window = asyncio.Semaphore(config.window)
+        # Sequences of the messages in flight that hold a permit of the window, the oldest first
+        holding = {}
+        # In closed mode a publisher gets its own messages back to know when to publish the next one
+        client = MqttClient(config.host, config.port, f"bench-pub-{os.getpid()}-{publisher_id}", config.protocol,
+                            on_message=lambda message, window=window, holding=holding: on_return(message, window, holding))
+        await client.connect()
+        if config.mode == "closed":
+            await client.subscribe(f"{config.prefix}{publisher_id}/#", config.qos)
+        publishers.append((publisher_id, client, window, holding))
+
+    await asyncio.gather(*(publish(*publisher) for publisher in publishers))
+
+    # Give the last messages time to be delivered
+    await asyncio.sleep(1)
+
+    for client in subscribers + [client for _, client, _, _ in publishers]:
+        await client.disconnect()
+
+    return result
+
+
+def _worker_entry(config: BenchConfig, publisher_ids: list, subscriber_ids: list, start_at: float) -> BenchResult:
+    return asyncio.run(_run_worker(config, publisher_ids, subscriber_ids, start_at))
+
+
+def run_round(config: BenchConfig, workers: int = 1) -> BenchResult:
+    """
+    Run one round of the benchmark.
+
+    Parameters
+    ----------
+    config : BenchConfig
+        Settings of the round
+    workers : int
+        Number of processes the publishers and subscribers are spread over
+
+    Returns
+    -------
+    BenchResult
+        The merged result of every worker
+    """
+    # Leave time for every client to connect before the load starts
+    start_at = time.monotonic() + 1 + 0.01 * (config.publishers + config.subscribers)
+    shares = [(list(range(config.publishers))[worker::workers], list(range(config.subscribers))[worker::workers])
+              for worker in range(workers)]
+
+    result = BenchResult()
+    if workers == 1:
+        result.merge(_worker_entry(config, *shares[0], start_at))
+        return result
+
+    # The monotonic clock is shared by the processes, so latencies can be measured across workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_worker_entry, config, publisher_ids, subscriber_ids, start_at)
+                   for publisher_ids, subscriber_ids in shares]
+        for future in futures:
+            result.merge(future.result())
+
+    return result
+
+
+def format_result(config: BenchConfig, result: BenchResult) -> str:
+    """
+    Format a result as a row of the report.
+    """
+    expected = result.published * config.subscribers
+    lost = max(0, expected - result.delivered)
+    latency = result.latency
+    return (f"{config.payload_size:>8} {config.qos:>3} {result.published / config.duration:>11.0f} "
+            f"{result.delivered / config.duration:>12.0f} {result.delivered_bytes / config.duration / 2 ** 20:>8.2f} "
+            f"{latency.percentile(50) / 1000:>8.2f} {latency.percentile(99) / 1000:>8.2f} "
+            f"{latency.percentile(99.9) / 1000:>8.2f} {(latency.max or 0) / 1000:>8.2f} "
+            f"{100 * lost / expected if expected else 0:>6.2f}%")
+
+
+def main():
+    """
+    Benchmark the broker for every payload size and QoS level.
+    """
+    broker_env = dotenv.dotenv_values(os.path.join(REPO_ROOT, "broker", ".env"))
+
+    parser = argparse.ArgumentParser(description="Measure the throughput and latency of the MQTT broker")
+    parser.add_argument("--host", default=broker_env.get("BROKER_HOST") or "127.0.0.1", help="Host of the broker")
+    parser.add_argument("--port", type=int, default=int(broker_env.get("BROKER_PORT") or 1883), help="Port of the broker")
+    parser.add_argument("--protocol", choices=["3.1.1", "5"], default="3.1.1", help="MQTT protocol version")
+    parser.add_argument("--publishers", type=int, default=4, help="Number of publishers")
+    parser.add_argument("--subscribers", type=int, default=4, help="Number of subscribers, each one receives every message")
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[64, 1024], help="Payload sizes in bytes")
+    parser.add_argument("--qos", type=int, nargs="+", choices=[0, 1, 2], default=[0, 1], help="QoS levels")
+    parser.add_argument("--mode", choices=["closed", "rate"], default="closed",
+                        help="closed keeps a window of messages in flight per publisher, rate publishes at a fixed rate")
+    parser.add_argument("--window", type=int, default=16, help="Messages in flight per publisher in closed mode")
+    parser.add_argument("--rate", type=float, default=1000, help="Total messages per second in rate mode")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds measured per round")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds of load before the measure starts")
+    parser.add_argument("--topics", nargs="+", help="Topics to publish on, the topics of the services by default")
+    parser.add_argument("--prefix", default="bench/", help="Prefix of the benchmark topics")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes running the clients")
+    args = parser.parse_args()
+
+    topics = args.topics or load_service_topics(os.path.join(REPO_ROOT, "services")) or ["test"]
+    protocol = MQTT_5 if args.protocol == "5" else MQTT_311
+
+    print(f"Broker {args.host}:{args.port}, MQTT {args.protocol}, {args.publishers} publishers, "
+          f"{args.subscribers} subscribers, {args.mode} mode, topics: {', '.join(topics)}")
+    print(f"{'payload':>8} {'qos':>3} {'publish/s':>11} {'delivered/s':>12} {'MiB/s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'p99.9 ms':>8} {'max ms':>8} {'lost':>7}")
+
+    for payload_size in args.payload_sizes:
+        for qos in args.qos:
+            config = BenchConfig(args.host, args.port, topics, protocol, args.publishers, args.subscribers,
+                                 max(payload_size, PAYLOAD_HEADER.size), qos, args.mode, args.window, args.rate,
+                                 args.duration, args.warmup, args.prefix)
+            result = run_round(config, args.workers)
+            print(format_result(config, result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+"""
+Lightweight asyncio MQTT broker that can stand in for the aedes broker.
+
+The aedes broker has to be installed, linted and built before a single
+message can flow. This broker runs inside the orchestrator instead and is
+listening as soon as its socket is bound. It implements the part of MQTT
+3.1.1 and MQTT 5 the services use:
+- connect with a clean session, keep alive and will messages
+- subscribe and unsubscribe with the + and # wildcards
+- publish at QoS 0 and 1, and QoS 2 from the clients. Subscriptions are
+  granted at most QoS 1
+- retained messages
+- shared subscriptions ($share/<group>/<filter>), used by the replicas of a
+  service, where every message goes to one member of the group in turn
+
+Messages are not queued for disconnected clients and are not sent again, as
+they are not by the services' own clients either. A client that falls behind,
+with MAX_IN_FLIGHT QoS 1 messages not acknowledged or more than
+SESSION_BUFFER_HIGH bytes waiting to be sent, misses the messages routed to it
+until it catches up. Every message received can be handed to an on_publish
+hook, e.g. to trace or count the traffic.
+
+Usage:
+    python -m orchestrator.mqtt_broker --host 127.0.0.1 --port 1883
+"""
+import argparse
+import asyncio
+import os
+import struct
+import threading
+
+import dotenv
+
+from orchestrator.mqtt import (CONNACK, CONNECT, DISCONNECT, MQTT_5, MQTT_311, PINGREQ, PINGRESP, PUBACK, PUBCOMP,
+                               PUBLISH, PUBREC, PUBREL, SUBACK, SUBSCRIBE, UNSUBACK, UNSUBSCRIBE, Message, MqttError,
+                               build_packet, decode_publish, decode_string, encode_publish, read_packet,
+                               skip_properties, topic_matches)
+
+# Root of the repository, the standalone broker reads its address from the broker's .env file
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Prefix of the shared subscriptions
+SHARE_PREFIX = "$share/"
+
+# Highest QoS granted to a subscription
+MAX_QOS = 1
+
+# QoS 1 messages sent to a client and not acknowledged yet, the default Receive Maximum of MQTT 5.
+# It is below the 65535 packet ids, so there is always a free id for the next message
+MAX_IN_FLIGHT = 65535
+# Above this many bytes waiting to be sent to a client, the messages routed to it are dropped
+SESSION_BUFFER_HIGH = 4 * 1024 * 1024
+
+# CONNACK return codes
+CONNACK_UNSUPPORTED_PROTOCOL = {MQTT_311: 0x01, MQTT_5: 0x84}
+# SUBACK return code of a refused subscription
+SUBACK_FAILURE = 0x80
+
+
+class _Session:
+    """
+    A connected client.
+    """
+
+    def __init__(self, client_id: str, protocol: int, writer: asyncio.StreamWriter):
+        self.client_id = client_id
+        self.protocol = protocol
+        self.writer = writer
+        # QoS of every topic filter the client subscribed to, shared subscriptions excluded
+        self.subscriptions = {}
+        # Packet ids of the QoS 1 messages sent to the client and not acknowledged yet
+        self.in_flight = set()
+        # Packet ids of the QoS 2 messages received from the client and not released yet
+        self.incoming_qos2 = set()
+        self.will = None
+        self._last_packet_id = 0
+
+    def next_packet_id(self) -> int:
+        """
+        Get a packet id that is not in flight, or None if every id is.
+        """
+        for _ in range(65535):
+            self._last_packet_id = self._last_packet_id % 65535 + 1
+            if self._last_packet_id not in self.in_flight:
+                return self._last_packet_id
+        return None
+
+    def is_congested(self, qos: int) -> bool:
+        """
+        Check if the client is too far behind to be sent another message.
+        """
+        if qos and len(self.in_flight) >= MAX_IN_FLIGHT:
+            return True
+        return self.writer.transport.get_write_buffer_size() > SESSION_BUFFER_HIGH
+
+    def send(self, packet: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(packet)
+
+
+class _SharedGroup:
+    """
+    The members of a shared subscription, and whose turn it is.
+    """
+
+    def __init__(self):
+        # QoS of every member, by client id, in the order they joined
+        self.members = {}
+        self.turn = 0
+
+    def pick(self) -> tuple:
+        client_id = list(self.members)[self.turn % len(self.members)]
+        self.turn += 1
+        return client_id, self.members[client_id]
+
+
+def _parse_shared(topic_filter: str) -> tuple:
+    """
+    Split a shared subscription in its group and its filter.
+
+    Returns
+    -------
+    tuple or None
+        The group and the filter, or None if it is not a shared subscription
+    """
+    if not topic_filter.startswith(SHARE_PREFIX):
+        return None
+
+    group, _, shared_filter = topic_filter[len(SHARE_PREFIX):].partition("/")
+    if not group or not shared_filter:
+        return None
+    return group, shared_filter
+
+
+def _is_valid_filter(topic_filter: str) -> bool:
+    levels = topic_filter.split("/")
+    for index, level in enumerate(levels):
+        if "#" in level and (level != "#" or index != len(levels) - 1):
+            return False
+        if "+" in level and level != "+":
+            return False
+    return bool(topic_filter)
+
+
+class MqttBroker:
+    """
+    An MQTT broker running on an asyncio event loop.
+
+    Parameters
+    ----------
+    host : str
+        Host to listen on
+    port : int
+        Port to listen on
+    on_publish : Callable[[str, Message], None]
+        Called on the event loop with the client id and every message published to the broker, before it is routed
+    """
+
+    def __init__(self, host: str, port: int, on_publish=None):
+        self.host = host
+        self.port = int(port)
+        self.on_publish = on_publish
+
+        self.sessions = {}
+        self.retained = {}
+        # Shared subscriptions by group and filter
+        self.shared_groups = {}
+        self.published = 0
+        self.delivered = 0
+        # Messages not sent to a client because it was too far behind
+        self.dropped = 0
+
+        self._server = None
+        # Writer of every open connection, by the task handling it
+        self._connections = {}
+        self._thread = None
+        self._loop = None
+
+    async def start(self):
+        """
+        Start listening. Returns once the socket is bound.
+        """
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def close(self):
+        """
+        Stop listening and close every connection.
+        """
+        if self._server is not None:
+            self._server.close()
+        # Closing the connections ends their handlers, which asyncio does not expect to be cancelled
+        for writer in list(self._connections.values()):
+            writer.close()
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=5)
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+
+    def start_in_thread(self, timeout: float = 5):
+        """
+        Run the broker on its own event loop in a background thread. Returns once the socket is bound.
+
+        Raises
+        ------
+        OSError
+            If the port can not be bound
+        """
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self.start())
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                self._loop.close()
+                return
+
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.close())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="mqtt-broker", daemon=True)
+        self._thread.start()
+
+        if not started.wait(timeout):
+            raise TimeoutError(f"The MQTT broker did not start listening on {self.host}:{self.port} in time")
+        if errors:
+            raise errors[0]
+
+    def stop(self, timeout: float = 5):
+        """
+        Stop a broker started with start_in_thread.
+        """
+        if self._thread is None:
+            return
+
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        session = None
+        clean_disconnect = False
+
+        try:
+            session, keepalive = await self._accept(reader, writer)
+            if session is None:
+                return
+
+            while True:
+                # A client that stays silent for one and a half keep alive periods is gone
+                if keepalive:
+                    packet_type, flags, body = await asyncio.wait_for(read_packet(reader), keepalive * 1.5)
+                else:
+                    packet_type, flags, body = await read_packet(reader)
+
+                if packet_type == DISCONNECT:
+                    clean_disconnect = True
+                    break
+                self._handle_packet(session, packet_type, flags, body)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, MqttError, IndexError,
+                struct.error, UnicodeDecodeError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            if session is not None and self.sessions.get(session.client_id) is session:
+                self._remove_session(session)
+                if session.will is not None and not clean_disconnect:
+                    self._route(session.client_id, session.will)
+            writer.close()
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> tuple:
+        """
+        Read the CONNECT packet of a new connection and register its session.
+
+        Returns
+        -------
+        tuple
+            The session, or None if the connection was refused, and the keep alive interval in seconds
+        """
+        packet_type, _, body = await asyncio.wait_for(read_packet(reader), 10)
+        if packet_type != CONNECT:
+            raise MqttError(f"Expected CONNECT, got packet type {packet_type}")
+
+        _, offset = decode_string(body, 0)
+        protocol, flags = body[offset], body[offset + 1]
+        keepalive = struct.unpack_from(">H", body, offset + 2)[0]
+        offset += 4
+
+        if protocol not in (MQTT_311, MQTT_5):
+            writer.write(build_packet(CONNACK, 0, bytes([0, CONNACK_UNSUPPORTED_PROTOCOL[MQTT_311]])))
+            await writer.drain()
+            return None, keepalive
+
+        if protocol == MQTT_5:
+            offset = skip_properties(body, offset)
+        client_id, offset = decode_string(body, offset)
+        if not client_id:
+            client_id = f"broker-{os.urandom(6).hex()}"
+
+        will = None
+        if flags & 0x04:
+            if protocol == MQTT_5:
+                offset = skip_properties(body, offset)
+            will_topic, offset = decode_string(body, offset)
+            length = struct.unpack_from(">H", body, offset)[0]
+            will_payload = body[offset + 2:offset + 2 + length]
+            will = Message(will_topic, will_payload, min((flags >> 3) & 0x03, MAX_QOS), bool(flags & 0x20))
+
+        # A client that connects again with the same id takes over the session
+        previous = self.sessions.get(client_id)
+        if previous is not None:
+            self._remove_session(previous)
+            previous.writer.close()
+
+        session = _Session(client_id, protocol, writer)
+        session.will = will
+        self.sessions[client_id] = session
+
+        # Sessions are never kept, so session present is always 0
+        writer.write(build_packet(CONNACK, 0, b"\x00\x00" + (b"\x00" if protocol == MQTT_5 else b"")))
+        return session, keepalive
+
+    def _remove_session(self, session: _Session):
+        del self.sessions[session.client_id]
+        for key, group in list(self.shared_groups.items()):
+            group.members.pop(session.client_id, None)
+            if not group.members:
+                del self.shared_groups[key]
+
+    def _handle_packet(self, session: _Session, packet_type: int, flags: int, body: bytes):
+        if packet_type == PUBLISH:
+            topic, payload, qos, retain, packet_id = decode_publish(flags, body, session.protocol)
+            if qos == 1:
+                session.send(build_packet(PUBACK, 0, struct.pack(">H", packet_id)))
+            elif qos == 2:
+                session.send(build_packet(PUBREC, 0, struct.pack(">H", packet_id)))
+                # A QoS 2 message is routed once, even if the client sends it again before PUBREL
+                if packet_id in session.incoming_qos2:
+                    return
+                session.incoming_qos2.add(packet_id)
+            self._route(session.client_id, Message(topic, payload, qos, retain))
+        elif packet_type == PUBREL:
+            packet_id = struct.unpack_from(">H", body, 0)[0]
+            session.incoming_qos2.discard(packet_id)
+            session.send(build_packet(PUBCOMP, 0, struct.pack(">H", packet_id)))
+        elif packet_type == PUBACK:
+            session.in_flight.discard(struct.unpack_from(">H", body, 0)[0])
+        elif packet_type == SUBSCRIBE:
+            self._subscribe(session, body)
+        elif packet_type == UNSUBSCRIBE:
+            self._unsubscribe(session, body)
+        elif packet_type == PINGREQ:
+            session.send(build_packet(PINGRESP, 0, b""))
+        else:
+            raise MqttError(f"Unexpected packet type {packet_type}")
+
+    def _subscribe(self, session: _Session, body: bytes):
+        packet_id = struct.unpack_from(">H", body, 0)[0]
+        offset = skip_properties(body, 2) if session.protocol == MQTT_5 else 2
+
+        codes = bytearray()
+        retained = []
+        while offset < len(body):
+            topic_filter, offset = decode_string(body, offset)
+            qos = min(body[offset] & 0x03, MAX_QOS)
+            offset += 1
+
+            shared = _parse_shared(topic_filter)
+            if not _is_valid_filter(shared[1] if shared else topic_filter):
+                codes.append(SUBACK_FAILURE)
+                continue
+
+            codes.append(qos)
+            if shared:
+                self.shared_groups.setdefault(shared, _SharedGroup()).members[session.client_id] = qos
+            else:
+                session.subscriptions[topic_filter] = qos
+                retained.extend((message, qos) for topic, message in self.retained.items()
+                                if topic_matches(topic_filter, topic))
+
+        properties = b"\x00" if session.protocol == MQTT_5 else b""
+        session.send(build_packet(SUBACK, 0, struct.pack(">H", packet_id) + properties + bytes(codes)))
+
+        # The retained messages are sent after the SUBACK
+        for message, qos in retained:
+            self._send(session, message, qos, retain=True)
+
+    def _unsubscribe(self, session: _Session, body: bytes):
+        packet_id = struct.unpack_from(">H", body, 0)[0]
+        offset = skip_properties(body, 2) if session.protocol == MQTT_5 else 2
+
+        codes = bytearray()
+        while offset < len(body):
+            topic_filter, offset = decode_string(body, offset)
+            shared = _parse_shared(topic_filter)
+            if shared:
+                group = self.shared_groups.get(shared)
+                found = group is not None and group.members.pop(session.client_id, None) is not None
+                if group is not None and not group.members:
+                    del self.shared_groups[shared]
+            else:
+                found = session.subscriptions.pop(topic_filter, None) is not None
+            # MQTT 5 reason codes: success or no subscription existed
+            codes.append(0x00 if found else 0x11)
+
+        reply = struct.pack(">H", packet_id)
+        if session.protocol == MQTT_5:
+            reply += b"\x00" + bytes(codes)
+        session.send(build_packet(UNSUBACK, 0, reply))
+
+    def _send(self, session: _Session, message: Message, qos: int, retain: bool = False):
+        # A slow client misses messages rather than growing the memory of the broker
+        if session.is_congested(qos):
+            self.dropped += 1
+            return
+
+        packet_id = None
+        if qos:
+            packet_id = session.next_packet_id()
+            session.in_flight.add(packet_id)
+        session.send(encode_publish(message.topic, message.payload, qos, retain, packet_id, session.protocol))
+        self.delivered += 1
+
+    def _route(self, client_id: str, message: Message):
+        """
+        Deliver a message to every subscriber, and keep it if it is retained.
+        """
+        self.published += 1
+        if self.on_publish is not None:
+            self.on_publish(client_id, message)
+
+        if message.retain:
+            # An empty retained message clears the retained message of the topic
+            if message.payload:
+                self.retained[message.topic] = message
+            else:
+                self.retained.pop(message.topic, None)
+
+        # A client with several matching subscriptions gets the message once, at the highest QoS
+        recipients = {}
+        for session in self.sessions.values():
+            granted = [qos for topic_filter, qos in session.subscriptions.items()
+                       if topic_matches(topic_filter, message.topic)]
+            if granted:
+                recipients[session.client_id] = max(granted)
+
+        for (_, shared_filter), group in self.shared_groups.items():
+            if topic_matches(shared_filter, message.topic):
+                member, qos = group.pick()
+                recipients[member] = max(qos, recipients.get(member, 0))
+
+        for recipient, qos in recipients.items():
+            self._send(self.sessions[recipient], message, min(qos, message.qos))
+
+
+def main():
+    """
+    Run the broker until it is interrupted.
+    """
+    broker_env = dotenv.dotenv_values(os.path.join(REPO_ROOT, "broker", ".env"))
+
+    parser = argparse.ArgumentParser(description="Run the lightweight MQTT broker")
+    parser.add_argument("--host", default=broker_env.get("BROKER_HOST") or "127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=int(broker_env.get("BROKER_PORT") or 1883), help="Port to listen on")
+    args = parser.parse_args()
+
+    async def serve():
+        broker = MqttBroker(args.host, args.port)
+        await broker.start()
+        print(f"Broker running on port {args.port}", flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await broker.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
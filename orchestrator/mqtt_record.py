@@ -0,0 +1,606 @@
+"""
+MQTT traffic recorder and replay.
+
+The recorder connects to the broker, subscribes to # and appends every
+message to a recording directory. A recording is a series of append-only
+segment files of up to --segment-size bytes. Every record of a segment is a
+fixed header (receive time in nanoseconds, topic length, QoS and retain
+flags, payload length) followed by the topic and the payload.
+
+Next to every segment, a sparse index holds one entry per block of about
+--index-interval bytes of records: the time of its first and last message,
+its offset, its number of messages and a 64 bit mask of the hashes of its
+topics. A replay seeks to the first block of its time range with a binary
+search, and skips the blocks that can not hold any of the topics it replays
+when the topics are given without wildcards. The records written after the
+last index entry, e.g. when the recorder was killed, are still replayed.
+
+The replay memory-maps the segments, so a recording of any size is replayed
+without being loaded in memory, and re-publishes the messages at their
+recorded pace (--speed 1), N times faster (--speed N) or as fast as possible
+(--speed 0).
+
+Usage:
+    python -m orchestrator.mqtt_record record --duration 60
+    python -m orchestrator.mqtt_record info .orchestrator/recordings/20240101-120000
+    python -m orchestrator.mqtt_record replay .orchestrator/recordings/20240101-120000 --speed 10 --topics "user/#"
+"""
+import argparse
+import asyncio
+import bisect
+import glob
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import NamedTuple
+
+import dotenv
+
+from orchestrator.mqtt import MqttClient, topic_matches
+
+# Root of the repository, the tools read the broker address from it and keep the recordings in its state dir
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_RECORDINGS_DIR = os.path.join(REPO_ROOT, ".orchestrator", "recordings")
+
+# Header of a segment: magic and creation time in nanoseconds
+SEGMENT_MAGIC = b"MQTTSEG1"
+SEGMENT_HEADER = struct.Struct(">8sQ")
+# Header of a record: receive time in nanoseconds, topic length, flags (QoS << 1 | retain) and payload length
+RECORD_HEADER = struct.Struct(">QHBI")
+# Entry of the index: first and last time, offset of the block, number of records and topic mask
+INDEX_ENTRY = struct.Struct(">QQQIQ")
+
+SEGMENT_EXTENSION = ".seg"
+INDEX_EXTENSION = ".idx"
+
+# QoS 1 and 2 messages waiting for their acknowledgement during a replay
+MAX_IN_FLIGHT = 1000
+
+
+class IndexEntry(NamedTuple):
+    """
+    A block of records of a segment.
+    """
+    first_time: int
+    last_time: int
+    offset: int
+    count: int
+    topic_mask: int
+
+
+class Record(NamedTuple):
+    """
+    A recorded message. Only its own payload is copied out of the memory-mapped segment.
+    """
+    timestamp: int
+    topic: str
+    payload: bytes
+    qos: int
+    retain: bool
+
+
+def get_topic_mask(topic: str) -> int:
+    """
+    Get the bit of a topic in the topic mask of an index entry.
+    """
+    return 1 << (zlib.crc32(topic.encode()) & 63)
+
+
+class SegmentWriter:
+    """
+    Append messages to the segments of a recording.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the recording. It is created if it does not exist
+    max_segment_bytes : int
+        Size at which the next segment is started
+    index_interval : int
+        Bytes of records per index entry
+    """
+
+    def __init__(self, directory: str, max_segment_bytes: int = 64 * 1024 * 1024, index_interval: int = 64 * 1024):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.index_interval = index_interval
+        self.messages = 0
+        self.bytes_written = 0
+
+        os.makedirs(directory, exist_ok=True)
+        existing = glob.glob(os.path.join(directory, f"*{SEGMENT_EXTENSION}"))
+        self._segment_number = len(existing)
+        self._segment = None
+        self._index = None
+        self._block = None
+        self._open_segment()
+
+    def _open_segment(self):
+        self._segment_number += 1
+        base = os.path.join(self.directory, f"{self._segment_number:08d}")
+        self._segment = open(f"{base}{SEGMENT_EXTENSION}", "wb", buffering=1024 * 1024)
+        self._index = open(f"{base}{INDEX_EXTENSION}", "wb")
+        self._segment.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, time.time_ns()))
+        self._offset = SEGMENT_HEADER.size
+
+    def _flush_block(self):
+        """
+        Write the index entry of the current block. The records are flushed first,
+        so an entry never points past the data on disk.
+        """
+        if self._block is None:
+            return
+
+        self._segment.flush()
+        self._index.write(INDEX_ENTRY.pack(*self._block))
+        self._index.flush()
+        self._block = None
+
+    def write(self, timestamp: int, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        """
+        Append a message.
+
+        Parameters
+        ----------
+        timestamp : int
+            Time the message was received, in nanoseconds since the epoch
+        topic : str
+            Topic of the message
+        payload : bytes
+            Payload of the message
+        qos : int
+            QoS the message was received with
+        retain : bool
+            Retain flag of the message
+        """
+        encoded_topic = topic.encode()
+        record = (RECORD_HEADER.pack(timestamp, len(encoded_topic), (qos << 1) | int(retain), len(payload))
+                  + encoded_topic + payload)
+
+        if self._offset + len(record) > self.max_segment_bytes and self._offset > SEGMENT_HEADER.size:
+            self._flush_block()
+            self._segment.close()
+            self._index.close()
+            self._open_segment()
+
+        if self._block is None:
+            self._block = IndexEntry(timestamp, timestamp, self._offset, 0, 0)
+        self._block = IndexEntry(self._block.first_time, timestamp, self._block.offset, self._block.count + 1,
+                                 self._block.topic_mask | get_topic_mask(topic))
+
+        self._segment.write(record)
+        self._offset += len(record)
+        self.messages += 1
+        self.bytes_written += len(record)
+
+        if self._offset - self._block.offset >= self.index_interval:
+            self._flush_block()
+
+    def close(self):
+        """
+        Index the last block and close the segment.
+        """
+        if self._segment is None:
+            return
+
+        self._flush_block()
+        self._segment.close()
+        self._index.close()
+        self._segment = None
+
+
+class SegmentReader:
+    """
+    A memory-mapped segment and its index.
+
+    Parameters
+    ----------
+    path : str
+        Path of the segment file
+
+    Raises
+    ------
+    ValueError
+        If the file is not a segment
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.created_at = SEGMENT_HEADER.unpack_from(self._map, 0)
+        if magic != SEGMENT_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a segment of an MQTT recording")
+
+        self.blocks = self._load_index()
+
+    def _load_index(self) -> list:
+        blocks = []
+        index_path = os.path.splitext(self.path)[0] + INDEX_EXTENSION
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                data = f.read()
+            # A partly written entry at the end is ignored
+            for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+                blocks.append(IndexEntry(*INDEX_ENTRY.unpack_from(data, offset)))
+
+        # The records after the last entry were not indexed, they make one more block
+        tail_offset = self._skip_records(blocks[-1].offset, blocks[-1].count) if blocks else SEGMENT_HEADER.size
+        tail = self._scan_block(tail_offset)
+        if tail is not None:
+            blocks.append(tail)
+
+        return blocks
+
+    def _read_record(self, offset: int) -> tuple:
+        """
+        Read the record at an offset.
+
+        Returns
+        -------
+        tuple
+            The record and the offset of the next one, or None and the offset if the record is incomplete
+        """
+        if offset + RECORD_HEADER.size > len(self._map):
+            return None, offset
+
+        timestamp, topic_length, flags, payload_length = RECORD_HEADER.unpack_from(self._map, offset)
+        topic_start = offset + RECORD_HEADER.size
+        payload_start = topic_start + topic_length
+        end = payload_start + payload_length
+        if end > len(self._map):
+            return None, offset
+
+        topic = self._map[topic_start:payload_start].decode()
+        payload = self._map[payload_start:end]
+        return Record(timestamp, topic, payload, flags >> 1, bool(flags & 0x01)), end
+
+    def _skip_records(self, offset: int, count: int) -> int:
+        for _ in range(count):
+            if offset + RECORD_HEADER.size > len(self._map):
+                break
+            _, topic_length, _, payload_length = RECORD_HEADER.unpack_from(self._map, offset)
+            offset += RECORD_HEADER.size + topic_length + payload_length
+        return offset
+
+    def _scan_block(self, offset: int):
+        """
+        Build the index entry of the records from an offset to the end of the segment.
+        """
+        block = None
+        while True:
+            record, next_offset = self._read_record(offset)
+            if record is None:
+                return block
+            if block is None:
+                block = IndexEntry(record.timestamp, record.timestamp, offset, 0, 0)
+            block = block._replace(last_time=record.timestamp, count=block.count + 1,
+                                   topic_mask=block.topic_mask | get_topic_mask(record.topic))
+            offset = next_offset
+
+    def records(self, start_time: int = None, end_time: int = None, topic_mask: int = None):
+        """
+        Iterate over the records of the segment.
+
+        Parameters
+        ----------
+        start_time : int
+            Skip the records received before this time, in nanoseconds since the epoch
+        end_time : int
+            Stop at the first record received at or after this time
+        topic_mask : int
+            Skip the blocks whose topic mask has none of these bits
+
+        Yields
+        ------
+        Record
+            The records in the order they were received
+        """
+        first_block = 0
+        if start_time is not None:
+            # The blocks are in time order, so the first block that ends after start_time is found by bisection
+            last_times = [block.last_time for block in self.blocks]
+            first_block = bisect.bisect_left(last_times, start_time)
+
+        for block in self.blocks[first_block:]:
+            if end_time is not None and block.first_time >= end_time:
+                return
+            if topic_mask is not None and not block.topic_mask & topic_mask:
+                continue
+
+            offset = block.offset
+            for _ in range(block.count):
+                record, offset = self._read_record(offset)
+                if record is None:
+                    return
+                if start_time is not None and record.timestamp < start_time:
+                    continue
+                if end_time is not None and record.timestamp >= end_time:
+                    return
+                yield record
+
+    def close(self):
+        self._map.close()
+
+
+def open_recording(directory: str) -> list:
+    """
+    Open the segments of a recording in order.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the recording
+
+    Returns
+    -------
+    list
+        List of SegmentReader
+
+    Raises
+    ------
+    FileNotFoundError
+        If the directory holds no segment
+    """
+    paths = sorted(glob.glob(os.path.join(directory, f"*{SEGMENT_EXTENSION}")))
+    if not paths:
+        raise FileNotFoundError(f"No recording in {directory}")
+
+    return [SegmentReader(path) for path in paths]
+
+
+def iter_recording(segments: list, start_time: int = None, end_time: int = None, topic_filters: list = None):
+    """
+    Iterate over the records of a recording, optionally in a time range and for some topics.
+
+    Parameters
+    ----------
+    segments : list
+        List of SegmentReader, in order
+    start_time : int
+        Skip the records received before this time, in nanoseconds since the epoch
+    end_time : int
+        Stop at the first record received at or after this time
+    topic_filters : list
+        Only yield the records whose topic matches one of these filters. The + and # wildcards are supported
+
+    Yields
+    ------
+    Record
+        The records in the order they were received
+    """
+    topic_mask = None
+    # The index can only skip blocks for topics given without wildcards
+    if topic_filters and not any("+" in topic_filter or "#" in topic_filter for topic_filter in topic_filters):
+        topic_mask = 0
+        for topic_filter in topic_filters:
+            topic_mask |= get_topic_mask(topic_filter)
+
+    for segment in segments:
+        if segment.blocks and end_time is not None and segment.blocks[0].first_time >= end_time:
+            return
+        for record in segment.records(start_time, end_time, topic_mask):
+            if topic_filters and not any(topic_matches(topic_filter, record.topic) for topic_filter in topic_filters):
+                continue
+            yield record
+
+
+async def record_traffic(host: str, port: int, directory: str, duration: float = None, topic_filter: str = "#",
+                         max_segment_bytes: int = 64 * 1024 * 1024, index_interval: int = 64 * 1024) -> SegmentWriter:
+    """
+    Record the messages published to the broker until the duration is over or the task is cancelled.
+
+    Parameters
+    ----------
+    host : str
+        Host of the broker
+    port : int
+        Port of the broker
+    directory : str
+        Directory of the recording
+    duration : float
+        Seconds to record for, forever if None
+    topic_filter : str
+        Topic filter to subscribe to
+    max_segment_bytes : int
+        Size at which the next segment is started
+    index_interval : int
+        Bytes of records per index entry
+
+    Returns
+    -------
+    SegmentWriter
+        The closed writer, with the number of messages and bytes recorded
+    """
+    writer = SegmentWriter(directory, max_segment_bytes, index_interval)
+
+    def on_message(message):
+        writer.write(time.time_ns(), message.topic, message.payload, message.qos, message.retain)
+
+    client = MqttClient(host, port, f"recorder-{os.getpid()}", on_message=on_message)
+    try:
+        await client.connect()
+        # QoS 2 lets the broker deliver every message with the QoS it was published with
+        await client.subscribe(topic_filter, 2)
+        print(f"Recording {topic_filter} from {host}:{port} to {directory}")
+
+        closed = asyncio.ensure_future(client.closed)
+        await asyncio.wait([closed], timeout=duration)
+        if closed.done():
+            print("The broker closed the connection")
+    finally:
+        await client.disconnect()
+        writer.close()
+
+    return writer
+
+
+async def replay_recording(directory: str, host: str, port: int, speed: float = 1, topic_filters: list = None,
+                           start: float = 0, end: float = None, qos: int = None) -> dict:
+    """
+    Publish the messages of a recording again.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the recording
+    host : str
+        Host of the broker
+    port : int
+        Port of the broker
+    speed : float
+        1 keeps the recorded pace, N replays N times faster and 0 as fast as possible
+    topic_filters : list
+        Only replay the messages whose topic matches one of these filters
+    start : float
+        Seconds after the first message of the recording to start the replay at
+    end : float
+        Seconds after the first message of the recording to stop the replay at
+    qos : int
+        QoS to publish with, the recorded QoS by default
+
+    Returns
+    -------
+    dict
+        Number of messages and bytes published, the duration of the replay and how late the replay got at worst
+    """
+    segments = open_recording(directory)
+    recording_start = next((segment.blocks[0].first_time for segment in segments if segment.blocks), 0)
+    start_time = recording_start + int(start * 1e9) if start else None
+    end_time = recording_start + int(end * 1e9) if end is not None else None
+
+    client = MqttClient(host, port, f"replay-{os.getpid()}")
+    await client.connect()
+
+    stats = {"messages": 0, "bytes": 0, "duration": 0.0, "max_lag": 0.0}
+    in_flight = set()
+    window = asyncio.Semaphore(MAX_IN_FLIGHT)
+    first_time = None
+    replay_start = time.monotonic()
+    try:
+        for record in iter_recording(segments, start_time, end_time, topic_filters):
+            if first_time is None:
+                first_time = record.timestamp
+                replay_start = time.monotonic()
+
+            if speed > 0:
+                due = replay_start + (record.timestamp - first_time) / 1e9 / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    stats["max_lag"] = max(stats["max_lag"], -delay)
+
+            message_qos = record.qos if qos is None else qos
+            payload = record.payload
+            if message_qos:
+                # The acknowledgements are awaited in the background so that they do not slow the replay down
+                await window.acquire()
+                task = asyncio.create_task(client.publish(record.topic, payload, message_qos, record.retain))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                task.add_done_callback(lambda _: window.release())
+            else:
+                await client.publish(record.topic, payload, 0, record.retain)
+
+            stats["messages"] += 1
+            stats["bytes"] += len(payload)
+
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=10)
+        stats["duration"] = time.monotonic() - replay_start
+    finally:
+        await client.disconnect()
+        for segment in segments:
+            segment.close()
+
+    return stats
+
+
+def format_info(directory: str) -> str:
+    """
+    Describe a recording from the indexes of its segments.
+    """
+    segments = open_recording(directory)
+    try:
+        rows = [f"{'segment':<16} {'size MiB':>9} {'blocks':>7} {'messages':>9} {'first':>23} {'seconds':>9}"]
+        total = 0
+        for segment in segments:
+            messages = sum(block.count for block in segment.blocks)
+            total += messages
+            first = segment.blocks[0].first_time if segment.blocks else segment.created_at
+            last = segment.blocks[-1].last_time if segment.blocks else first
+            first_text = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(first / 1e9))
+            rows.append(f"{os.path.basename(segment.path):<16} {os.path.getsize(segment.path) / 2 ** 20:>9.2f} "
+                        f"{len(segment.blocks):>7} {messages:>9} {first_text:>23} {(last - first) / 1e9:>9.1f}")
+        rows.append(f"{len(segments)} segments, {total} messages")
+    finally:
+        for segment in segments:
+            segment.close()
+
+    return "\n".join(rows)
+
+
+def main():
+    """
+    Record the traffic of the broker, describe a recording or replay it.
+    """
+    broker_env = dotenv.dotenv_values(os.path.join(REPO_ROOT, "broker", ".env"))
+    default_host = broker_env.get("BROKER_HOST") or "127.0.0.1"
+    default_port = int(broker_env.get("BROKER_PORT") or 1883)
+
+    parser = argparse.ArgumentParser(description="Record the MQTT traffic of the stack and replay it")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="Record every message published to the broker")
+    record_parser.add_argument("directory", nargs="?", help="Directory of the recording, a new one in .orchestrator/recordings by default")
+    record_parser.add_argument("--duration", type=float, help="Seconds to record for, until Ctrl-C by default")
+    record_parser.add_argument("--topic", default="#", help="Topic filter to record")
+    record_parser.add_argument("--segment-size", type=int, default=64 * 1024 * 1024, help="Size in bytes at which a new segment is started")
+    record_parser.add_argument("--index-interval", type=int, default=64 * 1024, help="Bytes of records per index entry")
+
+    info_parser = subparsers.add_parser("info", help="Describe a recording")
+    info_parser.add_argument("directory", help="Directory of the recording")
+
+    replay_parser = subparsers.add_parser("replay", help="Publish the messages of a recording again")
+    replay_parser.add_argument("directory", help="Directory of the recording")
+    replay_parser.add_argument("--speed", type=float, default=1, help="1 keeps the recorded pace, N replays N times faster, 0 as fast as possible")
+    replay_parser.add_argument("--topics", nargs="+", help="Only replay the messages matching these topic filters")
+    replay_parser.add_argument("--start", type=float, default=0, help="Seconds into the recording to start at")
+    replay_parser.add_argument("--end", type=float, help="Seconds into the recording to stop at")
+    replay_parser.add_argument("--qos", type=int, choices=[0, 1, 2], help="QoS to publish with, the recorded one by default")
+
+    for subparser in (record_parser, replay_parser):
+        subparser.add_argument("--host", default=default_host, help="Host of the broker")
+        subparser.add_argument("--port", type=int, default=default_port, help="Port of the broker")
+
+    args = parser.parse_args()
+
+    if args.command == "info":
+        print(format_info(args.directory))
+        return
+
+    if args.command == "record":
+        directory = args.directory or os.path.join(DEFAULT_RECORDINGS_DIR, time.strftime("%Y%m%d-%H%M%S"))
+        task = record_traffic(args.host, args.port, directory, args.duration, args.topic, args.segment_size,
+                              args.index_interval)
+        try:
+            writer = asyncio.run(task)
+            print(f"Recorded {writer.messages} messages, {writer.bytes_written / 2 ** 20:.2f} MiB to {directory}")
+        except KeyboardInterrupt:
+            print(f"Recording stopped, saved to {directory}")
+        return
+
+    stats = asyncio.run(replay_recording(args.directory, args.host, args.port, args.speed, args.topics, args.start,
+                                         args.end, args.qos))
+    rate = stats["messages"] / stats["duration"] if stats["duration"] else 0
+    print(f"Replayed {stats['messages']} messages, {stats['bytes'] / 2 ** 20:.2f} MiB in {stats['duration']:.1f}s "
+          f"({rate:.0f} messages/s), at most {stats['max_lag'] * 1000:.1f}ms behind schedule")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+"""
+Live request/reply latency tracer of the MQTT traffic.
+
+The gateway publishes every request to a service as a JSON object carrying a
+correlationId and the replyTopic to answer on, and the service publishes its
+reply to that topic with the same correlationId. The tracer subscribes to
+every topic, remembers each request by its reply topic and correlationId,
+and records the time until its reply in the histogram of the request topic.
+As both messages are seen through the broker, the latency covers the service
+and the broker hop of the reply, which is what the gateway waits for.
+
+Memory is bounded whatever the traffic:
+- the statistics of every topic are kept in a ring of fixed size windows,
+  each with a fixed size histogram, so the numbers reported cover the last
+  windows * window seconds and older windows are reused;
+- the requests waiting for a reply are capped and expire after a timeout;
+- the number of topics is capped, the extra ones are counted as (other).
+
+The tracer can run on its own against any broker, or inside main.py with
+--trace, where it is fed by the hook of the embedded broker when there is one.
+
+Usage:
+    python -m orchestrator.mqtt_trace --interval 5 --top 10
+    python -m orchestrator.mqtt_trace --duration 60 --prometheus .orchestrator/trace.prom
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+
+import dotenv
+
+from orchestrator.histogram import LatencyHistogram
+from orchestrator.mqtt import MqttClient
+
+# Root of the repository, the tracer reads the broker address from it
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Topic the statistics of the topics above the cap are counted under
+OTHER_TOPIC = "(other)"
+
+# Seconds between two writes of the Prometheus text file
+EXPORT_INTERVAL = 5
+
+# Only the payloads holding this key can be requests or replies, the others are not parsed
+CORRELATION_KEY = b'"correlationId"'
+
+
+class _Window:
+    """
+    Statistics of one topic during one window of time.
+    """
+
+    def __init__(self, window_id: int):
+        self.window_id = window_id
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.replies = 0
+        self.request_bytes = 0
+        self.reply_bytes = 0
+
+    def reset(self, window_id: int):
+        self.window_id = window_id
+        self.latency.reset()
+        self.requests = 0
+        self.replies = 0
+        self.request_bytes = 0
+        self.reply_bytes = 0
+
+
+class TopicStats:
+    """
+    Rolling statistics of the requests of one topic.
+
+    Parameters
+    ----------
+    windows : int
+        Number of windows kept
+    """
+
+    def __init__(self, windows: int):
+        self.windows = [_Window(-1) for _ in range(windows)]
+        self.total_requests = 0
+        self.total_replies = 0
+        self.total_bytes = 0
+        self.timeouts = 0
+
+    def get_window(self, window_id: int) -> _Window:
+        """
+        Get the window of a window id, reusing the slot of the oldest window.
+        """
+        window = self.windows[window_id % len(self.windows)]
+        if window.window_id != window_id:
+            window.reset(window_id)
+        return window
+
+    def recent(self, window_id: int) -> list:
+        """
+        Get the windows that are not older than the ring, the current one included.
+        """
+        return [window for window in self.windows if window_id - len(self.windows) < window.window_id <= window_id]
+
+
+class LatencyTracer:
+    """
+    Pair requests with their replies and keep rolling statistics per request topic.
+
+    Parameters
+    ----------
+    window : float
+        Seconds per window
+    windows : int
+        Number of windows kept, the statistics cover the last window * windows seconds
+    reply_timeout : float
+        Seconds after which a request without reply is counted as timed out
+    max_pending : int
+        Largest number of requests waiting for a reply. The oldest ones are counted as timed out beyond that
+    max_topics : int
+        Largest number of request topics. The requests of the other topics are counted under (other)
+    prometheus_path : str
+        Prometheus text file the statistics are written to every EXPORT_INTERVAL seconds while messages flow, if given
+    """
+
+    def __init__(self, window: float = 10, windows: int = 6, reply_timeout: float = 30, max_pending: int = 100000,
+                 max_topics: int = 1000, prometheus_path: str = None):
+        self.window = window
+        self.window_count = windows
+        self.reply_timeout = reply_timeout
+        self.max_pending = max_pending
+        self.max_topics = max_topics
+        self.prometheus_path = prometheus_path
+
+        self.topics = {}
+        # Requests waiting for a reply by reply topic and correlation id, oldest first
+        self.pending = {}
+        self.started_at = time.monotonic()
+        self._next_export = self.started_at + EXPORT_INTERVAL
+        self._lock = threading.Lock()
+
+    def _get_stats(self, topic: str) -> TopicStats:
+        stats = self.topics.get(topic)
+        if stats is None:
+            if len(self.topics) >= self.max_topics:
+                topic = OTHER_TOPIC
+            stats = self.topics.setdefault(topic, TopicStats(self.window_count))
+        return stats
+
+    def _expire(self, now: float):
+        """
+        Count the requests that waited too long, and the oldest ones above the cap, as timed out.
+        """
+        while self.pending:
+            key = next(iter(self.pending))
+            sent_at, topic = self.pending[key]
+            if now - sent_at < self.reply_timeout and len(self.pending) <= self.max_pending:
+                break
+            del self.pending[key]
+            self._get_stats(topic).timeouts += 1
+
+    def observe(self, topic: str, payload: bytes, now: float = None):
+        """
+        Look at a message published to the broker.
+
+        Parameters
+        ----------
+        topic : str
+            Topic of the message
+        payload : bytes
+            Payload of the message
+        now : float
+            time.monotonic() value of the time the message was seen, the current time by default
+        """
+        if CORRELATION_KEY not in payload:
+            return
+
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+
+        correlation_id = data.get("correlationId")
+        if not isinstance(correlation_id, str):
+            return
+
+        now = time.monotonic() if now is None else now
+        window_id = int(now / self.window)
+        reply_topic = data.get("replyTopic")
+
+        with self._lock:
+            if isinstance(reply_topic, str):
+                stats = self._get_stats(topic)
+                window = stats.get_window(window_id)
+                window.requests += 1
+                window.request_bytes += len(payload)
+                stats.total_requests += 1
+                stats.total_bytes += len(payload)
+                self.pending[(reply_topic, correlation_id)] = (now, topic)
+            else:
+                request = self.pending.pop((topic, correlation_id), None)
+                if request is None:
+                    return
+                sent_at, request_topic = request
+                stats = self._get_stats(request_topic)
+                window = stats.get_window(window_id)
+                window.replies += 1
+                window.reply_bytes += len(payload)
+                window.latency.record((now - sent_at) * 1e6)
+                stats.total_replies += 1
+                stats.total_bytes += len(payload)
+
+            self._expire(now)
+
+        if self.prometheus_path is not None and now >= self._next_export:
+            self._next_export = now + EXPORT_INTERVAL
+            self.write_prometheus(self.prometheus_path)
+
+    def summarize(self, now: float = None) -> list:
+        """
+        Summarize the recent statistics of every request topic.
+
+        Returns
+        -------
+        list
+            One dict per topic, slowest first by p99 latency, with the rates of requests, replies and bytes per second,
+            the p50, p99 and max latency in milliseconds, the requests waiting for a reply and the timeouts
+        """
+        now = time.monotonic() if now is None else now
+        window_id = int(now / self.window)
+        # The current window is only partly over
+        span = min(self.window * (self.window_count - 1) + now % self.window, now - self.started_at) or 1
+
+        with self._lock:
+            self._expire(now)
+            in_flight = {}
+            for _, topic in self.pending.values():
+                in_flight[topic] = in_flight.get(topic, 0) + 1
+
+            summary = []
+            for topic, stats in self.topics.items():
+                windows = stats.recent(window_id)
+                latency = LatencyHistogram()
+                for window in windows:
+                    latency.merge(window.latency)
+
+                summary.append({
+                    "topic": topic,
+                    "requests_per_s": sum(window.requests for window in windows) / span,
+                    "replies_per_s": sum(window.replies for window in windows) / span,
+                    "bytes_per_s": sum(window.request_bytes + window.reply_bytes for window in windows) / span,
+                    "p50_ms": latency.percentile(50) / 1000,
+                    "p99_ms": latency.percentile(99) / 1000,
+                    "max_ms": (latency.max or 0) / 1000,
+                    "in_flight": in_flight.get(topic, 0),
+                    "requests": stats.total_requests,
+                    "replies": stats.total_replies,
+                    "bytes": stats.total_bytes,
+                    "timeouts": stats.timeouts,
+                })
+
+        summary.sort(key=lambda entry: entry["p99_ms"], reverse=True)
+        return summary
+
+    def format_top(self, count: int = 10) -> str:
+        """
+        Format the slowest request topics as a table.
+        """
+        rows = [f"{'topic':<32} {'req/s':>8} {'reply/s':>8} {'KiB/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+                f"{'waiting':>8} {'timeouts':>8}"]
+        for entry in self.summarize()[:count]:
+            rows.append(f"{entry['topic']:<32} {entry['requests_per_s']:>8.1f} {entry['replies_per_s']:>8.1f} "
+                        f"{entry['bytes_per_s'] / 1024:>8.1f} {entry['p50_ms']:>8.2f} {entry['p99_ms']:>8.2f} "
+                        f"{entry['max_ms']:>8.2f} {entry['in_flight']:>8} {entry['timeouts']:>8}")
+        return "\n".join(rows)
+
+    def write_prometheus(self, path: str):
+        """
+        Write the statistics of every request topic to a file in the Prometheus text format.
+        The file is replaced atomically so a scraper never reads half of it.
+
+        Parameters
+        ----------
+        path : str
+            Path of the Prometheus text file
+        """
+        summary = self.summarize()
+        lines = ["# TYPE orchestrator_mqtt_reply_latency_ms gauge"]
+        for entry in summary:
+            for quantile, key in (("0.5", "p50_ms"), ("0.99", "p99_ms"), ("1", "max_ms")):
+                lines.append(f'orchestrator_mqtt_reply_latency_ms{{topic="{entry["topic"]}",quantile="{quantile}"}} '
+                             f'{entry[key]:.3f}')
+        for metric, key in (("requests", "requests"), ("replies", "replies"), ("bytes", "bytes"), ("timeouts", "timeouts")):
+            lines.append(f"# TYPE orchestrator_mqtt_{metric}_total counter")
+            for entry in summary:
+                lines.append(f'orchestrator_mqtt_{metric}_total{{topic="{entry["topic"]}"}} {entry[key]}')
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+async def run_tracer(tracer: LatencyTracer, host: str, port: int, topic_filter: str = "#", interval: float = 5,
+                     top: int = 10, duration: float = None, stop_event: threading.Event = None):
+    """
+    Feed a tracer with the messages of a broker, printing the slowest topics every interval.
+
+    Parameters
+    ----------
+    tracer : LatencyTracer
+        The tracer to feed
+    host : str
+        Host of the broker
+    port : int
+        Port of the broker
+    topic_filter : str
+        Topic filter covering the requests and the replies
+    interval : float
+        Seconds between two reports. 0 disables them
+    top : int
+        Number of topics per report
+    duration : float
+        Seconds to trace for, until cancelled if None
+    stop_event : threading.Event
+        Stops the tracer when set, e.g. from another thread
+    """
+    client = MqttClient(host, port, f"tracer-{os.getpid()}",
+                        on_message=lambda message: tracer.observe(message.topic, message.payload))
+    await client.connect()
+    await client.subscribe(topic_filter)
+
+    deadline = time.monotonic() + duration if duration is not None else None
+    next_report = time.monotonic() + interval
+    try:
+        while not client.closed.done() and (deadline is None or time.monotonic() < deadline):
+            if stop_event is not None and stop_event.is_set():
+                break
+            await asyncio.sleep(0.1)
+
+            if interval and time.monotonic() >= next_report:
+                next_report += interval
+                print(f"\n{tracer.format_top(top)}")
+    finally:
+        await client.disconnect()
+        if tracer.prometheus_path is not None:
+            tracer.write_prometheus(tracer.prometheus_path)
+
+
+class TracerClient:
+    """
+    Run run_tracer in a background thread, without periodic reports.
+
+    Parameters
+    ----------
+    tracer : LatencyTracer
+        The tracer to feed
+    host : str
+        Host of the broker
+    port : int
+        Port of the broker
+    """
+
+    def __init__(self, tracer: LatencyTracer, host: str, port: int):
+        self.tracer = tracer
+        self.host = host
+        self.port = port
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        try:
+            asyncio.run(run_tracer(self.tracer, self.host, self.port, interval=0, stop_event=self._stop_event))
+        except Exception as e:
+            print(f"The MQTT tracer stopped:\n{e!r}")
+
+    def start(self):
+        """
+        Start tracing in a background thread.
+        """
+        self._thread = threading.Thread(target=self._run, name="mqtt-tracer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop tracing. Does nothing if the tracer is not running.
+        """
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join(5)
+        self._thread = None
+
+
+def main():
+    """
+    Trace the request/reply latency of the stack until interrupted.
+    """
+    broker_env = dotenv.dotenv_values(os.path.join(REPO_ROOT, "broker", ".env"))
+
+    parser = argparse.ArgumentParser(description="Trace the request/reply latency of every MQTT topic")
+    parser.add_argument("--host", default=broker_env.get("BROKER_HOST") or "127.0.0.1", help="Host of the broker")
+    parser.add_argument("--port", type=int, default=int(broker_env.get("BROKER_PORT") or 1883), help="Port of the broker")
+    parser.add_argument("--topic", default="#", help="Topic filter covering the requests and the replies")
+    parser.add_argument("--interval", type=float, default=5, help="Seconds between two reports")
+    parser.add_argument("--top", type=int, default=10, help="Number of topics per report")
+    parser.add_argument("--window", type=float, default=10, help="Seconds per statistics window")
+    parser.add_argument("--windows", type=int, default=6, help="Number of windows the statistics cover")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds after which a request without reply times out")
+    parser.add_argument("--duration", type=float, help="Seconds to trace for, until Ctrl-C by default")
+    parser.add_argument("--prometheus", help="Keep the statistics in this Prometheus text file")
+    args = parser.parse_args()
+
+    tracer = LatencyTracer(args.window, args.windows, args.timeout, prometheus_path=args.prometheus)
+    print(f"Tracing {args.topic} on {args.host}:{args.port}")
+    try:
+        asyncio.run(run_tracer(tracer, args.host, args.port, args.topic, args.interval, args.top, args.duration))
+    except KeyboardInterrupt:
+        pass
+
+    print(f"\n{tracer.format_top(args.top)}")
+
+
+if __name__ == "__main__":
+    main()
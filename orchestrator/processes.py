@@ -0,0 +1,229 @@
+"""
+Process handles of the components and the teardown of the stack.
+
+Every component is started in its own session, so it is the leader of a
+process group that holds its whole tree (sh -> npm -> node -> ...). The
+stack is torn down in reverse dependency order: the gateway first, then the
+services, the broker and finally the mongod instances. All the components of
+a tier are signalled at once and waited on together, so a tier takes as long
+as its slowest component instead of the sum of all of them. The mongod
+instances are asked to shut down cleanly so that the next boot does not have
+to recover their WiredTiger journal.
+"""
+import os
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import psutil
+
+from orchestrator import mongo_wire
+
+# Order in which the kinds of components are torn down
+TEARDOWN_ORDER = ["gateway", "service", "broker", "database"]
+
+
+class ProcessHandle(NamedTuple):
+    """
+    A process spawned by the orchestrator.
+
+    Attributes
+    ----------
+    process : subprocess.Popen
+        The spawned process. It is the leader of its own process group
+    out_file : file
+        The file the output of the process is saved to
+    err_file : file
+        The file the errors of the process are saved to
+    name : str
+        Name of the component
+    kind : str
+        Kind of the component, one of "database", "broker", "service" or "gateway"
+    port : int
+        Port the component listens on, if it is known
+    """
+    process: object
+    out_file: object
+    err_file: object
+    name: str
+    kind: str = "service"
+    port: int = None
+
+
+def _collect_tree(pid: int) -> list:
+    """
+    Get a process and all of its children, or an empty list if it is already gone.
+    """
+    try:
+        parent = psutil.Process(pid)
+        return [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+def _signal_tree(pid: int, processes: list, sig: int):
+    """
+    Send a signal to the process group led by pid and to every process of its tree,
+    as a child may have moved to another group.
+    """
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    for process in processes:
+        try:
+            process.send_signal(sig)
+        except psutil.NoSuchProcess:
+            pass
+
+
+def _is_running(process: psutil.Process) -> bool:
+    """
+    Check if a process is still running. A zombie has exited, even if nobody reaped it yet,
+    which happens when the process was reparented to a PID 1 that does not reap (e.g. in a container).
+    """
+    try:
+        # is_running() also makes sure that the PID was not reused by another process
+        return process.is_running() and process.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def _wait_gone(handles: list, processes: list, timeout: float) -> list:
+    """
+    Wait until every process has exited or the timeout expires.
+
+    Returns
+    -------
+    list
+        The processes that are still running
+    """
+    deadline = time.monotonic() + timeout
+    alive = list(processes)
+
+    while alive:
+        # Reap the processes we spawned so that they do not stay around as zombies
+        for handle in handles:
+            handle.process.poll()
+
+        alive = [process for process in alive if _is_running(process)]
+        if not alive or time.monotonic() >= deadline:
+            break
+        time.sleep(0.02)
+
+    return alive
+
+
+def _shutdown_mongo(handle: ProcessHandle) -> bool:
+    """
+    Ask a mongod instance to shut down cleanly.
+
+    Returns
+    -------
+    bool
+        True if the shutdown command was sent, False if the instance could not be reached
+    """
+    try:
+        with mongo_wire.MongoConnection("127.0.0.1", handle.port, timeout=5) as connection:
+            connection.command("admin", {"shutdown": 1})
+    except ConnectionError:
+        # mongod closes the connection without answering once it shuts down
+        return True
+    except (OSError, mongo_wire.MongoCommandError):
+        return False
+
+    return True
+
+
+def terminate_tier(handles: list, grace_period: float) -> list:
+    """
+    Terminate the process trees of a tier of components at once.
+    Every tree gets SIGTERM (or a shutdown command for mongod), then a single wait covers the whole tier,
+    and the processes that are still alive after grace_period seconds are killed.
+
+    Parameters
+    ----------
+    handles : list
+        List of ProcessHandle of the tier
+    grace_period : float
+        Seconds to wait for the processes to terminate gracefully before killing them
+
+    Returns
+    -------
+    list
+        List of the names of the components that had to be killed
+    """
+    trees = {handle.name: _collect_tree(handle.process.pid) for handle in handles}
+
+    # Ask the mongod instances to shut down cleanly, in parallel as each command waits for a reply
+    databases = [handle for handle in handles if handle.kind == "database" and handle.port is not None]
+    shut_down = set()
+    if databases:
+        with ThreadPoolExecutor(max_workers=len(databases)) as executor:
+            for handle, sent in zip(databases, executor.map(_shutdown_mongo, databases)):
+                if sent:
+                    shut_down.add(handle.name)
+
+    for handle in handles:
+        if handle.name not in shut_down:
+            _signal_tree(handle.process.pid, trees[handle.name], signal.SIGTERM)
+
+    # One wait for the whole tier
+    alive = _wait_gone(handles, [process for tree in trees.values() for process in tree], grace_period)
+    alive_pids = {process.pid for process in alive}
+
+    killed = []
+    for handle in handles:
+        stragglers = [process for process in trees[handle.name] if process.pid in alive_pids]
+        if stragglers:
+            _signal_tree(handle.process.pid, stragglers, signal.SIGKILL)
+            killed.append(handle.name)
+
+    _wait_gone(handles, alive, 1)
+
+    return killed
+
+
+def kill_process_tree(process):
+    """
+    Kill the tree of a process right away and reap it, e.g. when a component fails after its process was spawned
+    and before it got a handle that the teardown would find.
+
+    Parameters
+    ----------
+    process : subprocess.Popen
+        The spawned process, the leader of its own process group
+    """
+    _signal_tree(process.pid, _collect_tree(process.pid), signal.SIGKILL)
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        print(f"Process with PID {process.pid} did not exit after SIGKILL")
+
+
+def group_by_tier(handles: list) -> list:
+    """
+    Group process handles in teardown order.
+
+    Parameters
+    ----------
+    handles : list
+        List of ProcessHandle
+
+    Returns
+    -------
+    list
+        List of lists of ProcessHandle, the first tier has to be terminated first.
+        Handles of unknown kinds are terminated first
+    """
+    tiers = [[] for _ in range(len(TEARDOWN_ORDER) + 1)]
+    for handle in handles:
+        kind = getattr(handle, "kind", "service")
+        index = TEARDOWN_ORDER.index(kind) + 1 if kind in TEARDOWN_ORDER else 0
+        tiers[index].append(handle)
+
+    return [tier for tier in tiers if tier]
@@ -0,0 +1,350 @@
+"""
+Readiness engine used to know when the components of the stack are up.
+
+A component is ready when all of its checks pass:
+- LogFlagCheck tails a log file from its last offset and matches a green flag
+  in a streaming way, including a flag split across two reads.
+- TcpCheck connects to a port, e.g. the port of the broker.
+- MongoPingCheck sends a ping command to a mongod instance.
+
+Many components are waited on at once. On Linux the log files are watched
+with inotify so a green flag is seen as soon as it is written, elsewhere the
+files are polled with a cheap size check. A component that does not get
+ready in time raises a TimeoutError, and a component whose process exits
+before it is ready fails right away.
+"""
+import ctypes
+import ctypes.util
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+from orchestrator import mongo_wire
+
+
+class ComponentExitedError(RuntimeError):
+    """
+    Raised when the process of a component exits before the component is ready.
+    """
+
+
+class GreenFlagMatcher:
+    """
+    Find a green flag in a stream of chunks. The end of every chunk is kept so that
+    a flag split across two chunks is still found.
+
+    Parameters
+    ----------
+    green_flag : str
+        The string to look for
+    """
+
+    def __init__(self, green_flag: str):
+        self.green_flag = green_flag.encode()
+        self.found = False
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Feed the next chunk of the stream.
+
+        Parameters
+        ----------
+        chunk : bytes
+            The next chunk
+
+        Returns
+        -------
+        bool
+            True if the green flag was found in the stream so far
+        """
+        if self.found:
+            return True
+
+        data = self._tail + chunk
+        if self.green_flag in data:
+            self.found = True
+            self._tail = b""
+        else:
+            # Only keep what could be the start of the flag
+            self._tail = data[-(len(self.green_flag) - 1):] if len(self.green_flag) > 1 else b""
+
+        return self.found
+
+    def reset(self):
+        """
+        Forget everything that was fed so far.
+        """
+        self.found = False
+        self._tail = b""
+
+
+class LogFlagCheck:
+    """
+    Check that passes once a green flag is written to a log file.
+    Only the bytes written since the previous poll are read.
+
+    Parameters
+    ----------
+    log_file : str
+        Path to the log file
+    green_flag : str
+        The string to look for in the log file
+    """
+
+    def __init__(self, log_file: str, green_flag: str):
+        self.log_file = log_file
+        self.matcher = GreenFlagMatcher(green_flag)
+        self.offset = 0
+
+    def describe(self) -> str:
+        return f"green flag '{self.matcher.green_flag.decode()}'"
+
+    def poll(self) -> bool:
+        if self.matcher.found:
+            return True
+
+        try:
+            size = os.stat(self.log_file).st_size
+        except FileNotFoundError:
+            # Maybe it is not created yet
+            return False
+
+        # The file was truncated, e.g. the component was restarted
+        if size < self.offset:
+            self.offset = 0
+            self.matcher.reset()
+
+        if size == self.offset:
+            return False
+
+        with open(self.log_file, "rb") as f:
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+        self.offset += len(chunk)
+
+        return self.matcher.feed(chunk)
+
+
+class TcpCheck:
+    """
+    Check that passes once a TCP connection to a port is accepted.
+
+    Parameters
+    ----------
+    host : str
+        Host to connect to
+    port : int
+        Port to connect to
+    """
+    is_probe = True
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = int(port)
+
+    def describe(self) -> str:
+        return f"TCP connection to {self.host}:{self.port}"
+
+    def poll(self) -> bool:
+        try:
+            with socket.create_connection((self.host, self.port), timeout=0.5):
+                return True
+        except OSError:
+            return False
+
+
+class MongoPingCheck:
+    """
+    Check that passes once a mongod instance answers a ping command.
+
+    Parameters
+    ----------
+    host : str
+        Host of the mongod instance
+    port : int
+        Port of the mongod instance
+    """
+    is_probe = True
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = int(port)
+
+    def describe(self) -> str:
+        return f"mongod ping on {self.host}:{self.port}"
+
+    def poll(self) -> bool:
+        return mongo_wire.ping(self.host, self.port, timeout=0.5)
+
+
+class ReadinessTarget:
+    """
+    A component to wait for.
+
+    Parameters
+    ----------
+    name : str
+        Name of the component
+    checks : list
+        Checks that all have to pass for the component to be ready
+    process : Popen
+        If given, the wait fails as soon as this process exits
+    timeout : float
+        Number of seconds to wait for the component
+    """
+
+    def __init__(self, name: str, checks: list, process=None, timeout: float = 60):
+        self.name = name
+        self.checks = checks
+        self.process = process
+        self.timeout = timeout
+
+    def poll(self) -> bool:
+        # Poll every check, even after one failed, so that the log offsets keep up
+        results = [check.poll() for check in self.checks]
+        return all(results)
+
+
+class _Inotify:
+    """
+    Thin ctypes wrapper around inotify, used to wake up as soon as a log file is written.
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watched = set()
+
+    def watch(self, path: str):
+        if path in self._watched:
+            return
+
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self._watched.add(path)
+
+    def drain(self):
+        # The events themselves do not matter, every pending check is polled after a wake up
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _create_inotify():
+    """
+    Create an inotify instance, or return None where inotify is not available.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        return _Inotify()
+    except (OSError, AttributeError):
+        return None
+
+
+def wait_until_ready(targets: list, cancel_event: threading.Event = None, probe_interval: float = 0.1,
+                     poll_interval: float = 0.05):
+    """
+    Wait for every target to be ready.
+
+    Parameters
+    ----------
+    targets : list
+        List of ReadinessTarget to wait for
+    cancel_event : threading.Event
+        If given, stop waiting as soon as the event is set
+    probe_interval : float
+        Seconds between two rounds of TCP and mongod probes
+    poll_interval : float
+        Seconds between two polls of the log files when inotify is not available
+
+    Raises
+    ------
+    TimeoutError
+        If a target is not ready before its timeout
+    ComponentExitedError
+        If the process of a target exits before the target is ready
+    RuntimeError
+        If the cancel event is set
+    """
+    start_time = time.monotonic()
+    pending = list(targets)
+
+    # Watch the dirs of the log files, the files themselves may not exist yet
+    inotify = _create_inotify()
+    selector = selectors.DefaultSelector()
+    if inotify is not None:
+        try:
+            for target in pending:
+                for check in target.checks:
+                    if getattr(check, "log_file", None):
+                        inotify.watch(os.path.dirname(os.path.abspath(check.log_file)))
+            selector.register(inotify.fd, selectors.EVENT_READ)
+        except OSError:
+            inotify.close()
+            inotify = None
+
+    try:
+        while True:
+            for target in list(pending):
+                if target.poll():
+                    pending.remove(target)
+                    continue
+
+                # Fail early if the process exited. Poll once more as the flag may have been written right before
+                if target.process is not None and target.process.poll() is not None:
+                    if target.poll():
+                        pending.remove(target)
+                        continue
+                    raise ComponentExitedError(
+                        f"[{target.name}] Exited with code {target.process.returncode} before it was ready.")
+
+                if time.monotonic() - start_time >= target.timeout:
+                    failing = ", ".join(check.describe() for check in target.checks if not check.poll())
+                    raise TimeoutError(f"[{target.name}] Did not get ready in {target.timeout} seconds ({failing}).")
+
+            if not pending:
+                return
+
+            if cancel_event is not None and cancel_event.is_set():
+                raise RuntimeError(f"Cancelled while waiting for {', '.join(target.name for target in pending)}.")
+
+            # Sleep until a log file is written, the next probe round or the next timeout
+            has_probes = any(getattr(check, "is_probe", False) for target in pending for check in target.checks)
+            wait_time = probe_interval if has_probes else (0.25 if inotify is not None else poll_interval)
+            next_timeout = min(target.timeout for target in pending) - (time.monotonic() - start_time)
+            wait_time = max(0, min(wait_time, next_timeout))
+
+            if inotify is not None:
+                if selector.select(wait_time):
+                    inotify.drain()
+            elif cancel_event is not None:
+                cancel_event.wait(wait_time)
+            else:
+                time.sleep(wait_time)
+    finally:
+        selector.close()
+        if inotify is not None:
+            inotify.close()
+        # Checks fed by the output of a component stop listening to it, whether the target got ready or not
+        for target in targets:
+            for check in target.checks:
+                if hasattr(check, "close"):
+                    check.close()
@@ -0,0 +1,377 @@
+"""
+Runtime profiles of the components: node runtime options and CPU/IO placement.
+
+A profile sets, for one component or a kind of component:
+
+- the size of the libuv threadpool (UV_THREADPOOL_SIZE). bcrypt, crypto,
+  zlib and the fs calls of node run on it, and it has 4 threads by default,
+- the V8 heap limit (--max-old-space-size) and the size of the young
+  generation (--max-semi-space-size), given to node through NODE_OPTIONS so
+  that they reach the node process behind the npm, nodemon and sh wrappers,
+- the CPUs the component runs on, its nice value and its I/O priority.
+
+The placement is applied with psutil to the whole process tree of the
+component. The tree is placed again until the actual node (or mongod)
+process shows up, as the wrappers may have forked it before the first pass,
+and the processes it forks later inherit the placement.
+
+Usage:
+    python main.py --runtime user_service.threadpool=16 user_service.heap=1024
+    python main.py --placement auto --runtime database.ionice=be:2
+"""
+import os
+import threading
+import time
+from dataclasses import dataclass, field, fields, replace
+
+import psutil
+
+# Largest threadpool libuv accepts
+MAX_THREADPOOL_SIZE = 1024
+# libuv default
+DEFAULT_THREADPOOL_SIZE = 4
+
+# Keys of --runtime and the fields of RuntimeProfile they set
+PROFILE_KEYS = {
+    "threadpool": "threadpool_size",
+    "heap": "max_old_space_size",
+    "semi-space": "max_semi_space_size",
+    "node-options": "node_options",
+    "cpus": "cpus",
+    "nice": "nice",
+    "ionice": "ionice",
+}
+
+# The I/O scheduling classes only exist on Linux, the dict is empty elsewhere
+IONICE_CLASSES = {
+    name: getattr(psutil, attribute)
+    for name, attribute in (("idle", "IOPRIO_CLASS_IDLE"), ("be", "IOPRIO_CLASS_BE"), ("best-effort", "IOPRIO_CLASS_BE"))
+    if hasattr(psutil, attribute)
+}
+
+
+@dataclass
+class RuntimeProfile:
+    """
+    Runtime options and placement of a component. The options left to None are not changed.
+
+    Attributes
+    ----------
+    threadpool_size : int
+        Threads of the libuv threadpool
+    max_old_space_size : int
+        V8 heap limit in MB
+    max_semi_space_size : int
+        Size of a semi-space of the V8 young generation in MB. A larger young generation
+        means fewer scavenges for services that allocate a lot of short-lived objects
+    node_options : list
+        Other options added to NODE_OPTIONS
+    cpus : list
+        CPUs the component may run on
+    nice : int
+        Nice value, negative values need privileges
+    ionice : str
+        I/O scheduling class, "idle", "be" or "be:<level>" with a level from 0 (highest) to 7
+    """
+    threadpool_size: int = None
+    max_old_space_size: int = None
+    max_semi_space_size: int = None
+    node_options: list = field(default_factory=list)
+    cpus: list = None
+    nice: int = None
+    ionice: str = None
+
+    def merged(self, other: "RuntimeProfile") -> "RuntimeProfile":
+        """
+        Get a copy of the profile with the options set in other on top.
+        """
+        changes = {}
+        for profile_field in fields(self):
+            value = getattr(other, profile_field.name)
+            if profile_field.name == "node_options":
+                changes["node_options"] = self.node_options + value
+            elif value is not None:
+                changes[profile_field.name] = value
+        return replace(self, **changes)
+
+    def has_placement(self) -> bool:
+        return self.cpus is not None or self.nice is not None or self.ionice is not None
+
+    def describe(self) -> str:
+        parts = []
+        if self.threadpool_size is not None:
+            parts.append(f"threadpool {self.threadpool_size}")
+        if self.max_old_space_size is not None:
+            parts.append(f"heap {self.max_old_space_size}MB")
+        if self.max_semi_space_size is not None:
+            parts.append(f"semi-space {self.max_semi_space_size}MB")
+        if self.node_options:
+            parts.append(" ".join(self.node_options))
+        if self.cpus is not None:
+            parts.append(f"cpus {format_cpus(self.cpus)}")
+        if self.nice is not None:
+            parts.append(f"nice {self.nice}")
+        if self.ionice is not None:
+            parts.append(f"ionice {self.ionice}")
+        return ", ".join(parts) or "defaults"
+
+
+def parse_cpus(value: str) -> list:
+    """
+    Parse a CPU list such as 0-3,8.
+
+    Raises
+    ------
+    ValueError
+        If the list is malformed or names a CPU the host does not have
+    """
+    cpu_count = os.cpu_count() or 1
+    cpus = []
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        if not first.isdigit() or (last and not last.isdigit()):
+            raise ValueError(f"Invalid CPU list {value!r}, expected e.g. 0-3,8")
+        cpus.extend(range(int(first), int(last or first) + 1))
+
+    if not cpus or max(cpus) >= cpu_count:
+        raise ValueError(f"Invalid CPU list {value!r}, the host has CPUs 0-{cpu_count - 1}")
+    return sorted(set(cpus))
+
+
+def format_cpus(cpus: list) -> str:
+    """
+    Format a CPU list as ranges, e.g. 0-3,8.
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def parse_ionice(value: str) -> tuple:
+    """
+    Parse an I/O scheduling class into the psutil class and level.
+
+    Raises
+    ------
+    ValueError
+        If the class is unknown, the level is out of range or the platform has no I/O scheduling classes
+    """
+    if not IONICE_CLASSES:
+        raise ValueError(f"Invalid ionice {value!r}, the I/O scheduling classes are only supported on Linux")
+
+    name, _, level = value.partition(":")
+    if name not in IONICE_CLASSES or (level and (name == "idle" or not level.isdigit() or int(level) > 7)):
+        raise ValueError(f"Invalid ionice {value!r}, expected idle, be or be:<0-7>")
+    return IONICE_CLASSES[name], int(level) if level else None
+
+
+def parse_runtime_profiles(values: list, names: list) -> dict:
+    """
+    Parse the runtime options given as NAME.KEY=VALUE.
+
+    Parameters
+    ----------
+    values : list
+        List of strings such as user_service.threadpool=16, user_service.0.cpus=2-3 or database.ionice=be:2
+    names : list
+        Names a profile may be given to: components, services and kinds of components
+
+    Returns
+    -------
+    dict
+        The profile of every name given
+
+    Raises
+    ------
+    ValueError
+        If a value is malformed or names an unknown component or key
+    """
+    profiles = {}
+    for value in values:
+        target, _, option = value.partition("=")
+        name, _, key = target.rpartition(".")
+        if name not in names:
+            raise ValueError(f"Unknown component {name!r} in --runtime {value!r}, expected one of {', '.join(names)}")
+        if key not in PROFILE_KEYS:
+            raise ValueError(f"Unknown runtime option {key!r} in {value!r}, expected one of {', '.join(PROFILE_KEYS)}")
+
+        profile_field = PROFILE_KEYS[key]
+        if key == "cpus":
+            parsed = parse_cpus(option)
+        elif key == "ionice":
+            parse_ionice(option)
+            parsed = option
+        elif key == "node-options":
+            parsed = option.split()
+        else:
+            try:
+                parsed = int(option)
+            except ValueError:
+                raise ValueError(f"Invalid number in --runtime {value!r}")
+            if key == "threadpool" and not 1 <= parsed <= MAX_THREADPOOL_SIZE:
+                raise ValueError(f"Invalid threadpool size in {value!r}, expected 1 to {MAX_THREADPOOL_SIZE}")
+            if key in ("heap", "semi-space") and parsed < 1:
+                raise ValueError(f"Invalid size in {value!r}, expected a number of MB")
+
+        profiles[name] = profiles.get(name, RuntimeProfile()).merged(RuntimeProfile(**{profile_field: parsed}))
+
+    return profiles
+
+
+def plan_placement(hot_services: list, cpu_count: int = None) -> dict:
+    """
+    Split the CPUs between the mongod instances, the hot services and the other components, so that
+    they stop contending for the same cores. The hot services get the largest share and a threadpool
+    as large as their share.
+
+    Parameters
+    ----------
+    hot_services : list
+        Services doing CPU bound work on the threadpool, such as hashing passwords with bcrypt
+    cpu_count : int
+        Number of CPUs of the host, all of them by default
+
+    Returns
+    -------
+    dict
+        Profiles for every kind of component and for every hot service,
+        or an empty dict if the host has less than 3 CPUs to split
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    if cpu_count < 3:
+        return {}
+
+    # A quarter of the CPUs for the mongod instances, a quarter for the broker, the gateway and the other services
+    database_count = max(1, cpu_count // 4)
+    other_count = max(1, cpu_count // 4)
+    other_cpus = list(range(0, other_count))
+    hot_cpus = list(range(other_count, cpu_count - database_count))
+    database_cpus = list(range(cpu_count - database_count, cpu_count))
+
+    plan = {
+        "database": RuntimeProfile(cpus=database_cpus),
+        "broker": RuntimeProfile(cpus=other_cpus),
+        "service": RuntimeProfile(cpus=other_cpus),
+        "gateway": RuntimeProfile(cpus=other_cpus),
+    }
+    for service in hot_services:
+        plan[service] = RuntimeProfile(cpus=hot_cpus, threadpool_size=max(DEFAULT_THREADPOOL_SIZE, len(hot_cpus)))
+    return plan
+
+
+def apply_runtime_env(profile: RuntimeProfile, env: dict):
+    """
+    Set the node runtime options of a profile in the environment of a component.
+    NODE_OPTIONS reaches every node process of the component, including the one behind npm and nodemon.
+    """
+    if profile.threadpool_size is not None:
+        env["UV_THREADPOOL_SIZE"] = str(profile.threadpool_size)
+
+    node_options = []
+    if profile.max_old_space_size is not None:
+        node_options.append(f"--max-old-space-size={profile.max_old_space_size}")
+    if profile.max_semi_space_size is not None:
+        node_options.append(f"--max-semi-space-size={profile.max_semi_space_size}")
+    node_options.extend(profile.node_options)
+
+    if node_options:
+        env["NODE_OPTIONS"] = " ".join(filter(None, [env.get("NODE_OPTIONS", "")] + node_options))
+
+
+def _place(process: psutil.Process, profile: RuntimeProfile, warnings: set, unsupported: set):
+    """
+    Apply the placement of a profile to a single process. Missing privileges are reported once per option,
+    and the options the platform does not support are reported once and no longer tried.
+    """
+    options = []
+    if profile.cpus is not None:
+        options.append(("cpus", lambda: process.cpu_affinity(profile.cpus)))
+    if profile.nice is not None:
+        options.append(("nice", lambda: process.nice(profile.nice)))
+    if profile.ionice is not None:
+        ioclass, level = parse_ionice(profile.ionice)
+        options.append(("ionice", lambda: process.ionice(ioclass, level) if level is not None else process.ionice(ioclass)))
+
+    for option, apply in options:
+        if option in unsupported:
+            continue
+        try:
+            apply()
+        except psutil.NoSuchProcess:
+            return
+        except (psutil.AccessDenied, PermissionError):
+            warnings.add(option)
+        except (AttributeError, NotImplementedError):
+            # cpu_affinity and ionice do not exist on macOS
+            unsupported.add(option)
+
+
+def place_process_tree(name: str, pid: int, profile: RuntimeProfile, target: str = "node", timeout: float = 30,
+                       interval: float = 0.1) -> threading.Thread:
+    """
+    Apply the placement of a profile to the process tree of a component in a background thread.
+    The tree is placed again every interval until a process named target is in it.
+
+    Parameters
+    ----------
+    name : str
+        Name of the component, for the messages
+    pid : int
+        PID of the root of the tree, the process spawned by the orchestrator
+    profile : RuntimeProfile
+        The profile to apply
+    target : str
+        Name of the process the profile is meant for, e.g. node or mongod
+    timeout : float
+        Seconds to keep looking for the target process
+    interval : float
+        Seconds between two passes over the tree
+
+    Returns
+    -------
+    threading.Thread
+        The thread placing the tree, or None if the profile has no placement
+    """
+    if not profile.has_placement():
+        return None
+
+    def run():
+        warnings = set()
+        unsupported = set()
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                root = psutil.Process(pid)
+                tree = [root] + root.children(recursive=True)
+            except psutil.NoSuchProcess:
+                return
+
+            for process in tree:
+                _place(process, profile, warnings, unsupported)
+
+            targets = []
+            for process in tree:
+                try:
+                    if process.name() == target:
+                        targets.append(process.pid)
+                except psutil.NoSuchProcess:
+                    pass
+
+            if targets or time.monotonic() >= deadline:
+                break
+            time.sleep(interval)
+
+        placed = f"{target} {', '.join(map(str, targets))}" if targets else f"{len(tree)} processes, no {target} found"
+        print(f"Placed {name} ({placed})")
+        if warnings:
+            print(f"Could not set the {', '.join(sorted(warnings))} of {name}, it needs more privileges")
+        if unsupported:
+            print(f"Could not set the {', '.join(sorted(unsupported))} of {name}, it is not supported on this platform")
+
+    thread = threading.Thread(target=run, name=f"place-{name}", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,227 @@
+"""
+Split the Postman collection across several isolated test stacks.
+
+`python main.py --test --profile prod --shards K` runs K test stacks side by
+side on one host. Every stack is a child `main.py --test` with its own ports,
+given to its packages as environment overrides, its own logs dir and its own
+dbpaths. The collection is split on its top-level items: a folder is never
+split, so the requests of a folder still run in order against the same stack.
+The items are spread over the shards by their number of requests, largest
+first, and keep their order within a shard. The gateway port in the URLs of
+every shard is rewritten to the gateway of its stack.
+
+Every child runs its shard with newman and saves its JSON report, which are
+merged into a single report and exit code.
+"""
+import copy
+import json
+import re
+import socket
+
+# Statistics of a newman run that are summed across the shards
+REPORT_STATS = ["requests", "tests", "assertions", "testScripts", "prerequestScripts"]
+
+
+def allocate_ports(count: int, host: str = "127.0.0.1") -> list:
+    """
+    Get ports that are free on the host. All the ports are held until every port is allocated,
+    so they are distinct, but another process may take one before it is used.
+
+    Parameters
+    ----------
+    count : int
+        Number of ports
+    host : str
+        Host the ports are allocated on
+
+    Returns
+    -------
+    list
+        The port numbers
+    """
+    sockets = []
+    try:
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.bind((host, 0))
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def replace_uri_port(uri: str, port: int) -> str:
+    """
+    Point a URI such as mqtt://127.0.0.1:1884 or mongodb://localhost:27021/user to another port of the same host.
+
+    Raises
+    ------
+    ValueError
+        If the URI has no scheme and host
+    """
+    match = re.match(r"^([a-z][a-z0-9+.-]*://(?:[^@/]*@)?)([^/:?,]+)(?::\d+)?(.*)$", uri, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid URI {uri!r}")
+
+    prefix, host, rest = match.groups()
+    return f"{prefix}{host}:{port}{rest}"
+
+
+def count_requests(item: dict) -> int:
+    """
+    Count the requests of a collection item, a request or a folder.
+    """
+    if "item" not in item:
+        return 1
+    return sum(count_requests(child) for child in item["item"])
+
+
+def split_collection(collection: dict, shard_count: int) -> list:
+    """
+    Split a collection on its top-level items.
+
+    Parameters
+    ----------
+    collection : dict
+        The Postman collection
+    shard_count : int
+        Number of shards wanted
+
+    Returns
+    -------
+    list
+        One collection per shard, with the collection-level variables, scripts and auth of the original.
+        There are fewer shards than asked if the collection has fewer top-level items
+    """
+    items = collection.get("item", [])
+    shard_count = max(1, min(shard_count, len(items)))
+
+    # Longest processing time first: give the largest items to the least loaded shard
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    for index in sorted(range(len(items)), key=lambda index: -count_requests(items[index])):
+        shard = loads.index(min(loads))
+        shards[shard].append(index)
+        loads[shard] += count_requests(items[index])
+
+    collections = []
+    for shard_number, indexes in enumerate(shards):
+        shard_collection = copy.deepcopy({key: value for key, value in collection.items() if key != "item"})
+        shard_collection["item"] = [copy.deepcopy(items[index]) for index in sorted(indexes)]
+        shard_collection.setdefault("info", {})["name"] = (
+            f"{collection.get('info', {}).get('name', 'collection')} (shard {shard_number + 1}/{shard_count})")
+        collections.append(shard_collection)
+
+    return collections
+
+
+def rewrite_port(value, old_port: int, new_port: int):
+    """
+    Rewrite a port in every URL of a collection, in the raw URLs, the parsed URLs, the variables and the scripts.
+
+    Parameters
+    ----------
+    value : dict, list or str
+        The collection or a part of it
+    old_port : int
+        The port to replace, e.g. the port of the gateway in its .env file
+    new_port : int
+        The port of the gateway of the shard
+
+    Returns
+    -------
+    dict, list or str
+        A rewritten copy
+    """
+    if isinstance(value, dict):
+        rewritten = {key: rewrite_port(child, old_port, new_port) for key, child in value.items()}
+        # A parsed URL keeps its port apart from its host
+        if "host" in value and str(value.get("port")) == str(old_port):
+            rewritten["port"] = str(new_port)
+        return rewritten
+    if isinstance(value, list):
+        return [rewrite_port(child, old_port, new_port) for child in value]
+    if isinstance(value, str):
+        return re.sub(rf"(https?://[^/:\s\"'?#]+):{old_port}(?!\d)", rf"\g<1>:{new_port}", value)
+
+    return value
+
+
+def load_report(path: str) -> dict:
+    """
+    Load the JSON report of a newman run, or None if the run did not save one, e.g. because its stack did not boot.
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def merge_reports(results: list) -> dict:
+    """
+    Merge the results of the shards.
+
+    Parameters
+    ----------
+    results : list
+        One dict per shard with its "shard" number, "exit_code", "duration" in seconds, "log" path
+        and newman "report", which may be None
+
+    Returns
+    -------
+    dict
+        The summed statistics, the failures of every shard with their shard number, the shards and the merged exit code
+    """
+    stats = {name: {"total": 0, "failed": 0} for name in REPORT_STATS}
+    failures = []
+    shards = []
+
+    for result in results:
+        run = (result["report"] or {}).get("run", {})
+        for name in REPORT_STATS:
+            stat = run.get("stats", {}).get(name, {})
+            stats[name]["total"] += stat.get("total", 0)
+            stats[name]["failed"] += stat.get("failed", 0)
+
+        for failure in run.get("failures", []):
+            error = failure.get("error", {})
+            failures.append({
+                "shard": result["shard"],
+                "request": failure.get("source", {}).get("name"),
+                "test": error.get("test"),
+                "message": error.get("message"),
+            })
+
+        shards.append({
+            "shard": result["shard"],
+            "exit_code": result["exit_code"],
+            "duration": result["duration"],
+            "requests": run.get("stats", {}).get("requests", {}).get("total", 0),
+            "failed_assertions": run.get("stats", {}).get("assertions", {}).get("failed", 0),
+            "log": result["log"],
+            "report": result["report"] is not None,
+        })
+
+    exit_code = 0 if results and all(result["exit_code"] == 0 for result in results) else 1
+    return {"exit_code": exit_code, "stats": stats, "failures": failures, "shards": shards}
+
+
+def format_report(merged: dict) -> str:
+    """
+    Format the merged report as a table of the shards followed by the failures.
+    """
+    rows = [f"{'shard':>5} {'exit':>5} {'time':>8} {'requests':>9} {'failed':>7}  log"]
+    for shard in merged["shards"]:
+        rows.append(f"{shard['shard']:>5} {shard['exit_code']:>5} {shard['duration']:>7.1f}s {shard['requests']:>9} "
+                    f"{shard['failed_assertions']:>7}  {shard['log']}{'' if shard['report'] else ' (no report)'}")
+
+    stats = merged["stats"]
+    rows.append(f"\n{stats['requests']['total']} requests, {stats['assertions']['total']} assertions, "
+                f"{stats['assertions']['failed']} failed")
+
+    for failure in merged["failures"]:
+        rows.append(f"  shard {failure['shard']}: {failure['request']} - {failure['test']}: {failure['message']}")
+
+    return "\n".join(rows)
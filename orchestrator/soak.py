@@ -0,0 +1,291 @@
+"""
+Soak test of the stack: a steady load for a long time, and the trends of the components under it.
+
+Leaks and slow degradations of the long-lived services (an MQTT client or
+mongoose connections that pile up listeners, buffers or sockets) only show up
+after hours. The soak test sends the requests of the Postman collection to
+the gateway at a constant rate for the whole duration, in windows of
+--soak-window seconds, while the telemetry sampler records the RSS and the
+open fds of the process tree of every component.
+
+Once the load is over, a line is fitted by least squares to the RSS and the
+fds of every component and to the p99 latency of the windows, after a
+warmup during which the JIT, the caches and the connection pools fill up.
+A trend is flagged when its slope is above its threshold and the line
+explains most of the variance (R² of at least --soak-min-r2), so that the
+sawtooth of the garbage collector or a single slow window is not taken for
+growth. The report names every flagged component and its growth rate.
+"""
+import asyncio
+import json
+import math
+import os
+import time
+from typing import NamedTuple
+
+from orchestrator.http_load import REPORT_HEADER, format_step, load_postman_requests, run_profile
+from orchestrator.telemetry import TelemetrySampler
+
+MIB = 1024 * 1024
+
+
+class Trend(NamedTuple):
+    """
+    A line fitted to a series of samples.
+
+    Attributes
+    ----------
+    slope : float
+        Growth per hour
+    start : float
+        Value of the line at the first sample
+    r2 : float
+        Coefficient of determination, 1 when the samples are on the line
+    samples : int
+        Number of samples fitted
+    """
+    slope: float
+    start: float
+    r2: float
+    samples: int
+
+
+def fit_trend(times: list, values: list) -> Trend:
+    """
+    Fit a line to a series by least squares.
+
+    Parameters
+    ----------
+    times : list
+        Times of the samples in seconds
+    values : list
+        Values of the samples
+
+    Returns
+    -------
+    Trend
+        The fitted line, or None if there are less than 3 samples or they are all at the same time
+    """
+    count = len(times)
+    if count < 3:
+        return None
+
+    mean_time = sum(times) / count
+    mean_value = sum(values) / count
+    time_variance = sum((sample_time - mean_time) ** 2 for sample_time in times)
+    if time_variance == 0:
+        return None
+
+    covariance = sum((sample_time - mean_time) * (value - mean_value) for sample_time, value in zip(times, values))
+    slope = covariance / time_variance
+    intercept = mean_value - slope * mean_time
+
+    total = sum((value - mean_value) ** 2 for value in values)
+    residual = sum((value - (intercept + slope * sample_time)) ** 2 for sample_time, value in zip(times, values))
+    # A flat series is perfectly explained by a flat line
+    r2 = 1 - residual / total if total > 0 else 1.0
+
+    return Trend(slope * 3600, intercept + slope * times[0], r2, count)
+
+
+def is_growing(trend: Trend, threshold: float, min_r2: float, relative: bool = False) -> bool:
+    """
+    Tell if a trend grows faster than a threshold per hour, steadily enough to not be noise.
+    A relative threshold is a fraction of the start value per hour.
+    """
+    if trend is None or trend.r2 < min_r2:
+        return False
+    if relative:
+        return trend.start > 0 and trend.slope / trend.start > threshold
+    return trend.slope > threshold
+
+
+def analyze_soak(sampler: TelemetrySampler, windows: list, started_at: float, warmup: float, rss_growth: float,
+                 fd_growth: float, p99_drift: float, min_r2: float, max_error_rate: float, exited: list) -> dict:
+    """
+    Fit the trends of the soak test and flag the ones beyond their thresholds.
+
+    Parameters
+    ----------
+    sampler : TelemetrySampler
+        The sampler that recorded the components during the load
+    windows : list
+        List of (end time, StepResult) of the windows of the load
+    started_at : float
+        Time the load started at
+    warmup : float
+        Seconds at the start of the load that are not fitted
+    rss_growth : float
+        RSS growth of a component above which it is flagged, in MiB per hour
+    fd_growth : float
+        Growth of the open fds of a component above which it is flagged, per hour
+    p99_drift : float
+        Growth of the p99 latency above which it is flagged, as a fraction of the p99 after the warmup per hour
+    min_r2 : float
+        Trends that explain less of the variance of their samples are not flagged
+    max_error_rate : float
+        Fraction of failed requests above which the run is flagged
+    exited : list
+        Components whose process exited during the load
+
+    Returns
+    -------
+    dict
+        The trends of every component, the latency trend, the errors and the list of findings
+    """
+    fitted_from = started_at + warmup
+    components = []
+    findings = []
+
+    for name, ring in sampler.rings.items():
+        rows = [(timestamp, values) for timestamp, values in ring.rows() if fitted_from <= timestamp]
+        times = [timestamp - started_at for timestamp, _ in rows]
+        rss = fit_trend(times, [values[1] / MIB for _, values in rows])
+        fds = fit_trend(times, [values[3] for _, values in rows])
+
+        component = {"component": name, "rss": rss._asdict() if rss else None, "fds": fds._asdict() if fds else None}
+        components.append(component)
+
+        if is_growing(rss, rss_growth, min_r2):
+            findings.append(f"{name}: RSS grows by {rss.slope:.1f} MiB/h from {rss.start:.1f} MiB (R² {rss.r2:.2f})")
+        if is_growing(fds, fd_growth, min_r2):
+            findings.append(f"{name}: open fds grow by {fds.slope:.1f}/h from {fds.start:.0f} (R² {fds.r2:.2f})")
+
+    for name in exited:
+        findings.append(f"{name}: exited during the soak test")
+
+    # Every window is fitted at its middle
+    fitted_windows = [(end - result.duration / 2 - started_at, result) for end, result in windows
+                      if end - result.duration / 2 >= fitted_from]
+    latency = fit_trend([window_time for window_time, _ in fitted_windows],
+                        [result.latency.percentile(99) / 1000 for _, result in fitted_windows])
+    if is_growing(latency, p99_drift, min_r2, relative=True):
+        findings.append(f"gateway: p99 latency drifts by {latency.slope:.2f} ms/h from {latency.start:.2f} ms "
+                        f"({100 * latency.slope / latency.start:.0f}%/h, R² {latency.r2:.2f})")
+
+    sent = sum(result.sent for _, result in windows)
+    failed = sum(result.errors + result.dropped for _, result in windows)
+    error_rate = failed / sent if sent else 0.0
+    if error_rate > max_error_rate:
+        findings.append(f"gateway: {100 * error_rate:.2f}% of the {sent} requests failed")
+
+    return {
+        "components": sorted(components, key=lambda component: -(component["rss"] or {}).get("slope", 0)),
+        "p99_ms": latency._asdict() if latency else None,
+        "requests": sent,
+        "error_rate": error_rate,
+        "findings": findings,
+    }
+
+
+def _format_trend(trend: dict, unit: str, digits: int) -> str:
+    if trend is None:
+        return f"{'-':>10} {'-':>10} {'-':>5}"
+    return f"{trend['start']:>10.{digits}f} {trend['slope']:>+8.{digits}f}{unit} {trend['r2']:>5.2f}"
+
+
+def format_soak_report(report: dict) -> str:
+    """
+    Format the trends of the components, followed by the findings.
+    """
+    rows = [f"{'component':<24} {'rss MiB':>10} {'MiB/h':>10} {'R²':>5} {'fds':>10} {'fds/h':>10} {'R²':>5}"]
+    for component in report["components"]:
+        rows.append(f"{component['component']:<24} {_format_trend(component['rss'], '  ', 1)} "
+                    f"{_format_trend(component['fds'], '  ', 1)}")
+
+    latency = report["p99_ms"]
+    if latency is not None:
+        rows.append(f"\ngateway p99 {latency['start']:.2f} ms, {latency['slope']:+.2f} ms/h (R² {latency['r2']:.2f}) "
+                    f"over {latency['samples']} windows")
+    rows.append(f"{report['requests']} requests, {100 * report['error_rate']:.2f}% failed")
+
+    if report["findings"]:
+        rows.append("\nSoak test failed:")
+        rows.extend(f"  {finding}" for finding in report["findings"])
+    else:
+        rows.append("\nNo growth or drift beyond the thresholds.")
+
+    return "\n".join(rows)
+
+
+def run_soak_test(base_url: str, collection_path: str, handles: list, duration: float, rate: float, window: float = 60,
+                  sample_interval: float = 5, warmup: float = 120, rss_growth: float = 10, fd_growth: float = 10,
+                  p99_drift: float = 0.2, min_r2: float = 0.5, max_error_rate: float = 0.01, connections: int = 64,
+                  timeout: float = 10, report_path: str = None) -> int:
+    """
+    Run a soak test against the running stack and print its report.
+
+    Parameters
+    ----------
+    base_url : str
+        URL of the gateway
+    collection_path : str
+        Postman collection to take the requests from
+    handles : list
+        The ProcessHandle of the components
+    duration : float
+        Seconds of load
+    rate : float
+        Requests per second
+    window : float
+        Seconds per window of load, the p99 latency is measured per window
+    sample_interval : float
+        Seconds between two samples of the components
+    warmup : float
+        Seconds at the start of the load that are not fitted
+    rss_growth, fd_growth, p99_drift, min_r2, max_error_rate
+        Thresholds, see analyze_soak
+    connections : int
+        Maximum number of keep-alive connections to the gateway
+    timeout : float
+        Seconds after which a request counts as an error
+    report_path : str
+        If given, the report is saved to this JSON file
+
+    Returns
+    -------
+    int
+        0 if nothing was flagged, 1 otherwise
+    """
+    requests = load_postman_requests(collection_path)
+    if not requests:
+        raise ValueError(f"No request in {collection_path}")
+
+    window_count = max(1, math.ceil(duration / window))
+    if warmup >= duration:
+        print(f"The warmup of {warmup:.0f}s is as long as the soak test, nothing would be fitted")
+        warmup = 0
+
+    sampler = TelemetrySampler(handles, sample_interval, capacity=int(duration / sample_interval) + 16, uss_every=10 ** 9)
+    windows = []
+    started_at = time.time()
+
+    def on_window(result):
+        windows.append((time.time(), result))
+        elapsed = time.time() - started_at
+        print(f"[{elapsed / 60:>6.1f} min] {format_step(result)}")
+
+    print(f"\nSoak test of {base_url}: {rate:.0f} req/s for {duration:.0f}s in windows of {window:.0f}s, "
+          f"{len(requests)} requests from the collection, components sampled every {sample_interval:.0f}s")
+    print(f"{'':>12} {REPORT_HEADER}")
+
+    sampler.start()
+    try:
+        asyncio.run(run_profile(base_url, requests, [rate] * window_count, duration / window_count, connections, timeout,
+                                on_step=on_window))
+    finally:
+        sampler.stop()
+
+    exited = [handle.name for handle in handles if handle.process.poll() is not None]
+    report = analyze_soak(sampler, windows, started_at, warmup, rss_growth, fd_growth, p99_drift, min_r2,
+                          max_error_rate, exited)
+    report.update({"duration": duration, "rate": rate, "window": window, "warmup": warmup})
+
+    print(f"\n{format_soak_report(report)}")
+    if report_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Soak report saved to {report_path}")
+
+    return 1 if report["findings"] else 0
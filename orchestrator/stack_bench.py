@@ -0,0 +1,328 @@
+"""
+Benchmark of the phases of the orchestrator itself, against stub components.
+
+Every scenario builds a throwaway copy of the layout of the repository (the
+broker, the services and the gateway, with their .env files on free ports)
+and puts stubs of npm, npx, node and mongod on the PATH (see
+orchestrator/bench_stub.py). It then runs the real code of main.py: the
+component graph, the spawn_* functions, the readiness checks and
+cleanup_processes. The stubs are ready after known delays, so the time the
+orchestrator adds on top of them is what is measured:
+
+- graph: building the component graph
+- cold_boot: the first boot, which installs and builds the packages
+- boot: the next boots, with the install and build caches up to date
+- ready_overhead: the longest time a component waited on top of its own start delay,
+  the latency of the readiness checks
+- teardown: cleanup_processes
+
+The medians of the phases are compared to a baseline saved with
+--save-baseline, and the benchmark fails if one of them got slower than the
+baseline by more than the tolerance. No node or mongod is needed.
+
+Usage:
+    python -m orchestrator.stack_bench --save-baseline
+    python -m orchestrator.stack_bench
+    python -m orchestrator.stack_bench --scenarios stubborn --iterations 5
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from orchestrator.bench_stub import CONFIG_ENV, DEFAULT_CONFIG
+from orchestrator.shards import allocate_ports
+
+# Root of the repository, main.py is imported from it
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_BASELINE_PATH = os.path.join(REPO_ROOT, ".orchestrator", "stack_bench_baseline.json")
+STUB_PATH = os.path.join(REPO_ROOT, "orchestrator", "bench_stub.py")
+
+# Same layout as the repository
+SERVICES = ["user_service", "ad_service", "chat_service", "notification_service", "admin_service"]
+SERVICES_WITHOUT_DATABASE = ["notification_service"]
+DATABASE_NAMES = {"user_service": "user", "ad_service": "ad", "chat_service": "chat", "admin_service": "admin"}
+
+# Stub config and stack options of every scenario
+SCENARIOS = {
+    # The prod profile, the usual boot
+    "prod": {
+        "stub": {},
+        "options": {"profile": "prod"},
+    },
+    # Test mode, which also drops the databases before the services start
+    "test": {
+        "stub": {},
+        "options": {"profile": "prod", "is_testing": True},
+    },
+    # A single shared mongod and the embedded broker
+    "shared": {
+        "stub": {},
+        "options": {"profile": "prod", "mongo_mode": "shared", "broker": "embedded"},
+    },
+    # Components with child processes that ignore SIGTERM, the teardown has to kill them
+    "stubborn": {
+        "stub": {"children": 2, "depth": 2, "ignore_sigterm": True},
+        "options": {"profile": "prod"},
+    },
+}
+
+PHASES = ["graph", "cold_boot", "boot", "ready_overhead", "teardown"]
+
+
+def write_stub_executables(bin_dir: str):
+    """
+    Write the npm, npx, node and mongod wrappers that run the stub.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for executable in ["npm", "npx", "node", "mongod"]:
+        path = os.path.join(bin_dir, executable)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{STUB_PATH}" {executable} "$@"\n')
+        os.chmod(path, 0o755)
+
+
+def create_tree(root: str) -> dict:
+    """
+    Create the packages of the stack with their .env and .env.test files on free ports.
+
+    Returns
+    -------
+    dict
+        The paths of the tree, as main.py computes them from the repository
+    """
+    broker_port, gateway_port, *database_ports = allocate_ports(2 + len(DATABASE_NAMES))
+    paths = {
+        "services_root": os.path.join(root, "services"),
+        "broker_path": os.path.join(root, "broker"),
+        "gateway_path": os.path.join(root, "api_gateway"),
+        "logs_dir": os.path.join(root, "logs"),
+        "state_dir": os.path.join(root, ".orchestrator"),
+        "mongo_base_path": os.path.join(root, "mongo_data"),
+    }
+
+    packages = {paths["broker_path"]: {"BROKER_PORT": broker_port, "BROKER_HOST": "127.0.0.1"},
+                paths["gateway_path"]: {"BROKER_URI": f"mqtt://127.0.0.1:{broker_port}", "GATEWAY_PORT": gateway_port,
+                                        "GATEWAY_HOST": "127.0.0.1"}}
+    for service in SERVICES:
+        packages[os.path.join(paths["services_root"], service)] = {"BROKER_URI": f"mqtt://127.0.0.1:{broker_port}"}
+    for (service, database_name), port in zip(DATABASE_NAMES.items(), database_ports):
+        env = packages[os.path.join(paths["services_root"], service)]
+        env["DATABASE_URI"] = f"mongodb://localhost:{port}/{database_name}"
+
+    for package_path, env in packages.items():
+        os.makedirs(os.path.join(package_path, "src"), exist_ok=True)
+        with open(os.path.join(package_path, "package.json"), "w") as f:
+            json.dump({"name": os.path.basename(package_path), "version": "1.0.0"}, f)
+        with open(os.path.join(package_path, "package-lock.json"), "w") as f:
+            json.dump({"lockfileVersion": 3}, f)
+        with open(os.path.join(package_path, "tsconfig.json"), "w") as f:
+            json.dump({"compilerOptions": {"outDir": "dist"}}, f)
+        with open(os.path.join(package_path, "src", "app.ts"), "w") as f:
+            f.write("export {};\n")
+
+        for env_file_name, suffix in ((".env", ""), (".env.test", "-test")):
+            with open(os.path.join(package_path, env_file_name), "w") as f:
+                for key, value in env.items():
+                    if key == "DATABASE_URI":
+                        value = f"{value}{suffix}"
+                    f.write(f"{key}={value}\n")
+
+    os.makedirs(paths["logs_dir"], exist_ok=True)
+    return paths
+
+
+def get_ready_overhead(graph, timings: dict, delays: dict) -> float:
+    """
+    Get the longest time a component took to be ready on top of the start delay of its stub.
+    """
+    overheads = [ready_at - started_at - delays.get(graph[name].kind, 0)
+                 for name, (started_at, ready_at) in timings.items() if graph[name].kind != "task"]
+    return max(overheads, default=0)
+
+
+def run_scenario(name: str, iterations: int, grace_period: float, log_file) -> dict:
+    """
+    Boot and tear down the stack of a scenario several times.
+
+    Parameters
+    ----------
+    name : str
+        Name of the scenario in SCENARIOS
+    iterations : int
+        Number of boots. The first one is the cold boot
+    grace_period : float
+        Seconds cleanup_processes waits for the components to stop before killing them
+    log_file : file
+        File the output of the orchestrator is written to
+
+    Returns
+    -------
+    dict
+        The list of the timings in seconds of every phase
+    """
+    import main as stack
+
+    scenario = SCENARIOS[name]
+    root = tempfile.mkdtemp(prefix=f"stack-bench-{name}-")
+    samples = {phase: [] for phase in PHASES}
+
+    try:
+        paths = create_tree(root)
+        write_stub_executables(os.path.join(root, "bin"))
+
+        stub_config = dict(DEFAULT_CONFIG)
+        stub_config.update(scenario["stub"])
+        stub_config_path = os.path.join(root, "stub_config.json")
+        with open(stub_config_path, "w") as f:
+            json.dump(stub_config, f)
+
+        options = stack.StackOptions(mongo_base_path=paths["mongo_base_path"], **scenario["options"])
+        env_file_name = ".env.test" if options.is_testing else ".env"
+
+        environ = dict(os.environ)
+        os.environ["PATH"] = f"{os.path.join(root, 'bin')}{os.pathsep}{os.environ.get('PATH', '')}"
+        os.environ[CONFIG_ENV] = stub_config_path
+        try:
+            for iteration in range(iterations):
+                handles = []
+                with contextlib.redirect_stdout(log_file):
+                    print(f"\n=== {name} iteration {iteration + 1}")
+                    try:
+                        phase_start = time.perf_counter()
+                        graph = stack.build_component_graph(
+                            SERVICES, SERVICES_WITHOUT_DATABASE, env_file_name, paths["services_root"],
+                            paths["broker_path"], paths["gateway_path"], paths["logs_dir"], paths["state_dir"], options)
+                        samples["graph"].append(time.perf_counter() - phase_start)
+
+                        phase_start = time.perf_counter()
+                        timings = stack.start_graph(graph, handles)
+                        samples["cold_boot" if iteration == 0 else "boot"].append(time.perf_counter() - phase_start)
+                        samples["ready_overhead"].append(get_ready_overhead(graph, timings, stub_config["delays"]))
+                    finally:
+                        phase_start = time.perf_counter()
+                        stack.cleanup_processes(handles, grace_period=grace_period, database_grace_period=grace_period)
+                        samples["teardown"].append(time.perf_counter() - phase_start)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return samples
+
+
+def summarize(samples: dict) -> dict:
+    """
+    Get the median of every phase that was measured.
+    """
+    return {phase: statistics.median(values) for phase, values in samples.items() if values}
+
+
+def compare(results: dict, baseline: dict, tolerance: float, slack: float) -> list:
+    """
+    Compare the medians of the phases to the baseline.
+
+    Parameters
+    ----------
+    results : dict
+        Median of every phase, by scenario
+    baseline : dict
+        Median of every phase of the baseline, by scenario
+    tolerance : float
+        Relative slowdown allowed, e.g. 0.25 for 25%
+    slack : float
+        Absolute slowdown in seconds allowed on top, so that phases of a few milliseconds do not fail on noise
+
+    Returns
+    -------
+    list
+        One row per phase: (scenario, phase, median, baseline or None, regressed)
+    """
+    rows = []
+    for scenario, phases in results.items():
+        for phase, median in phases.items():
+            reference = baseline.get(scenario, {}).get(phase)
+            regressed = reference is not None and median > reference * (1 + tolerance) + slack
+            rows.append((scenario, phase, median, reference, regressed))
+    return rows
+
+
+def format_rows(rows: list) -> str:
+    """
+    Format the comparison as a table.
+    """
+    lines = [f"{'scenario':<10} {'phase':<15} {'median':>9} {'baseline':>9} {'change':>8}  status"]
+    for scenario, phase, median, reference, regressed in rows:
+        if reference is None:
+            baseline_text, change_text, status = "-", "-", "new"
+        else:
+            baseline_text = f"{reference * 1000:.0f}ms"
+            change_text = f"{(median - reference) / reference * 100:+.0f}%" if reference > 0 else "-"
+            status = "REGRESSED" if regressed else "ok"
+        lines.append(f"{scenario:<10} {phase:<15} {median * 1000:>7.0f}ms {baseline_text:>9} {change_text:>8}  {status}")
+    return "\n".join(lines)
+
+
+def main():
+    """
+    Run the benchmark of the orchestrator and compare it to the baseline.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the boot and the teardown of the orchestrator against stub components")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS), help="Scenarios to run")
+    parser.add_argument("--iterations", type=int, default=3, help="Boots per scenario, the first one is the cold boot")
+    parser.add_argument("--grace-period", type=float, default=1,
+                        help="Seconds the teardown waits for a component to stop before killing it")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="Path of the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Relative slowdown allowed before a phase fails")
+    parser.add_argument("--slack", type=float, default=0.05, help="Absolute slowdown in seconds allowed on top of the tolerance")
+    parser.add_argument("--log", help="Save the output of the orchestrator to this file instead of discarding it")
+    args = parser.parse_args()
+
+    if args.iterations < 2:
+        parser.error("--iterations must be at least 2, the first boot is the cold boot")
+
+    sys.path.insert(0, REPO_ROOT)
+
+    results = {}
+    with open(args.log or os.devnull, "w") as log_file:
+        for scenario in args.scenarios:
+            print(f"Running {scenario} ({args.iterations} boots)")
+            try:
+                results[scenario] = summarize(run_scenario(scenario, args.iterations, args.grace_period, log_file))
+            except Exception as e:
+                print(f"Scenario {scenario} failed: {e}" + (f". Check {args.log}" if args.log else ", rerun with --log"))
+                sys.exit(1)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    rows = compare(results, baseline, args.tolerance, args.slack)
+    print(f"\n{format_rows(rows)}")
+
+    if args.save_baseline:
+        baseline.update(results)
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=1)
+        print(f"\nBaseline saved to {args.baseline}")
+        return
+
+    if not baseline:
+        print(f"\nNo baseline in {args.baseline}, save one with --save-baseline")
+    regressed = [f"{scenario} {phase}" for scenario, phase, _, _, is_regressed in rows if is_regressed]
+    if regressed:
+        print(f"\nSlower than the baseline: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
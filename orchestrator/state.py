@@ -0,0 +1,65 @@
+"""
+Small JSON files the orchestrator keeps in its state dir between runs.
+"""
+import json
+import os
+import threading
+
+_state_lock = threading.Lock()
+
+
+def load_state(state_dir: str, file_name: str) -> dict:
+    """
+    Load a JSON state file.
+
+    Parameters
+    ----------
+    state_dir : str
+        Directory where the orchestrator keeps its state
+    file_name : str
+        Name of the state file
+
+    Returns
+    -------
+    dict
+        The content of the file, or an empty dict if it does not exist or is broken
+    """
+    state_path = os.path.join(state_dir, file_name)
+    if not os.path.exists(state_path):
+        return {}
+
+    try:
+        with open(state_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # A broken state file is treated as an empty one
+        return {}
+
+
+def update_state(state_dir: str, file_name: str, key: str, value):
+    """
+    Set a key in a JSON state file.
+
+    Parameters
+    ----------
+    state_dir : str
+        Directory where the orchestrator keeps its state
+    file_name : str
+        Name of the state file
+    key : str
+        The key to set
+    value
+        The value to set. It has to be JSON serializable
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, file_name)
+
+    # Several components update the state at the same time, so the read-modify-write has to be atomic
+    with _state_lock:
+        state = load_state(state_dir, file_name)
+        state[key] = value
+
+        tmp_path = f"{state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, state_path)
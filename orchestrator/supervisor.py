@@ -0,0 +1,443 @@
+"""
+Supervisor that keeps the components of a booted stack running.
+
+Once the stack is booted, the supervisor polls the process of every
+component. When a component exits, only that component is restarted: its
+leftover processes are terminated, it is started again from its node in the
+component graph and only its own readiness check is run. The components that
+depend on it keep running and reconnect to it on their own. A component that
+keeps crashing is restarted after an exponential backoff, which is reset once
+the component stayed up long enough.
+
+Operators drive the supervisor through a local control socket that takes one
+command per connection: status, restart <component> or stop.
+
+Usage:
+    python -m orchestrator.supervisor status
+    python -m orchestrator.supervisor restart user_service
+    python -m orchestrator.supervisor stop
+"""
+import argparse
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from orchestrator.graph import ComponentGraph
+from orchestrator.processes import terminate_tier
+
+# Root of the repository, the control socket is in its state dir by default
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_SOCKET_PATH = os.path.join(REPO_ROOT, ".orchestrator", "supervisor.sock")
+
+# Largest command accepted on the control socket
+MAX_COMMAND_BYTES = 1024
+
+
+class _ComponentState:
+    """
+    What the supervisor knows about one component.
+    """
+
+    def __init__(self, name: str, kind: str):
+        self.name = name
+        self.kind = kind
+        # One of "running", "backoff" or "restarting"
+        self.status = "running"
+        self.started_at = time.monotonic()
+        # Crashes since the component last stayed up for stable_after seconds
+        self.crashes = 0
+        self.restarts = 0
+        self.restart_at = None
+        self.last_exit = None
+
+
+class Supervisor:
+    """
+    Restart the components of a booted stack on their own when they exit.
+
+    Parameters
+    ----------
+    graph : ComponentGraph
+        The graph the stack was booted from. The components are restarted from their nodes
+    handles : list
+        List of the process handles of the stack. The handles of a restarted component are replaced in it
+    multiplexer : LogMultiplexer
+        Log multiplexer the components are attached to, used to print the last lines of a crashed component
+        and to save its last lines before its log files are closed
+    backoff_base : float
+        Seconds to wait before the first restart of a crashed component. The wait doubles with every crash in a row
+    backoff_max : float
+        Longest wait before a restart
+    stable_after : float
+        Seconds a component has to stay up for its crashes to be forgotten
+    grace_period : float
+        Seconds to wait for the leftover processes of a component to terminate before killing them
+    database_grace_period : float
+        Seconds to wait for a mongod instance to shut down cleanly before killing it
+    poll_interval : float
+        Seconds between two checks of the processes
+    """
+
+    def __init__(self, graph: ComponentGraph, handles: list, multiplexer=None, backoff_base: float = 1,
+                 backoff_max: float = 60, stable_after: float = 30, grace_period: float = 3,
+                 database_grace_period: float = 30, poll_interval: float = 0.2):
+        self.graph = graph
+        self.handles = handles
+        self.multiplexer = multiplexer
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.grace_period = grace_period
+        self.database_grace_period = database_grace_period
+        self.poll_interval = poll_interval
+
+        # Only the components that left a process behind are supervised, the tasks are not run again
+        self.states = {}
+        for handle in handles:
+            if handle.name in graph and handle.name not in self.states:
+                self.states[handle.name] = _ComponentState(handle.name, graph[handle.name].kind)
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max(len(self.states), 1), thread_name_prefix="restart")
+
+    def _component_handles(self, name: str) -> list:
+        return [handle for handle in list(self.handles) if handle.name == name]
+
+    def _get_backoff(self, crashes: int) -> float:
+        return min(self.backoff_max, self.backoff_base * 2 ** (crashes - 1))
+
+    def _schedule_restart(self, state: _ComponentState, reason: str, ran_for: float = 0):
+        """
+        Count a crash of a component and schedule its restart. Must be called with the lock held.
+        ran_for is how long the component was up, a failed restart was never up.
+        """
+        now = time.monotonic()
+        if ran_for >= self.stable_after:
+            state.crashes = 0
+        state.crashes += 1
+
+        delay = self._get_backoff(state.crashes)
+        state.status = "backoff"
+        state.restart_at = now + delay
+        print(f"{state.name} {reason}, restarting it in {delay:.0f}s (crash {state.crashes} in a row)")
+
+    def _release(self, handles: list):
+        """
+        Terminate what is left of the processes of a component, close its log files and forget its handles.
+        """
+        running = [handle for handle in handles if handle.process.poll() is None]
+        if running:
+            is_database = all(handle.kind == "database" for handle in running)
+            terminate_tier(running, self.database_grace_period if is_database else self.grace_period)
+
+        deadline = time.monotonic() + 1
+        for handle in handles:
+            if self.multiplexer is not None:
+                self.multiplexer.wait_closed(handle.name, max(0, deadline - time.monotonic()))
+            handle.out_file.close()
+            handle.err_file.close()
+            self.handles.remove(handle)
+
+    def _restart(self, name: str):
+        """
+        Restart a component and wait for it to be ready. The components that depend on it are left alone.
+        """
+        component = self.graph[name]
+        state = self.states[name]
+        restart_start = time.monotonic()
+
+        try:
+            self._release(self._component_handles(name))
+            if self._stop_event.is_set():
+                return
+
+            print(f"Restarting {name}...")
+            component_handles = component.start() or []
+            self.handles.extend(component_handles)
+
+            # Only the readiness of the component itself is checked again
+            if component.ready is not None:
+                component.ready(component_handles, self._stop_event)
+        except Exception as e:
+            with self._lock:
+                if self._stop_event.is_set():
+                    return
+                state.last_exit = str(e)
+                self._schedule_restart(state, f"failed to restart ({e})")
+            return
+
+        with self._lock:
+            state.status = "running"
+            state.started_at = time.monotonic()
+            state.restarts += 1
+            state.restart_at = None
+        print(f"{name} restarted and ready after {time.monotonic() - restart_start:.1f}s")
+
+    def check(self):
+        """
+        Check the process of every component once. Schedule the restart of the components that exited
+        and start the restarts that are due.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for name, state in self.states.items():
+                if state.status == "running":
+                    exited = [handle for handle in self._component_handles(name) if handle.process.poll() is not None]
+                    if not exited:
+                        continue
+
+                    exit_code = exited[0].process.returncode
+                    state.last_exit = f"exit code {exit_code}"
+                    if self.multiplexer is not None and self.multiplexer.has_component(name):
+                        print(f"\n{name} exited with code {exit_code}")
+                        print(self.multiplexer.format_crash_dump(name, 20))
+                    self._schedule_restart(state, f"exited with code {exit_code}", now - state.started_at)
+                elif state.status == "backoff" and now >= state.restart_at:
+                    state.status = "restarting"
+                    self._executor.submit(self._restart, name)
+
+    def restart(self, name: str, wait: bool = False) -> str:
+        """
+        Restart a component now, whether it is running or waiting for its backoff.
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+        wait : bool
+            If true, return once the component is ready again or failed to restart
+
+        Returns
+        -------
+        str
+            The reply to the operator
+        """
+        with self._lock:
+            state = self.states.get(name)
+            if state is None:
+                return f"error: unknown component {name!r}, expected one of {', '.join(self.states)}"
+            if state.status == "restarting":
+                return f"error: {name} is already restarting"
+
+            # A restart asked by an operator is not a crash
+            state.status = "restarting"
+            state.crashes = 0
+            future = self._executor.submit(self._restart, name)
+
+        if not wait:
+            return f"Restarting {name}"
+
+        future.result()
+        with self._lock:
+            if state.status != "running":
+                return f"error: {name} {state.last_exit}"
+        return f"Restarted {name}"
+
+    def wait_until_running(self, timeout: float) -> list:
+        """
+        Wait for every component to be running, e.g. for the crashed ones to be restarted.
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait
+
+        Returns
+        -------
+        list
+            Names of the components that are still not running
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                waiting = [name for name, state in self.states.items() if state.status != "running"]
+            if not waiting or time.monotonic() >= deadline or self._stop_event.is_set():
+                return waiting
+            time.sleep(self.poll_interval)
+
+    def format_status(self) -> str:
+        """
+        Format the state of every component as a table.
+        """
+        now = time.monotonic()
+        rows = [f"{'component':<28} {'kind':<9} {'state':<18} {'pid':>8} {'uptime':>9} {'restarts':>8}  last exit"]
+        with self._lock:
+            for name, state in self.states.items():
+                status = state.status
+                if status == "backoff":
+                    status = f"backoff ({max(0, state.restart_at - now):.0f}s)"
+                pids = [str(handle.process.pid) for handle in self._component_handles(name)]
+                uptime = f"{now - state.started_at:.0f}s" if state.status == "running" else "-"
+                rows.append(f"{name:<28} {state.kind:<9} {status:<18} {','.join(pids) or '-':>8} {uptime:>9} "
+                            f"{state.restarts:>8}  {state.last_exit or '-'}")
+
+        return "\n".join(rows)
+
+    def handle_command(self, command: str) -> str:
+        """
+        Run a command of the control socket.
+
+        Parameters
+        ----------
+        command : str
+            One of status, restart <component> or stop
+
+        Returns
+        -------
+        str
+            The reply to the operator. Errors start with "error:"
+        """
+        words = command.split()
+        if words == ["status"]:
+            return self.format_status()
+        if len(words) == 2 and words[0] == "restart":
+            return self.restart(words[1])
+        if words == ["stop"]:
+            self.stop()
+            return "Stopping the stack"
+
+        return f"error: unknown command {command.strip()!r}, expected status, restart <component> or stop"
+
+    def run(self):
+        """
+        Supervise the components until stop is called. Restarts that are in progress are cancelled on the way out.
+        """
+        try:
+            while not self._stop_event.wait(self.poll_interval):
+                self.check()
+        finally:
+            self._stop_event.set()
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def stop(self):
+        """
+        Make run return.
+        """
+        self._stop_event.set()
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline(MAX_COMMAND_BYTES).decode(errors="replace")
+        reply = self.server.controller.handle_command(command)
+        self.wfile.write(f"{reply}\n".encode())
+
+
+class ControlServer:
+    """
+    Local control socket of a supervisor. Every connection sends one command line and gets the reply back.
+
+    Parameters
+    ----------
+    controller : Supervisor
+        The supervisor the commands are run on. Subclasses with their own handler_class may take another controller
+    socket_path : str
+        Path of the Unix socket. A stale socket left by a previous run is replaced
+    """
+
+    # Handles the connections, it finds the controller in self.server.controller
+    handler_class = _ControlHandler
+
+    def __init__(self, controller: Supervisor, socket_path: str = DEFAULT_SOCKET_PATH):
+        self.controller = controller
+        self.socket_path = socket_path
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Listen on the control socket in a background thread.
+        """
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, self.handler_class)
+        self._server.daemon_threads = True
+        self._server.controller = self.controller
+        # Only the user running the stack may control it
+        os.chmod(self.socket_path, 0o600)
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name="control-socket", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop listening and remove the socket.
+        """
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def send_command(command: str, socket_path: str = DEFAULT_SOCKET_PATH, timeout: float = 10) -> str:
+    """
+    Send a command to the control socket of a running supervisor.
+
+    Parameters
+    ----------
+    command : str
+        One of status, restart <component> or stop
+    socket_path : str
+        Path of the control socket
+    timeout : float
+        Seconds to wait for the reply
+
+    Returns
+    -------
+    str
+        The reply of the supervisor
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        connection.sendall(f"{command}\n".encode())
+
+        chunks = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    return b"".join(chunks).decode().rstrip("\n")
+
+
+def main():
+    """
+    Send a command to the supervisor of the stack started with main.py --supervise.
+    """
+    parser = argparse.ArgumentParser(description="Control the supervisor of the stack")
+    parser.add_argument("command", choices=["status", "restart", "stop"], help="Command to send")
+    parser.add_argument("component", nargs="?", help="Component to restart")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Path of the control socket")
+    args = parser.parse_args()
+
+    if (args.command == "restart") != (args.component is not None):
+        parser.error("restart takes the name of a component, the other commands take none")
+
+    command = f"{args.command} {args.component}" if args.component else args.command
+    try:
+        reply = send_command(command, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No supervisor is listening on {args.socket}, start the stack with main.py --supervise")
+        sys.exit(1)
+
+    print(reply)
+    if reply.startswith("error:"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
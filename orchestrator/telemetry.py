@@ -0,0 +1,377 @@
+"""
+Resource telemetry of the components of the stack.
+
+A background thread samples the whole process tree of every component
+(sh -> npm -> node -> ..., or mongod) at a fixed interval and records, per
+component, the sum over the live processes of its tree of:
+- the CPU usage in percent of one core,
+- the resident (RSS) and unique (USS) memory,
+- the open file descriptors and the threads,
+- the context switches and the bytes read and written (cumulative counters).
+
+The samples are kept in preallocated ring buffers of doubles, so sampling does
+not allocate per sample and the memory used is fixed. USS has to read
+/proc/<pid>/smaps, which is much more expensive than the other metrics, so it
+is only sampled every few ticks. The samples can be exported to a CSV file
+and the last sample of every component to a Prometheus text file, which is
+rewritten at every tick (for the textfile collector of node_exporter).
+"""
+import array
+import os
+import threading
+import time
+
+import psutil
+
+# Metrics recorded per sample, in the order they are stored in the ring buffers
+METRICS = ("cpu_percent", "rss_bytes", "uss_bytes", "open_fds", "threads", "ctx_switches", "read_bytes", "write_bytes")
+
+# Metrics that are cumulative counters, reported as rates in the summary
+COUNTERS = ("ctx_switches", "read_bytes", "write_bytes")
+
+
+class MetricRing:
+    """
+    Fixed size ring buffer of samples, backed by two preallocated arrays of doubles.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of samples kept, the oldest samples are overwritten
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.width = len(METRICS)
+        self.timestamps = array.array("d", bytes(8 * capacity))
+        self.values = array.array("d", bytes(8 * capacity * self.width))
+        self.count = 0
+
+    def append(self, timestamp: float, values: list):
+        """
+        Record a sample, given as one value per metric of METRICS.
+        """
+        index = self.count % self.capacity
+        self.timestamps[index] = timestamp
+        offset = index * self.width
+        # Written in place, the ring does not allocate once it is created
+        for position, value in enumerate(values):
+            self.values[offset + position] = value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def rows(self):
+        """
+        Iterate over the samples from the oldest to the newest.
+
+        Yields
+        ------
+        tuple
+            The timestamp of the sample and the list of its values
+        """
+        start = self.count - len(self)
+        for position in range(start, self.count):
+            index = position % self.capacity
+            offset = index * self.width
+            yield self.timestamps[index], self.values[offset:offset + self.width].tolist()
+
+    def column(self, metric: str) -> list:
+        """
+        Get every value of a metric, from the oldest to the newest sample.
+        """
+        column = METRICS.index(metric)
+        return [values[column] for _, values in self.rows()]
+
+    def last(self):
+        """
+        Get the newest sample, or None if there is none.
+        """
+        if not self.count:
+            return None
+        index = (self.count - 1) % self.capacity
+        offset = index * self.width
+        return self.timestamps[index], self.values[offset:offset + self.width].tolist()
+
+
+class TelemetrySampler:
+    """
+    Samples the process trees of the components in a background thread.
+
+    Parameters
+    ----------
+    handles : list
+        The list of ProcessHandle of the stack. It is read at every tick, so components
+        added to the list after the sampler started are picked up
+    interval : float
+        Seconds between two samples
+    capacity : int
+        Number of samples kept per component
+    uss_every : int
+        USS is sampled every uss_every ticks, the previous value is repeated in between
+    prometheus_path : str
+        If given, the last sample of every component is written to this file at every tick
+    csv_path : str
+        If given, every sample is written to this CSV file when the sampler stops
+    """
+
+    def __init__(self, handles: list, interval: float = 1.0, capacity: int = 3600, uss_every: int = 10,
+                 prometheus_path: str = None, csv_path: str = None):
+        self.handles = handles
+        self.interval = interval
+        self.capacity = capacity
+        self.uss_every = max(1, uss_every)
+        self.prometheus_path = prometheus_path
+        self.csv_path = csv_path
+
+        self.rings = {}
+        self.ticks = 0
+        self.sampling_time = 0.0
+
+        # psutil.Process objects are kept between ticks, cpu_percent needs the previous reading of the same object
+        self._processes = {}
+        self._last_uss = {}
+        self._last_counters = {}
+        self._counters = {}
+        self._proc_children = os.path.exists(f"/proc/{os.getpid()}/task/{os.getpid()}/children")
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start sampling in a background thread.
+        """
+        self._thread = threading.Thread(target=self._run, name="telemetry-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and write the CSV file. Does nothing if the sampler is not running.
+        """
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+        if self.csv_path is not None:
+            self.write_csv(self.csv_path)
+
+    def _get_process(self, pid: int) -> psutil.Process:
+        process = self._processes.get(pid)
+        if process is None or not process.is_running():
+            process = psutil.Process(pid)
+            # The first reading only sets the reference point
+            process.cpu_percent(None)
+            self._processes[pid] = process
+        return process
+
+    def _tree_pids(self, root: psutil.Process) -> list:
+        """
+        Get the PIDs of a process and of all of its children.
+        On Linux the children are read from /proc/<pid>/task/<tid>/children, which only visits the tree,
+        where psutil would scan every process of the system for every component.
+        """
+        if not self._proc_children:
+            return [root.pid] + [child.pid for child in root.children(recursive=True)]
+
+        pids = []
+        stack = [root.pid]
+        while stack:
+            pid = stack.pop()
+            pids.append(pid)
+            try:
+                for tid in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{tid}/children", "rb") as f:
+                        stack.extend(int(child) for child in f.read().split())
+            except OSError:
+                # The process exited during the walk
+                continue
+        return pids
+
+    def _sample_tree(self, handle, with_uss: bool) -> list:
+        """
+        Sum the metrics of the live processes of the tree of a component.
+        The counters are summed from their increments, so that they do not go down when a process exits.
+        """
+        try:
+            pids = self._tree_pids(self._get_process(handle.process.pid))
+        except psutil.NoSuchProcess:
+            return None
+
+        totals = [0.0] * len(METRICS)
+        uss = 0.0
+        counters = self._counters.setdefault(handle.name, [0.0] * len(COUNTERS))
+        for pid in pids:
+            try:
+                process = self._get_process(pid)
+                with process.oneshot():
+                    if process.status() == psutil.STATUS_ZOMBIE:
+                        continue
+                    totals[0] += process.cpu_percent(None)
+                    totals[1] += process.memory_info().rss
+                    if hasattr(process, "num_fds"):
+                        totals[3] += process.num_fds()
+                    totals[4] += process.num_threads()
+
+                    switches = process.num_ctx_switches()
+                    current = [switches.voluntary + switches.involuntary, 0, 0]
+                    if hasattr(process, "io_counters"):
+                        try:
+                            io = process.io_counters()
+                            current[1:] = [io.read_bytes, io.write_bytes]
+                        except psutil.AccessDenied:
+                            pass
+                if with_uss:
+                    try:
+                        uss += process.memory_full_info().uss
+                    except psutil.AccessDenied:
+                        pass
+            except psutil.NoSuchProcess:
+                # The process exited during the tick
+                continue
+
+            previous = self._last_counters.get(pid, [0, 0, 0])
+            for index, value in enumerate(current):
+                counters[index] += max(0, value - previous[index])
+            self._last_counters[pid] = current
+
+        if with_uss:
+            self._last_uss[handle.name] = uss
+        totals[2] = self._last_uss.get(handle.name, 0.0)
+        totals[-len(COUNTERS):] = counters
+
+        return totals
+
+    def sample(self):
+        """
+        Take one sample of every component.
+        """
+        started = time.perf_counter()
+        timestamp = time.time()
+        with_uss = self.ticks % self.uss_every == 0
+
+        for handle in list(self.handles):
+            totals = self._sample_tree(handle, with_uss)
+            if totals is None:
+                continue
+
+            if handle.name not in self.rings:
+                self.rings[handle.name] = MetricRing(self.capacity)
+            self.rings[handle.name].append(timestamp, totals)
+
+        # Forget the processes that exited
+        for pid in [pid for pid, process in self._processes.items() if not process.is_running()]:
+            del self._processes[pid]
+            self._last_counters.pop(pid, None)
+
+        if self.prometheus_path is not None:
+            self.write_prometheus(self.prometheus_path)
+
+        self.ticks += 1
+        self.sampling_time += time.perf_counter() - started
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Telemetry sample failed: {e}")
+            self._stop_event.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    def write_csv(self, path: str):
+        """
+        Write every sample of every component to a CSV file.
+
+        Parameters
+        ----------
+        path : str
+            Path of the CSV file
+        """
+        with open(path, "w") as f:
+            f.write("timestamp,component," + ",".join(METRICS) + "\n")
+            for name, ring in self.rings.items():
+                for timestamp, values in ring.rows():
+                    # The CPU usage is a percentage, every other metric is a count
+                    fields = [f"{values[0]:.1f}"] + [f"{value:.0f}" for value in values[1:]]
+                    f.write(f"{timestamp:.3f},{name},{','.join(fields)}\n")
+
+    def write_prometheus(self, path: str):
+        """
+        Write the last sample of every component to a file in the Prometheus text format.
+        The file is replaced atomically so a scraper never reads half of it.
+
+        Parameters
+        ----------
+        path : str
+            Path of the Prometheus text file
+        """
+        lines = []
+        for metric in METRICS:
+            kind = "counter" if metric in COUNTERS else "gauge"
+            lines.append(f"# TYPE orchestrator_component_{metric} {kind}")
+            for name, ring in self.rings.items():
+                _, values = ring.last()
+                lines.append(f'orchestrator_component_{metric}{{component="{name}"}} {values[METRICS.index(metric)]:.1f}')
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def summarize(self) -> list:
+        """
+        Summarize the samples of every component.
+
+        Returns
+        -------
+        list
+            One dict per component, sorted by peak RSS, with the mean and peak CPU usage, the peak RSS and USS,
+            the last number of fds and threads and the rates of the counters per second
+        """
+        summary = []
+        for name, ring in self.rings.items():
+            cpu = ring.column("cpu_percent")
+            first_timestamp, first = next(ring.rows())
+            last_timestamp, last = ring.last()
+            elapsed = last_timestamp - first_timestamp
+
+            entry = {
+                "component": name,
+                "samples": len(ring),
+                "cpu_mean": sum(cpu) / len(cpu),
+                "cpu_max": max(cpu),
+                "rss_max": max(ring.column("rss_bytes")),
+                "uss_max": max(ring.column("uss_bytes")),
+                "open_fds": last[METRICS.index("open_fds")],
+                "threads": last[METRICS.index("threads")],
+            }
+            for counter in COUNTERS:
+                column = METRICS.index(counter)
+                entry[f"{counter}_per_s"] = (last[column] - first[column]) / elapsed if elapsed > 0 else 0.0
+            summary.append(entry)
+
+        return sorted(summary, key=lambda entry: entry["rss_max"], reverse=True)
+
+    def format_summary(self) -> str:
+        """
+        Format the summary as a table, followed by the overhead of the sampler.
+        """
+        mib = 1024 * 1024
+        lines = [f"{'component':<24} {'cpu avg':>8} {'cpu max':>8} {'rss max':>9} {'uss max':>9} {'fds':>5} "
+                 f"{'thr':>4} {'ctx/s':>8} {'read/s':>10} {'write/s':>10}"]
+        for entry in self.summarize():
+            lines.append(f"{entry['component']:<24} {entry['cpu_mean']:>7.1f}% {entry['cpu_max']:>7.1f}% "
+                         f"{entry['rss_max'] / mib:>6.1f}MiB {entry['uss_max'] / mib:>6.1f}MiB {entry['open_fds']:>5.0f} "
+                         f"{entry['threads']:>4.0f} {entry['ctx_switches_per_s']:>8.0f} "
+                         f"{entry['read_bytes_per_s'] / 1024:>7.1f}KiB {entry['write_bytes_per_s'] / 1024:>7.1f}KiB")
+
+        if self.ticks:
+            per_tick = self.sampling_time / self.ticks
+            lines.append(f"Sampler overhead: {per_tick * 1000:.2f} ms per sample, "
+                         f"{100 * per_tick / self.interval:.2f}% of the interval ({self.ticks} samples)")
+
+        return "\n".join(lines)
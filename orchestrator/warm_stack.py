@@ -0,0 +1,300 @@
+"""
+Daemon that keeps a booted test stack resident and runs the Postman tests on demand.
+
+`python main.py --test --daemon --profile prod` boots the test stack once and
+keeps it running under a supervisor. Every test run submitted by a client:
+
+1. rebuilds the packages whose sources changed since their running build and
+   restarts only the components that run them,
+2. waits for every component to be running,
+3. empties the test databases, keeping the indexes built by the services,
+4. runs the newman collection against the running gateway and streams its
+   output back to the client, followed by its exit code.
+
+The runs are serialized, a run submitted while another one is in progress
+waits for it. The daemon also takes the status, restart <component> and stop
+commands of the supervisor.
+
+Usage:
+    python -m orchestrator.warm_stack run
+    python -m orchestrator.warm_stack status
+    python -m orchestrator.warm_stack restart user_service
+    python -m orchestrator.warm_stack stop
+"""
+import argparse
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from orchestrator.build_cache import build_package, needs_build
+from orchestrator.install_cache import install_package
+from orchestrator.supervisor import MAX_COMMAND_BYTES, REPO_ROOT, ControlServer, Supervisor
+
+DEFAULT_SOCKET_PATH = os.path.join(REPO_ROOT, ".orchestrator", "warm_stack.sock")
+
+# Prefix of the last line of the reply to a run, followed by the exit code of the tests
+EXIT_PREFIX = "exit "
+
+
+class TestDaemon:
+    """
+    Run the tests against a resident stack.
+
+    Parameters
+    ----------
+    supervisor : Supervisor
+        Supervisor of the booted stack. It restarts the crashed components and the components whose sources changed
+    packages : dict
+        Components running each package, by package path. The packages are rebuilt when their sources change
+    reset_databases : Callable[[], None]
+        Empties the test databases before every run
+    test_command : str
+        Command running the tests against the running gateway
+    test_cwd : str
+        Directory to run the test command in
+    test_env : dict
+        Environment of the test command
+    state_dir : str
+        Directory where the orchestrator keeps its state, such as the build cache
+    ready_timeout : float
+        Seconds to wait for the crashed components to be running again before a run
+    """
+
+    def __init__(self, supervisor: Supervisor, packages: dict, reset_databases: Callable[[], None], test_command: str,
+                 test_cwd: str, test_env: dict, state_dir: str, ready_timeout: float = 60):
+        self.supervisor = supervisor
+        self.packages = packages
+        self.reset_databases = reset_databases
+        self.test_command = test_command
+        self.test_cwd = test_cwd
+        self.test_env = test_env
+        self.state_dir = state_dir
+        self.ready_timeout = ready_timeout
+
+        self.runs = 0
+        self._run_lock = threading.Lock()
+
+    def _rebuild_changed(self, write: Callable[[str], None]) -> bool:
+        """
+        Rebuild the packages whose sources changed and restart their components. Returns False if one of them failed.
+        """
+        changed = [package_path for package_path in self.packages if needs_build(package_path, self.state_dir)]
+        if not changed:
+            return True
+
+        write(f"Sources changed in {', '.join(os.path.basename(path) for path in changed)}, rebuilding")
+
+        def rebuild(package_path: str):
+            install_package(package_path, self.state_dir)
+            build_package(package_path, self.state_dir)
+
+        with ThreadPoolExecutor(max_workers=len(changed)) as executor:
+            futures = {package_path: executor.submit(rebuild, package_path) for package_path in changed}
+
+        failed = False
+        for package_path, future in futures.items():
+            try:
+                future.result()
+            except subprocess.CalledProcessError as e:
+                # tsc and npm report the errors on stdout
+                write(f"error: failed to build {os.path.basename(package_path)}\n{e.stdout.decode(errors='replace')}")
+                failed = True
+        if failed:
+            return False
+
+        # Only the components running the rebuilt packages are restarted, the other ones keep running
+        components = [name for package_path in changed for name in self.packages[package_path]]
+        with ThreadPoolExecutor(max_workers=max(len(components), 1)) as executor:
+            replies = list(executor.map(lambda name: self.supervisor.restart(name, wait=True), components))
+
+        for reply in replies:
+            write(reply)
+        return not any(reply.startswith("error:") for reply in replies)
+
+    def _run_command(self, write: Callable[[str], None]) -> int:
+        """
+        Run the test command and stream its output. The tests are killed if the client goes away.
+        """
+        process = subprocess.Popen(self.test_command, cwd=self.test_cwd, env=self.test_env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, shell=True, start_new_session=True)
+        try:
+            for line in process.stdout:
+                write(line.decode(errors="replace").rstrip("\n"))
+        except OSError as e:
+            print(f"Test client went away ({e}), stopping the tests")
+            os.killpg(process.pid, signal.SIGTERM)
+            raise e
+        finally:
+            process.stdout.close()
+            process.wait()
+
+        return process.returncode
+
+    def run_tests(self, write: Callable[[str], None]) -> int:
+        """
+        Run the tests once.
+
+        Parameters
+        ----------
+        write : Callable[[str], None]
+            Sends a line of output to the client
+
+        Returns
+        -------
+        int
+            The exit code of the tests, 1 if the stack could not be prepared
+        """
+        if self._run_lock.locked():
+            write("Waiting for the run in progress")
+
+        with self._run_lock:
+            self.runs += 1
+            run_start = time.monotonic()
+            print(f"\nTest run {self.runs}")
+
+            if not self._rebuild_changed(write):
+                return 1
+
+            waiting = self.supervisor.wait_until_running(self.ready_timeout)
+            if waiting:
+                write(f"error: {', '.join(waiting)} not running after {self.ready_timeout:.0f}s")
+                return 1
+
+            try:
+                self.reset_databases()
+            except Exception as e:
+                write(f"error: failed to reset the databases ({e})")
+                return 1
+            reset_time = time.monotonic() - run_start
+
+            exit_code = self._run_command(write)
+            summary = (f"Test run {self.runs} finished with exit code {exit_code} in {time.monotonic() - run_start:.1f}s "
+                       f"(stack ready in {reset_time:.1f}s)")
+            print(summary)
+            write(summary)
+
+            return exit_code
+
+    def handle_command(self, command: str, write: Callable[[str], None]):
+        """
+        Run a command of the control socket.
+
+        Parameters
+        ----------
+        command : str
+            run, or one of the commands of the supervisor
+        write : Callable[[str], None]
+            Sends a line of the reply to the client. The reply to run ends with "exit <code>"
+        """
+        words = command.split()
+        if words == ["run"]:
+            exit_code = self.run_tests(write)
+            write(f"{EXIT_PREFIX}{exit_code}")
+        elif words and words[0] in ("status", "restart", "stop"):
+            write(self.supervisor.handle_command(command))
+        else:
+            write(f"error: unknown command {command.strip()!r}, expected run, status, restart <component> or stop")
+
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline(MAX_COMMAND_BYTES).decode(errors="replace")
+        try:
+            self.server.controller.handle_command(command, lambda line: self.wfile.write(f"{line}\n".encode()))
+        # The client went away, e.g. with Ctrl-C, the run was stopped
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class TestDaemonServer(ControlServer):
+    """
+    Local control socket of a test daemon. The output of a run is streamed back line by line.
+
+    Parameters
+    ----------
+    controller : TestDaemon
+        The daemon the commands are run on
+    socket_path : str
+        Path of the Unix socket. A stale socket left by a previous run is replaced
+    """
+
+    handler_class = _DaemonHandler
+
+    def __init__(self, controller: TestDaemon, socket_path: str = DEFAULT_SOCKET_PATH):
+        super().__init__(controller, socket_path)
+
+
+def send_command(command: str, write: Callable[[str], None], socket_path: str = DEFAULT_SOCKET_PATH,
+                 connect_timeout: float = 10) -> int:
+    """
+    Send a command to a running test daemon and pass its reply on line by line.
+
+    Parameters
+    ----------
+    command : str
+        run, status, restart <component> or stop
+    write : Callable[[str], None]
+        Receives every line of the reply, except the exit code of a run
+    socket_path : str
+        Path of the control socket
+    connect_timeout : float
+        Seconds to wait for the connection. A run may take as long as the tests
+
+    Returns
+    -------
+    int
+        The exit code of the tests for a run, otherwise 1 if the daemon replied with an error and 0 if it did not
+    """
+    exit_code = 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(connect_timeout)
+        connection.connect(socket_path)
+        connection.settimeout(None)
+        connection.sendall(f"{command}\n".encode())
+
+        with connection.makefile("r", encoding="utf-8", errors="replace") as reply:
+            for line in reply:
+                line = line.rstrip("\n")
+                if line.startswith(EXIT_PREFIX) and line[len(EXIT_PREFIX):].lstrip("-").isdigit():
+                    exit_code = int(line[len(EXIT_PREFIX):])
+                    continue
+                if line.startswith("error:"):
+                    exit_code = 1
+                write(line)
+
+    return exit_code
+
+
+def main():
+    """
+    Send a command to the test daemon started with main.py --test --daemon.
+    """
+    parser = argparse.ArgumentParser(description="Run the tests against the resident test stack")
+    parser.add_argument("command", choices=["run", "status", "restart", "stop"], help="Command to send")
+    parser.add_argument("component", nargs="?", help="Component to restart")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Path of the control socket")
+    args = parser.parse_args()
+
+    if (args.command == "restart") != (args.component is not None):
+        parser.error("restart takes the name of a component, the other commands take none")
+
+    command = f"{args.command} {args.component}" if args.component else args.command
+    try:
+        exit_code = send_command(command, print, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No test daemon is listening on {args.socket}, start it with main.py --test --daemon --profile prod")
+        sys.exit(1)
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,20 @@ export async function unsubscribeFromTopics(
     }
 }
 
+/**
+ * Get what to subscribe to for the given MQTT topic. When MQTT_SHARE_GROUP is
+ * set, the service runs as one of several replicas and subscribes through the
+ * shared subscription $share/<group>/<topic>, so that every message is
+ * handled by a single replica.
+ * @param topic - The MQTT topic.
+ * @returns The topic, or the shared subscription to the topic.
+ */
+export function getSubscriptionTopic(topic: string): string {
+    const shareGroup: string | undefined = process.env.MQTT_SHARE_GROUP;
+
+    return shareGroup ? `$share/${shareGroup}/${topic}` : topic;
+}
+
 /**
  * Subscribe to the given MQTT topic.
  * @param client - The MQTT client to use to subscribe.
@@ -39,7 +53,7 @@ export async function subscribeToTopic(
     topic: string,
 ): Promise<void> {
     try {
-        await client.subscribeAsync(topic);
+        await client.subscribeAsync(getSubscriptionTopic(topic));
         console.log(`Subscribed to topic: ${topic}`);
     } catch (err) {
         throw new Error(`Failed to subscribe to topic: ${topic}\n${err}`);
@@ -56,7 +70,7 @@ export async function unsubscribeFromTopic(
     topic: string,
 ): Promise<void> {
     try {
-        await client.unsubscribeAsync(topic);
+        await client.unsubscribeAsync(getSubscriptionTopic(topic));
         console.log(`Unsubscribed from topic: ${topic}`);
     } catch (err) {
         throw new Error(`Failed to unsubscribe from topic: ${topic}\n${err}`);
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+from orchestrator.graph import Component, ComponentGraph, start_graph
+
+
+def make_graph(edges: dict) -> ComponentGraph:
+    graph = ComponentGraph()
+    for name, dependencies in edges.items():
+        graph.add(Component(name=name, kind="task", start=lambda: None, depends_on=list(dependencies)))
+    return graph
+
+
+def test_tiers_group_components_by_depth():
+    graph = make_graph({
+        "database": [],
+        "broker": [],
+        "service": ["database", "broker"],
+        "other_service": ["broker"],
+        "gateway": ["service", "other_service"],
+    })
+
+    tiers = [sorted(tier) for tier in graph.tiers()]
+
+    assert tiers == [["broker", "database"], ["other_service", "service"], ["gateway"]]
+
+
+def test_tiers_of_an_empty_graph():
+    assert ComponentGraph().tiers() == []
+
+
+def test_tiers_leave_out_cycles():
+    graph = make_graph({"root": [], "a": ["b"], "b": ["a"]})
+
+    assert graph.tiers() == [["root"]]
+
+
+def test_add_rejects_duplicate_names():
+    graph = make_graph({"broker": []})
+
+    with pytest.raises(ValueError, match="already in the graph"):
+        graph.add(Component(name="broker", kind="broker", start=lambda: None))
+
+
+def test_validate_rejects_unknown_dependency():
+    graph = make_graph({"service": ["broker"]})
+
+    with pytest.raises(ValueError, match="depends on unknown component broker"):
+        graph.validate()
+
+
+def test_validate_rejects_cycles():
+    graph = make_graph({"a": ["c"], "b": ["a"], "c": ["b"]})
+
+    with pytest.raises(ValueError, match="cycle"):
+        graph.validate()
+
+
+def test_dependents_are_transitive():
+    graph = make_graph({"database": [], "service": ["database"], "gateway": ["service"], "broker": []})
+
+    assert sorted(graph.dependents("database")) == ["gateway", "service"]
+    assert graph.dependents("broker") == []
+
+
+def test_start_graph_starts_components_after_their_dependencies():
+    order = []
+    lock = threading.Lock()
+    graph = ComponentGraph()
+
+    def starter(name):
+        def start():
+            with lock:
+                order.append(name)
+        return start
+
+    for name, dependencies in {"database": [], "broker": [], "service": ["database", "broker"],
+                               "gateway": ["service"]}.items():
+        graph.add(Component(name=name, kind="task", start=starter(name), depends_on=dependencies))
+
+    timings = start_graph(graph, [])
+
+    assert set(order[:2]) == {"database", "broker"}
+    assert order[2:] == ["service", "gateway"]
+    assert set(timings) == {"database", "broker", "service", "gateway"}
+    for dependency, dependent in (("database", "service"), ("broker", "service"), ("service", "gateway")):
+        assert timings[dependency][1] <= timings[dependent][0]
+
+
+def test_start_graph_cancels_the_other_components_on_error():
+    cancelled = threading.Event()
+
+    def fail():
+        raise RuntimeError("broken")
+
+    def wait_for_cancel(handles, cancel_event):
+        cancelled.set() if cancel_event.wait(5) else None
+
+    graph = ComponentGraph()
+    graph.add(Component(name="slow", kind="task", start=lambda: None, ready=wait_for_cancel))
+    graph.add(Component(name="broken", kind="task", start=fail))
+    graph.add(Component(name="never", kind="task", start=lambda: None, depends_on=["broken"]))
+
+    started_at = time.monotonic()
+    with pytest.raises(RuntimeError, match="broken"):
+        start_graph(graph, [])
+
+    assert cancelled.is_set()
+    assert time.monotonic() - started_at < 5
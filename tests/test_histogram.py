@@ -0,0 +1,95 @@
+import random
+
+from orchestrator.histogram import LatencyHistogram
+
+
+def histogram_of(values) -> LatencyHistogram:
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    return histogram
+
+
+def test_empty_histogram():
+    histogram = LatencyHistogram()
+
+    assert histogram.percentile(50) == 0
+    assert histogram.mean == 0.0
+    assert histogram.min is None and histogram.max is None
+
+
+def test_small_values_are_exact():
+    histogram = histogram_of(range(1, 64))
+
+    assert histogram.percentile(0) == 1
+    assert histogram.percentile(50) == 32
+    assert histogram.percentile(90) == 57
+    assert histogram.percentile(100) == 63
+    assert histogram.mean == 32.0
+
+
+def test_large_values_are_within_the_bucket_error():
+    generator = random.Random(42)
+    values = sorted(generator.randint(0, 10_000_000) for _ in range(10_000))
+    histogram = histogram_of(values)
+
+    for percentile in (1, 25, 50, 75, 90, 99, 99.9):
+        exact = values[max(1, int(len(values) * percentile / 100 + 0.5)) - 1]
+        estimate = histogram.percentile(percentile)
+        assert exact <= estimate <= exact * (1 + 1 / 32)
+
+
+def test_percentile_is_capped_by_the_max():
+    histogram = histogram_of([1000, 1001, 1002])
+
+    assert histogram.percentile(100) == 1002
+    assert histogram.max == 1002 and histogram.min == 1000
+
+
+def test_negative_values_are_recorded_as_zero():
+    histogram = histogram_of([-5, 3])
+
+    assert histogram.min == 0
+    assert histogram.percentile(50) == 0
+
+
+def test_huge_values_are_kept_in_the_last_bucket():
+    histogram = histogram_of([1 << 60])
+
+    assert histogram.percentile(50) == 1 << 60
+
+
+def test_merge():
+    generator = random.Random(7)
+    first_values = [generator.randint(0, 100_000) for _ in range(1000)]
+    second_values = [generator.randint(50_000, 5_000_000) for _ in range(500)]
+    first, second = histogram_of(first_values), histogram_of(second_values)
+    both = histogram_of(first_values + second_values)
+
+    first.merge(second)
+
+    assert first.counts == both.counts
+    assert (first.count, first.total, first.min, first.max) == (both.count, both.total, both.min, both.max)
+    for percentile in (50, 99, 100):
+        assert first.percentile(percentile) == both.percentile(percentile)
+
+
+def test_merge_with_empty_histograms():
+    histogram = histogram_of([10, 20])
+
+    histogram.merge(LatencyHistogram())
+    assert (histogram.count, histogram.min, histogram.max) == (2, 10, 20)
+
+    empty = LatencyHistogram()
+    empty.merge(histogram)
+    assert (empty.count, empty.min, empty.max, empty.percentile(100)) == (2, 10, 20, 20)
+
+
+def test_reset():
+    histogram = histogram_of([5, 500, 50_000])
+    histogram.reset()
+
+    assert histogram.count == 0 and histogram.total == 0
+    assert histogram.min is None and histogram.max is None
+    assert not any(histogram.counts)
+    assert histogram.percentile(99) == 0
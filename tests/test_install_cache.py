@@ -0,0 +1,59 @@
+import os
+
+from orchestrator.install_cache import link_into_store
+
+
+def make_node_modules(root, files: dict) -> str:
+    node_modules = os.path.join(root, "node_modules")
+    for relative_path, content in files.items():
+        path = os.path.join(node_modules, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+    return node_modules
+
+
+def read(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_shared_files_are_linked_read_only(tmp_path):
+    store = str(tmp_path / "store")
+    files = {"typescript/lib/tsc.js": b"tsc" * 100, "nodemon/package.json": b"{}\n", ".package-lock.json": b"{}"}
+    first = make_node_modules(tmp_path / "first", files)
+    second = make_node_modules(tmp_path / "second", files)
+
+    assert link_into_store(first, store) == 0
+    assert link_into_store(second, store) == 300 + 3
+
+    for node_modules in (first, second):
+        stat = os.stat(os.path.join(node_modules, "typescript/lib/tsc.js"))
+        assert stat.st_nlink == 3
+        assert stat.st_mode & 0o222 == 0
+    assert os.stat(os.path.join(first, "typescript/lib/tsc.js")).st_ino == \
+        os.stat(os.path.join(second, "typescript/lib/tsc.js")).st_ino
+
+    # npm rewrites its hidden lockfile in place, it is not shared
+    assert os.stat(os.path.join(first, ".package-lock.json")).st_nlink == 1
+    assert os.stat(os.path.join(first, ".package-lock.json")).st_mode & 0o200
+
+
+def test_changed_store_entry_is_not_reused(tmp_path):
+    store = str(tmp_path / "store")
+    first = make_node_modules(tmp_path / "first", {"pkg/index.js": b"original"})
+    link_into_store(first, store)
+
+    # A write through one of the links, as root can do despite the permissions
+    shared = os.path.join(first, "pkg/index.js")
+    os.chmod(shared, 0o644)
+    with open(shared, "r+b") as f:
+        f.write(b"patched!")
+
+    second = make_node_modules(tmp_path / "second", {"pkg/index.js": b"original"})
+    assert link_into_store(second, store) == 0
+
+    assert read(os.path.join(second, "pkg/index.js")) == b"original"
+    stored_files = [os.path.join(dir_path, name) for dir_path, _, names in os.walk(store) for name in names]
+    assert [read(path) for path in stored_files] == [b"original"]
+    assert os.stat(stored_files[0]).st_ino == os.stat(os.path.join(second, "pkg/index.js")).st_ino
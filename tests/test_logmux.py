@@ -0,0 +1,88 @@
+import collections
+import os
+import selectors
+import subprocess
+import sys
+
+import pytest
+
+from orchestrator.logmux import LogMultiplexer, RotatingLogFile, _Stream
+
+
+@pytest.fixture
+def pipe_stream(tmp_path):
+    """
+    A multiplexer reading a pipe written by the test, with the lines of the pipe collected by a listener.
+    """
+    multiplexer = LogMultiplexer()
+    multiplexer._rings["svc"] = collections.deque(maxlen=10)
+    multiplexer._open_streams["svc"] = 1
+    multiplexer._selector = selectors.DefaultSelector()
+    lines = []
+    multiplexer.add_listener("svc", lines.append)
+
+    read_fd, write_fd = os.pipe()
+    log_file = RotatingLogFile(str(tmp_path / "svc.out"))
+    stream = _Stream("svc", os.fdopen(read_fd, "rb"), log_file, False)
+    key = multiplexer._selector.register(read_fd, selectors.EVENT_READ, stream)
+
+    def feed(data: bytes):
+        if data:
+            os.write(write_fd, data)
+        else:
+            os.close(write_fd)
+        multiplexer._read(key)
+
+    yield feed, lines
+    log_file.close()
+
+
+def test_crlf_split_across_reads(pipe_stream):
+    feed, lines = pipe_stream
+
+    feed(b"abc\r")
+    assert lines == []
+
+    feed(b"\ndef\n")
+    assert lines == [b"abc\r\n", b"def\n"]
+
+
+def test_carriage_returns_end_lines(pipe_stream):
+    feed, lines = pipe_stream
+
+    feed(b"10%\r20%\r")
+    assert lines == [b"10%\r"]
+
+    feed(b"done\n")
+    assert lines == [b"10%\r", b"20%\r", b"done\n"]
+
+
+def test_incomplete_line_is_flushed_at_the_end_of_file(pipe_stream):
+    feed, lines = pipe_stream
+
+    feed(b"first\nsecond")
+    feed(b"")
+
+    assert lines == [b"first\n", b"second\n"]
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+def test_attach_reads_both_pipes(tmp_path, threaded):
+    multiplexer = LogMultiplexer()
+    multiplexer._threaded = threaded
+    script = "import sys; print('one'); print('oops', file=sys.stderr); sys.stdout.write('two\\r\\nthree')"
+    process = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    out_file, err_file = multiplexer.attach("svc", process, str(tmp_path / "svc.out"), str(tmp_path / "svc.err"))
+    process.wait()
+
+    assert multiplexer.wait_closed("svc", 10)
+    out_lines = [line for _, stream, line in multiplexer.tail("svc") if stream == "out"]
+    err_lines = [line for _, stream, line in multiplexer.tail("svc") if stream == "err"]
+    assert out_lines == ["one", "two\r", "three"]
+    assert err_lines == ["oops"]
+
+    out_file.close()
+    err_file.close()
+    with open(tmp_path / "svc.out", "rb") as f:
+        assert [line.split(b" ", 1)[1] for line in f.read().splitlines()] == [b"one", b"two", b"three"]
@@ -0,0 +1,134 @@
+import datetime
+import struct
+
+import pytest
+
+from orchestrator.mongo_wire import ObjectId, decode_document, encode_document
+
+
+def test_round_trip_of_every_type():
+    document = {
+        "small": 5,
+        "negative": -(1 << 31),
+        "large": 1 << 40,
+        "ratio": 0.25,
+        "name": "Volvo 240 – été",
+        "sold": False,
+        "deleted": True,
+        "owner": None,
+        "image": b"\x00\x01\xff",
+        "_id": ObjectId(bytes(range(12))),
+        "created": datetime.datetime(2024, 3, 1, 12, 30, 45, 123000, tzinfo=datetime.timezone.utc),
+        "specs": {"doors": 4, "engine": {"litres": 2.3, "fuel": "petrol"}},
+        "tags": ["classic", 1984, {"colour": "red"}, []],
+    }
+
+    encoded = encode_document(document)
+    decoded, end = decode_document(encoded)
+
+    assert decoded == document
+    assert end == len(encoded)
+    assert list(decoded) == list(document)
+
+
+def test_integer_sizes():
+    encoded = encode_document({"a": (1 << 31) - 1, "b": 1 << 31, "c": -(1 << 31) - 1})
+
+    # The type byte follows the 4 bytes of the size of the document
+    assert encoded[4] == 0x10
+    assert encoded[4 + 1 + 2 + 4] == 0x12
+    assert decode_document(encoded)[0] == {"a": (1 << 31) - 1, "b": 1 << 31, "c": -(1 << 31) - 1}
+
+
+def test_encoding_matches_the_spec():
+    assert encode_document({}) == b"\x05\x00\x00\x00\x00"
+    assert encode_document({"hello": "world"}) == (
+        b"\x16\x00\x00\x00\x02hello\x00\x06\x00\x00\x00world\x00\x00"
+    )
+    assert encode_document({"n": 1}) == b"\x0c\x00\x00\x00\x10n\x00\x01\x00\x00\x00\x00"
+
+
+def test_tuples_are_decoded_as_lists():
+    decoded, _ = decode_document(encode_document({"point": (1, 2.5)}))
+
+    assert decoded == {"point": [1, 2.5]}
+
+
+def test_naive_datetime_is_utc():
+    naive = datetime.datetime(2025, 1, 2, 3, 4, 5, 6000)
+    decoded, _ = decode_document(encode_document({"at": naive}))
+
+    assert decoded["at"] == naive.replace(tzinfo=datetime.timezone.utc)
+    assert decoded["at"].tzinfo == datetime.timezone.utc
+
+
+def test_datetime_keeps_milliseconds():
+    for millis in range(0, 1000, 7):
+        value = datetime.datetime(2024, 3, 1, 12, 30, 45, millis * 1000, tzinfo=datetime.timezone.utc)
+        decoded, _ = decode_document(encode_document({"at": value}))
+        assert decoded["at"] == value
+
+
+def test_datetime_is_not_rounded_down():
+    # 1099006878.916 * 1000 is 1099006878915.9999 as a float
+    value = datetime.datetime(2004, 10, 28, 23, 41, 18, 916000, tzinfo=datetime.timezone.utc)
+    encoded = encode_document({"at": value})
+
+    assert struct.unpack_from("<q", encoded, 4 + 1 + 3)[0] == 1099006878916
+    assert decode_document(encoded)[0]["at"] == value
+
+
+def test_sub_millisecond_precision_is_dropped():
+    value = datetime.datetime(2024, 3, 1, 12, 30, 45, 123999, tzinfo=datetime.timezone.utc)
+
+    assert decode_document(encode_document({"at": value}))[0]["at"] == value.replace(microsecond=123000)
+
+
+def test_datetime_before_the_epoch():
+    value = datetime.datetime(1969, 7, 20, 20, 17, 40, 250000, tzinfo=datetime.timezone.utc)
+
+    assert decode_document(encode_document({"at": value}))[0]["at"] == value
+
+
+def test_decode_at_an_offset():
+    first = encode_document({"a": 1})
+    second = encode_document({"b": "two"})
+    data = b"header" + first + second
+
+    decoded, end = decode_document(data, len(b"header"))
+    assert decoded == {"a": 1}
+
+    decoded, end = decode_document(data, end)
+    assert decoded == {"b": "two"}
+    assert end == len(data)
+
+
+def test_timestamp_is_decoded_as_its_raw_value():
+    element = b"\x11ts\x00" + struct.pack("<Q", (1700000000 << 32) | 3)
+    data = struct.pack("<i", len(element) + 5) + element + b"\0"
+
+    assert decode_document(data)[0] == {"ts": (1700000000 << 32) | 3}
+
+
+def test_unsupported_types():
+    with pytest.raises(TypeError, match="set"):
+        encode_document({"a": {1, 2}})
+
+    with pytest.raises(ValueError, match="null byte"):
+        encode_document({"a\0b": 1})
+
+    element = b"\x13d\x00" + bytes(16)
+    with pytest.raises(ValueError, match="0x13"):
+        decode_document(struct.pack("<i", len(element) + 5) + element + b"\0")
+
+
+def test_object_id():
+    generated = ObjectId()
+
+    assert len(generated.binary) == 12
+    assert ObjectId() != generated
+    assert ObjectId(generated.binary) == generated
+    assert str(ObjectId(bytes(range(12)))) == "000102030405060708090a0b"
+
+    with pytest.raises(ValueError):
+        ObjectId(b"short")
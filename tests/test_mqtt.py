@@ -0,0 +1,110 @@
+import asyncio
+import struct
+
+import pytest
+
+from orchestrator.mqtt import (MQTT_5, MQTT_311, PUBLISH, MqttError, build_packet, decode_publish, decode_string,
+                               decode_varint, encode_publish, encode_string, encode_varint, read_packet,
+                               topic_matches)
+
+
+@pytest.mark.parametrize("topic_filter, topic, expected", [
+    ("user/login", "user/login", True),
+    ("user/login", "user/logout", False),
+    ("user/+", "user/login", True),
+    ("user/+", "user/login/reply", False),
+    ("user/+/reply", "user/login/reply", True),
+    ("+/+", "user/login", True),
+    ("+", "user", True),
+    ("+", "user/login", False),
+    ("user/#", "user", True),
+    ("user/#", "user/login/reply", True),
+    ("user/#", "users/login", False),
+    ("#", "user/login", True),
+    ("user/+", "user/", True),
+    ("user/login", "user/login/", False),
+    ("/+", "/user", True),
+    ("#", "$SYS/broker/uptime", False),
+    ("+/broker/uptime", "$SYS/broker/uptime", False),
+    ("$SYS/#", "$SYS/broker/uptime", True),
+    ("$share/group/user/#", "user/login", False),
+])
+def test_topic_matches(topic_filter, topic, expected):
+    assert topic_matches(topic_filter, topic) is expected
+
+
+@pytest.mark.parametrize("value, encoded", [
+    (0, b"\x00"),
+    (127, b"\x7f"),
+    (128, b"\x80\x01"),
+    (16_383, b"\xff\x7f"),
+    (16_384, b"\x80\x80\x01"),
+    (268_435_455, b"\xff\xff\xff\x7f"),
+])
+def test_varint(value, encoded):
+    assert encode_varint(value) == encoded
+    assert decode_varint(b"\xaa" + encoded + b"\xbb", 1) == (value, 1 + len(encoded))
+
+
+def test_malformed_varint():
+    with pytest.raises(MqttError):
+        decode_varint(b"\xff\xff\xff\xff\x01", 0)
+
+
+def test_string():
+    encoded = encode_string("voiture/été")
+
+    assert encoded[:2] == struct.pack(">H", len("voiture/été".encode()))
+    assert decode_string(encoded + b"rest", 0) == ("voiture/été", len(encoded))
+    assert encode_string(b"\x00\x01") == b"\x00\x02\x00\x01"
+
+
+def test_build_packet():
+    assert build_packet(12, 0, b"") == b"\xc0\x00"
+    packet = build_packet(PUBLISH, 0, bytes(200))
+    assert packet[:3] == b"\x30\xc8\x01" and len(packet) == 203
+
+
+def test_publish_qos0_matches_the_spec():
+    assert encode_publish("a/b", b"hi") == b"\x30\x07\x00\x03a/bhi"
+
+
+@pytest.mark.parametrize("protocol", [MQTT_311, MQTT_5])
+@pytest.mark.parametrize("qos, retain, packet_id", [(0, False, None), (1, True, 1), (2, False, 65535)])
+def test_publish_round_trip(protocol, qos, retain, packet_id):
+    payload = bytes(range(256)) * 3
+    packet = encode_publish("garage/cars/42", payload, qos=qos, retain=retain, packet_id=packet_id,
+                            protocol=protocol)
+
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(packet)
+        reader.feed_eof()
+        return await read_packet(reader)
+
+    packet_type, flags, body = asyncio.run(read())
+
+    assert packet_type == PUBLISH
+    assert decode_publish(flags, body, protocol) == ("garage/cars/42", payload, qos, retain, packet_id)
+
+
+def test_publish_dup_flag():
+    assert encode_publish("t", b"", qos=1, packet_id=7, dup=True)[0] == 0x3a
+
+
+def test_decode_publish_skips_mqtt5_properties():
+    # Message expiry interval property (0x02) of 60 seconds
+    body = encode_string("t") + struct.pack(">H", 9) + b"\x05\x02\x00\x00\x00\x3c" + b"payload"
+
+    assert decode_publish(0x02, body, MQTT_5) == ("t", b"payload", 1, False, 9)
+
+
+def test_read_packet_of_a_closed_stream():
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"\x30\x05ab")
+        reader.feed_eof()
+        return await read_packet(reader)
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        asyncio.run(read())
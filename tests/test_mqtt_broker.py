@@ -0,0 +1,112 @@
+import struct
+import threading
+
+from orchestrator.mqtt import MQTT_311, PUBLISH, Message, decode_publish
+from orchestrator.mqtt_broker import MAX_IN_FLIGHT, SESSION_BUFFER_HIGH, MqttBroker, _Session
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.buffered = 0
+
+    def get_write_buffer_size(self) -> int:
+        return self.buffered
+
+
+class FakeWriter:
+    """
+    Keeps the packets written to a client, as an asyncio.StreamWriter would send them.
+    """
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.packets = []
+
+    def is_closing(self) -> bool:
+        return False
+
+    def write(self, packet: bytes):
+        self.packets.append(packet)
+
+
+def subscribed_session(broker: MqttBroker, client_id: str, topic_filter: str, qos: int) -> _Session:
+    session = _Session(client_id, MQTT_311, FakeWriter())
+    session.subscriptions[topic_filter] = qos
+    broker.sessions[client_id] = session
+    return session
+
+
+def published_packet_ids(session: _Session) -> list:
+    packet_ids = []
+    for packet in session.writer.packets:
+        # Every PUBLISH of these tests is under 128 bytes, its remaining length is one byte
+        assert packet[0] >> 4 == PUBLISH
+        packet_ids.append(decode_publish(packet[0] & 0x0F, packet[2:], MQTT_311)[4])
+    return packet_ids
+
+
+def test_packet_ids_skip_the_ids_in_flight_and_wrap():
+    session = _Session("client", MQTT_311, FakeWriter())
+    session.in_flight.update({1, 2, 4})
+
+    assert session.next_packet_id() == 3
+    assert session.next_packet_id() == 5
+
+    session._last_packet_id = 65534
+    assert session.next_packet_id() == 65535
+    assert session.next_packet_id() == 3
+
+
+def test_next_packet_id_returns_when_every_id_is_in_flight():
+    session = _Session("client", MQTT_311, FakeWriter())
+    session.in_flight.update(range(1, 65536))
+
+    assert session.next_packet_id() is None
+
+
+def test_full_in_flight_window_does_not_hang_the_broker():
+    broker = MqttBroker("127.0.0.1", 0)
+    stuck = subscribed_session(broker, "stuck", "cars/#", 1)
+    stuck.in_flight.update(range(1, 65536))
+    healthy = subscribed_session(broker, "healthy", "cars/#", 1)
+
+    # Routed in a thread so that a broker that spins fails the test rather than hanging it
+    routing = threading.Thread(target=broker._route, args=("publisher", Message("cars/42", b"sold", 1)), daemon=True)
+    routing.start()
+    routing.join(5)
+
+    assert not routing.is_alive()
+    assert stuck.writer.packets == []
+    assert published_packet_ids(healthy) == [1]
+    assert (broker.delivered, broker.dropped) == (1, 1)
+
+
+def test_in_flight_messages_are_capped():
+    broker = MqttBroker("127.0.0.1", 0)
+    session = subscribed_session(broker, "slow", "cars/#", 1)
+    session.in_flight.update(range(1, MAX_IN_FLIGHT))
+
+    broker._route("publisher", Message("cars/1", b"a", 1))
+    broker._route("publisher", Message("cars/2", b"b", 1))
+    assert published_packet_ids(session) == [MAX_IN_FLIGHT]
+    assert broker.dropped == 1
+
+    # An acknowledgement makes room for the next message
+    broker._handle_packet(session, 4, 0, struct.pack(">H", 17))
+    broker._route("publisher", Message("cars/3", b"c", 1))
+    assert published_packet_ids(session) == [MAX_IN_FLIGHT, 17]
+
+
+def test_messages_are_dropped_while_the_write_buffer_is_full():
+    broker = MqttBroker("127.0.0.1", 0)
+    session = subscribed_session(broker, "slow", "cars/#", 0)
+
+    session.writer.transport.buffered = SESSION_BUFFER_HIGH + 1
+    broker._route("publisher", Message("cars/1", b"a"))
+    assert session.writer.packets == []
+
+    session.writer.transport.buffered = 0
+    broker._route("publisher", Message("cars/2", b"b"))
+    assert published_packet_ids(session) == [None]
+    assert (broker.delivered, broker.dropped) == (1, 1)
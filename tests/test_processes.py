@@ -0,0 +1,58 @@
+import subprocess
+import time
+
+import psutil
+import pytest
+
+import main
+from orchestrator.processes import ProcessHandle, group_by_tier, kill_process_tree
+
+
+def wait_gone(pids: list, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        alive = [pid for pid in pids if psutil.pid_exists(pid) and psutil.Process(pid).status() != psutil.STATUS_ZOMBIE]
+        if not alive:
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_group_by_tier():
+    handles = [ProcessHandle(None, None, None, name, kind)
+               for name, kind in [("db", "database"), ("svc", "service"), ("gw", "gateway"), ("x", "task"), ("mq", "broker")]]
+
+    assert [[handle.name for handle in tier] for tier in group_by_tier(handles)] == [["x"], ["gw"], ["svc"], ["mq"], ["db"]]
+
+
+def test_kill_process_tree():
+    process = subprocess.Popen("sleep 60 & sleep 60", shell=True, start_new_session=True)
+    time.sleep(0.2)
+    pids = [process.pid] + [child.pid for child in psutil.Process(process.pid).children(recursive=True)]
+
+    kill_process_tree(process)
+
+    assert process.returncode is not None
+    assert wait_gone(pids)
+
+
+def test_failed_spawn_does_not_leak_its_process(tmp_path, monkeypatch):
+    spawned = []
+    popen = subprocess.Popen
+
+    def recording_popen(*args, **kwargs):
+        spawned.append(popen(*args, **kwargs))
+        return spawned[-1]
+
+    def failing_attach(*args):
+        raise OSError("no space left on device")
+
+    monkeypatch.setattr(main.subprocess, "Popen", recording_popen)
+    monkeypatch.setattr(main.log_multiplexer, "attach", failing_attach)
+    monkeypatch.setitem(main.LAUNCH_COMMANDS, "dev", "sleep 60")
+
+    with pytest.raises(OSError):
+        main.spawn_broker(str(tmp_path), str(tmp_path), ".env")
+
+    assert len(spawned) == 1
+    assert spawned[0].returncode is not None
@@ -0,0 +1,54 @@
+from orchestrator.readiness import GreenFlagMatcher
+
+
+def test_flag_in_one_chunk():
+    matcher = GreenFlagMatcher("Listening on port")
+
+    assert not matcher.feed(b"starting\n")
+    assert matcher.feed(b"Listening on port 3000\n")
+    assert matcher.found
+
+
+def test_flag_split_across_chunks():
+    matcher = GreenFlagMatcher("Listening on port")
+
+    assert not matcher.feed(b"> node index.js\nListen")
+    assert not matcher.feed(b"ing on ")
+    assert matcher.feed(b"port 3000\n")
+
+
+def test_flag_fed_one_byte_at_a_time():
+    matcher = GreenFlagMatcher("ready")
+    results = [matcher.feed(bytes([byte])) for byte in b"not yet... ready!"]
+
+    assert results.index(True) == len("not yet... ready") - 1
+    assert all(results[results.index(True):])
+
+
+def test_partial_flag_is_not_a_match():
+    matcher = GreenFlagMatcher("Listening on port")
+
+    assert not matcher.feed(b"Listening on")
+    assert not matcher.feed(b" socket\nListening")
+    assert not matcher.found
+
+
+def test_single_character_flag():
+    matcher = GreenFlagMatcher("$")
+
+    assert not matcher.feed(b"abc")
+    assert matcher.feed(b"x$y")
+
+
+def test_found_stays_true_and_reset_forgets():
+    matcher = GreenFlagMatcher("ready")
+    matcher.feed(b"rea")
+    matcher.reset()
+
+    assert not matcher.feed(b"dy")
+    assert matcher.feed(b"ready")
+    assert matcher.feed(b"anything")
+
+    matcher.reset()
+    assert not matcher.found
+    assert not matcher.feed(b"anything")
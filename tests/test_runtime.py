@@ -0,0 +1,85 @@
+import importlib
+
+import psutil
+import pytest
+
+from orchestrator import runtime
+from orchestrator.runtime import RuntimeProfile, _place, format_cpus, parse_cpus, parse_ionice, parse_runtime_profiles
+
+linux_only = pytest.mark.skipif(not hasattr(psutil, "IOPRIO_CLASS_BE"), reason="ionice classes only exist on Linux")
+
+
+def test_cpu_lists():
+    assert parse_cpus("0,0-0") == [0]
+    assert format_cpus([0, 1, 2, 5, 7, 8]) == "0-2,5,7-8"
+    with pytest.raises(ValueError):
+        parse_cpus("0-x")
+    with pytest.raises(ValueError):
+        parse_cpus(str(4096))
+
+
+@linux_only
+def test_parse_ionice():
+    assert parse_ionice("idle") == (psutil.IOPRIO_CLASS_IDLE, None)
+    assert parse_ionice("be:2") == (psutil.IOPRIO_CLASS_BE, 2)
+    for value in ("rt", "be:8", "idle:1", "be:x"):
+        with pytest.raises(ValueError):
+            parse_ionice(value)
+
+
+def test_runtime_profiles():
+    profiles = parse_runtime_profiles(["user_service.threadpool=16", "user_service.heap=1024", "database.nice=5"],
+                                      ["user_service", "database"])
+
+    assert profiles["user_service"] == RuntimeProfile(threadpool_size=16, max_old_space_size=1024)
+    assert profiles["database"] == RuntimeProfile(nice=5)
+    with pytest.raises(ValueError, match="Unknown component"):
+        parse_runtime_profiles(["gateway.heap=10"], ["user_service"])
+    with pytest.raises(ValueError, match="threadpool"):
+        parse_runtime_profiles(["user_service.threadpool=0"], ["user_service"])
+
+
+def test_import_without_ionice_classes(monkeypatch):
+    # The I/O scheduling classes of psutil only exist on Linux
+    monkeypatch.delattr(psutil, "IOPRIO_CLASS_IDLE", raising=False)
+    monkeypatch.delattr(psutil, "IOPRIO_CLASS_BE", raising=False)
+    try:
+        reloaded = importlib.reload(runtime)
+
+        assert reloaded.IONICE_CLASSES == {}
+        with pytest.raises(ValueError, match="only supported on Linux"):
+            reloaded.parse_runtime_profiles(["database.ionice=be:2"], ["database"])
+    finally:
+        monkeypatch.undo()
+        importlib.reload(runtime)
+
+
+class ProcessWithoutPlacement:
+    """
+    A process of a platform without cpu_affinity, like macOS.
+    """
+
+    def __init__(self):
+        self.nice_value = None
+        self.affinity_calls = 0
+
+    def cpu_affinity(self, cpus):
+        self.affinity_calls += 1
+        raise AttributeError("cpu_affinity")
+
+    def nice(self, value):
+        self.nice_value = value
+
+
+def test_unsupported_placement_is_reported_once():
+    process = ProcessWithoutPlacement()
+    profile = RuntimeProfile(cpus=[0], nice=5)
+    warnings, unsupported = set(), set()
+
+    _place(process, profile, warnings, unsupported)
+    _place(process, profile, warnings, unsupported)
+
+    assert unsupported == {"cpus"}
+    assert warnings == set()
+    assert process.nice_value == 5
+    assert process.affinity_calls == 1